@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_driver_parsing
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the CPU time that Felix's main thread spends receiving and parsing
+endpoint updates, with raw values (Felix parses) and with values that were
+already parsed by the driver.
+
+Usage: python benchmarks/bench_driver_parsing.py [number of updates]
+"""
+import json
+import sys
+import time
+
+from calico.etcddriver.protocol import (
+    MessageWriter, MSG_KEY_UPDATES, new_unpacker
+)
+from calico.felix.parsing import ValueParser, ParserConfig
+
+KEY = "/calico/v1/host/host%d/workload/openstack/wl%d/endpoint/%032x"
+CONFIG = ParserConfig(HOSTNAME="host0", IFACE_PREFIX="tap")
+
+
+class BufferSocket(object):
+    def __init__(self):
+        self.chunks = []
+
+    def sendall(self, data):
+        self.chunks.append(data)
+
+
+def make_updates(num_updates):
+    value = json.dumps({
+        "state": "active",
+        "name": "tap1234567890",
+        "mac": "aa:bb:cc:dd:ee:ff",
+        "profile_ids": ["prof-1"],
+        "ipv4_nets": ["10.0.0.1/32"],
+        "labels": {"app": "frontend", "tier": "web"},
+    })
+    return [(KEY % (i // 100, i, i), value) for i in xrange(num_updates)]
+
+
+def encode(updates, parser):
+    sck = BufferSocket()
+    writer = MessageWriter(sck, batch_updates=True)
+    for key, value in updates:
+        if parser:
+            parsed, value = parser.parse(key, value)
+            writer.send_update(key, value, parsed=parsed)
+        else:
+            writer.send_update(key, value)
+    writer.flush()
+    return sck.chunks
+
+
+def felix_side(chunks, parser):
+    """Simulates Felix: decodes the messages, parses any raw values."""
+    unpacker = new_unpacker()
+    count = 0
+    start = time.time()
+    for chunk in chunks:
+        unpacker.feed(chunk)
+        for msg in unpacker:
+            for update in msg[MSG_KEY_UPDATES]:
+                if len(update) == 2:
+                    parser.parse(*update)
+                count += 1
+    return count, time.time() - start
+
+
+def main():
+    num_updates = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    updates = make_updates(num_updates)
+    parser = ValueParser(CONFIG)
+    print "Updates: %s" % num_updates
+    raw_chunks = encode(updates, None)
+    start = time.time()
+    parsed_chunks = encode(updates, parser)
+    driver_time = time.time() - start
+    count, raw_time = felix_side(raw_chunks, parser)
+    assert count == num_updates
+    count, parsed_time = felix_side(parsed_chunks, parser)
+    assert count == num_updates
+    print "Felix, raw values:    %8.2fs" % raw_time
+    print "Felix, parsed values: %8.2fs" % parsed_time
+    print "Driver, parsing:      %8.2fs" % driver_time
+    print "Felix speed-up: %.2fx" % (raw_time / parsed_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_lazy_tags
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the time and memory used by the IpsetManager to load a cluster's
+endpoints when only a few of its tags are referenced locally, versus when
+every tag is referenced (which matches the old behaviour of tracking the
+members of every tag).  Each case is measured in a child process, by the
+growth of its resident set size.
+
+Usage: python benchmarks/bench_lazy_tags.py [endpoints] [profiles]
+           [referenced tags]
+"""
+import logging
+import os
+import sys
+import time
+
+import gevent
+from mock import Mock
+
+from calico.datamodel_v1 import WloadEndpointId
+from calico.felix.futils import IPV4
+from calico.felix.ipsets import IpsetManager
+
+TAGS_PER_PROFILE = 5
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def make_manager():
+    config = Mock()
+    config.MAX_IPSET_SIZE = 2**20
+    mgr = IpsetManager(IPV4, config)
+    # Handle messages inline, without starting the actor.
+    mgr.greenlet = gevent.getcurrent()
+    return mgr
+
+
+def measure(name, num_endpoints, num_profiles, num_referenced):
+    mgr = make_manager()
+    tag_ids = []
+    for i in xrange(num_profiles):
+        tags = ["tag-%s-%s" % (i, j) for j in xrange(TAGS_PER_PROFILE)]
+        mgr.on_tags_update("profile-%s" % i, tags)
+        tag_ids.extend(tags)
+    for tag_id in tag_ids[:num_referenced]:
+        mgr.get_and_incref(tag_id)
+    start_rss = rss_bytes()
+    start = time.time()
+    for i in xrange(num_endpoints):
+        endpoint_id = WloadEndpointId("host-%s" % (i % 1000), "k8s",
+                                      "workload-%s" % i, "eth0")
+        mgr.on_endpoint_update(endpoint_id, {
+            "profile_ids": ["profile-%s" % (i % num_profiles)],
+            "ipv4_nets": ["10.%s.%s.%s/32" % (i >> 16, (i >> 8) & 0xff,
+                                              i & 0xff)],
+        })
+    elapsed = time.time() - start
+    print "%-12s %8.1f MB %8.2fs" % (name,
+                                    (rss_bytes() - start_rss) / 1e6,
+                                    elapsed)
+
+
+def main():
+    logging.disable(logging.INFO)
+    num_endpoints = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_profiles = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    num_referenced = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    print "Endpoints: %s, tags: %s, referenced tags: %s" % (
+        num_endpoints, num_profiles * TAGS_PER_PROFILE, num_referenced
+    )
+    for name, referenced in [("all tags", num_profiles * TAGS_PER_PROFILE),
+                             ("referenced", num_referenced)]:
+        # Measure in a child process so that the measurements don't
+        # interfere.
+        pid = os.fork()
+        if pid == 0:
+            measure(name, num_endpoints, num_profiles, referenced)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_match_storage
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the memory used to store the matches between selectors and
+endpoints, using a pair of MultiDicts versus a BitmapBiMultiDict.  Each
+storage type is measured in a child process, by the growth of its resident
+set size.
+
+Usage: python benchmarks/bench_match_storage.py [endpoints] [selectors]
+           [fraction of selectors matched per endpoint]
+"""
+import os
+import random
+import sys
+import time
+
+from calico.calcollections import MultiDict, BitmapBiMultiDict
+from calico.datamodel_v1 import WloadEndpointId
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def make_matches(num_endpoints, num_selectors, fraction):
+    rand = random.Random(1234)
+    selector_ids = ["selector-%s" % i for i in xrange(num_selectors)]
+    for i in xrange(num_endpoints):
+        endpoint_id = WloadEndpointId("host-%s" % (i % 100), "k8s",
+                                      "workload-%s" % i, "eth0")
+        for selector_id in selector_ids:
+            if rand.random() < fraction:
+                yield selector_id, endpoint_id
+
+
+def store_multidicts(matches):
+    by_expr_id = MultiDict()
+    by_item_id = MultiDict()
+    for expr_id, item_id in matches:
+        by_expr_id.add(expr_id, item_id)
+        by_item_id.add(item_id, expr_id)
+    return by_expr_id, by_item_id
+
+
+def store_bitmaps(matches):
+    index = BitmapBiMultiDict()
+    for expr_id, item_id in matches:
+        index.add(expr_id, item_id)
+    return index
+
+
+def measure(name, store_fn, args):
+    # Generate the IDs up front so that we only measure the storage.
+    matches = list(make_matches(*args))
+    start_rss = rss_bytes()
+    start = time.time()
+    index = store_fn(matches)
+    elapsed = time.time() - start
+    del matches
+    print "%-10s %8.1f MB %8.2fs" % (name,
+                                    (rss_bytes() - start_rss) / 1e6,
+                                    elapsed)
+    return index
+
+
+def main():
+    num_endpoints = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_selectors = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    fraction = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+    args = (num_endpoints, num_selectors, fraction)
+    print "Endpoints: %s, selectors: %s, match fraction: %s" % args
+    for name, store_fn in [("multidict", store_multidicts),
+                           ("bitmap", store_bitmaps)]:
+        # Measure in a child process so that the measurements don't
+        # interfere.
+        pid = os.fork()
+        if pid == 0:
+            measure(name, store_fn, args)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_path_dispatch
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the rate at which a PathDispatcher, programmed with Felix's paths,
+dispatches a resync-like mix of events, compared with the per-segment tree
+walk that it replaced.
+
+Usage: python benchmarks/bench_path_dispatch.py [number of events]
+"""
+import logging
+import sys
+import time
+
+from calico.etcdutils import PathDispatcher, EtcdEvent, ACTION_MAPPING
+from calico.felix.parsing import (
+    TAGS_KEY, RULES_KEY, PROFILE_LABELS_KEY, TIER_DATA, TIERED_PROFILE,
+    HOST_IP_KEY, PER_ENDPOINT_KEY, HOST_IFACE_KEY, CIDR_V4_KEY,
+    CONFIG_PARAM_KEY, PER_HOST_CONFIG_PARAM_KEY
+)
+
+ENDPOINT = "/calico/v1/host/host%d/workload/openstack/wl%d/endpoint/%032x"
+PROFILE = "/calico/v1/policy/profile/prof-%d/%s"
+
+_log = logging.getLogger(__name__)
+
+
+class Handlers(object):
+    """Handlers with the same signatures as Felix's."""
+    def __init__(self):
+        self.count = 0
+
+    def on_profile(self, response, profile_id):
+        self.count += 1
+
+    def on_tier_data(self, response, tier):
+        self.count += 1
+
+    def on_policy(self, response, tier, policy_id):
+        self.count += 1
+
+    def on_host_ip(self, response, hostname):
+        self.count += 1
+
+    def on_endpoint(self, response, hostname, orchestrator, workload_id,
+                    endpoint_id):
+        self.count += 1
+
+    def on_host_ep(self, response, hostname, endpoint_id):
+        self.count += 1
+
+    def on_pool(self, response, pool_id):
+        self.count += 1
+
+    def on_config(self, response, config_param):
+        self.count += 1
+
+    def on_host_config(self, response, hostname, config_param):
+        self.count += 1
+
+
+def make_dispatcher(handlers):
+    dispatcher = PathDispatcher()
+    # Same order as Felix's _FelixEtcdWatcher._register_paths().
+    for path, handler in [(TAGS_KEY, handlers.on_profile),
+                          (RULES_KEY, handlers.on_profile),
+                          (PROFILE_LABELS_KEY, handlers.on_profile),
+                          (TIER_DATA, handlers.on_tier_data),
+                          (TIERED_PROFILE, handlers.on_policy),
+                          (HOST_IP_KEY, handlers.on_host_ip),
+                          (PER_ENDPOINT_KEY, handlers.on_endpoint),
+                          (HOST_IFACE_KEY, handlers.on_host_ep),
+                          (CIDR_V4_KEY, handlers.on_pool),
+                          (CONFIG_PARAM_KEY, handlers.on_config),
+                          (PER_HOST_CONFIG_PARAM_KEY,
+                           handlers.on_host_config)]:
+        dispatcher.register(path, on_set=handler, on_del=handler)
+    return dispatcher
+
+
+def make_events(num_events):
+    """Mostly endpoints, with a profile's keys for every 10 endpoints."""
+    events = []
+    for i in xrange(num_events):
+        if i % 10 < 7:
+            key = ENDPOINT % (i // 100, i, i)
+        else:
+            key = PROFILE % (i // 10, ["tags", "rules", "labels"][i % 10 - 7])
+        events.append(EtcdEvent("set", key, "{}"))
+    return events
+
+
+def tree_walk_dispatch(dispatcher, response):
+    """
+    The per-segment tree walk that the compiled routes replaced, including
+    its debug logging (disabled, as in production).
+    """
+    _log.debug("etcd event %s for key %s", response.action, response.key)
+    key_parts = response.key.strip("/").split("/")
+    handler_node = dispatcher.handler_root
+    captures = {}
+    for next_part in key_parts:
+        if "capture" in handler_node:
+            capture_name, handler_node = handler_node["capture"]
+            captures[capture_name] = next_part
+        elif next_part in handler_node:
+            handler_node = handler_node[next_part]
+        else:
+            return
+    action = ACTION_MAPPING.get(response.action)
+    if action in handler_node:
+        _log.debug("Found handler for event %s for %s, captures: %s",
+                   action, response.key, captures)
+        handler_node[action](response, **captures)
+
+
+def run(name, events, dispatch_fn):
+    handlers = Handlers()
+    dispatcher = make_dispatcher(handlers)
+    start = time.time()
+    for event in events:
+        dispatch_fn(dispatcher, event)
+    elapsed = time.time() - start
+    assert handlers.count == len(events), (handlers.count, len(events))
+    print "%-10s %8.2fs %10.0f events/s" % (name, elapsed,
+                                           len(events) / elapsed)
+    return elapsed
+
+
+def main():
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    events = make_events(num_events)
+    print "Events: %s" % num_events
+    tree_time = run("tree walk", events, tree_walk_dispatch)
+    compiled_time = run("compiled", events, PathDispatcher.handle_event)
+    print "Speed-up: %.2fx" % (tree_time / compiled_time)
+
+
+if __name__ == "__main__":
+    main()
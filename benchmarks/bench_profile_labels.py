@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_profile_labels
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures how long it takes to handle a label change on a profile that many
+endpoints inherit from, using the bulk update path versus updating each
+endpoint individually.
+
+Usage: python benchmarks/bench_profile_labels.py [number of endpoints]
+"""
+import logging
+import sys
+import time
+
+from calico.felix.labels import (LabelInheritanceIndex, LabelSetIndex,
+                                 LabelValueIndex)
+from calico.felix.selectors import parse_selector
+
+SELECTORS = [
+    'role == "frontend"',
+    'role == "db" && env == "prod"',
+    'env in {"prod", "staging"} && has(team)',
+    'env != "dev" && role not in {"test", "debug"}',
+    '(role == "frontend" || role == "backend") && !has(quarantine)',
+    'has(role) && tier == "web" && env == "prod" && team == "payments"',
+    'app == "shop" && pod-template-hash != "abc"',
+    'has(quarantine)',
+]
+
+
+def make_index(num_endpoints):
+    label_index = LabelSetIndex(LabelValueIndex())
+    inherit_index = LabelInheritanceIndex(label_index)
+    for i, sel in enumerate(SELECTORS):
+        label_index.on_expression_update("sel-%s" % i, parse_selector(sel))
+    inherit_index.on_parent_labels_update("profile",
+                                          {"env": "prod", "team": "web"})
+    for i in xrange(num_endpoints):
+        # Each endpoint has a unique label, as pods from a deployment do.
+        labels = {"role": "frontend", "app": "shop", "pod": "pod-%s" % i}
+        inherit_index.on_item_update("ep-%s" % i, labels, ["profile"])
+    return inherit_index
+
+
+def per_item_update(inherit_index, parent_id, labels):
+    # Equivalent to the old behaviour: mark all the children dirty and
+    # update them one at a time.
+    inherit_index.labels_by_parent_id[parent_id] = labels
+    inherit_index._dirty_items.update(
+        inherit_index.item_ids_by_parent_id.iter_values(parent_id)
+    )
+    inherit_index._flush_updates()
+
+
+def run(name, update_fn, inherit_index):
+    start = time.time()
+    for env in ["staging", "dev", "prod"]:
+        update_fn(inherit_index, "profile", {"env": env, "team": "web"})
+    elapsed = time.time() - start
+    print "%-10s %8.2fs" % (name, elapsed)
+    return elapsed
+
+
+def main():
+    logging.disable(logging.DEBUG)
+    num_endpoints = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print "Selectors: %s, endpoints: %s" % (len(SELECTORS), num_endpoints)
+    per_item_time = run("per-item", per_item_update,
+                        make_index(num_endpoints))
+    bulk_time = run("bulk", LabelInheritanceIndex.on_parent_labels_update,
+                    make_index(num_endpoints))
+    print "Speed-up: %.2fx" % (per_item_time / bulk_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_ring_transport
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Compares driver -> Felix throughput over the socket and over the shared
+memory ring buffer.  The writer runs in a forked child process, as the
+driver would.
+
+Usage: python benchmarks/bench_ring_transport.py [number of updates]
+"""
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from calico.etcddriver.protocol import (
+    MessageReader, MessageWriter, MSG_TYPE_UPDATE_BATCH, MSG_KEY_UPDATES,
+    MSG_TYPE_STATUS, MSG_KEY_STATUS, STATUS_IN_SYNC
+)
+from calico.etcddriver.ringbuffer import (
+    RingBuffer, RingMessageReader, RingMessageWriter
+)
+
+KEY = "/calico/v1/host/host%d/workload/openstack/wl%d/endpoint/%032x"
+
+
+def write_updates(writer, num_updates):
+    value = json.dumps({
+        "state": "active",
+        "name": "tap1234567890",
+        "mac": "aa:bb:cc:dd:ee:ff",
+        "profile_ids": ["prof-1"],
+        "ipv4_nets": ["10.0.0.1/32"],
+    })
+    for i in xrange(num_updates):
+        writer.send_update(KEY % (i // 100, i, i), value)
+    writer.send_message(MSG_TYPE_STATUS, {MSG_KEY_STATUS: STATUS_IN_SYNC})
+
+
+def run(name, num_updates, ring_path):
+    felix_sck, driver_sck = socket.socketpair()
+    felix_ring = None
+    if ring_path:
+        felix_ring = RingBuffer.create(ring_path)
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        felix_sck.close()
+        if ring_path:
+            writer = RingMessageWriter(driver_sck, RingBuffer.open(ring_path),
+                                       batch_updates=True)
+        else:
+            writer = MessageWriter(driver_sck, batch_updates=True)
+        write_updates(writer, num_updates)
+        os._exit(0)
+    driver_sck.close()
+    if felix_ring:
+        reader = RingMessageReader(felix_sck, felix_ring)
+    else:
+        reader = MessageReader(felix_sck)
+    count = 0
+    done = False
+    while not done:
+        for msg_type, msg in reader.new_messages(timeout=None):
+            if msg_type == MSG_TYPE_UPDATE_BATCH:
+                count += len(msg[MSG_KEY_UPDATES])
+            else:
+                done = True
+    elapsed = time.time() - start
+    os.waitpid(pid, 0)
+    felix_sck.close()
+    assert count == num_updates, (count, num_updates)
+    print "%-10s %8.2fs %10.0f updates/s" % (name, elapsed,
+                                            count / elapsed)
+    return elapsed
+
+
+def main():
+    num_updates = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print "Updates: %s" % num_updates
+        socket_time = run("socket", num_updates, None)
+        ring_time = run("ring", num_updates, os.path.join(tmp_dir, "ring"))
+        print "Speed-up: %.2fx" % (socket_time / ring_time)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
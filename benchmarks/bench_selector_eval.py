@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_selector_eval
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the rate at which realistic selectors are evaluated against
+endpoint labels, walking the tree of ExprNodes versus calling the
+compiled function.
+
+Usage: python benchmarks/bench_selector_eval.py [number of label dicts]
+"""
+import random
+import sys
+import time
+
+from calico.felix.selectors import parse_selector
+
+SELECTORS = [
+    'role == "frontend"',
+    'role == "db" && env == "prod"',
+    'env in {"prod", "staging"} && has(team)',
+    'env != "dev" && role not in {"test", "debug"}',
+    '(role == "frontend" || role == "backend") && !has(quarantine)',
+    'has(role) && tier == "web" && env == "prod" && team == "payments"',
+]
+ROLES = ["frontend", "backend", "db", "test", "cache"]
+ENVS = ["prod", "staging", "dev"]
+TIERS = ["web", "app", "data"]
+TEAMS = ["payments", "search", "infra"]
+
+
+def make_labels(num_dicts):
+    rand = random.Random(1234)
+    labels = []
+    for _ in xrange(num_dicts):
+        d = {"role": rand.choice(ROLES), "env": rand.choice(ENVS)}
+        if rand.random() < 0.7:
+            d["tier"] = rand.choice(TIERS)
+        if rand.random() < 0.5:
+            d["team"] = rand.choice(TEAMS)
+        if rand.random() < 0.05:
+            d["quarantine"] = "true"
+        labels.append(d)
+    return labels
+
+
+def run(name, fns, labels):
+    start = time.time()
+    matches = 0
+    for fn in fns:
+        for label_dict in labels:
+            if fn(label_dict):
+                matches += 1
+    elapsed = time.time() - start
+    evaluations = len(fns) * len(labels)
+    print "%-10s %8.2fs %10.0f evaluations/s" % (name, elapsed,
+                                                evaluations / elapsed)
+    return elapsed, matches
+
+
+def main():
+    num_dicts = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    labels = make_labels(num_dicts)
+    exprs = [parse_selector(s) for s in SELECTORS]
+    print "Selectors: %s, label dicts: %s" % (len(exprs), num_dicts)
+    tree_time, tree_matches = run("tree walk",
+                                  [e.expr_op.evaluate for e in exprs],
+                                  labels)
+    compiled_time, compiled_matches = run("compiled",
+                                          [e.compiled for e in exprs],
+                                          labels)
+    assert tree_matches == compiled_matches
+    print "Speed-up: %.2fx" % (tree_time / compiled_time)
+
+
+if __name__ == "__main__":
+    main()
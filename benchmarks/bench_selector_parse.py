@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_selector_parse
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the rate at which distinct selectors are parsed, using the
+pyparsing grammar versus the hand-written parser, and the one-off cost of
+building the pyparsing grammar.
+
+Usage: python benchmarks/bench_selector_parse.py [number of selectors]
+"""
+import random
+import sys
+import time
+
+from calico.felix import selectors
+from calico.felix.selectors import _define_grammar
+
+TEMPLATES = [
+    'role == "%s"',
+    'role == "db" && env == "%s"',
+    'env in {"prod", "%s"} && has(team)',
+    'env != "dev" && role not in {"test", "%s"}',
+    '(role == "frontend" || role == "%s") && !has(quarantine)',
+    'has(role) && tier == "web" && env == "prod" && team == "%s"',
+]
+
+
+def make_selectors(num_selectors):
+    rand = random.Random(1234)
+    return [rand.choice(TEMPLATES) % ii for ii in xrange(num_selectors)]
+
+
+def run(name, fn, sels):
+    start = time.time()
+    results = [fn(s) for s in sels]
+    elapsed = time.time() - start
+    print "%-12s %8.2fs %10.0f selectors/s" % (name, elapsed,
+                                              len(sels) / elapsed)
+    return elapsed, results
+
+
+def main():
+    num_selectors = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sels = make_selectors(num_selectors)
+    start = time.time()
+    _define_grammar()
+    print "Grammar build: %.3fs" % (time.time() - start)
+    print "Selectors: %s" % num_selectors
+    grammar_time, grammar_ops = run("pyparsing",
+                                    selectors._parse_with_grammar, sels)
+    parser_time, parser_exprs = run(
+        "hand-written", selectors._parse_no_cache, sels
+    )
+    assert grammar_ops == [e.expr_op for e in parser_exprs]
+    print "Speed-up: %.2fx" % (grammar_time / parser_time)
+
+
+if __name__ == "__main__":
+    main()
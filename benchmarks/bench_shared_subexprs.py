@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_shared_subexprs
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the rate at which many selectors that share clauses are evaluated
+against a set of label dicts, evaluating each selector independently versus
+sharing the results of their common sub-expressions.
+
+Usage: python benchmarks/bench_shared_subexprs.py [selectors] [label dicts]
+"""
+import random
+import sys
+import time
+
+from calico.felix.labels import SharedSubExpressions
+from calico.felix.selectors import parse_selector
+
+# Clauses that are shared between many selectors.
+SHARED_CLAUSES = [
+    '(env == "prod" || env == "staging" || env == "qa")',
+    '!(has(quarantine) || has(debug))',
+    '(tier == "web" || tier == "app" || role != "test")',
+]
+ENVS = ["prod", "staging", "qa", "dev"]
+TIERS = ["web", "app", "data"]
+
+
+def make_selectors(num_selectors):
+    selectors = []
+    for i in xrange(num_selectors):
+        selectors.append("%s && %s && app == 'app-%s' && team != 't%s'" % (
+            SHARED_CLAUSES[i % 2], SHARED_CLAUSES[2], i, i % 7
+        ))
+    return [parse_selector(s) for s in selectors]
+
+
+def make_labels(num_dicts, num_apps):
+    rand = random.Random(1234)
+    labels = []
+    for _ in xrange(num_dicts):
+        d = {"env": rand.choice(ENVS),
+             "tier": rand.choice(TIERS),
+             "app": "app-%s" % rand.randint(0, num_apps),
+             "team": "t%s" % rand.randint(0, 9)}
+        if rand.random() < 0.05:
+            d["quarantine"] = "true"
+        labels.append(d)
+    return labels
+
+
+def run(name, fns, labels, use_memo):
+    start = time.time()
+    matches = 0
+    for label_dict in labels:
+        if use_memo:
+            memo = {}
+            for fn in fns:
+                if fn(label_dict, memo):
+                    matches += 1
+        else:
+            for fn in fns:
+                if fn(label_dict):
+                    matches += 1
+    elapsed = time.time() - start
+    evaluations = len(fns) * len(labels)
+    print "%-10s %8.2fs %10.0f evaluations/s" % (name, elapsed,
+                                                evaluations / elapsed)
+    return elapsed, matches
+
+
+def main():
+    num_selectors = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_dicts = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    exprs = make_selectors(num_selectors)
+    labels = make_labels(num_dicts, num_selectors)
+    print "Selectors: %s, label dicts: %s" % (num_selectors, num_dicts)
+    independent_time, independent_matches = run(
+        "compiled", [e.compiled for e in exprs], labels, False
+    )
+    sub_exprs = SharedSubExpressions()
+    fns = [sub_exprs.acquire(e.expr_op) for e in exprs]
+    print "Shared sub-expressions: %s" % len(sub_exprs)
+    shared_time, shared_matches = run("shared", fns, labels, True)
+    assert independent_matches == shared_matches
+    print "Speed-up: %.2fx" % (independent_time / shared_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_snapshot_parse
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Compares the etcd driver's snapshot parsers on a synthetic etcd dump.
+
+Usage: python benchmarks/bench_snapshot_parse.py [size in MB, default 500]
+
+The dump is written to a temporary file, which is then parsed once with the
+reference _parse_map() parser (ijson.parse() token stream) and once with
+parse_snapshot()'s _parse_events() parser.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from calico.etcddriver import driver
+
+ENDPOINT_DIR = "/calico/v1/host/host%d/workload/openstack/wl%d/endpoint"
+
+
+def write_dump(f, target_bytes):
+    """
+    Writes a synthetic etcd recursive GET response for /calico/v1 to f,
+    containing workload endpoints spread over a number of hosts.
+
+    :returns the number of leaf keys written.
+    """
+    f.write('{"action":"get","node":{"key":"/calico/v1","dir":true,'
+            '"nodes":[')
+    num_keys = 0
+    index = 10
+    while f.tell() < target_bytes:
+        host = num_keys // 100
+        key = (ENDPOINT_DIR % (host, num_keys)) + "/" + "%032x" % num_keys
+        value = json.dumps({
+            "state": "active",
+            "name": "tap%010x" % num_keys,
+            "mac": "aa:bb:cc:dd:ee:ff",
+            "profile_ids": ["prof-%d" % (num_keys % 50)],
+            "ipv4_nets": ["10.%d.%d.%d/32" % ((num_keys >> 16) & 0xff,
+                                             (num_keys >> 8) & 0xff,
+                                             num_keys & 0xff)],
+            "labels": {"app": "app-%d" % (num_keys % 20), "env": "prod"},
+        })
+        if num_keys:
+            f.write(",")
+        # Wrap each key in its own directory so that the parser has to deal
+        # with nesting as it would with a real dump.
+        json.dump({
+            "key": key.rsplit("/", 1)[0],
+            "dir": True,
+            "nodes": [{
+                "key": key,
+                "value": value,
+                "modifiedIndex": index,
+                "createdIndex": index,
+            }],
+            "modifiedIndex": index,
+            "createdIndex": index,
+        }, f)
+        num_keys += 1
+        index += 1
+    f.write('],"modifiedIndex":1,"createdIndex":1}}')
+    return num_keys
+
+
+class FileResponse(object):
+    """Minimal stand-in for the urllib3 response object."""
+    status = 200
+
+    def __init__(self, f):
+        self._f = f
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+
+def parse_reference(f, callback):
+    parser = driver.ijson.parse(f)
+    next(parser)
+    driver._parse_map(parser, callback)
+
+
+def parse_fast(f, callback):
+    driver.parse_snapshot(FileResponse(f), callback)
+
+
+def run(name, parse_fn, path, expected_keys):
+    count = [0]
+
+    def callback(mod, key, value):
+        count[0] += 1
+
+    with open(path, "rb") as f:
+        start = time.time()
+        parse_fn(f, callback)
+        elapsed = time.time() - start
+    assert count[0] == expected_keys, (count[0], expected_keys)
+    print "%-10s %8.2fs %10.0f keys/s" % (name, elapsed,
+                                         expected_keys / elapsed)
+    return elapsed
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    fd, path = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            num_keys = write_dump(f, size_mb * 1024 * 1024)
+        print "ijson backend: %s" % driver.ijson.__name__
+        print "Dump: %s MB, %s keys" % (size_mb, num_keys)
+        ref_time = run("reference", parse_reference, path, num_keys)
+        fast_time = run("fast", parse_fast, path, num_keys)
+        print "Speed-up: %.2fx" % (ref_time / fast_time)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_tag_index_memory
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the memory used by the tag membership index when every endpoint
+is in every tag.  Compares the old representation (per-tag dicts of IP to
+owner tuples or sets of owner tuples) with TagMembershipIndex's bitmaps
+and owner counts.  Each representation is measured in a child process, by
+the growth of its resident set size.
+
+Usage: python benchmarks/bench_tag_index_memory.py [endpoints] [tags]
+"""
+from collections import defaultdict
+import logging
+import os
+import sys
+import time
+
+from calico.datamodel_v1 import WloadEndpointId
+from calico.felix.ipsets import TagMembershipIndex
+
+# Fraction of IPs that are shared by a second endpoint.
+SHARED_IP_FRACTION = 0.01
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def make_mappings(num_endpoints, num_tags):
+    tag_ids = ["tag-%s" % i for i in xrange(num_tags)]
+    shared_every = int(1 / SHARED_IP_FRACTION)
+    endpoints = []
+    for i in xrange(num_endpoints):
+        endpoint_id = WloadEndpointId("host-%s" % (i % 1000), "k8s",
+                                      "workload-%s" % i, "eth0")
+        if i % shared_every == 1:
+            # Shares the previous endpoint's IP.
+            ip = endpoints[-1][1]
+        else:
+            ip = "10.%s.%s.%s" % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+        endpoints.append((endpoint_id, ip))
+    return tag_ids, endpoints
+
+
+def store_owner_tuples(tag_ids, endpoints):
+    # The representation that TagMembershipIndex used to use.  Borrow the
+    # real index's change tracking so that the timings are comparable.
+    changes = TagMembershipIndex()
+    ip_owners_by_tag = defaultdict(lambda: defaultdict(lambda: None))
+    for tag_id in tag_ids:
+        for endpoint_id, ip in endpoints:
+            owners = ip_owners_by_tag[tag_id][ip]
+            new_mapping = ("profile", endpoint_id)
+            if not owners:
+                changes._on_ip_added(ip, tag_id)
+                ip_owners_by_tag[tag_id][ip] = new_mapping
+            elif isinstance(owners, set):
+                owners.add(new_mapping)
+            else:
+                ip_owners_by_tag[tag_id][ip] = set([owners, new_mapping])
+    changes.get_and_reset_changes_by_tag()
+    return ip_owners_by_tag
+
+
+def store_index(tag_ids, endpoints):
+    index = TagMembershipIndex()
+    for tag_id in tag_ids:
+        for endpoint_id, ip in endpoints:
+            index.add_mapping(tag_id, "profile", endpoint_id, ip)
+    # Changes are normally collected after each batch.
+    index.get_and_reset_changes_by_tag()
+    return index
+
+
+def measure(name, store_fn, args):
+    # Generate the IDs up front so that we only measure the index.
+    tag_ids, endpoints = make_mappings(*args)
+    start_rss = rss_bytes()
+    start = time.time()
+    index = store_fn(tag_ids, endpoints)
+    elapsed = time.time() - start
+    print "%-14s %8.1f MB %8.2fs" % (name,
+                                    (rss_bytes() - start_rss) / 1e6,
+                                    elapsed)
+    return index
+
+
+def main():
+    logging.disable(logging.DEBUG)
+    num_endpoints = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_tags = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    args = (num_endpoints, num_tags)
+    print "Endpoints: %s, tags: %s" % args
+    for name, store_fn in [("owner tuples", store_owner_tuples),
+                           ("index", store_index)]:
+        # Measure in a child process so that the measurements don't
+        # interfere.
+        pid = os.fork()
+        if pid == 0:
+            measure(name, store_fn, args)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    main()
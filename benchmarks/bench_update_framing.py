@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+benchmarks.bench_update_framing
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures driver -> Felix update throughput over a socketpair, with and
+without batched update messages.
+
+Usage: python benchmarks/bench_update_framing.py [number of updates]
+"""
+import json
+import socket
+import sys
+import time
+from threading import Thread
+
+from calico.etcddriver.protocol import (
+    MessageReader, MessageWriter, MSG_TYPE_UPDATE, MSG_TYPE_UPDATE_BATCH,
+    MSG_KEY_UPDATES, MSG_TYPE_STATUS, MSG_KEY_STATUS, STATUS_IN_SYNC
+)
+
+KEY = "/calico/v1/host/host%d/workload/openstack/wl%d/endpoint/%032x"
+
+
+def make_updates(num_updates):
+    value = json.dumps({
+        "state": "active",
+        "name": "tap1234567890",
+        "mac": "aa:bb:cc:dd:ee:ff",
+        "profile_ids": ["prof-1"],
+        "ipv4_nets": ["10.0.0.1/32"],
+    })
+    return [(KEY % (i // 100, i, i), value) for i in xrange(num_updates)]
+
+
+def write_updates(sck, updates, batch):
+    writer = MessageWriter(sck, batch_updates=batch)
+    for key, value in updates:
+        writer.send_update(key, value)
+    writer.send_message(MSG_TYPE_STATUS, {MSG_KEY_STATUS: STATUS_IN_SYNC})
+
+
+def run(name, updates, batch):
+    felix_sck, driver_sck = socket.socketpair()
+    writer_thread = Thread(target=write_updates,
+                           args=(driver_sck, updates, batch))
+    reader = MessageReader(felix_sck)
+    count = 0
+    start = time.time()
+    writer_thread.start()
+    done = False
+    while not done:
+        for msg_type, msg in reader.new_messages(timeout=None):
+            if msg_type == MSG_TYPE_UPDATE:
+                count += 1
+            elif msg_type == MSG_TYPE_UPDATE_BATCH:
+                count += len(msg[MSG_KEY_UPDATES])
+            else:
+                done = True
+    elapsed = time.time() - start
+    writer_thread.join()
+    felix_sck.close()
+    driver_sck.close()
+    assert count == len(updates), (count, len(updates))
+    print "%-10s %8.2fs %10.0f updates/s" % (name, elapsed,
+                                            count / elapsed)
+    return elapsed
+
+
+def main():
+    num_updates = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    updates = make_updates(num_updates)
+    print "Updates: %s" % num_updates
+    unbatched_time = run("unbatched", updates, False)
+    batched_time = run("batched", updates, True)
+    print "Speed-up: %.2fx" % (unbatched_time / batched_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,7 @@ Collection classes and utils.
 """
 
 import logging
+from array import array
 
 _log = logging.getLogger(__name__)
 
@@ -182,3 +183,340 @@ class MultiDict(object):
     def __nonzero__(self):
         """Implement bool(<multidict>). True if we have some entries."""
         return bool(self._index)
+
+
+class DenseIdMap(object):
+    """
+    Maps hashable IDs to small, dense integers, re-using the integers of
+    IDs that have been freed.
+    """
+
+    def __init__(self):
+        self._num_by_id = {}
+        # Maps from integer back to ID; None for a free integer.
+        self._ids = []
+        self._free_nums = []
+
+    def get_or_alloc(self, id_):
+        """
+        :return: the integer for the given ID, allocating one if needed.
+        """
+        num = self._num_by_id.get(id_)
+        if num is None:
+            if self._free_nums:
+                num = self._free_nums.pop()
+                self._ids[num] = id_
+            else:
+                num = len(self._ids)
+                self._ids.append(id_)
+            self._num_by_id[id_] = num
+        return num
+
+    def get(self, id_):
+        """
+        :return: the integer for the given ID or None if it has none.
+        """
+        return self._num_by_id.get(id_)
+
+    def id_for(self, num):
+        """
+        :return: the ID that the given integer is allocated to.
+        """
+        return self._ids[num]
+
+    def free(self, id_):
+        """Frees the integer for the given ID, if it has one."""
+        num = self._num_by_id.pop(id_, None)
+        if num is not None:
+            self._ids[num] = None
+            self._free_nums.append(num)
+
+    def __len__(self):
+        return len(self._num_by_id)
+
+
+_WORD_BITS = array("L").itemsize * 8
+
+
+def _set_bit(bitmap, num):
+    """
+    Sets a bit in an array-backed bitmap, growing it if needed.
+
+    :return: True if the bit was previously clear.
+    """
+    word, bit = divmod(num, _WORD_BITS)
+    if word >= len(bitmap):
+        bitmap.extend([0] * (word + 1 - len(bitmap)))
+    mask = 1 << bit
+    old_word = bitmap[word]
+    if old_word & mask:
+        return False
+    bitmap[word] = old_word | mask
+    return True
+
+
+def _clear_bit(bitmap, num):
+    """
+    Clears a bit in an array-backed bitmap, trimming any trailing zero
+    words so that an empty bitmap has length 0.
+
+    :return: True if the bit was previously set.
+    """
+    word, bit = divmod(num, _WORD_BITS)
+    if word >= len(bitmap):
+        return False
+    mask = 1 << bit
+    old_word = bitmap[word]
+    if not old_word & mask:
+        return False
+    bitmap[word] = old_word & ~mask
+    while bitmap and not bitmap[-1]:
+        bitmap.pop()
+    return True
+
+
+def _test_bit(bitmap, num):
+    word, bit = divmod(num, _WORD_BITS)
+    return word < len(bitmap) and bool(bitmap[word] & (1 << bit))
+
+
+def _iter_bits(words):
+    """Yields the numbers of the set bits in the given sequence of words."""
+    base = 0
+    for word in words:
+        while word:
+            low_bit = word & -word
+            yield base + low_bit.bit_length() - 1
+            word ^= low_bit
+        base += _WORD_BITS
+
+
+class BitmapBiMultiDict(object):
+    """
+    Represents a two-way mapping between keys and sets of values; equivalent
+    to a pair of MultiDicts, one in each direction, that are kept in sync.
+
+    As an occupancy optimization, keys and values are mapped to dense
+    integers and each key's values (and vice versa) are stored as a bitmap
+    of those integers.  Each key and value is only stored once, no matter
+    how many mappings it is in.
+
+    The by_key and by_value attributes are read-only views of each
+    direction that support the read methods of MultiDict.
+    """
+
+    def __init__(self):
+        self._key_nums = DenseIdMap()
+        self._value_nums = DenseIdMap()
+        # Bitmaps of value integers, indexed by key integer, and vice versa.
+        # A bitmap is an array of words; empty bitmaps are removed.
+        self._values_by_key_num = {}
+        self._keys_by_value_num = {}
+        self.by_key = _BitmapMultiDictView(self._key_nums,
+                                           self._values_by_key_num,
+                                           self._value_nums)
+        self.by_value = _BitmapMultiDictView(self._value_nums,
+                                             self._keys_by_value_num,
+                                             self._key_nums)
+
+    def add(self, key, value):
+        """
+        Adds the mapping between key and value.
+
+        :return: True if the mapping was added, False if it was already
+                 present.
+        """
+        key_num = self._key_nums.get_or_alloc(key)
+        value_num = self._value_nums.get_or_alloc(value)
+        values = self._values_by_key_num.get(key_num)
+        if values is None:
+            values = self._values_by_key_num[key_num] = array("L")
+        if not _set_bit(values, value_num):
+            return False
+        keys = self._keys_by_value_num.get(value_num)
+        if keys is None:
+            keys = self._keys_by_value_num[value_num] = array("L")
+        _set_bit(keys, key_num)
+        return True
+
+    def discard(self, key, value):
+        """
+        Removes the mapping between key and value.
+
+        :return: True if the mapping was removed, False if it wasn't
+                 present.
+        """
+        key_num = self._key_nums.get(key)
+        value_num = self._value_nums.get(value)
+        if key_num is None or value_num is None:
+            return False
+        values = self._values_by_key_num[key_num]
+        if not _clear_bit(values, value_num):
+            return False
+        if not values:
+            del self._values_by_key_num[key_num]
+            self._key_nums.free(key)
+        keys = self._keys_by_value_num[value_num]
+        _clear_bit(keys, key_num)
+        if not keys:
+            del self._keys_by_value_num[value_num]
+            self._value_nums.free(value)
+        return True
+
+    def contains(self, key, value):
+        """
+        :return: True if the given key/value mapping is present.
+        """
+        return self.by_key.contains(key, value)
+
+    def diff_values(self, key, new_values):
+        """
+        Compares the values that are mapped to the given key with the given
+        values, using a bitwise diff.
+
+        :param new_values: iterable of distinct values.
+        :return: tuple of lists of the values that would be added and
+                 removed to make the key's values equal new_values.
+        """
+        # Values that aren't in any mapping yet must be new.
+        added = []
+        new_bitmap = array("L")
+        for value in new_values:
+            value_num = self._value_nums.get(value)
+            if value_num is None:
+                added.append(value)
+            else:
+                _set_bit(new_bitmap, value_num)
+        key_num = self._key_nums.get(key)
+        old_bitmap = self._values_by_key_num.get(key_num, array("L"))
+        num_words = max(len(old_bitmap), len(new_bitmap))
+        old_bitmap = old_bitmap + array("L", [0] * (num_words -
+                                                    len(old_bitmap)))
+        new_bitmap.extend([0] * (num_words - len(new_bitmap)))
+        added_words = (n & ~o for o, n in zip(old_bitmap, new_bitmap))
+        removed_words = (o & ~n for o, n in zip(old_bitmap, new_bitmap))
+        id_for = self._value_nums.id_for
+        added.extend(id_for(num) for num in _iter_bits(added_words))
+        removed = [id_for(num) for num in _iter_bits(removed_words)]
+        return added, removed
+
+    def __nonzero__(self):
+        return bool(self._values_by_key_num)
+
+
+class _BitmapMultiDictView(object):
+    """One direction of a BitmapBiMultiDict."""
+
+    def __init__(self, key_nums, bitmaps_by_key_num, value_nums):
+        self._key_nums = key_nums
+        self._bitmaps_by_key_num = bitmaps_by_key_num
+        self._value_nums = value_nums
+
+    def _bitmap(self, key):
+        key_num = self._key_nums.get(key)
+        if key_num is None:
+            return None
+        return self._bitmaps_by_key_num.get(key_num)
+
+    def contains(self, key, value):
+        """
+        :return: True if the given key/value mapping is present.
+        """
+        bitmap = self._bitmap(key)
+        if bitmap is None:
+            return False
+        value_num = self._value_nums.get(value)
+        return value_num is not None and _test_bit(bitmap, value_num)
+
+    def iter_values(self, key):
+        """
+        :return: an iterator over the values for the given key.  Iterates
+                 over a snapshot so it is safe to modify the mappings while
+                 iterating.
+        """
+        bitmap = self._bitmap(key)
+        if bitmap is None:
+            return iter([])
+        id_for = self._value_nums.id_for
+        return iter([id_for(num) for num in _iter_bits(bitmap)])
+
+    def num_items(self, key):
+        """
+        :return: The number of items associated with the given key.  Returns 0
+                 if the key is not in the mapping.
+        """
+        bitmap = self._bitmap(key)
+        if bitmap is None:
+            return 0
+        return sum(bin(word).count("1") for word in bitmap)
+
+    def __contains__(self, key):
+        """Implements the 'in' operator, True if the key is present."""
+        return self._bitmap(key) is not None
+
+    def __len__(self):
+        """Implements len(<view>), the number of keys present."""
+        return len(self._bitmaps_by_key_num)
+
+    def __nonzero__(self):
+        """Implement bool(<view>). True if we have some entries."""
+        return bool(self._bitmaps_by_key_num)
+
+
+class BitmapMultiDict(_BitmapMultiDictView):
+    """
+    Maps keys to sets of values, like a MultiDict, but stores each key's
+    values as a bitmap of dense integers, like one direction of a
+    BitmapBiMultiDict.
+
+    Rather than keeping a reverse index, each value's integer is freed once
+    the number of keys that it is mapped to drops to zero; that count is
+    stored in an array, which is much cheaper than a bitmap per value.
+    """
+
+    def __init__(self):
+        super(BitmapMultiDict, self).__init__(DenseIdMap(), {}, DenseIdMap())
+        # Number of keys that each value integer is mapped to.
+        self._value_refs = array("L")
+
+    def add(self, key, value):
+        """
+        Adds the mapping between key and value.
+
+        :return: True if the mapping was added, False if it was already
+                 present.
+        """
+        key_num = self._key_nums.get_or_alloc(key)
+        value_num = self._value_nums.get_or_alloc(value)
+        values = self._bitmaps_by_key_num.get(key_num)
+        if values is None:
+            values = self._bitmaps_by_key_num[key_num] = array("L")
+        if not _set_bit(values, value_num):
+            return False
+        value_refs = self._value_refs
+        if value_num >= len(value_refs):
+            value_refs.extend([0] * (value_num + 1 - len(value_refs)))
+        value_refs[value_num] += 1
+        return True
+
+    def discard(self, key, value):
+        """
+        Removes the mapping between key and value.
+
+        :return: True if the mapping was removed, False if it wasn't
+                 present.
+        """
+        key_num = self._key_nums.get(key)
+        value_num = self._value_nums.get(value)
+        if key_num is None or value_num is None:
+            return False
+        values = self._bitmaps_by_key_num[key_num]
+        if not _clear_bit(values, value_num):
+            return False
+        if not values:
+            del self._bitmaps_by_key_num[key_num]
+            self._key_nums.free(key)
+        self._value_refs[value_num] -= 1
+        if not self._value_refs[value_num]:
+            self._value_nums.free(value)
+        return True
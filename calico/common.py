@@ -270,17 +270,18 @@ def complete_logging(logfile=None,
                 root_logger.removeHandler(handler)
             else:
                 handler.setLevel(syslog_level)
-        elif isinstance(handler, logging.StreamHandler):
-            if stream_level is None:
-                root_logger.removeHandler(handler)
-            else:
-                handler.setLevel(stream_level)
         elif isinstance(handler, logging.handlers.WatchedFileHandler):
+            # Must be checked before its StreamHandler superclass.
             file_handler = handler
             if file_level is None:
                 root_logger.removeHandler(handler)
             else:
                 handler.setLevel(file_level)
+        elif isinstance(handler, logging.StreamHandler):
+            if stream_level is None:
+                root_logger.removeHandler(handler)
+            else:
+                handler.setLevel(stream_level)
 
     # If we've been given a log file, log to file as well.
     if logfile and file_level is not None:
@@ -297,6 +298,41 @@ def complete_logging(logfile=None,
             file_handler.setFormatter(formatter)
             root_logger.addHandler(file_handler)
 
+    _disable_below_min_level(file_level, syslog_level, stream_level)
+
+    _log.info("Logging initialized")
+
+
+def update_logging_levels(file_level=logging.DEBUG,
+                          syslog_level=logging.ERROR,
+                          stream_level=logging.ERROR):
+    """
+    Updates the levels of the handlers that have already been set up by
+    :meth:`complete_logging() <calico.common.complete_logging>`, for use
+    when the configuration changes after start of day.
+
+    Unlike complete_logging(), this never adds or removes a handler; a
+    level of None silences the handler so that it can be re-enabled by a
+    later update.
+    """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.handlers.SysLogHandler):
+            level = syslog_level
+        elif isinstance(handler, logging.handlers.WatchedFileHandler):
+            level = file_level
+        elif isinstance(handler, logging.StreamHandler):
+            level = stream_level
+        else:
+            continue
+        handler.setLevel(level if level is not None
+                         else logging.CRITICAL + 1)
+
+    _disable_below_min_level(file_level, syslog_level, stream_level)
+
+    _log.info("Logging levels updated")
+
+
+def _disable_below_min_level(file_level, syslog_level, stream_level):
     # Optimization: disable all logging below the minimum level that we care
     # about.  The global "disable" setting is the first thing that gets checked
     # in the logging framework so it's the fastest way to disable logging.
@@ -306,8 +342,6 @@ def complete_logging(logfile=None,
     min_log_level = min(levels)
     logging.disable(min_log_level - 1)
 
-    _log.info("Logging initialized")
-
 
 class ValidationFailed(Exception):
     """
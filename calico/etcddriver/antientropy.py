@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.etcddriver.antientropy
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Per-subtree digests of the driver's view of etcd.
+
+Used to check the driver's data against etcd one subtree at a time, as a
+cheaper alternative to periodically re-reading the whole snapshot.  Each
+subtree's digest is the XOR of a hash of each (key, modifiedIndex) pair in
+the subtree, which we can maintain incrementally as keys change.
+
+Subtrees are the per-host directories under /calico/v1/host and the other
+top-level directories of /calico/v1.  Leaf keys directly under /calico/v1,
+such as the Ready flag, are not tracked.
+"""
+import logging
+
+from calico.datamodel_v1 import VERSION_DIR, HOST_DIR
+
+_log = logging.getLogger(__name__)
+
+_VERSION_DIR_PARTS = VERSION_DIR.strip("/").split("/")
+_NUM_VERSION_PARTS = len(_VERSION_DIR_PARTS)
+_HOST_DIR_NAME = HOST_DIR.strip("/").split("/")[-1]
+
+
+def subtree_for_key(key):
+    """
+    :returns: the subtree that the given key belongs to, or None if the key
+              is not in a tracked subtree.
+    """
+    parts = key.strip("/").split("/")
+    if parts[:_NUM_VERSION_PARTS] != _VERSION_DIR_PARTS:
+        return None
+    depth = _NUM_VERSION_PARTS + 1
+    if len(parts) > depth and parts[_NUM_VERSION_PARTS] == _HOST_DIR_NAME:
+        # Per-host subtree.
+        depth += 1
+    if len(parts) <= depth:
+        # Leaf key at the top of the subtree hierarchy.
+        return None
+    return "/" + "/".join(parts[:depth])
+
+
+def entry_hash(key, mod_idx):
+    return hash((key, mod_idx))
+
+
+def compute_digest(entries):
+    """
+    :param entries: iterable of (key, modifiedIndex) tuples.
+    :returns: the digest of the given keys.
+    """
+    digest = 0
+    for entry in entries:
+        digest ^= hash(entry)
+    return digest
+
+
+class SubtreeDigests(object):
+    """
+    Tracks the modifiedIndex of each key that the driver has sent to Felix
+    along with a digest for each subtree.
+    """
+    def __init__(self):
+        self._mod_idxs = {}
+        self._digests = {}
+        self._key_counts = {}
+
+    def update(self, key, mod_idx):
+        """
+        Records that the given key now has the given modifiedIndex.
+        """
+        subtree = subtree_for_key(key)
+        if subtree is None:
+            return
+        old_mod_idx = self._mod_idxs.get(key)
+        if old_mod_idx == mod_idx:
+            return
+        digest = self._digests.get(subtree, 0)
+        if old_mod_idx is None:
+            self._key_counts[subtree] = self._key_counts.get(subtree, 0) + 1
+        else:
+            digest ^= entry_hash(key, old_mod_idx)
+        self._mod_idxs[key] = mod_idx
+        self._digests[subtree] = digest ^ entry_hash(key, mod_idx)
+
+    def remove(self, key):
+        """
+        Records that the given key has been deleted.
+        """
+        mod_idx = self._mod_idxs.pop(key, None)
+        if mod_idx is None:
+            return
+        subtree = subtree_for_key(key)
+        count = self._key_counts[subtree] - 1
+        if count:
+            self._key_counts[subtree] = count
+            self._digests[subtree] ^= entry_hash(key, mod_idx)
+        else:
+            del self._key_counts[subtree]
+            del self._digests[subtree]
+
+    def digest(self, subtree):
+        """
+        :returns: the digest of the given subtree; 0 if it is empty.
+        """
+        return self._digests.get(subtree, 0)
+
+    def subtrees(self):
+        """
+        :returns: a set containing the non-empty subtrees.
+        """
+        return set(self._digests)
+
+    def mod_idxs_in(self, subtree):
+        """
+        :returns: dict mapping key to modifiedIndex for the keys in the given
+                  subtree.
+
+        Scans all keys; only intended for use when repairing a subtree.
+        """
+        return dict((k, m) for k, m in self._mod_idxs.iteritems()
+                    if subtree_for_key(k) == subtree)
+
+    def __len__(self):
+        return len(self._mod_idxs)
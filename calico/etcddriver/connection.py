@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.etcddriver.connection
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Management of the etcd driver's HTTP(S) connections to etcd.
+
+Setting up a connection to etcd, particularly a TLS one, is relatively
+expensive for both ends.  With thousands of hosts, each holding an idle
+watch, reconnecting every time a watch times out adds up to a steady
+handshake load on etcd.  The classes here let the watcher keep using a
+single connection for as long as it is known to be good.
+"""
+import logging
+import select
+import socket
+
+from prometheus_client import Counter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connectionpool import HTTPConnection, VerifiedHTTPSConnection
+from urllib3.response import HTTPResponse
+
+from calico.monotonic import monotonic_time
+
+_log = logging.getLogger(__name__)
+
+ETCD_CONNECTIONS_CREATED = Counter(
+    "felix_etcd_connections_created",
+    "Number of connections the etcd driver has made to etcd."
+)
+ETCD_TLS_HANDSHAKES = Counter(
+    "felix_etcd_tls_handshakes",
+    "Number of TLS handshakes the etcd driver has done with etcd."
+)
+ETCD_CONNECTION_RESETS = Counter(
+    "felix_etcd_connection_resets",
+    "Number of times the etcd driver has discarded its watch connection."
+)
+
+# TCP keepalive settings for our connections.  Since we hold idle watches
+# open for a long time, we rely on keepalives to detect a dead etcd server.
+KEEPALIVE_IDLE_SECS = 60
+KEEPALIVE_INTERVAL_SECS = 10
+KEEPALIVE_COUNT = 6
+
+# How often we check whether we've been asked to stop while waiting for an
+# event on an idle watch.
+WATCH_POLL_INTERVAL = 10
+# Maximum time that we leave a watch idle before we reissue it.  Reissuing
+# requires a new connection so this is a balance between handshake load and
+# guarding against a silently-broken connection.
+WATCH_MAX_IDLE_SECS = 600
+
+
+def _enable_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opt, value in [("TCP_KEEPIDLE", KEEPALIVE_IDLE_SECS),
+                       ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL_SECS),
+                       ("TCP_KEEPCNT", KEEPALIVE_COUNT)]:
+        if hasattr(socket, opt):  # Linux-only options.
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+
+
+def _buffered_bytes(resp):
+    """
+    :returns: the number of bytes of the response that have already been
+              read off the socket into httplib's read buffer, or 0 if we
+              can't tell.
+    """
+    fp = getattr(resp, "_fp", None)  # The httplib response.
+    fp = getattr(fp, "fp", fp)  # Its socket file.
+    rbuf = getattr(fp, "_rbuf", None)
+    if rbuf is None:
+        return 0
+    # The buffer's position is at the end of the unread data.
+    return rbuf.tell()
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        HTTPConnection.connect(self)
+        ETCD_CONNECTIONS_CREATED.inc()
+        _enable_keepalive(self.sock)
+
+
+class _CountingHTTPSConnection(VerifiedHTTPSConnection):
+    def connect(self):
+        VerifiedHTTPSConnection.connect(self)
+        ETCD_CONNECTIONS_CREATED.inc()
+        ETCD_TLS_HANDSHAKES.inc()
+        _enable_keepalive(self.sock)
+
+
+class EtcdHTTPConnectionPool(HTTPConnectionPool):
+    """HTTPConnectionPool that counts its connections."""
+    ConnectionCls = _CountingHTTPConnection
+
+
+class EtcdHTTPSConnectionPool(HTTPSConnectionPool):
+    """HTTPSConnectionPool that counts its connections and handshakes."""
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class EtcdConnectionManager(object):
+    """
+    Owns a single-connection pool to etcd on behalf of one thread.
+
+    The pool, and hence its connection, is kept until reset() is called.
+    The owner should call reset() whenever the connection may be in a bad
+    state, for example, after an error or after giving up on a response
+    part way through.
+    """
+    def __init__(self, pool_factory):
+        """
+        :param pool_factory: Function that returns a new pool, connected to
+               the current etcd URL.
+        """
+        self._pool_factory = pool_factory
+        self._pool = None
+
+    def get_pool(self):
+        """
+        :returns: the current pool, creating it if needed.
+        """
+        if self._pool is None:
+            _log.info("No HTTP pool, creating one...")
+            self._pool = self._pool_factory()
+        return self._pool
+
+    def reset(self, reason):
+        """
+        Discards the current pool and its connection.  A new one will be
+        created on the next call to get_pool().
+        """
+        if self._pool is None:
+            return
+        _log.info("Discarding HTTP pool: %s", reason)
+        ETCD_CONNECTION_RESETS.inc()
+        try:
+            self._pool.close()
+        except Exception:
+            _log.exception("Failed to close HTTP pool")
+        self._pool = None
+
+    def wait_for_data(self, resp, should_stop):
+        """
+        Waits for the body of a (watch) response to start arriving.
+
+        Unlike a read timeout, which leaves the connection unusable, waiting
+        here lets us hold an idle watch open while periodically checking
+        whether we should stop.
+
+        :param resp: urllib3 response, opened with preload_content=False.
+        :param should_stop: Function returning True if we should give up.
+        :returns: True if data is available (or we can't tell, for example,
+                  if the response is not backed by a socket).  False if we
+                  gave up waiting, in which case the caller must discard the
+                  response and call reset().
+        """
+        if not isinstance(resp, HTTPResponse):
+            return True
+        sock = getattr(getattr(resp, "_connection", None), "sock", None)
+        if sock is None:
+            return True
+        if _buffered_bytes(resp):
+            # The body arrived along with the headers so httplib has already
+            # read it off the socket.
+            return True
+        deadline = monotonic_time() + WATCH_MAX_IDLE_SECS
+        while True:
+            # An SSL socket may already have decrypted data buffered, which
+            # select() doesn't know about.
+            pending = getattr(sock, "pending", None)
+            if pending is not None and pending():
+                return True
+            readable, _, _ = select.select([sock], [], [],
+                                           WATCH_POLL_INTERVAL)
+            if readable:
+                return True
+            if should_stop():
+                _log.info("Asked to stop while waiting for data.")
+                return False
+            if monotonic_time() >= deadline:
+                _log.info("No data for %ss, giving up on request.",
+                          WATCH_MAX_IDLE_SECS)
+                return False
@@ -31,9 +31,10 @@ The driver is responsible for
   Felix about all the individual keys that are deleted.
 """
 import logging
+import os
 import random
 import socket
-from Queue import Queue, Empty
+from Queue import Queue, Empty, Full
 from functools import partial
 
 from ijson import JSONError
@@ -50,12 +51,17 @@ import time
 from urlparse import urlparse
 
 try:
-    from ijson.backends import yajl2 as ijson
-except (ImportError, AttributeError): # pragma: no cover
-    # Fall back on Python-native implementation.
-    # Added for RH6.5 compatibility where yajl is not available.
-    from ijson.backends import python as ijson  # pragma: no cover
-from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+    # C extension backend, bundled with recent versions of ijson.  Much faster
+    # than the ctypes backend because it doesn't call back into Python for
+    # each token.
+    from ijson.backends import yajl2_c as ijson
+except (ImportError, AttributeError):  # pragma: no cover
+    try:
+        from ijson.backends import yajl2 as ijson
+    except (ImportError, AttributeError):
+        # Fall back on Python-native implementation.
+        # Added for RH6.5 compatibility where yajl is not available.
+        from ijson.backends import python as ijson
 import urllib3.exceptions
 import httplib
 from prometheus_client import Counter, Histogram, Gauge, start_http_server
@@ -65,26 +71,62 @@ from calico.etcddriver.protocol import (
     MSG_KEY_ETCD_URLS, MSG_KEY_HOSTNAME, MSG_KEY_LOG_FILE, MSG_KEY_SEV_FILE,
     MSG_KEY_SEV_SYSLOG, MSG_KEY_SEV_SCREEN, STATUS_WAIT_FOR_READY,
     STATUS_RESYNC, STATUS_IN_SYNC, MSG_TYPE_CONFIG_LOADED,
-    MSG_KEY_GLOBAL_CONFIG, MSG_KEY_HOST_CONFIG, MSG_TYPE_UPDATE, MSG_KEY_KEY,
-    MSG_KEY_VALUE, MessageWriter, MSG_TYPE_STATUS, MSG_KEY_STATUS,
+    MSG_KEY_GLOBAL_CONFIG, MSG_KEY_HOST_CONFIG, MessageWriter,
+    MSG_TYPE_STATUS, MSG_KEY_STATUS,
     MSG_KEY_KEY_FILE, MSG_KEY_CERT_FILE, MSG_KEY_CA_FILE, WriteFailed,
-    SocketClosed, MSG_KEY_PROM_PORT)
+    SocketClosed, MSG_KEY_PROM_PORT, MSG_KEY_PROTOCOL_VERSION,
+    PROTOCOL_VERSION_1, PROTOCOL_VERSION_BATCHED_UPDATES, MSG_KEY_RING_FILE,
+    MSG_KEY_PARSER_CONFIG, MSG_KEY_IFACE_PREFIX,
+    MSG_KEY_STRIP_REMOTE_ENDPOINTS, MSG_KEY_WATCHER_QUEUE_SIZE,
+    MSG_KEY_FILTER_KEYS, MSG_KEY_ANTI_ENTROPY)
+from calico.etcddriver.antientropy import SubtreeDigests, compute_digest
+from calico.etcddriver.ringbuffer import RingBuffer, RingMessageWriter
+from calico.etcddriver.connection import (
+    EtcdConnectionManager, EtcdHTTPConnectionPool, EtcdHTTPSConnectionPool
+)
 from calico.etcdutils import ACTION_MAPPING
 from calico.common import complete_logging
 from calico.monotonic import monotonic_time
 from calico.datamodel_v1 import (
     READY_KEY, CONFIG_DIR, dir_for_per_host_config, VERSION_DIR,
-    ROOT_DIR)
+    ROOT_DIR, HOST_DIR)
 from calico.etcddriver.hwm import HighWaterTracker
+from calico.felix.parsing import ValueParser, ParserConfig, KeyFilter
 
 _log = logging.getLogger(__name__)
 
 
-# Bound on the size of the queue between watcher and resync thread.  In
-# general, Felix and the resync thread process much more quickly than the
-# watcher can read from etcd so this is defensive.
+# Default bound on the size of the queue between watcher and resync thread.
+# In general, Felix and the resync thread process much more quickly than the
+# watcher can read from etcd so this is defensive.  If the queue fills up,
+# the watcher stops rather than buffering more events and we re-read the
+# snapshot to catch up on the events that it missed.  Felix can override
+# the size in its config message.
 WATCHER_QUEUE_SIZE = 20000
 
+# Size of the chunks that we read from the snapshot response when parsing it.
+SNAPSHOT_READ_BUF_SIZE = 64 * 1024
+
+# If the watcher falls this many etcd indexes behind the head of etcd's event
+# history, we re-read the snapshot to catch up rather than draining the events
+# one request at a time.  Must be comfortably below the size of etcd's event
+# history (1000 events) or the watcher will hit an "index cleared" error,
+# which requires a full resync, before we catch up.
+WATCHER_LAG_CATCH_UP_THRESH = 500
+# Marker put on the watcher queue to ask the resync thread to catch up.
+CATCH_UP_REQUIRED = object()
+# Marker put on the watcher queue, in place of None, by a watcher that
+# stopped because the queue was full.
+WATCHER_OVERFLOWED = object()
+
+# When an anti-entropy check finds a subtree that differs from etcd, we wait
+# this long, to give any in-flight events a chance to arrive, then re-read it
+# and only repair the keys that still differ.
+ANTI_ENTROPY_CONFIRM_DELAY = 5
+# If an anti-entropy check has to repair more than this many subtrees, we
+# give up and fall back on a full resync.
+ANTI_ENTROPY_MAX_REPAIRED_SUBTREES = 20
+
 # Threshold in seconds for detecting watcher tight looping on exception.
 REQ_TIGHT_LOOP_THRESH = 0.2
 # How often to log stats.
@@ -102,6 +144,41 @@ ETCD_INDEX_CLEARED = Counter("felix_etcd_index_cleared",
 ETCD_OTHER_ERROR = Counter("felix_etcd_other_error",
                            "Number of unexpected etcd errors, triggering "
                            "resync.")
+ETCD_WATCHER_LAG = Gauge("felix_etcd_watcher_lag",
+                         "Number of etcd indexes that the watcher was behind "
+                         "at its last event.")
+WATCHER_QUEUE_DEPTH = Gauge("felix_etcd_watcher_queue_depth",
+                            "Number of events queued between the watcher "
+                            "and the resync thread.")
+WATCHER_QUEUE_OVERFLOWS = Counter("felix_etcd_watcher_queue_overflows",
+                                  "Number of times the watcher stopped "
+                                  "because its queue was full.")
+CATCH_UPS = Counter("felix_etcd_catch_ups",
+                    "Number of times the watcher fell behind and we re-read "
+                    "the snapshot to catch up.")
+RESYNC_PHASE_TIME = Histogram("felix_resync_phase_time",
+                              "Time spent in each phase of resyncs and "
+                              "catch-ups.",
+                              ["phase"])
+FELIX_WRITE_TIME = Histogram("felix_driver_write_time",
+                             "Time spent blocked writing to Felix per flush.")
+ETCD_PROCESSING_LAG = Gauge("felix_etcd_processing_lag",
+                            "Latest etcd index seen by the watcher minus the "
+                            "index of the last event that we processed.")
+KEYS_PROCESSED = Counter("felix_etcd_keys_processed",
+                         "Number of keys processed from snapshots and events "
+                         "by top-level subtree of /calico/v1.",
+                         ["subtree"])
+ANTI_ENTROPY_CHECKS = Counter("felix_etcd_anti_entropy_checks",
+                              "Number of anti-entropy checks started.")
+ANTI_ENTROPY_SUBTREES_CHECKED = Counter(
+    "felix_etcd_anti_entropy_subtrees_checked",
+    "Number of subtrees read from etcd by anti-entropy checks."
+)
+ANTI_ENTROPY_KEYS_REPAIRED = Counter(
+    "felix_etcd_anti_entropy_keys_repaired",
+    "Number of keys that anti-entropy checks found to differ from etcd."
+)
 RESYNC_STATE = Gauge("felix_resync_state",
                      "1=wait-for-ready; 2=in-resync; 3=in-sync; "
                      "4=in-resync-watcher-dead")
@@ -115,9 +192,14 @@ RESYNC_STATE_WATCHER_DIED_DURING_RESYNC = 4
 
 class EtcdDriver(object):
     def __init__(self, felix_sck):
-        # Wrap the socket with our protocol reader/writer objects.
+        # Wrap the socket with our protocol reader/writer objects.  The
+        # writer may be replaced by a ring buffer writer once we receive the
+        # init message.
+        self._felix_sck = felix_sck
         self._msg_reader = MessageReader(felix_sck)
-        self._msg_writer = MessageWriter(felix_sck)
+        self._msg_writer = MessageWriter(
+            felix_sck, on_write_time=FELIX_WRITE_TIME.observe
+        )
 
         # Global stop event used to signal to all threads to stop.
         self._stop_event = Event()
@@ -134,6 +216,10 @@ class EtcdDriver(object):
         self._watcher_thread = None  # Created on demand
         self._watcher_stop_event = None
         self._watcher_start_index = None
+        self._watcher_queue_size = WATCHER_QUEUE_SIZE
+        # Set by the resync thread if the watcher overflowed its queue while
+        # a snapshot was in progress.
+        self._catch_up_required = False
 
         # High-water mark cache.  Owned by resync thread.
         self._hwms = HighWaterTracker()
@@ -151,6 +237,25 @@ class EtcdDriver(object):
             self._felix_updates_sent,
         ]
         self._last_resync_stat_log_time = monotonic_time()
+        # Time spent merging in watcher events during the current snapshot.
+        self._snapshot_merge_time = 0
+        # Per-subtree children of KEYS_PROCESSED, cached to avoid the
+        # overhead of looking them up for every key.
+        self._subtree_counters = {}
+        # Latest etcd index seen by the watcher.  Written by the watcher
+        # thread, read by the resync thread.
+        self._latest_etcd_index = None
+
+        # Digests of the data that we've sent to Felix, if Felix asked for
+        # anti-entropy checks.  Owned by the resync thread.
+        self._digests = None
+        # Subtrees still to be checked in the current anti-entropy check.
+        # Sorted in reverse so that we can pop() the next one.
+        self._subtrees_to_check = []
+        # List of (due time, subtree, differences) for subtrees that
+        # differed from etcd and are waiting to be re-read.
+        self._subtrees_to_confirm = []
+        self._subtrees_repaired = 0
 
         # Set by the reader thread once the init message has been received
         # from Felix.
@@ -164,6 +269,12 @@ class EtcdDriver(object):
         # are initialized).
         self._etcd_url_lock = Lock()
         self._hostname = None
+        # Set by the reader thread, before _config_received, if Felix asks us
+        # to decode and validate values on its behalf.
+        self._value_parser = None
+        # Set by the reader thread, before _config_received, if Felix asks us
+        # to skip the keys that it ignores.
+        self._key_filter = None
         # Set by the reader thread once the logging config has been received
         # from Felix.  Triggers the first resync.
         self._config_received = Event()
@@ -171,6 +282,9 @@ class EtcdDriver(object):
         # Flag to request a resync.  Set by the reader thread, polled by the
         # resync and merge thread.
         self._resync_requested = False
+        # Flag to request an anti-entropy check.  Set by the reader thread,
+        # polled by the resync and merge thread.
+        self._anti_entropy_requested = False
 
     def start(self):
         """Starts the driver's reader and resync threads."""
@@ -256,6 +370,31 @@ class EtcdDriver(object):
         self._etcd_cert_file = msg[MSG_KEY_CERT_FILE]
         self._etcd_ca_file = msg[MSG_KEY_CA_FILE]
         self._hostname = msg[MSG_KEY_HOSTNAME]
+        ring_file = msg.get(MSG_KEY_RING_FILE)
+        if ring_file:
+            # Felix has asked us to send our messages via a shared memory
+            # ring buffer.  We haven't sent anything yet so it's safe to
+            # switch writer.
+            _log.info("Using shared memory ring buffer %s", ring_file)
+            ring = RingBuffer.open(ring_file)
+            # Now both processes have it mapped, the file is no longer
+            # needed.
+            try:
+                os.unlink(ring_file)
+            except OSError:
+                _log.exception("Failed to remove ring buffer file")
+            self._msg_writer = RingMessageWriter(
+                self._felix_sck, ring, on_write_time=FELIX_WRITE_TIME.observe,
+                stop_event=self._stop_event
+            )
+        # Older versions of Felix don't advertise a protocol version, only
+        # send them updates that they understand.
+        felix_version = msg.get(MSG_KEY_PROTOCOL_VERSION, PROTOCOL_VERSION_1)
+        self._msg_writer.batch_updates = (
+            felix_version >= PROTOCOL_VERSION_BATCHED_UPDATES
+        )
+        _log.info("Felix supports protocol version %s; batching updates: %s",
+                  felix_version, self._msg_writer.batch_updates)
         self._init_received.set()
 
     def _handle_config(self, msg):
@@ -273,13 +412,36 @@ class EtcdDriver(object):
             _log.info("Prometheus metrics enabled, starting driver metrics"
                       "server on port %s", msg[MSG_KEY_PROM_PORT])
             start_http_server(msg[MSG_KEY_PROM_PORT])
+        self._watcher_queue_size = msg.get(MSG_KEY_WATCHER_QUEUE_SIZE,
+                                           WATCHER_QUEUE_SIZE)
+        if msg.get(MSG_KEY_FILTER_KEYS):
+            _log.info("Felix asked us to skip keys that it ignores.")
+            self._key_filter = KeyFilter(self._hostname)
+        if msg.get(MSG_KEY_ANTI_ENTROPY):
+            _log.info("Felix asked us to track digests for anti-entropy.")
+            self._digests = SubtreeDigests()
+        parser_config = msg.get(MSG_KEY_PARSER_CONFIG)
+        if parser_config:
+            _log.info("Felix asked us to parse values: %s", parser_config)
+            self._value_parser = ValueParser(
+                ParserConfig(
+                    HOSTNAME=self._hostname,
+                    IFACE_PREFIX=parser_config[MSG_KEY_IFACE_PREFIX],
+                ),
+                strip_remote_endpoints=parser_config.get(
+                    MSG_KEY_STRIP_REMOTE_ENDPOINTS, False
+                ),
+            )
 
         self._config_received.set()
         _log.info("Received config from Felix: %s", msg)
 
     def _handle_resync(self, msg):
         _log.info("Got resync message from felix: %s", msg)
-        self._resync_requested = True
+        if msg.get(MSG_KEY_ANTI_ENTROPY) and self._digests is not None:
+            self._anti_entropy_requested = True
+        else:
+            self._resync_requested = True
 
     def _resync_and_merge(self):
         """
@@ -295,6 +457,9 @@ class EtcdDriver(object):
             _log.info("Stop event not set, starting new resync...")
             self._reset_resync_thread_stats()
             loop_start = monotonic_time()
+            # A resync supersedes any in-progress anti-entropy check.
+            self._subtrees_to_check = []
+            self._subtrees_to_confirm = []
             try:
                 # Start with a fresh HTTP pool just in case it got into a bad
                 # state.
@@ -303,12 +468,15 @@ class EtcdDriver(object):
                 # Before we get to the snapshot, Felix needs the configuration.
                 self._send_status(STATUS_WAIT_FOR_READY)
                 self._wait_for_ready()
+                phase_start = _end_phase("wait_for_ready", loop_start)
                 self._preload_config()
                 # Wait for config if we have not already received it.
                 self._wait_for_config()
+                phase_start = _end_phase("config", phase_start)
                 # Kick off the snapshot request as far as the headers.
                 self._send_status(STATUS_RESYNC)
                 resp, snapshot_index = self._start_snapshot_request()
+                _end_phase("snapshot_headers", phase_start)
                 # Before reading from the snapshot, start the watcher thread.
                 self._ensure_watcher_running(snapshot_index)
                 # Incrementally process the snapshot, merging in events from
@@ -316,6 +484,8 @@ class EtcdDriver(object):
                 self._process_snapshot_and_events(resp, snapshot_index)
                 # We're now in-sync.  Tell Felix.
                 self._send_status(STATUS_IN_SYNC)
+                # Any catch-up from now on needs to scan for deletions.
+                self._first_resync = False
                 # Then switch to processing events only.
                 RESYNCS_COMPLETED.inc()
                 time_to_resync = monotonic_time() - loop_start
@@ -540,9 +710,20 @@ class EtcdDriver(object):
         :param snapshot_index: the etcd index of the response.
         """
         self._hwms.start_tracking_deletions()
+        self._snapshot_merge_time = 0
+        parse_start = monotonic_time()
         parse_snapshot(etcd_response,
                        callback=partial(self._handle_etcd_node,
                                         snapshot_index=snapshot_index))
+        parse_end = monotonic_time()
+        # Parsing the snapshot is interleaved with merging in events from
+        # the watcher, which we time separately.
+        RESYNC_PHASE_TIME.labels("snapshot_parse").observe(
+            parse_end - parse_start - self._snapshot_merge_time
+        )
+        RESYNC_PHASE_TIME.labels("watcher_merge").observe(
+            self._snapshot_merge_time
+        )
 
         # Save occupancy by throwing away the deletion tracking metadata.
         self._hwms.stop_tracking_deletions()
@@ -550,6 +731,7 @@ class EtcdDriver(object):
         # mark all the values seen in the current snapshot above and then this
         # sweeps the ones we didn't touch.
         self._scan_for_deletions(snapshot_index)
+        _end_phase("deletion_scan", parse_end)
 
     def _handle_etcd_node(self, snap_mod, snap_key, snap_value,
                           snapshot_index=None):
@@ -567,29 +749,37 @@ class EtcdDriver(object):
         """
         assert snapshot_index is not None
         self._snap_keys_processed.store_occurence()
-        old_hwm = self._hwms.update_hwm(snap_key, snapshot_index)
-        if snap_mod > old_hwm:
-            # This specific key's HWM is newer than the previous
-            # version we've seen, send an update.
-            self._on_key_updated(snap_key, snap_value)
+        if (self._key_filter is None or
+                self._key_filter.is_relevant(snap_key)):
+            self._count_key(snap_key)
+            old_hwm = self._hwms.update_hwm(snap_key, snapshot_index)
+            if snap_mod > old_hwm:
+                # This specific key's HWM is newer than the previous
+                # version we've seen, send an update.
+                if self._digests is not None:
+                    self._digests.update(snap_key, snap_mod)
+                self._on_key_updated(snap_key, snap_value)
         # After we process an update from the snapshot, process several
         # updates from the watcher queue (if there are any).  We limit the
         # number to ensure that we always finish the snapshot eventually.
         # The limit isn't too sensitive but values much lower than 100 seemed
         # to starve the watcher in testing.
-        for _ in xrange(100):
-            if not self._watcher_queue or self._watcher_queue.empty():
-                # Don't block on the watcher if there's nothing to do.
-                break
-            try:
-                self._handle_next_watcher_event(resync_in_progress=True)
-            except WatcherDied:
-                # Continue processing to ensure that we make
-                # progress.
-                _log.warning("Watcher thread died, continuing "
-                             "with snapshot")
-                RESYNC_STATE.set(RESYNC_STATE_WATCHER_DIED_DURING_RESYNC)
-                break
+        if self._watcher_queue and not self._watcher_queue.empty():
+            merge_start = monotonic_time()
+            for _ in xrange(100):
+                if not self._watcher_queue or self._watcher_queue.empty():
+                    # Don't block on the watcher if there's nothing to do.
+                    break
+                try:
+                    self._handle_next_watcher_event(resync_in_progress=True)
+                except WatcherDied:
+                    # Continue processing to ensure that we make
+                    # progress.
+                    _log.warning("Watcher thread died, continuing "
+                                 "with snapshot")
+                    RESYNC_STATE.set(RESYNC_STATE_WATCHER_DIED_DURING_RESYNC)
+                    break
+            self._snapshot_merge_time += monotonic_time() - merge_start
         self._check_stop_event()
         self._maybe_log_resync_thread_stats()
 
@@ -622,6 +812,8 @@ class EtcdDriver(object):
         for ev_key in deleted_keys:
             # We didn't see the value during the snapshot or via
             # the event queue.  It must have been deleted.
+            if self._digests is not None:
+                self._digests.remove(ev_key)
             self._on_key_updated(ev_key, None)
         _log.info("Found %d deleted keys", len(deleted_keys))
 
@@ -633,6 +825,9 @@ class EtcdDriver(object):
         :raises FelixWriteFailed:
         :raises ResyncRequested:
         """
+        if not resync_in_progress and self._catch_up_required:
+            self._catch_up()
+            return
         if self._watcher_queue is None:
             raise WatcherDied()
         while not self._stop_event.is_set():
@@ -641,6 +836,14 @@ class EtcdDriver(object):
             if not resync_in_progress and self._resync_requested:
                 _log.info("Resync requested, triggering one.")
                 raise ResyncRequested()
+            if not resync_in_progress:
+                if self._anti_entropy_requested:
+                    self._start_anti_entropy_check()
+                if (self._watcher_queue.empty() and
+                        self._check_next_subtree()):
+                    # Nothing else to do so we checked a subtree against
+                    # etcd.  Return to give the caller a chance to flush.
+                    return
             self._maybe_log_resync_thread_stats()
             try:
                 event = self._next_watcher_event()
@@ -653,11 +856,38 @@ class EtcdDriver(object):
         if event is None:
             self._watcher_queue = None
             raise WatcherDied()
+        if event is WATCHER_OVERFLOWED:
+            # The watcher has stopped.  Rather than resyncing, we fold the
+            # events that it missed into a catch-up, after the current
+            # snapshot if there is one.
+            _log.warning("Watcher queue overflowed, catch-up required.")
+            self._watcher_queue = None
+            self._catch_up_required = True
+            if not resync_in_progress:
+                self._catch_up()
+            return
+        if event is CATCH_UP_REQUIRED:
+            if resync_in_progress:
+                # The snapshot that we're processing will catch us up.
+                _log.info("Watcher is lagging but resync already in "
+                          "progress.")
+            else:
+                self._catch_up()
+            return
         self._event_keys_processed.store_occurence()
         ev_mod, ev_key, ev_val = event
+        self._count_key(ev_key)
+        if self._latest_etcd_index is not None:
+            ETCD_PROCESSING_LAG.set(max(self._latest_etcd_index - ev_mod, 0))
         if ev_val is not None:
             # Normal update.
-            self._hwms.update_hwm(ev_key, ev_mod)
+            old_hwm = self._hwms.update_hwm(ev_key, ev_mod)
+            if ev_mod <= old_hwm:
+                # Already superseded, for example, by an anti-entropy repair.
+                _log.debug("Skipping stale event for %s", ev_key)
+                return
+            if self._digests is not None:
+                self._digests.update(ev_key, ev_mod)
             self._on_key_updated(ev_key, ev_val)
         else:
             # Deletion.  In case this is a directory deletion, we search the
@@ -666,8 +896,198 @@ class EtcdDriver(object):
             deleted_keys = self._hwms.store_deletion(ev_key,
                                                      ev_mod)
             for child_key in deleted_keys:
+                if self._digests is not None:
+                    self._digests.remove(child_key)
                 self._on_key_updated(child_key, None)
 
+    def _count_key(self, key):
+        """
+        Counts a processed key against its subtree of /calico/v1.
+        """
+        parts = key.split("/", 4)
+        subtree = parts[3] if len(parts) > 3 else ""
+        try:
+            counter = self._subtree_counters[subtree]
+        except KeyError:
+            counter = KEYS_PROCESSED.labels(subtree)
+            self._subtree_counters[subtree] = counter
+        counter.inc()
+
+    def _catch_up(self):
+        """
+        Catches up with etcd after the watcher has fallen behind by
+        re-reading the snapshot and merging it in via the high-water mark
+        tracker.
+
+        Unlike a resync, Felix is not involved; it only sees updates for the
+        keys that changed.
+        :raises HTTPException
+        :raises HTTPError
+        :raises socket.error
+        :raises DriverShutdown
+        """
+        _log.warning("Watcher has fallen behind, re-reading snapshot to "
+                     "catch up.")
+        CATCH_UPS.inc()
+        self._catch_up_required = False
+        # The lagging watcher's queued events are all older than the new
+        # snapshot so it's safe to discard them.
+        self._stop_watcher()
+        resp, snapshot_index = self._start_snapshot_request()
+        self._ensure_watcher_running(snapshot_index)
+        self._process_snapshot_and_events(resp, snapshot_index)
+        _log.info("Caught up with etcd at index %s.", snapshot_index)
+
+    def _start_anti_entropy_check(self):
+        """
+        Starts checking our data against etcd, one subtree at a time, as an
+        alternative to a full resync.  The subtrees are then checked by
+        _check_next_subtree() while the resync thread is otherwise idle.
+        """
+        self._anti_entropy_requested = False
+        if self._subtrees_to_check:
+            _log.info("Anti-entropy check already in progress.")
+            return
+        _log.info("Starting anti-entropy check.")
+        ANTI_ENTROPY_CHECKS.inc()
+        subtrees = self._digests.subtrees()
+        # Include subtrees that we don't know about, in case we missed
+        # their creation.
+        for dir_key in self._list_dirs(VERSION_DIR):
+            if dir_key == HOST_DIR:
+                subtrees.update(self._list_dirs(HOST_DIR))
+            else:
+                subtrees.add(dir_key)
+        self._subtrees_to_check = sorted(subtrees, reverse=True)
+        self._subtrees_repaired = 0
+
+    def _check_next_subtree(self):
+        """
+        Does the next step of the anti-entropy check, if any: either
+        re-reads a subtree that differed from etcd and repairs it, or
+        checks the next subtree.
+
+        :returns: True if it did anything.
+        :raises ResyncRequired: if too many subtrees need repair.
+        """
+        if (self._subtrees_to_confirm and
+                self._subtrees_to_confirm[0][0] <= monotonic_time()):
+            _, subtree, differences = self._subtrees_to_confirm.pop(0)
+            self._repair_subtree(subtree, differences)
+            return True
+        if not self._subtrees_to_check:
+            return False
+        subtree = self._subtrees_to_check.pop()
+        ANTI_ENTROPY_SUBTREES_CHECKED.inc()
+        etcd_nodes, _ = self._read_subtree(subtree)
+        digest = compute_digest((k, m) for k, (m, _) in etcd_nodes.iteritems())
+        if digest != self._digests.digest(subtree):
+            differences = self._diff_subtree(subtree, etcd_nodes)
+            _log.warning("Subtree %s differs from etcd in %s keys, will "
+                         "re-check it in %ss.", subtree, len(differences),
+                         ANTI_ENTROPY_CONFIRM_DELAY)
+            self._subtrees_to_confirm.append(
+                (monotonic_time() + ANTI_ENTROPY_CONFIRM_DELAY,
+                 subtree, differences)
+            )
+        if not self._subtrees_to_check:
+            _log.info("Finished checking subtrees against etcd.")
+        return True
+
+    def _repair_subtree(self, subtree, old_differences):
+        """
+        Re-reads a subtree that differed from etcd and sends Felix the
+        correct value of each key that still differs in the same way.
+        Differences that have resolved themselves were due to events that
+        were in flight.
+
+        The keys' high-water marks are updated so that any stale events
+        still in flight are skipped.
+        """
+        etcd_nodes, etcd_index = self._read_subtree(subtree)
+        differences = self._diff_subtree(subtree, etcd_nodes)
+        differences &= old_differences
+        if not differences:
+            _log.info("Subtree %s now matches etcd.", subtree)
+            return
+        self._subtrees_repaired += 1
+        if self._subtrees_repaired > ANTI_ENTROPY_MAX_REPAIRED_SUBTREES:
+            _log.error("More than %s subtrees differ from etcd, falling "
+                       "back on a full resync.",
+                       ANTI_ENTROPY_MAX_REPAIRED_SUBTREES)
+            raise ResyncRequired()
+        _log.warning("Repairing %s keys in subtree %s.", len(differences),
+                     subtree)
+        ANTI_ENTROPY_KEYS_REPAIRED.inc(len(differences))
+        for key, etcd_mod, _ in sorted(differences):
+            if etcd_mod is None:
+                self._digests.remove(key)
+                for deleted_key in self._hwms.store_deletion(key, etcd_index):
+                    self._on_key_updated(deleted_key, None)
+            else:
+                self._hwms.update_hwm(key, etcd_mod)
+                self._digests.update(key, etcd_mod)
+                self._on_key_updated(key, etcd_nodes[key][1])
+
+    def _diff_subtree(self, subtree, etcd_nodes):
+        """
+        :returns: frozenset of (key, modifiedIndex in etcd, modifiedIndex
+                  that we sent to Felix) for keys that differ.  Either index
+                  may be None if the key is missing.
+        """
+        our_mod_idxs = self._digests.mod_idxs_in(subtree)
+        differences = set()
+        for key, (etcd_mod, _) in etcd_nodes.iteritems():
+            our_mod = our_mod_idxs.pop(key, None)
+            if etcd_mod != our_mod:
+                differences.add((key, etcd_mod, our_mod))
+        for key, our_mod in our_mod_idxs.iteritems():
+            differences.add((key, None, our_mod))
+        return frozenset(differences)
+
+    def _read_subtree(self, subtree):
+        """
+        Reads a subtree from etcd.
+
+        :returns: tuple of dict mapping key to (modifiedIndex, value) for
+                  each relevant leaf key and the etcd index of the read.
+        :raises ResyncRequired: if the response can't be parsed.
+        """
+        resp = self._etcd_request(self._resync_http_pool, subtree,
+                                  recursive=True, timeout=30)
+        try:
+            etcd_index = int(resp.getheader("x-etcd-index", 0))
+            etcd_resp = json.loads(resp.data)
+            etcd_nodes = {}
+            if etcd_resp.get("errorCode") == 100:  # Not found
+                return etcd_nodes, etcd_index
+            for node in _leaf_nodes(etcd_resp["node"]):
+                key = node["key"]
+                if (self._key_filter is None or
+                        self._key_filter.is_relevant(key)):
+                    etcd_nodes[key] = (node["modifiedIndex"], node["value"])
+        except (TypeError, ValueError, KeyError) as e:
+            _log.warning("Failed to read %s from etcd: %r", subtree, e)
+            raise ResyncRequired(e)
+        return etcd_nodes, etcd_index
+
+    def _list_dirs(self, dir_key):
+        """
+        :returns: list of the keys of the directories in the given etcd
+                  directory.
+        :raises ResyncRequired: if the response can't be parsed.
+        """
+        resp = self._etcd_request(self._resync_http_pool, dir_key)
+        try:
+            etcd_resp = json.loads(resp.data)
+            if etcd_resp.get("errorCode") == 100:  # Not found
+                return []
+            return [n["key"] for n in etcd_resp["node"].get("nodes", [])
+                    if n.get("dir")]
+        except (TypeError, ValueError, KeyError) as e:
+            _log.warning("Failed to list %s in etcd: %r", dir_key, e)
+            raise ResyncRequired(e)
+
     def _next_watcher_event(self):
         """Get the next event from the watcher queue
 
@@ -691,7 +1111,10 @@ class EtcdDriver(object):
             return
 
         self._watcher_start_index = snapshot_index
-        self._watcher_queue = Queue(maxsize=WATCHER_QUEUE_SIZE)
+        self._watcher_queue = Queue(maxsize=self._watcher_queue_size)
+        # The new watcher starts from the snapshot, which covers anything
+        # that an overflowed watcher missed.
+        self._catch_up_required = False
         self._watcher_stop_event = Event()
         # Note: we pass the queue and event in as arguments so that the thread
         # will always access the current queue and event.  If it used self.xyz
@@ -720,18 +1143,18 @@ class EtcdDriver(object):
             if self._etcd_url_parts.scheme == "https":
                 _log.debug("Getting new HTTPS connection to %s:%s",
                            self._etcd_url_parts.hostname, port)
-                pool = HTTPSConnectionPool(self._etcd_url_parts.hostname,
-                                           port,
-                                           key_file=self._etcd_key_file,
-                                           cert_file=self._etcd_cert_file,
-                                           ca_certs=self._etcd_ca_file,
-                                           maxsize=1)
+                pool = EtcdHTTPSConnectionPool(self._etcd_url_parts.hostname,
+                                               port,
+                                               key_file=self._etcd_key_file,
+                                               cert_file=self._etcd_cert_file,
+                                               ca_certs=self._etcd_ca_file,
+                                               maxsize=1)
             else:
                 _log.debug("Getting new HTTP connection to %s:%s",
                            self._etcd_url_parts.hostname, port)
-                pool = HTTPConnectionPool(self._etcd_url_parts.hostname,
-                                          port,
-                                          maxsize=1)
+                pool = EtcdHTTPConnectionPool(self._etcd_url_parts.hostname,
+                                              port,
+                                              maxsize=1)
             return pool
 
     def _on_key_updated(self, key, value):
@@ -749,14 +1172,11 @@ class EtcdDriver(object):
             # again.
             _log.warning("Ready key no longer set to true, triggering resync.")
             raise ResyncRequired()
-        self._msg_writer.send_message(
-            MSG_TYPE_UPDATE,
-            {
-                MSG_KEY_KEY: key,
-                MSG_KEY_VALUE: value,
-            },
-            flush=False
-        )
+        if self._value_parser is not None and value is not None:
+            parsed, value = self._value_parser.parse(key, value)
+            self._msg_writer.send_update(key, value, parsed=parsed)
+        else:
+            self._msg_writer.send_update(key, value)
         self._felix_updates_sent.store_occurence()
 
     def _send_status(self, status):
@@ -816,12 +1236,22 @@ class EtcdDriver(object):
         etcd_response_time_stat = AggregateStat("etcd response time", "ms")
         stats = [etcd_response_time_stat,
                  non_req_time_stat]
-        http = None
+        # Whether we're waiting for the resync thread to catch up.  We only
+        # ask again once the lag has dropped.
+        catch_up_requested = False
+        # Event to put on the queue when we exit.
+        final_event = None
+        # We hold on to our connection to etcd for as long as possible since,
+        # with many hosts, reconnecting (particularly over TLS) puts
+        # significant load on etcd.
+        conn_mgr = EtcdConnectionManager(self.get_etcd_connection)
+
+        def should_stop():
+            return self._stop_event.is_set() or stop_event.is_set()
+
         try:
-            while not self._stop_event.is_set() and not stop_event.is_set():
-                if not http:
-                    _log.info("No HTTP pool, creating one...")
-                    http = self.get_etcd_connection()
+            while not should_stop():
+                http = conn_mgr.get_pool()
                 req_start_time = monotonic_time()
                 if req_end_time is not None:
                     # Calculate the time since the end of the previous request,
@@ -848,14 +1278,27 @@ class EtcdDriver(object):
                                      "poll on index %s: %s", next_index,
                                      resp.status)
                     self._check_cluster_id(resp)
+                    # Wait for an event without timing out the read, which
+                    # would force us to reconnect.
+                    if not conn_mgr.wait_for_data(resp, should_stop):
+                        # We can't reuse the connection while the response
+                        # is outstanding.
+                        resp.close()
+                        conn_mgr.reset("watch abandoned")
+                        continue
                     resp_body = resp.data  # Force read inside try block.
+                    try:
+                        etcd_index = int(resp.getheader("x-etcd-index"))
+                    except (TypeError, ValueError):
+                        etcd_index = None
                 except urllib3.exceptions.ReadTimeoutError:
-                    # 100% expected when there are no events.
+                    # Expected if the watch times out before etcd sends the
+                    # response headers or part way through the body.
                     _log.debug("Watch read timed out, restarting watch at "
                                "index %s", next_index)
                     # Workaround urllib3 bug #718.  After a ReadTimeout, the
                     # connection is incorrectly recycled.
-                    http = None
+                    conn_mgr.reset("read timed out")
                     continue
                 except (urllib3.exceptions.HTTPError,
                         httplib.HTTPException,
@@ -877,9 +1320,7 @@ class EtcdDriver(object):
                     # If available, connect to a different etcd URL in case
                     # only the previous one has failed.
                     self._rotate_etcd_url()
-                    # Workaround urllib3 bug #718.  After a ReadTimeout, the
-                    # connection is incorrectly recycled.
-                    http = None
+                    conn_mgr.reset("connection failed")
                     continue
                 # If we get to this point, we've got an etcd response to
                 # process; try to parse it.
@@ -900,7 +1341,7 @@ class EtcdDriver(object):
                     action = ACTION_MAPPING[etcd_resp["action"]]
                     is_dir = node.get("dir", False)
                     value = node.get("value")
-                    dir_creation = False
+                    skip_event = False
                     if is_dir:
                         if action == "delete":
                             if key.rstrip("/") in (VERSION_DIR, ROOT_DIR):
@@ -917,7 +1358,13 @@ class EtcdDriver(object):
                             # Just ignore sets to directories, we only track
                             # leaves.
                             _log.debug("Skipping non-delete to dir %s", key)
-                            dir_creation = True
+                            skip_event = True
+                    elif (self._key_filter is not None and
+                          not self._key_filter.is_relevant(key)):
+                        # Felix ignores this key so there's no point in
+                        # tracking it.
+                        _log.debug("Skipping irrelevant key %s", key)
+                        skip_event = True
                     modified_index = node["modifiedIndex"]
                 except (KeyError, TypeError, ValueError):
                     _log.exception("Unexpected format for etcd response to"
@@ -930,14 +1377,34 @@ class EtcdDriver(object):
                     # we record that in the stat.
                     etcd_response_time_stat.store_reading(etcd_response_time *
                                                           1000)
-                    if not dir_creation:
+                    if not skip_event:
                         # The resync thread doesn't need to know about
                         # directory creations so we skip them.  (It does need
                         # to know about deletions in order to clean up
                         # sub-keys.)
-                        event_queue.put((modified_index, key, value))
+                        if not self._queue_watcher_event(
+                                event_queue, (modified_index, key, value)):
+                            final_event = WATCHER_OVERFLOWED
+                            break
                     next_index = modified_index + 1
 
+                    if etcd_index is not None:
+                        self._latest_etcd_index = etcd_index
+                        lag = max(etcd_index - modified_index, 0)
+                        ETCD_WATCHER_LAG.set(lag)
+                        if lag > WATCHER_LAG_CATCH_UP_THRESH:
+                            if not catch_up_requested:
+                                _log.warning("Watcher is %s indexes behind "
+                                             "etcd, requesting catch-up.",
+                                             lag)
+                                if not self._queue_watcher_event(
+                                        event_queue, CATCH_UP_REQUIRED):
+                                    final_event = WATCHER_OVERFLOWED
+                                    break
+                                catch_up_requested = True
+                        elif lag < WATCHER_LAG_CATCH_UP_THRESH // 2:
+                            catch_up_requested = False
+
                     # Opportunistically log stats.
                     now = monotonic_time()
                     if now - last_log_time > STATS_LOG_INTERVAL:
@@ -954,7 +1421,8 @@ class EtcdDriver(object):
             raise
         finally:
             # Signal to the resync thread that we've exited.
-            event_queue.put(None)
+            self._put_final_watcher_event(event_queue, stop_event,
+                                          final_event)
             # Make sure we get some stats output from the watcher.
             for stat in stats:
                 _log.info("STAT: Final watcher %s", stat)
@@ -962,6 +1430,62 @@ class EtcdDriver(object):
                       "Was at index %s.  Queue length is %s.", next_index,
                       event_queue.qsize())
 
+    def _queue_watcher_event(self, event_queue, event):
+        """
+        Queues an event from the watcher to the resync thread without
+        blocking.
+
+        :returns: False if the queue was full.
+        """
+        try:
+            event_queue.put_nowait(event)
+        except Full:
+            _log.warning("Watcher queue full, stopping watcher.")
+            WATCHER_QUEUE_OVERFLOWS.inc()
+            return False
+        WATCHER_QUEUE_DEPTH.set(event_queue.qsize())
+        return True
+
+    def _put_final_watcher_event(self, event_queue, stop_event, event):
+        """
+        Puts the watcher's final event on the queue, waiting for space if
+        needed.  Gives up if the resync thread is no longer reading the
+        queue.
+        """
+        while True:
+            try:
+                event_queue.put(event, timeout=1)
+            except Full:
+                if self._stop_event.is_set() or stop_event.is_set():
+                    _log.info("Watcher queue abandoned, not signalling "
+                              "resync thread.")
+                    return
+            else:
+                return
+
+
+def _end_phase(phase, start_time):
+    """
+    Records the duration of a resync phase.
+
+    :returns: the end time of the phase.
+    """
+    end_time = monotonic_time()
+    RESYNC_PHASE_TIME.labels(phase).observe(end_time - start_time)
+    return end_time
+
+
+def _leaf_nodes(node):
+    """
+    Generator: yields the leaf nodes in a (recursive) etcd response node.
+    """
+    if node.get("dir"):
+        for child in node.get("nodes", []):
+            for leaf in _leaf_nodes(child):
+                yield leaf
+    else:
+        yield node
+
 
 def parse_snapshot(resp, callback):
     """
@@ -974,15 +1498,17 @@ def parse_snapshot(resp, callback):
     if resp.status != 200:
         raise ResyncRequired("Read from etcd failed.  HTTP status code %s",
                              resp.status)
-    parser = ijson.parse(resp)  # urllib3 response is file-like.
+    # urllib3 response is file-like.  We use basic_parse() rather than
+    # parse() because we don't need the JSON path prefix of each token and
+    # calculating it is a significant fraction of the parse time.
+    events = ijson.basic_parse(resp, buf_size=SNAPSHOT_READ_BUF_SIZE)
 
     try:
-        prefix, event, value = next(parser)
-        _log.debug("Read first token from response %s, %s, %s", prefix, event,
-                   value)
+        event, value = next(events)
+        _log.debug("Read first token from response %s, %s", event, value)
         if event == "start_map":
             # As expected, response is a map.
-            _parse_map(parser, callback)
+            _parse_events(events, callback)
         else:
             _log.error("Response from etcd did non contain a JSON map.")
             raise ResyncRequired("Bad response from etcd")
@@ -991,12 +1517,69 @@ def parse_snapshot(resp, callback):
         raise ResyncRequired("Bad JSON from etcd")
 
 
+def _parse_events(events, callback):
+    """
+    Searches the stream of basic JSON parse events for key/value pairs.
+
+    Iterative equivalent of _parse_map(), used by parse_snapshot().  Rather
+    than recursing for each subdirectory, it keeps a stack of the JSON maps
+    that are currently open and it only does a handful of string comparisons
+    per token.  Expects the opening "start_map" event to have already been
+    consumed.
+
+    :param events: iterator, returning (event, value) tuples as generated by
+           ijson's basic_parse().
+    :param callback: callback to call when a key/value pair is found.
+    :raises ResyncRequired if the response contains an etcd error code.
+    :raises ValueError if the response contains unexpected array entries.
+    """
+    # One [modifiedIndex, key, value] frame for each open JSON map.
+    frame = [None, None, None]
+    stack = [frame]
+    map_key = None
+    for event, value in events:
+        if event == "map_key":
+            map_key = value
+            continue
+        if event == "start_map":
+            frame = [None, None, None]
+            stack.append(frame)
+        elif event == "end_map":
+            mod_index, node_key, node_value = stack.pop()
+            if (node_key is not None and
+                    node_value is not None and
+                    mod_index is not None):
+                callback(mod_index, node_key, node_value)
+            if not stack:
+                break
+            frame = stack[-1]
+        elif map_key is None:
+            # A scalar value without a preceding key; we only expect to see
+            # maps inside the "nodes" array.
+            if event != "end_array":
+                raise ValueError("Unexpected: %s" % event)
+        elif map_key == "modifiedIndex":
+            frame[0] = value
+        elif map_key == "key":
+            frame[1] = value
+        elif map_key == "value":
+            frame[2] = value
+        elif map_key == "errorCode":
+            raise ResyncRequired("Error from etcd, etcd error code %s",
+                                 value)
+        # Any value, including the start of an array, consumes the key.
+        map_key = None
+
+
 def _parse_map(parser, callback):
     """
     Searches the stream of JSON tokens for key/value pairs.
 
     Calls itself recursively to handle subdirectories.
 
+    Reference implementation that works on the prefixed token stream
+    from ijson's parse(); parse_snapshot() uses the faster _parse_events().
+
     :param parser: iterator, returning JSON parse event tuples.
     :param callback: callback to call when a key/value pair is found.
     """
@@ -25,6 +25,12 @@ from io import BytesIO
 import msgpack
 import select
 
+from calico.datamodel_v1 import (
+    WloadEndpointId, HostEndpointId, ResolvedHostEndpointId, TieredPolicyId
+)
+from calico.felix.selectors import SelectorExpression, parse_selector
+from calico.monotonic import monotonic_time
+
 _log = logging.getLogger(__name__)
 
 MSG_KEY_TYPE = "type"
@@ -37,6 +43,14 @@ MSG_KEY_KEY_FILE = "etcd_key_file"
 MSG_KEY_CERT_FILE = "etcd_cert_file"
 MSG_KEY_CA_FILE = "etcd_ca_file"
 MSG_KEY_PROM_PORT = "prom_port"
+# Highest protocol version supported by the sender of the init message.
+# Missing from the init message of older versions of Felix, which only
+# support PROTOCOL_VERSION_1.
+MSG_KEY_PROTOCOL_VERSION = "proto_ver"
+# Optional path to a shared memory ring buffer file created by Felix.  If
+# present, the driver sends its messages via the ring buffer instead of the
+# socket.  See calico.etcddriver.ringbuffer.
+MSG_KEY_RING_FILE = "ring_file"
 
 # Config loaded message Driver -> Felix.
 MSG_TYPE_CONFIG_LOADED = "config_loaded"
@@ -49,6 +63,24 @@ MSG_KEY_LOG_FILE = "log_file"
 MSG_KEY_SEV_FILE = "sev_file"
 MSG_KEY_SEV_SCREEN = "sev_screen"
 MSG_KEY_SEV_SYSLOG = "sev_syslog"
+# Optional: if present, the driver decodes and validates the values of the
+# keys that Felix parses before sending them.  Maps to a dict containing
+# the config needed to do so.
+MSG_KEY_PARSER_CONFIG = "parser_conf"
+MSG_KEY_IFACE_PREFIX = "iface_prefix"
+# Optional, within the parser config: if True, the driver strips endpoints
+# that belong to other hosts down to the fields that Felix uses for them.
+MSG_KEY_STRIP_REMOTE_ENDPOINTS = "strip_remote"
+# Optional: bound on the number of events that the driver buffers between
+# its etcd watcher and the rest of the driver.
+MSG_KEY_WATCHER_QUEUE_SIZE = "watcher_queue_size"
+# Optional: if True, the driver skips keys that Felix ignores, such as other
+# hosts' config.  See calico.felix.parsing.KeyFilter.
+MSG_KEY_FILTER_KEYS = "filter_keys"
+# Optional: if True, the driver tracks digests of the data that it has sent
+# to Felix so that it can check them against etcd.  See
+# calico.etcddriver.antientropy.
+MSG_KEY_ANTI_ENTROPY = "anti_entropy"
 
 # Status message Driver -> Felix.
 MSG_TYPE_STATUS = "stat"
@@ -57,16 +89,148 @@ STATUS_WAIT_FOR_READY = "wait-for-ready"
 STATUS_RESYNC = "resync"
 STATUS_IN_SYNC = "in-sync"
 
-# Force resync message Felix->Driver.
+# Force resync message Felix->Driver.  If MSG_KEY_ANTI_ENTROPY is present and
+# True, the driver may check its data against etcd instead of doing a full
+# resync.
 MSG_TYPE_RESYNC = "resync"
 
 # Update message Driver -> Felix.
 MSG_TYPE_UPDATE = "u"
 MSG_KEY_KEY = "k"
 MSG_KEY_VALUE = "v"
+# Present and True if the value has been decoded and validated by the
+# driver.  A parsed value of None indicates that validation failed.
+MSG_KEY_PARSED = "p"
+
+# Batched update message Driver -> Felix.  Only sent if Felix advertised
+# support for PROTOCOL_VERSION_BATCHED_UPDATES in its init message.
+MSG_TYPE_UPDATE_BATCH = "ub"
+# List of [key, value] pairs, in order.  A value of None indicates deletion.
+# Updates whose value was parsed by the driver are sent as
+# [key, value, True] triples instead.
+MSG_KEY_UPDATES = "us"
+
+# Ring buffer wake-up message Driver -> Felix.  Sent over the socket after
+# messages have been written to the ring buffer.
+MSG_TYPE_RING_WAKEUP = "w"
+# Position in the ring buffer up to which the data is now valid.
+MSG_KEY_RING_POS = "p"
 
+# Protocol versions.  Version 1 sends one MSG_TYPE_UPDATE message per key.
+PROTOCOL_VERSION_1 = 1
+PROTOCOL_VERSION_BATCHED_UPDATES = 2
+PROTOCOL_VERSION = PROTOCOL_VERSION_BATCHED_UPDATES
 
+
+# Number of buffered messages that triggers a flush.
 FLUSH_THRESHOLD = 200
+# When batching updates, number of bytes of keys and values that triggers
+# the batch to be flushed.
+FLUSH_BYTES_THRESHOLD = 64 * 1024
+# When batching updates, maximum time in seconds that an update may sit in a
+# batch before we flush it (checked as further updates arrive).
+FLUSH_MAX_LATENCY = 0.05
+# Reading the clock is relatively expensive so we only check the age of the
+# batch every this many updates.
+FLUSH_LATENCY_CHECK_INTERVAL = 32
+# Rough size of a parsed value, used in place of its length when deciding
+# whether to flush a batch.
+PARSED_VALUE_SIZE_ESTIMATE = 512
+
+# msgpack extension type used to send parsed selectors, which are encoded as
+# the utf-8 encoding of the string that they were parsed from.
+EXT_TYPE_SELECTOR = 1
+# msgpack extension types used to send the IDs that Felix passes to its
+# worker processes (see calico.felix.workers).  Each is encoded as a packed
+# list of the ID's fields.
+EXT_TYPE_WLOAD_ENDPOINT_ID = 2
+EXT_TYPE_HOST_ENDPOINT_ID = 3
+EXT_TYPE_RESOLVED_HOST_ENDPOINT_ID = 4
+EXT_TYPE_TIERED_POLICY_ID = 5
+
+
+def _encode_ext(obj):
+    """msgpack default hook: encodes the non-native types in parsed values."""
+    if isinstance(obj, SelectorExpression):
+        expr_str = obj.expr_str
+        if expr_str is None:
+            expr_str = str(obj)
+        if isinstance(expr_str, unicode):
+            expr_str = expr_str.encode("utf-8")
+        return msgpack.ExtType(EXT_TYPE_SELECTOR, expr_str)
+    elif isinstance(obj, WloadEndpointId):
+        return msgpack.ExtType(EXT_TYPE_WLOAD_ENDPOINT_ID, msgpack.dumps(
+            [obj.host, obj.orchestrator, obj.workload, obj.endpoint]
+        ))
+    elif isinstance(obj, ResolvedHostEndpointId):
+        # Must be checked before its HostEndpointId superclass.
+        return msgpack.ExtType(EXT_TYPE_RESOLVED_HOST_ENDPOINT_ID,
+                               msgpack.dumps([obj.host, obj.endpoint,
+                                              obj.iface_name]))
+    elif isinstance(obj, HostEndpointId):
+        return msgpack.ExtType(EXT_TYPE_HOST_ENDPOINT_ID,
+                               msgpack.dumps([obj.host, obj.endpoint]))
+    elif isinstance(obj, TieredPolicyId):
+        return msgpack.ExtType(EXT_TYPE_TIERED_POLICY_ID,
+                               msgpack.dumps([obj.tier, obj.policy_id]))
+    raise TypeError("Unknown type: %r" % (obj,))
+
+
+def _decode_ext(code, data):
+    """msgpack ext_hook: reverses _encode_ext."""
+    if code == EXT_TYPE_SELECTOR:
+        return parse_selector(data.decode("utf-8"))
+    # The ID classes utf-8 encode their fields, which fails for str fields
+    # that contain non-ASCII characters so we decode the fields to unicode.
+    elif code == EXT_TYPE_WLOAD_ENDPOINT_ID:
+        return WloadEndpointId(*msgpack.loads(data, raw=False))
+    elif code == EXT_TYPE_HOST_ENDPOINT_ID:
+        return HostEndpointId(*msgpack.loads(data, raw=False))
+    elif code == EXT_TYPE_RESOLVED_HOST_ENDPOINT_ID:
+        host, endpoint, iface_name = msgpack.loads(data, raw=False)
+        # Unlike the other fields, the interface name is stored as-is.
+        return ResolvedHostEndpointId(host, endpoint,
+                                      iface_name.encode("utf-8"))
+    elif code == EXT_TYPE_TIERED_POLICY_ID:
+        return TieredPolicyId(*msgpack.loads(data, raw=False))
+    return msgpack.ExtType(code, data)
+
+
+def _intern_dict(d):
+    """msgpack object_hook: interns the dict's byte string keys/values."""
+    out = {}
+    for k, v in d.iteritems():
+        if isinstance(k, str):
+            k = intern(k)
+        if isinstance(v, str):
+            v = intern(v)
+        out[k] = v
+    return out
+
+
+def _intern_list(l):
+    """msgpack list_hook: interns the list's byte strings."""
+    return [intern(item) if isinstance(item, str) else item for item in l]
+
+
+def new_unpacker():
+    """
+    :returns: a msgpack Unpacker that understands our extension types.
+           Unicode strings are decoded to unicode, as json.loads() would
+           decode them.  Byte strings, which the parsing code produces by
+           interning, are decoded to interned byte strings so that parsed
+           values look the same as if they were parsed on our side.
+    """
+    return msgpack.Unpacker(ext_hook=_decode_ext,
+                            object_hook=_intern_dict,
+                            list_hook=_intern_list,
+                            raw=False)
+
+
+def _dumps(msg):
+    # Pack byte strings as msgpack bin so that they stay distinct from
+    # unicode strings.
+    return msgpack.dumps(msg, default=_encode_ext, use_bin_type=True)
 
 
 class SocketClosed(Exception):
@@ -84,11 +248,25 @@ class MessageWriter(object):
     Wrapper around a socket used to write protocol messages.
 
     Supports buffering a number of messages for subsequent flush().
+
+    If batch_updates is set, updates queued via send_update() are
+    accumulated and sent as MSG_TYPE_UPDATE_BATCH messages.  The batch is
+    flushed once it contains FLUSH_BYTES_THRESHOLD bytes of data or once its
+    oldest update is FLUSH_MAX_LATENCY seconds old, whichever comes first.
+
+    If on_write_time is set, it is called with the time, in seconds, that
+    each flush spent blocked writing to the peer.
     """
-    def __init__(self, sck):
+    def __init__(self, sck, batch_updates=False, on_write_time=None):
         self._sck = sck
+        self._on_write_time = on_write_time
         self._buf = BytesIO()
         self._updates_pending = 0
+        # Set once we know the peer supports batched updates.
+        self.batch_updates = batch_updates
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start_time = None
 
     def send_message(self, msg_type, fields=None, flush=True):
         """
@@ -102,15 +280,71 @@ class MessageWriter(object):
         :param dict fields: dict mapping MSG_KEY_* constants to values.
         :param flush: True to force the data to be written immediately.
         """
+        if self._batch:
+            # Preserve ordering with respect to any batched updates.
+            self._write_batch()
         msg = {MSG_KEY_TYPE: msg_type}
         if fields:
             msg.update(fields)
-        self._buf.write(msgpack.dumps(msg))
+        self._buf.write(_dumps(msg))
         if flush:
             self.flush()
         else:
             self._maybe_flush()
 
+    def send_update(self, key, value, parsed=False):
+        """
+        Buffers an update for the given key.  The update is sent as part
+        of a batch if batch_updates is set, or as an individual
+        MSG_TYPE_UPDATE message otherwise.
+
+        The buffer is flushed if it grows too large or too old but the
+        caller should call flush() once it has no more updates to send.
+
+        :param str key: The etcd key.
+        :param value: The new value or None for a deletion.
+        :param parsed: True if value has been decoded and validated, in
+               which case None indicates that validation failed.
+        """
+        if not self.batch_updates:
+            fields = {
+                MSG_KEY_KEY: key,
+                MSG_KEY_VALUE: value,
+            }
+            if parsed:
+                fields[MSG_KEY_PARSED] = True
+            self.send_message(MSG_TYPE_UPDATE, fields, flush=False)
+            return
+        if not self._batch:
+            self._batch_start_time = monotonic_time()
+        self._batch_bytes += len(key)
+        if parsed:
+            self._batch.append((key, value, True))
+            self._batch_bytes += PARSED_VALUE_SIZE_ESTIMATE
+        else:
+            self._batch.append((key, value))
+            if value is not None:
+                self._batch_bytes += len(value)
+        if self._batch_bytes >= FLUSH_BYTES_THRESHOLD:
+            self.flush()
+        elif (len(self._batch) % FLUSH_LATENCY_CHECK_INTERVAL == 0 and
+                monotonic_time() - self._batch_start_time >=
+                FLUSH_MAX_LATENCY):
+            self.flush()
+
+    def _write_batch(self):
+        """
+        Moves the pending batch of updates into the write buffer as a single
+        MSG_TYPE_UPDATE_BATCH message.
+        """
+        self._buf.write(_dumps({
+            MSG_KEY_TYPE: MSG_TYPE_UPDATE_BATCH,
+            MSG_KEY_UPDATES: self._batch,
+        }))
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start_time = None
+
     def _maybe_flush(self):
         self._updates_pending += 1
         if self._updates_pending > FLUSH_THRESHOLD:
@@ -121,21 +355,36 @@ class MessageWriter(object):
         Flushes the write buffer to the socket immediately.
         """
         _log.debug("Flushing the buffer to the socket")
+        if self._batch:
+            self._write_batch()
         buf_contents = self._buf.getvalue()
         if buf_contents:
+            if self._on_write_time is not None:
+                write_start = monotonic_time()
             try:
-                self._sck.sendall(buf_contents)
+                self._send_bytes(buf_contents)
             except socket.error as e:
                 _log.exception("Failed to write to socket")
                 raise WriteFailed(e)
+            if self._on_write_time is not None:
+                self._on_write_time(monotonic_time() - write_start)
             self._buf = BytesIO()
         self._updates_pending = 0
 
+    def _send_bytes(self, data):
+        """
+        Sends the given encoded messages to the peer.  Overridden by
+        alternative transports.
+
+        :raises socket.error if the write fails.
+        """
+        self._sck.sendall(data)
+
 
 class MessageReader(object):
     def __init__(self, sck):
         self._sck = sck
-        self._unpacker = msgpack.Unpacker()
+        self._unpacker = new_unpacker()
 
     def new_messages(self, timeout=1):
         """
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.etcddriver.ringbuffer
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Optional shared-memory transport for the Driver -> Felix direction of the
+protocol.
+
+Felix creates a file containing a single-producer, single-consumer ring
+buffer and passes its path to the driver in the init message.  Both
+processes mmap the file.  The driver then writes its (msgpack-encoded)
+messages into the ring buffer instead of the socket.  After each write, it
+sends a small MSG_TYPE_RING_WAKEUP message over the socket, which tells
+Felix how far into the ring buffer the valid data extends.  The socket
+therefore acts as the wake-up mechanism and the Felix -> Driver direction
+is unchanged.
+
+Felix only reads up to the position announced in a wake-up message.  Since
+the driver writes the data before it sends the wake-up (a system call), that
+guarantees that Felix never sees partially-written data.
+
+Layout of the file:
+
+* 8 bytes: write position (only written by the driver)
+* 8 bytes: read position (only written by Felix)
+* capacity bytes: data
+
+Positions are byte counts since the buffer was created; they are reduced
+modulo the capacity to find the offset into the data area.
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+
+import msgpack
+
+from calico.etcddriver.protocol import (
+    MessageReader, MessageWriter, WriteFailed, MSG_KEY_TYPE,
+    MSG_TYPE_RING_WAKEUP, MSG_KEY_RING_POS, new_unpacker
+)
+from calico.monotonic import monotonic_time
+
+_log = logging.getLogger(__name__)
+
+_POSITION = struct.Struct("=Q")
+WRITE_POS_OFFSET = 0
+READ_POS_OFFSET = _POSITION.size
+HEADER_SIZE = 2 * _POSITION.size
+
+# Default size of the data area, large enough to hold several hundred
+# batches of updates.
+DEFAULT_RING_CAPACITY = 16 * 1024 * 1024
+
+# How long the writer sleeps when the ring buffer is full, waiting for the
+# reader to catch up.
+RING_FULL_POLL_INTERVAL = 0.001
+# How long the writer waits for the reader to free up space before giving
+# up on it.  Felix reads continuously so, if it frees nothing for this long,
+# it has died or wedged.
+RING_FULL_TIMEOUT = 60
+
+
+class RingBuffer(object):
+    """
+    Single-producer, single-consumer byte ring buffer held in an mmap.
+
+    Each process should only call write() or read(), never both.
+    """
+    def __init__(self, mm, capacity):
+        self._mm = mm
+        self.capacity = capacity
+
+    @classmethod
+    def create(cls, path, capacity=DEFAULT_RING_CAPACITY):
+        """
+        Creates a new, empty ring buffer file at the given path and maps it.
+
+        :returns: the new RingBuffer.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            # Extending the file zero-fills it, which initialises both
+            # positions to 0.
+            os.ftruncate(fd, HEADER_SIZE + capacity)
+            mm = mmap.mmap(fd, HEADER_SIZE + capacity)
+        finally:
+            os.close(fd)
+        return cls(mm, capacity)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Maps an existing ring buffer file, created by create().
+
+        :returns: the RingBuffer.
+        """
+        fd = os.open(path, os.O_RDWR)
+        try:
+            size = os.fstat(fd).st_size
+            mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        return cls(mm, size - HEADER_SIZE)
+
+    @property
+    def write_pos(self):
+        return _POSITION.unpack_from(self._mm, WRITE_POS_OFFSET)[0]
+
+    @property
+    def read_pos(self):
+        return _POSITION.unpack_from(self._mm, READ_POS_OFFSET)[0]
+
+    def write(self, data):
+        """
+        Writes as much of data as will fit into the ring buffer.
+
+        :returns: the number of bytes written, which may be 0 if the buffer
+                  is full.
+        """
+        write_pos = self.write_pos
+        free = self.capacity - (write_pos - self.read_pos)
+        num_bytes = min(free, len(data))
+        if num_bytes:
+            self._copy_in(write_pos, data[:num_bytes])
+            _POSITION.pack_into(self._mm, WRITE_POS_OFFSET,
+                                write_pos + num_bytes)
+        return num_bytes
+
+    def read(self, up_to_pos):
+        """
+        Reads the data between the current read position and up_to_pos,
+        then advances the read position, freeing the space.
+
+        :param up_to_pos: position up to which the writer guarantees that
+               the data is valid.
+        :returns: the data; empty if we've already read up to up_to_pos.
+        """
+        read_pos = self.read_pos
+        num_bytes = up_to_pos - read_pos
+        if num_bytes <= 0:
+            return b""
+        assert num_bytes <= self.capacity, "Ring buffer overrun"
+        start = HEADER_SIZE + read_pos % self.capacity
+        first_chunk = min(num_bytes, HEADER_SIZE + self.capacity - start)
+        data = self._mm[start:start + first_chunk]
+        if first_chunk < num_bytes:
+            data += self._mm[HEADER_SIZE:HEADER_SIZE + num_bytes - first_chunk]
+        _POSITION.pack_into(self._mm, READ_POS_OFFSET, up_to_pos)
+        return data
+
+    def _copy_in(self, write_pos, data):
+        start = HEADER_SIZE + write_pos % self.capacity
+        first_chunk = min(len(data), HEADER_SIZE + self.capacity - start)
+        self._mm[start:start + first_chunk] = data[:first_chunk]
+        if first_chunk < len(data):
+            rest = len(data) - first_chunk
+            self._mm[HEADER_SIZE:HEADER_SIZE + rest] = data[first_chunk:]
+
+    def close(self):
+        self._mm.close()
+
+
+class RingMessageWriter(MessageWriter):
+    """
+    MessageWriter that writes its messages into a RingBuffer, using the
+    socket only to send wake-up messages.
+
+    If the ring buffer stays full for RING_FULL_TIMEOUT seconds, or
+    stop_event (a threading.Event) is set while we wait for space, the
+    write fails with WriteFailed, as it would if the socket failed.
+    """
+    def __init__(self, sck, ring, batch_updates=False, on_write_time=None,
+                 stop_event=None):
+        super(RingMessageWriter, self).__init__(sck,
+                                                batch_updates=batch_updates,
+                                                on_write_time=on_write_time)
+        self._ring = ring
+        self._stop_event = stop_event
+
+    def _send_bytes(self, data):
+        deadline = None
+        while data:
+            num_bytes = self._ring.write(data)
+            if num_bytes:
+                data = data[num_bytes:]
+                deadline = None
+                self._sck.sendall(msgpack.dumps({
+                    MSG_KEY_TYPE: MSG_TYPE_RING_WAKEUP,
+                    MSG_KEY_RING_POS: self._ring.write_pos,
+                }))
+                continue
+            if self._stop_event is not None and self._stop_event.is_set():
+                raise WriteFailed("Stopped while waiting for ring buffer")
+            now = monotonic_time()
+            if deadline is None:
+                deadline = now + RING_FULL_TIMEOUT
+            elif now >= deadline:
+                _log.error("Ring buffer full for %s seconds, giving up on "
+                           "Felix.", RING_FULL_TIMEOUT)
+                raise WriteFailed("Timed out waiting for ring buffer")
+            _log.debug("Ring buffer full, waiting for Felix to catch up")
+            time.sleep(RING_FULL_POLL_INTERVAL)
+
+
+class RingMessageReader(MessageReader):
+    """
+    MessageReader that reads messages from a RingBuffer when it is woken
+    up over the socket.
+
+    Messages sent directly over the socket (for example, by a driver that
+    doesn't support the ring buffer) are passed through as normal.
+    """
+    def __init__(self, sck, ring):
+        super(RingMessageReader, self).__init__(sck)
+        self._ring = ring
+        self._ring_unpacker = new_unpacker()
+
+    def new_messages(self, timeout=1):
+        """
+        Generator: generates 0 or more tuples containing message type and
+        message body (as a dict).  See MessageReader.new_messages().
+        """
+        for msg_type, msg in super(RingMessageReader,
+                                   self).new_messages(timeout=timeout):
+            if msg_type == MSG_TYPE_RING_WAKEUP:
+                data = self._ring.read(msg[MSG_KEY_RING_POS])
+                self._ring_unpacker.feed(data)
+                for ring_msg in self._ring_unpacker:
+                    # coverage.py doesn't fully support yield statements.
+                    yield ring_msg[MSG_KEY_TYPE], ring_msg  # pragma: nocover
+            else:
+                yield msg_type, msg  # pragma: nocover
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test_antientropy
+~~~~~~~~~~~~~~~~
+
+Tests for the per-subtree digests used by anti-entropy checks.
+"""
+
+import logging
+from unittest import TestCase
+
+from calico.etcddriver.antientropy import (
+    SubtreeDigests, subtree_for_key, compute_digest
+)
+
+_log = logging.getLogger(__name__)
+
+EP_KEY = "/calico/v1/host/h1/workload/o/w/endpoint/e"
+HOST_IP_KEY = "/calico/v1/host/h1/bird_ip"
+RULES_KEY = "/calico/v1/policy/profile/p1/rules"
+TAGS_KEY = "/calico/v1/policy/profile/p1/tags"
+
+
+class TestSubtreeForKey(TestCase):
+    def test_subtrees(self):
+        for key, subtree in [
+                (EP_KEY, "/calico/v1/host/h1"),
+                (HOST_IP_KEY, "/calico/v1/host/h1"),
+                (RULES_KEY, "/calico/v1/policy"),
+                ("/calico/v1/config/Foo", "/calico/v1/config"),
+                ("/calico/v1/Ready", None),
+                ("/calico/v1/host/h1", None),
+                ("/calico/felix/v1/host/h1/status", None)]:
+            self.assertEqual(subtree_for_key(key), subtree, key)
+
+
+class TestSubtreeDigests(TestCase):
+    def setUp(self):
+        self.digests = SubtreeDigests()
+
+    def test_incremental_digest_matches_computed(self):
+        self.digests.update(EP_KEY, 10)
+        self.digests.update(HOST_IP_KEY, 11)
+        self.digests.update(EP_KEY, 12)
+        self.digests.update(RULES_KEY, 13)
+        self.assertEqual(self.digests.digest("/calico/v1/host/h1"),
+                         compute_digest([(EP_KEY, 12), (HOST_IP_KEY, 11)]))
+        self.assertEqual(self.digests.digest("/calico/v1/policy"),
+                         compute_digest([(RULES_KEY, 13)]))
+        self.assertEqual(self.digests.subtrees(),
+                         set(["/calico/v1/host/h1", "/calico/v1/policy"]))
+        self.assertEqual(len(self.digests), 3)
+
+    def test_digest_detects_difference(self):
+        self.digests.update(RULES_KEY, 10)
+        self.digests.update(TAGS_KEY, 11)
+        for entries in [[(RULES_KEY, 10)],
+                        [(RULES_KEY, 10), (TAGS_KEY, 12)],
+                        [(RULES_KEY, 10), (TAGS_KEY, 11), ("/x", 1)]]:
+            self.assertNotEqual(self.digests.digest("/calico/v1/policy"),
+                                compute_digest(entries))
+
+    def test_remove(self):
+        self.digests.update(RULES_KEY, 10)
+        self.digests.update(TAGS_KEY, 11)
+        self.digests.remove(TAGS_KEY)
+        self.assertEqual(self.digests.digest("/calico/v1/policy"),
+                         compute_digest([(RULES_KEY, 10)]))
+        self.digests.remove(RULES_KEY)
+        self.assertEqual(self.digests.digest("/calico/v1/policy"), 0)
+        self.assertEqual(self.digests.subtrees(), set())
+        # Removing an unknown key is a no-op.
+        self.digests.remove(RULES_KEY)
+
+    def test_untracked_keys_ignored(self):
+        self.digests.update("/calico/v1/Ready", 10)
+        self.assertEqual(len(self.digests), 0)
+
+    def test_mod_idxs_in(self):
+        self.digests.update(EP_KEY, 10)
+        self.digests.update(RULES_KEY, 11)
+        self.assertEqual(self.digests.mod_idxs_in("/calico/v1/host/h1"),
+                         {EP_KEY: 10})
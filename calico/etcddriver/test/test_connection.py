@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.etcddriver.test_connection
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the etcd connection management.
+"""
+
+import httplib
+import logging
+import socket
+from unittest import TestCase
+
+from mock import Mock, patch
+from urllib3.response import HTTPResponse
+
+from calico.etcddriver import connection
+from calico.etcddriver.connection import EtcdConnectionManager
+
+_log = logging.getLogger(__name__)
+
+
+class TestEtcdConnectionManager(TestCase):
+    def setUp(self):
+        self.m_factory = Mock()
+        self.m_factory.side_effect = lambda: Mock()
+        self.mgr = EtcdConnectionManager(self.m_factory)
+        self.our_sck, self.etcd_sck = socket.socketpair()
+
+    def tearDown(self):
+        self.our_sck.close()
+        self.etcd_sck.close()
+
+    def make_resp(self):
+        m_conn = Mock()
+        m_conn.sock = self.our_sck
+        return HTTPResponse(body=self.our_sck.makefile("rb"),
+                            preload_content=False,
+                            connection=m_conn)
+
+    def test_pool_reused(self):
+        pool = self.mgr.get_pool()
+        self.assertTrue(self.mgr.get_pool() is pool)
+        self.assertEqual(self.m_factory.call_count, 1)
+
+    def test_reset(self):
+        pool = self.mgr.get_pool()
+        with patch.object(connection.ETCD_CONNECTION_RESETS, "inc") as m_inc:
+            self.mgr.reset("testing")
+            self.mgr.reset("no pool, no-op")
+        m_inc.assert_called_once_with()
+        pool.close.assert_called_once_with()
+        self.assertFalse(self.mgr.get_pool() is pool)
+
+    def test_reset_close_fails(self):
+        pool = self.mgr.get_pool()
+        pool.close.side_effect = RuntimeError()
+        self.mgr.reset("testing")
+        self.assertFalse(self.mgr.get_pool() is pool)
+
+    def test_wait_for_data_not_socket_backed(self):
+        self.assertTrue(self.mgr.wait_for_data(Mock(), Mock()))
+
+    def test_wait_for_data_available(self):
+        self.etcd_sck.sendall(b"{}")
+        m_should_stop = Mock(return_value=True)
+        self.assertTrue(self.mgr.wait_for_data(self.make_resp(),
+                                               m_should_stop))
+        self.assertFalse(m_should_stop.called)
+
+    def test_wait_for_data_already_buffered(self):
+        # Headers and body arrive in a single segment so httplib reads the
+        # body off the socket while parsing the headers.
+        self.etcd_sck.sendall(b"HTTP/1.1 200 OK\r\n"
+                              b"Content-Length: 2\r\n"
+                              b"\r\n"
+                              b"{}")
+        # Like urllib3's connections, use the socket module's wrapper, whose
+        # files do their buffering in Python.
+        sck = socket.socket(_sock=self.our_sck)
+        httplib_resp = httplib.HTTPResponse(sck, buffering=True)
+        httplib_resp.begin()
+        m_conn = Mock()
+        m_conn.sock = sck
+        resp = HTTPResponse.from_httplib(httplib_resp,
+                                         preload_content=False,
+                                         connection=m_conn)
+        m_should_stop = Mock(return_value=True)
+        self.assertTrue(self.mgr.wait_for_data(resp, m_should_stop))
+        self.assertFalse(m_should_stop.called)
+        self.assertEqual(resp.read(), b"{}")
+
+    @patch("calico.etcddriver.connection.WATCH_POLL_INTERVAL", 0.01)
+    def test_wait_for_data_stopped(self):
+        m_should_stop = Mock(side_effect=[False, True])
+        self.assertFalse(self.mgr.wait_for_data(self.make_resp(),
+                                                m_should_stop))
+        self.assertEqual(m_should_stop.call_count, 2)
+
+    @patch("calico.etcddriver.connection.WATCH_POLL_INTERVAL", 0.01)
+    @patch("calico.etcddriver.connection.monotonic_time", autospec=True)
+    def test_wait_for_data_max_idle(self, m_time):
+        m_time.side_effect = iter([0, 100, connection.WATCH_MAX_IDLE_SECS])
+        self.assertFalse(self.mgr.wait_for_data(self.make_resp(),
+                                                Mock(return_value=False)))
+
+    def test_keepalive(self):
+        sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            connection._enable_keepalive(sck)
+            self.assertTrue(sck.getsockopt(socket.SOL_SOCKET,
+                                           socket.SO_KEEPALIVE))
+        finally:
+            sck.close()
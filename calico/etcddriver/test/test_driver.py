@@ -21,7 +21,7 @@ Tests for the etcd driver module.
 import json
 import threading
 import traceback
-from Queue import Empty
+from Queue import Empty, Full, Queue
 
 from StringIO import StringIO
 from httplib import HTTPException
@@ -35,10 +35,13 @@ from urllib3 import HTTPConnectionPool
 from urllib3.exceptions import TimeoutError, HTTPError, ReadTimeoutError
 from calico.datamodel_v1 import READY_KEY, CONFIG_DIR, VERSION_DIR
 from calico.etcddriver import driver
+from calico.etcddriver.antientropy import SubtreeDigests
 from calico.etcddriver.driver import (
     EtcdDriver, DriverShutdown, ResyncRequired, WatcherDied, ijson
 )
 from calico.etcddriver.protocol import *
+from calico.etcddriver.ringbuffer import RingMessageWriter
+from calico.felix.parsing import ValueParser, ParserConfig, KeyFilter
 from calico.etcddriver.test.stubs import (
     StubMessageReader, StubMessageWriter, StubEtcd,
     FLUSH)
@@ -520,6 +523,103 @@ class TestEtcdDriverFV(TestCase):
         # Should trigger a resync.
         self.assert_status_message(STATUS_WAIT_FOR_READY)
 
+    def test_watcher_lag_triggers_catch_up(self):
+        self._run_initial_resync()
+        # Watcher gets an event but etcd is now well ahead of it.
+        watcher_req = self.watcher_etcd.get_next_request()
+        watcher_req.respond_with_value(
+            "/calico/v1/adir/fkey",
+            "f",
+            mod_index=15,
+            etcd_index=2000,
+            action="set"
+        )
+        self.assert_msg_to_felix(MSG_TYPE_UPDATE, {
+            MSG_KEY_KEY: "/calico/v1/adir/fkey",
+            MSG_KEY_VALUE: "f",
+        })
+        self.assert_flush_to_felix()
+        # Resync thread should re-read the snapshot...
+        snap_req = self.resync_etcd.assert_request(
+            VERSION_DIR, recursive=True, timeout=120, preload_content=False
+        )
+        snap_stream = snap_req.respond_with_stream(etcd_index=2000)
+        # ...and replace the watcher with one that starts from the snapshot.
+        while True:
+            watcher_req = self.watcher_etcd.get_next_request()
+            if watcher_req.kwargs["wait_index"] == 16:
+                # Old watcher's next poll, time it out so that it notices it
+                # has been stopped.
+                watcher_req.respond_with_exception(
+                    ReadTimeoutError(Mock(), "", "")
+                )
+            else:
+                break
+        watcher_req.assert_request(VERSION_DIR, recursive=True, timeout=90,
+                                   wait_index=2001)
+        snap_stream.write('''{
+            "action": "get",
+            "node": {
+                "key": "/calico/v1",
+                "dir": true,
+                "nodes": [
+                {
+                    "key": "/calico/v1/adir",
+                    "dir": true,
+                    "nodes": [
+                    {
+                        "key": "/calico/v1/adir/akey",
+                        "value": "akey's value",
+                        "modifiedIndex": 8
+                    },
+                    {
+                        "key": "/calico/v1/adir/bkey",
+                        "value": "b2",
+                        "modifiedIndex": 1500
+                    },
+                    {
+                        "key": "/calico/v1/adir/fkey",
+                        "value": "f",
+                        "modifiedIndex": 15
+                    }]
+                },
+                {
+                    "key": "/calico/v1/adir2",
+                    "dir": true,
+                    "nodes": [
+                    {
+                        "key": "/calico/v1/adir2/dkey",
+                        "value": "d",
+                        "modifiedIndex": 13
+                    }]
+                },
+                {
+                    "key": "/calico/v1/Ready",
+                    "value": "true",
+                    "modifiedIndex": 10
+                }]
+            }
+        }
+        ''')
+        snap_stream.write("")
+        # Only the changed key and the deletions make it to Felix, with no
+        # resync status messages.
+        self.assert_msg_to_felix(MSG_TYPE_UPDATE, {
+            MSG_KEY_KEY: "/calico/v1/adir/bkey",
+            MSG_KEY_VALUE: "b2",
+        })
+        deletions = set()
+        for _ in xrange(2):
+            msg = self.msg_writer.next_msg()
+            self.assertEqual(msg[0], MSG_TYPE_UPDATE)
+            self.assertEqual(msg[1][MSG_KEY_VALUE], None)
+            deletions.add(msg[1][MSG_KEY_KEY])
+        self.assertEqual(deletions, set(["/calico/v1/adir/ckey",
+                                         "/calico/v1/adir/ekey"]))
+        self.assert_flush_to_felix()
+        # Then the new watcher's events go straight through.
+        self.send_watcher_event_and_assert_felix_msg(2001, req=watcher_req)
+
     def send_watcher_event_and_assert_felix_msg(self, etcd_index, req=None):
         if req is None:
             req = self.watcher_etcd.get_next_request()
@@ -845,6 +945,41 @@ class TestDriver(TestCase):
                   preload_content=False)]
         )
 
+    def test_handle_init_protocol_version(self):
+        init_msg = {
+            MSG_KEY_ETCD_URLS: ["http://localhost:4001/"],
+            MSG_KEY_HOSTNAME: "ourhost",
+            MSG_KEY_KEY_FILE: None,
+            MSG_KEY_CERT_FILE: None,
+            MSG_KEY_CA_FILE: None
+        }
+        # Older Felix doesn't send a version, shouldn't get batches.
+        self.driver._handle_init(init_msg)
+        self.assertFalse(self.driver._msg_writer.batch_updates)
+        init_msg[MSG_KEY_PROTOCOL_VERSION] = PROTOCOL_VERSION_BATCHED_UPDATES
+        self.driver._handle_init(init_msg)
+        self.assertTrue(self.driver._msg_writer.batch_updates)
+
+    @patch("os.unlink", autospec=True)
+    @patch("calico.etcddriver.driver.RingBuffer", autospec=True)
+    def test_handle_init_ring_buffer(self, m_ring_buffer, m_unlink):
+        self.driver._handle_init({
+            MSG_KEY_ETCD_URLS: ["http://localhost:4001/"],
+            MSG_KEY_HOSTNAME: "ourhost",
+            MSG_KEY_KEY_FILE: None,
+            MSG_KEY_CERT_FILE: None,
+            MSG_KEY_CA_FILE: None,
+            MSG_KEY_PROTOCOL_VERSION: PROTOCOL_VERSION,
+            MSG_KEY_RING_FILE: "/run/felix-driver.ring",
+        })
+        self.assertEqual(m_ring_buffer.open.mock_calls,
+                         [call("/run/felix-driver.ring")])
+        self.assertEqual(m_unlink.mock_calls,
+                         [call("/run/felix-driver.ring")])
+        self.assertTrue(isinstance(self.driver._msg_writer,
+                                   RingMessageWriter))
+        self.assertTrue(self.driver._msg_writer.batch_updates)
+
     def test_cluster_id_check(self):
         m_resp = Mock()
         m_resp.getheader.return_value = "abcdef"
@@ -915,6 +1050,61 @@ class TestDriver(TestCase):
                           self.driver._handle_next_watcher_event,
                           False)
 
+    def test_handle_next_watcher_overflowed_during_resync(self):
+        m_queue = Mock()
+        m_queue.get.return_value = driver.WATCHER_OVERFLOWED
+        self.driver._watcher_queue = m_queue
+        with patch.object(self.driver, "_catch_up") as m_catch_up:
+            self.driver._handle_next_watcher_event(True)
+            # Catch up is deferred until the snapshot is done.
+            self.assertFalse(m_catch_up.called)
+            self.assertTrue(self.driver._catch_up_required)
+            self.assertEqual(self.driver._watcher_queue, None)
+            self.driver._handle_next_watcher_event(False)
+            m_catch_up.assert_called_once_with()
+
+    def test_handle_next_watcher_overflowed_in_sync(self):
+        m_queue = Mock()
+        m_queue.get.return_value = driver.WATCHER_OVERFLOWED
+        self.driver._watcher_queue = m_queue
+        with patch.object(self.driver, "_catch_up") as m_catch_up:
+            self.driver._handle_next_watcher_event(False)
+            m_catch_up.assert_called_once_with()
+
+    def test_watch_etcd_queue_overflow(self):
+        m_queue = Queue(maxsize=1)
+        m_stop_ev = Mock()
+        m_stop_ev.is_set.return_value = False
+        m_resp = Mock()
+        m_resp.data = json.dumps({
+            "action": "set",
+            "node": {"key": "/calico/v1/foo", "value": "bar",
+                     "modifiedIndex": 10},
+        })
+        self.driver.get_etcd_connection = Mock()
+        self.driver._check_cluster_id = Mock()
+        self.driver._etcd_request = Mock(side_effect=iter([
+            m_resp,
+            m_resp,
+            AssertionError()
+        ]))
+        self.driver._put_final_watcher_event = m_put = Mock()
+        with patch.object(driver.WATCHER_QUEUE_OVERFLOWS, "inc") as m_inc:
+            self.driver.watch_etcd(10, m_queue, m_stop_ev)
+        m_inc.assert_called_once_with()
+        m_put.assert_called_once_with(m_queue, m_stop_ev,
+                                      driver.WATCHER_OVERFLOWED)
+
+    def test_put_final_watcher_event_abandoned(self):
+        queue = Queue(maxsize=1)
+        queue.put("event")
+        stop_event = threading.Event()
+        stop_event.set()
+        with patch.object(queue, "put", autospec=True) as m_put:
+            m_put.side_effect = Full()
+            self.driver._put_final_watcher_event(queue, stop_event, None)
+        self.assertEqual(m_put.mock_calls, [call(None, timeout=1)])
+
     def test_ready_key_set_to_false(self):
         self.assertRaises(ResyncRequired,
                           self.driver._on_key_updated, READY_KEY, "false")
@@ -953,6 +1143,63 @@ class TestDriver(TestCase):
                         self.driver.watch_etcd(10, m_queue, m_stop_ev)
                         inc.assert_called_once_with()
 
+    def test_watch_etcd_reuses_connection(self):
+        m_queue = Mock()
+        m_queue.qsize.return_value = 1
+        m_stop_ev = Mock()
+        m_stop_ev.is_set.return_value = False
+        with patch.object(self.driver, "get_etcd_connection") as m_get_conn:
+            with patch.object(self.driver, "_etcd_request") as m_req:
+                with patch.object(self.driver, "_check_cluster_id"):
+                    m_resp = Mock()
+                    m_resp.data = json.dumps({
+                        "action": "set",
+                        "node": {"key": "/calico/v1/foo", "value": "bar",
+                                 "modifiedIndex": 10},
+                    })
+                    m_req.side_effect = iter([
+                        m_resp,
+                        m_resp,
+                        DriverShutdown()
+                    ])
+                    self.driver.watch_etcd(10, m_queue, m_stop_ev)
+        # Both requests should have used the same pool.
+        self.assertEqual(m_get_conn.call_count, 1)
+
+    def test_watch_etcd_read_timeout_resets_connection(self):
+        m_queue = Mock()
+        m_stop_ev = Mock()
+        m_stop_ev.is_set.return_value = False
+        with patch.object(self.driver, "get_etcd_connection") as m_get_conn:
+            with patch.object(self.driver, "_etcd_request") as m_req:
+                m_req.side_effect = iter([
+                    ReadTimeoutError(Mock(), "", ""),
+                    DriverShutdown()
+                ])
+                self.driver.watch_etcd(10, m_queue, m_stop_ev)
+        self.assertEqual(m_get_conn.call_count, 2)
+        m_get_conn.return_value.close.assert_called_once_with()
+
+    def test_watch_etcd_abandoned_watch(self):
+        m_queue = Mock()
+        m_stop_ev = Mock()
+        m_stop_ev.is_set.return_value = False
+        with patch.object(self.driver, "get_etcd_connection") as m_get_conn:
+            with patch.object(self.driver, "_etcd_request") as m_req:
+                with patch.object(self.driver, "_check_cluster_id"):
+                    with patch.object(driver.EtcdConnectionManager,
+                                      "wait_for_data",
+                                      autospec=True) as m_wait:
+                        m_wait.return_value = False
+                        m_resp = Mock()
+                        m_req.side_effect = iter([
+                            m_resp,
+                            DriverShutdown()
+                        ])
+                        self.driver.watch_etcd(10, m_queue, m_stop_ev)
+        m_resp.close.assert_called_once_with()
+        self.assertEqual(m_get_conn.call_count, 2)
+
     def test_parse_snapshot_bad_status(self):
         m_resp = Mock()
         m_resp.status = 500
@@ -1006,6 +1253,59 @@ class TestDriver(TestCase):
         next(parser)
         self.assertRaises(ValueError, driver._parse_map, parser, None)
 
+    def test_parse_events_error_from_etcd(self):
+        events = ijson.basic_parse(StringIO(json.dumps({
+            "errorCode": 100
+        })))
+        next(events)
+        self.assertRaises(ResyncRequired, driver._parse_events, events, None)
+
+    def test_parse_events_bad_data(self):
+        events = ijson.basic_parse(StringIO(json.dumps({
+            "nodes": [
+                "foo"
+            ]
+        })))
+        next(events)
+        self.assertRaises(ValueError, driver._parse_events, events, None)
+
+    def test_parse_events_nested_dirs(self):
+        events = ijson.basic_parse(StringIO(json.dumps({
+            "action": "get",
+            "node": {
+                "key": "/calico/v1",
+                "dir": True,
+                "nodes": [
+                    {
+                        "key": "/calico/v1/Ready",
+                        "value": "true",
+                        "modifiedIndex": 10,
+                        "createdIndex": 10,
+                    },
+                    {
+                        "key": "/calico/v1/config",
+                        "dir": True,
+                        "nodes": [
+                            {
+                                "key": "/calico/v1/config/LogSeverityFile",
+                                "value": "info",
+                                "modifiedIndex": 12,
+                            },
+                        ],
+                        "modifiedIndex": 11,
+                    },
+                ],
+                "modifiedIndex": 1,
+            },
+        })))
+        next(events)
+        callback = Mock()
+        driver._parse_events(events, callback)
+        self.assertEqual(callback.mock_calls, [
+            call(10, "/calico/v1/Ready", "true"),
+            call(12, "/calico/v1/config/LogSeverityFile", "info"),
+        ])
+
     def test_join_not_stopped(self):
         with patch.object(self.driver._stop_event, "wait"):
             self.assertFalse(self.driver.join())
@@ -1019,7 +1319,7 @@ class TestDriver(TestCase):
         stop_event.set()
         m_queue = Mock()
         self.driver.watch_etcd(10, m_queue, stop_event)
-        self.assertEqual(m_queue.put.mock_calls, [call(None)])
+        self.assertEqual(m_queue.put.mock_calls, [call(None, timeout=1)])
 
     def test_watch_etcd_driver_shutdown(self):
         stop_event = threading.Event()
@@ -1030,7 +1330,7 @@ class TestDriver(TestCase):
         m_queue = Mock()
         self.driver.watch_etcd(10, m_queue, stop_event)
         # And send it's normal shutdown signal.
-        self.assertEqual(m_queue.put.mock_calls, [call(None)])
+        self.assertEqual(m_queue.put.mock_calls, [call(None, timeout=1)])
 
     @patch("calico.etcddriver.driver.complete_logging", autospec=True)
     @patch("calico.etcddriver.driver.start_http_server", autospec=True)
@@ -1049,6 +1349,311 @@ class TestDriver(TestCase):
                                           stream_level="INFO",
                                           gevent_in_use=False)
 
+    @patch("calico.etcddriver.driver.complete_logging", autospec=True)
+    def test_handle_config_parser(self, compl_log):
+        self.driver._hostname = "thehostname"
+        self.driver._handle_config({
+            MSG_KEY_LOG_FILE: "/tmp/driver.log",
+            MSG_KEY_SEV_FILE: "DEBUG",
+            MSG_KEY_SEV_SCREEN: "INFO",
+            MSG_KEY_SEV_SYSLOG: "WARNING",
+            MSG_KEY_PROM_PORT: None,
+            MSG_KEY_PARSER_CONFIG: {MSG_KEY_IFACE_PREFIX: "tap",
+                                    MSG_KEY_STRIP_REMOTE_ENDPOINTS: True},
+        })
+        self.assertTrue(self.driver._config_received.is_set())
+        # Local endpoint names are checked against the interface prefix so
+        # the driver needs both values.
+        self.assertEqual(self.driver._value_parser._config,
+                         ParserConfig(HOSTNAME="thehostname",
+                                      IFACE_PREFIX="tap"))
+        self.assertTrue(self.driver._value_parser._strip_remote_endpoints)
+
+    @patch("calico.etcddriver.driver.complete_logging", autospec=True)
+    def test_handle_config_filter_keys(self, compl_log):
+        self.driver._hostname = "thehostname"
+        self.driver._handle_config({
+            MSG_KEY_LOG_FILE: "/tmp/driver.log",
+            MSG_KEY_SEV_FILE: "DEBUG",
+            MSG_KEY_SEV_SCREEN: "INFO",
+            MSG_KEY_SEV_SYSLOG: "WARNING",
+            MSG_KEY_PROM_PORT: None,
+            MSG_KEY_FILTER_KEYS: True,
+        })
+        self.assertTrue(self.driver._key_filter.is_relevant(
+            "/calico/v1/host/thehostname/config/Foo"
+        ))
+        self.assertFalse(self.driver._key_filter.is_relevant(
+            "/calico/v1/host/otherhost/config/Foo"
+        ))
+
+    def test_count_key(self):
+        with patch.object(driver.KEYS_PROCESSED, "labels") as m_labels:
+            self.driver._count_key("/calico/v1/policy/tier/t1/metadata")
+            self.driver._count_key("/calico/v1/policy/profile/p1/rules")
+            self.driver._count_key("/calico/v1/Ready")
+        # Counters are cached per subtree.
+        self.assertEqual(m_labels.mock_calls, [
+            call("policy"), call().inc(), call().inc(),
+            call("Ready"), call().inc(),
+        ])
+
+    def test_handle_next_watcher_event_processing_lag(self):
+        m_queue = Mock()
+        m_queue.get.return_value = (90, "/calico/v1/config/Foo", "bar")
+        self.driver._watcher_queue = m_queue
+        self.driver._latest_etcd_index = 100
+        with patch.object(self.driver, "_on_key_updated"), \
+                patch.object(driver.ETCD_PROCESSING_LAG, "set") as m_set:
+            self.driver._handle_next_watcher_event(False)
+        m_set.assert_called_once_with(10)
+
+    def test_handle_etcd_node_filtered(self):
+        self.driver._key_filter = KeyFilter("thehostname")
+        self.driver._watcher_queue = None
+        with patch.object(self.driver, "_on_key_updated") as m_update:
+            self.driver._handle_etcd_node(
+                5, "/calico/v1/host/otherhost/config/Foo", "bar",
+                snapshot_index=10
+            )
+            self.driver._handle_etcd_node(
+                5, "/calico/v1/config/Foo", "bar", snapshot_index=10
+            )
+        self.assertEqual(m_update.mock_calls,
+                         [call("/calico/v1/config/Foo", "bar")])
+        # Only the relevant key is tracked.
+        self.assertEqual(len(self.driver._hwms), 1)
+
+    def test_watch_etcd_filtered(self):
+        self.driver._key_filter = KeyFilter("thehostname")
+        m_queue = Mock()
+        m_queue.qsize.return_value = 1
+        m_stop_ev = Mock()
+        m_stop_ev.is_set.return_value = False
+        responses = []
+        for key in ["/calico/v1/host/otherhost/config/Foo",
+                    "/calico/v1/config/Foo"]:
+            m_resp = Mock()
+            m_resp.data = json.dumps({
+                "action": "set",
+                "node": {"key": key, "value": "bar", "modifiedIndex": 10},
+            })
+            responses.append(m_resp)
+        self.driver.get_etcd_connection = Mock()
+        self.driver._check_cluster_id = Mock()
+        self.driver._etcd_request = Mock(
+            side_effect=iter(responses + [DriverShutdown()])
+        )
+        self.driver.watch_etcd(10, m_queue, m_stop_ev)
+        self.assertEqual(m_queue.put_nowait.mock_calls,
+                         [call((10, "/calico/v1/config/Foo", "bar"))])
+
+    @patch("calico.etcddriver.driver.complete_logging", autospec=True)
+    def test_handle_config_watcher_queue_size(self, compl_log):
+        self.driver._handle_config({
+            MSG_KEY_LOG_FILE: "/tmp/driver.log",
+            MSG_KEY_SEV_FILE: "DEBUG",
+            MSG_KEY_SEV_SCREEN: "INFO",
+            MSG_KEY_SEV_SYSLOG: "WARNING",
+            MSG_KEY_PROM_PORT: None,
+            MSG_KEY_WATCHER_QUEUE_SIZE: 100,
+        })
+        self.assertEqual(self.driver._watcher_queue_size, 100)
+
+    @patch("calico.etcddriver.driver.complete_logging", autospec=True)
+    def test_handle_config_anti_entropy(self, compl_log):
+        self.driver._handle_config({
+            MSG_KEY_LOG_FILE: "/tmp/driver.log",
+            MSG_KEY_SEV_FILE: "DEBUG",
+            MSG_KEY_SEV_SCREEN: "INFO",
+            MSG_KEY_SEV_SYSLOG: "WARNING",
+            MSG_KEY_PROM_PORT: None,
+            MSG_KEY_ANTI_ENTROPY: True,
+        })
+        self.assertTrue(isinstance(self.driver._digests, SubtreeDigests))
+
+    def test_handle_resync_anti_entropy(self):
+        # Without digests, we can only do a full resync.
+        self.driver._handle_resync({MSG_KEY_ANTI_ENTROPY: True})
+        self.assertTrue(self.driver._resync_requested)
+        self.assertFalse(self.driver._anti_entropy_requested)
+        self.driver._resync_requested = False
+        self.driver._digests = SubtreeDigests()
+        self.driver._handle_resync({MSG_KEY_ANTI_ENTROPY: True})
+        self.assertFalse(self.driver._resync_requested)
+        self.assertTrue(self.driver._anti_entropy_requested)
+        self.driver._handle_resync({})
+        self.assertTrue(self.driver._resync_requested)
+
+    def setup_anti_entropy(self):
+        """
+        Sets up the driver as if it was in sync, with anti-entropy enabled,
+        and stubs out etcd reads so that they return self.etcd_data.
+        """
+        self.driver._digests = SubtreeDigests()
+        self.driver._watcher_queue = Queue()
+        self.driver._hwms.stop_tracking_deletions()
+        for mod, key in [(5, AE_RULES_KEY), (6, AE_TAGS_KEY),
+                         (7, AE_EP_KEY)]:
+            self.driver._handle_etcd_node(mod, key, "old", snapshot_index=10)
+        self.etcd_data = {
+            VERSION_DIR: {"node": {"key": VERSION_DIR, "dir": True, "nodes": [
+                {"key": "/calico/v1/Ready", "value": "true"},
+                {"key": "/calico/v1/host", "dir": True},
+                {"key": "/calico/v1/policy", "dir": True},
+            ]}},
+            "/calico/v1/host": {"node": {"key": "/calico/v1/host",
+                                         "dir": True, "nodes": [
+                {"key": "/calico/v1/host/h1", "dir": True},
+                {"key": "/calico/v1/host/h2", "dir": True},
+            ]}},
+            "/calico/v1/host/h1": _etcd_dir([(AE_EP_KEY, 7, "old")]),
+            "/calico/v1/host/h2": _etcd_dir([(AE_NEW_EP_KEY, 12, "new")]),
+            "/calico/v1/policy": _etcd_dir([(AE_RULES_KEY, 5, "old"),
+                                            (AE_TAGS_KEY, 11, "new")]),
+        }
+        self.etcd_reads = []
+
+        def etcd_request(pool, key, **kwargs):
+            self.etcd_reads.append(key)
+            resp = Mock()
+            resp.data = json.dumps(self.etcd_data.get(key, {"errorCode": 100}))
+            resp.getheader.return_value = "20"
+            return resp
+        self.driver._etcd_request = etcd_request
+
+    def run_anti_entropy_steps(self, num_steps):
+        for _ in xrange(num_steps):
+            self.assertTrue(self.driver._check_next_subtree())
+        self.assertFalse(self.driver._check_next_subtree())
+
+    def test_anti_entropy_repairs_differences(self):
+        self.setup_anti_entropy()
+        self.driver._anti_entropy_requested = True
+        with patch.object(self.driver, "_on_key_updated") as m_update:
+            # Starting the check, from the event loop, reads the first
+            # subtree.
+            self.driver._handle_next_watcher_event(resync_in_progress=False)
+            self.assertFalse(self.driver._anti_entropy_requested)
+            self.run_anti_entropy_steps(2)
+            self.assertEqual(self.etcd_reads, [
+                VERSION_DIR, "/calico/v1/host", "/calico/v1/host/h1",
+                "/calico/v1/host/h2", "/calico/v1/policy",
+            ])
+            # Nothing is repaired until the differences are confirmed.
+            self.assertEqual(m_update.mock_calls, [])
+            with patch("calico.etcddriver.driver.monotonic_time") as m_time:
+                m_time.return_value = time.time() + 1000000
+                self.run_anti_entropy_steps(2)
+        self.assertEqual(m_update.mock_calls, [
+            call(AE_NEW_EP_KEY, "new"),
+            call(AE_TAGS_KEY, "new"),
+        ])
+        # Now in sync with etcd.
+        digests = self.driver._digests
+        self.assertEqual(digests.mod_idxs_in("/calico/v1/policy"),
+                         {AE_RULES_KEY: 5, AE_TAGS_KEY: 11})
+        self.driver._start_anti_entropy_check()
+        self.run_anti_entropy_steps(3)
+        self.assertEqual(self.driver._subtrees_to_confirm, [])
+        # A stale event for a repaired key is skipped.
+        self.driver._watcher_queue.put((9, AE_TAGS_KEY, "stale"))
+        with patch.object(self.driver, "_on_key_updated") as m_update:
+            self.driver._handle_next_watcher_event(resync_in_progress=False)
+        self.assertEqual(m_update.mock_calls, [])
+
+    def test_anti_entropy_ignores_in_flight_events(self):
+        self.setup_anti_entropy()
+        del self.etcd_data["/calico/v1/host/h2"]
+        self.driver._start_anti_entropy_check()
+        self.run_anti_entropy_steps(3)
+        self.assertEqual(len(self.driver._subtrees_to_confirm), 1)
+        # The difference was due to an event that was in flight.
+        self.driver._watcher_queue.put((11, AE_TAGS_KEY, "new"))
+        with patch.object(self.driver, "_on_key_updated") as m_update:
+            self.driver._handle_next_watcher_event(resync_in_progress=False)
+            with patch("calico.etcddriver.driver.monotonic_time") as m_time:
+                m_time.return_value = time.time() + 1000000
+                self.run_anti_entropy_steps(1)
+        self.assertEqual(m_update.mock_calls, [call(AE_TAGS_KEY, "new")])
+
+    def test_anti_entropy_repairs_deletion(self):
+        self.setup_anti_entropy()
+        self.etcd_data["/calico/v1/host/h1"] = _etcd_dir([])
+        del self.etcd_data["/calico/v1/host/h2"]
+        self.etcd_data["/calico/v1/policy"] = _etcd_dir([
+            (AE_RULES_KEY, 5, "old"), (AE_TAGS_KEY, 6, "old")
+        ])
+        self.driver._start_anti_entropy_check()
+        self.run_anti_entropy_steps(3)
+        with patch.object(self.driver, "_on_key_updated") as m_update:
+            with patch("calico.etcddriver.driver.monotonic_time") as m_time:
+                m_time.return_value = time.time() + 1000000
+                self.run_anti_entropy_steps(1)
+        self.assertEqual(m_update.mock_calls, [call(AE_EP_KEY, None)])
+        self.assertEqual(len(self.driver._hwms), 2)
+        self.assertEqual(self.driver._digests.subtrees(),
+                         set(["/calico/v1/policy"]))
+
+    def test_anti_entropy_falls_back_on_resync(self):
+        self.setup_anti_entropy()
+        self.driver._start_anti_entropy_check()
+        self.run_anti_entropy_steps(3)
+        with patch("calico.etcddriver.driver.monotonic_time") as m_time, \
+                patch("calico.etcddriver.driver."
+                      "ANTI_ENTROPY_MAX_REPAIRED_SUBTREES", 0):
+            m_time.return_value = time.time() + 1000000
+            self.assertRaises(ResyncRequired,
+                              self.driver._check_next_subtree)
+
+    def test_anti_entropy_bad_data(self):
+        self.setup_anti_entropy()
+        self.etcd_data[VERSION_DIR] = {"foo": "bar"}
+        self.assertRaises(ResyncRequired,
+                          self.driver._start_anti_entropy_check)
+        self.etcd_data["/calico/v1/policy"] = {"node": {"key": "foo"}}
+        self.assertRaises(ResyncRequired,
+                          self.driver._read_subtree, "/calico/v1/policy")
+
+    def test_on_key_updated_parses_values(self):
+        self.driver._value_parser = ValueParser(
+            ParserConfig(HOSTNAME="thehostname", IFACE_PREFIX="tap")
+        )
+        with patch.object(self.driver, "_msg_writer") as m_writer:
+            self.driver._on_key_updated(
+                "/calico/v1/policy/profile/prof1/tags", '["a"]'
+            )
+            self.driver._on_key_updated(
+                "/calico/v1/policy/profile/prof1/tags", "{"
+            )
+            self.driver._on_key_updated(
+                "/calico/v1/policy/profile/prof1/tags", None
+            )
+            self.driver._on_key_updated("/calico/v1/config/Foo", "bar")
+        self.assertEqual(m_writer.send_update.mock_calls, [
+            call("/calico/v1/policy/profile/prof1/tags", ["a"], parsed=True),
+            call("/calico/v1/policy/profile/prof1/tags", None, parsed=True),
+            call("/calico/v1/policy/profile/prof1/tags", None),
+            call("/calico/v1/config/Foo", "bar", parsed=False),
+        ])
+
+
+AE_EP_KEY = "/calico/v1/host/h1/workload/o/w/endpoint/e"
+AE_NEW_EP_KEY = "/calico/v1/host/h2/workload/o/w/endpoint/e"
+AE_RULES_KEY = "/calico/v1/policy/profile/p1/rules"
+AE_TAGS_KEY = "/calico/v1/policy/profile/p1/tags"
+
+
+def _etcd_dir(leaves):
+    """
+    :returns: an etcd response for a recursive read of a directory containing
+              the given (key, modifiedIndex, value) leaves.
+    """
+    return {"node": {"key": "/dir", "dir": True, "nodes": [
+        {"key": key, "modifiedIndex": mod, "value": value}
+        for key, mod, value in leaves
+    ]}}
+
 
 def dump_all_thread_stacks():
     print >> sys.stderr, "\n*** STACKTRACE - START ***\n"
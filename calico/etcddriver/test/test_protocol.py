@@ -28,7 +28,13 @@ import msgpack
 from calico.etcddriver.protocol import (
     MessageWriter, STATUS_RESYNC, MSG_KEY_STATUS, MSG_TYPE_STATUS,
     MSG_KEY_TYPE, STATUS_IN_SYNC, MessageReader,
-    SocketClosed, WriteFailed)
+    SocketClosed, WriteFailed, MSG_TYPE_UPDATE, MSG_KEY_KEY, MSG_KEY_VALUE,
+    MSG_TYPE_UPDATE_BATCH, MSG_KEY_UPDATES, FLUSH_BYTES_THRESHOLD,
+    MSG_KEY_PARSED, new_unpacker)
+from calico.datamodel_v1 import (
+    WloadEndpointId, HostEndpointId, ResolvedHostEndpointId, TieredPolicyId
+)
+from calico.felix.selectors import parse_selector
 
 _log = logging.getLogger(__name__)
 
@@ -36,7 +42,7 @@ _log = logging.getLogger(__name__)
 class StubWriterSocket(object):
     def __init__(self):
         self.chunks = []
-        self.unpacker = msgpack.Unpacker()
+        self.unpacker = new_unpacker()
         self.exception = None
 
     def sendall(self, data):
@@ -117,6 +123,141 @@ class TestMessageWriter(TestCase):
             })
         self.assert_no_more_messages()
 
+    @patch("calico.etcddriver.protocol.monotonic_time", autospec=True)
+    def test_write_time(self, m_time):
+        m_time.side_effect = iter([10, 10.5])
+        m_on_write_time = Mock()
+        writer = MessageWriter(self.sck, on_write_time=m_on_write_time)
+        writer.flush()  # Nothing to write, shouldn't be timed.
+        writer.send_message(MSG_TYPE_STATUS, {MSG_KEY_STATUS: STATUS_RESYNC})
+        self.assertEqual(m_on_write_time.mock_calls, [call(0.5)])
+
+    def test_send_update_unbatched(self):
+        self.writer.send_update("/foo", "bar")
+        self.assert_no_more_messages()
+        self.writer.flush()
+        self.assert_message_sent({
+            MSG_KEY_TYPE: MSG_TYPE_UPDATE,
+            MSG_KEY_KEY: "/foo",
+            MSG_KEY_VALUE: "bar",
+        })
+        self.assert_no_more_messages()
+
+    @patch("calico.etcddriver.protocol.monotonic_time", autospec=True)
+    def test_send_update_batched(self, m_time):
+        m_time.return_value = 10
+        self.writer.batch_updates = True
+        self.writer.send_update("/foo", "bar")
+        self.writer.send_update("/baz", None)
+        self.assert_no_more_messages()
+        # A non-update message forces the batch out first, to maintain
+        # ordering.
+        self.writer.send_message(MSG_TYPE_STATUS,
+                                 {
+                                     MSG_KEY_STATUS: STATUS_IN_SYNC
+                                 })
+        self.assert_message_sent({
+            MSG_KEY_TYPE: MSG_TYPE_UPDATE_BATCH,
+            MSG_KEY_UPDATES: [["/foo", "bar"], ["/baz", None]],
+        })
+        self.assert_message_sent({
+            MSG_KEY_TYPE: MSG_TYPE_STATUS,
+            MSG_KEY_STATUS: STATUS_IN_SYNC
+        })
+        self.assert_no_more_messages()
+
+    def test_send_update_parsed_unbatched(self):
+        self.writer.send_update("/foo", None, parsed=True)
+        self.writer.flush()
+        self.assert_message_sent({
+            MSG_KEY_TYPE: MSG_TYPE_UPDATE,
+            MSG_KEY_KEY: "/foo",
+            MSG_KEY_VALUE: None,
+            MSG_KEY_PARSED: True,
+        })
+        self.assert_no_more_messages()
+
+    @patch("calico.etcddriver.protocol.monotonic_time", autospec=True)
+    def test_send_update_parsed_batched(self, m_time):
+        m_time.return_value = 10
+        self.writer.batch_updates = True
+        selector = parse_selector("a == 'b'")
+        self.writer.send_update("/foo", {"selector": selector}, parsed=True)
+        self.writer.send_update("/bar", "baz")
+        self.writer.flush()
+        msg = self.sck.next_msg()
+        self.assertEqual(msg, {
+            MSG_KEY_TYPE: MSG_TYPE_UPDATE_BATCH,
+            MSG_KEY_UPDATES: [["/foo", {"selector": selector}, True],
+                              ["/bar", "baz"]],
+        })
+        # Selectors are decoded via the parse cache.
+        self.assertIs(msg[MSG_KEY_UPDATES][0][1]["selector"], selector)
+        self.assert_no_more_messages()
+
+    def test_send_message_ids(self):
+        ids = [
+            WloadEndpointId("h", "o", "w", "e"),
+            HostEndpointId("h", "e"),
+            ResolvedHostEndpointId("h", "e", "eth0"),
+            TieredPolicyId("t", "p"),
+        ]
+        self.writer.send_message(MSG_TYPE_STATUS, {"ids": ids})
+        msg = self.sck.next_msg()
+        self.assertEqual(msg["ids"], ids)
+        # Check the types since some of the IDs compare equal to instances
+        # of their subclasses.
+        self.assertEqual([type(i) for i in msg["ids"]],
+                         [type(i) for i in ids])
+        self.assert_no_more_messages()
+
+    def test_send_update_parsed_non_ascii(self):
+        selector = parse_selector(u"role == 'caf\xe9'")
+        labels = {u"a": u"\xe9"}
+        self.writer.send_update("/foo",
+                                {"selector": selector, "labels": labels},
+                                parsed=True)
+        self.writer.flush()
+        msg = self.sck.next_msg()
+        value = msg[MSG_KEY_VALUE]
+        self.assertEqual(value["selector"], selector)
+        self.assertTrue(value["selector"].evaluate({"role": u"caf\xe9"}))
+        # Strings come back as unicode, as they would from json.loads().
+        self.assertEqual(value["labels"], labels)
+        self.assertIsInstance(value["labels"]["a"], unicode)
+        self.assert_no_more_messages()
+
+    @patch("calico.etcddriver.protocol.monotonic_time", autospec=True)
+    def test_send_update_batch_bytes_threshold(self, m_time):
+        m_time.return_value = 10
+        self.writer.batch_updates = True
+        value = "x" * (FLUSH_BYTES_THRESHOLD // 2)
+        self.writer.send_update("/foo", value)
+        self.assert_no_more_messages()
+        self.writer.send_update("/bar", value)
+        self.assert_message_sent({
+            MSG_KEY_TYPE: MSG_TYPE_UPDATE_BATCH,
+            MSG_KEY_UPDATES: [["/foo", value], ["/bar", value]],
+        })
+        self.assert_no_more_messages()
+
+    @patch("calico.etcddriver.protocol.FLUSH_LATENCY_CHECK_INTERVAL", 1)
+    @patch("calico.etcddriver.protocol.monotonic_time", autospec=True)
+    def test_send_update_batch_latency_threshold(self, m_time):
+        m_time.side_effect = iter([10, 10, 10.01, 11])
+        self.writer.batch_updates = True
+        self.writer.send_update("/foo", "bar")
+        self.writer.send_update("/baz", "boo")
+        self.assert_no_more_messages()
+        # The first update has now been waiting for too long.
+        self.writer.send_update("/biz", "buz")
+        self.assert_message_sent({
+            MSG_KEY_TYPE: MSG_TYPE_UPDATE_BATCH,
+            MSG_KEY_UPDATES: [["/foo", "bar"], ["/baz", "boo"],
+                              ["/biz", "buz"]],
+        })
+        self.assert_no_more_messages()
+
     def test_flush_no_content(self):
         self.writer.flush()
         self.assertFalse(self.sck.chunks)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.etcddriver.test_ringbuffer
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the shared memory ring buffer transport.
+"""
+
+import logging
+import os
+import shutil
+import socket
+import tempfile
+from threading import Event
+from unittest import TestCase
+
+from mock import patch
+
+from calico.etcddriver.protocol import (
+    MSG_TYPE_STATUS, MSG_KEY_STATUS, STATUS_RESYNC, STATUS_IN_SYNC,
+    MSG_KEY_TYPE, MessageWriter, WriteFailed
+)
+from calico.etcddriver.ringbuffer import (
+    RingBuffer, RingMessageWriter, RingMessageReader, RING_FULL_TIMEOUT
+)
+
+_log = logging.getLogger(__name__)
+
+
+class TestRingBuffer(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "ring")
+        self.writer_ring = RingBuffer.create(self.path, 16)
+        self.reader_ring = RingBuffer.open(self.path)
+
+    def tearDown(self):
+        self.writer_ring.close()
+        self.reader_ring.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_open_reads_capacity(self):
+        self.assertEqual(self.reader_ring.capacity, 16)
+
+    def test_write_read(self):
+        self.assertEqual(self.writer_ring.write(b"abcdef"), 6)
+        self.assertEqual(self.reader_ring.read(6), b"abcdef")
+        self.assertEqual(self.reader_ring.read(6), b"")
+
+    def test_read_only_up_to_pos(self):
+        self.writer_ring.write(b"abcdef")
+        self.assertEqual(self.reader_ring.read(3), b"abc")
+        self.assertEqual(self.reader_ring.read(6), b"def")
+
+    def test_full(self):
+        self.assertEqual(self.writer_ring.write(b"x" * 20), 16)
+        self.assertEqual(self.writer_ring.write(b"y"), 0)
+        self.assertEqual(self.reader_ring.read(4), b"xxxx")
+        self.assertEqual(self.writer_ring.write(b"yyyyyy"), 4)
+
+    def test_wrap_around(self):
+        self.writer_ring.write(b"0123456789")
+        self.reader_ring.read(10)
+        self.assertEqual(self.writer_ring.write(b"abcdefghij"), 10)
+        self.assertEqual(self.writer_ring.write_pos, 20)
+        self.assertEqual(self.reader_ring.read(20), b"abcdefghij")
+
+
+class TestRingMessages(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, "ring")
+        self.felix_ring = RingBuffer.create(path, 64)
+        self.driver_ring = RingBuffer.open(path)
+        self.felix_sck, self.driver_sck = socket.socketpair()
+        self.reader = RingMessageReader(self.felix_sck, self.felix_ring)
+        self.writer = RingMessageWriter(self.driver_sck, self.driver_ring)
+
+    def tearDown(self):
+        self.felix_sck.close()
+        self.driver_sck.close()
+        self.felix_ring.close()
+        self.driver_ring.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def read_all(self):
+        msgs = []
+        for _ in xrange(10):
+            new_msgs = list(self.reader.new_messages(timeout=0.1))
+            if not new_msgs:
+                break
+            msgs.extend(new_msgs)
+        return msgs
+
+    def test_roundtrip(self):
+        self.writer.send_message(MSG_TYPE_STATUS,
+                                 {MSG_KEY_STATUS: STATUS_RESYNC})
+        self.writer.send_message(MSG_TYPE_STATUS,
+                                 {MSG_KEY_STATUS: STATUS_IN_SYNC})
+        self.assertEqual(self.read_all(), [
+            (MSG_TYPE_STATUS, {MSG_KEY_TYPE: MSG_TYPE_STATUS,
+                               MSG_KEY_STATUS: STATUS_RESYNC}),
+            (MSG_TYPE_STATUS, {MSG_KEY_TYPE: MSG_TYPE_STATUS,
+                               MSG_KEY_STATUS: STATUS_IN_SYNC}),
+        ])
+
+    @patch("time.sleep", autospec=True)
+    def test_message_larger_than_ring(self, m_sleep):
+        # The writer should block until the reader frees up space.
+        value = "x" * 200
+
+        def read_some(_):
+            msgs.extend(self.reader.new_messages(timeout=0.1))
+
+        msgs = []
+        m_sleep.side_effect = read_some
+        self.writer.send_message(MSG_TYPE_STATUS, {MSG_KEY_STATUS: value})
+        msgs.extend(self.read_all())
+        self.assertEqual(msgs, [
+            (MSG_TYPE_STATUS, {MSG_KEY_TYPE: MSG_TYPE_STATUS,
+                               MSG_KEY_STATUS: value}),
+        ])
+        self.assertTrue(m_sleep.called)
+
+    @patch("time.sleep", autospec=True)
+    @patch("calico.etcddriver.ringbuffer.monotonic_time", autospec=True)
+    def test_ring_full_timeout(self, m_time, m_sleep):
+        # Felix never reads so the ring buffer stays full.
+        m_time.side_effect = iter([10, 11, 10 + RING_FULL_TIMEOUT])
+        self.assertRaises(WriteFailed, self.writer.send_message,
+                          MSG_TYPE_STATUS, {MSG_KEY_STATUS: "x" * 200})
+        self.assertEqual(len(m_sleep.mock_calls), 2)
+
+    @patch("time.sleep", autospec=True)
+    def test_ring_full_stop_event(self, m_sleep):
+        stop_event = Event()
+        writer = RingMessageWriter(self.driver_sck, self.driver_ring,
+                                   stop_event=stop_event)
+        m_sleep.side_effect = lambda _: stop_event.set()
+        self.assertRaises(WriteFailed, writer.send_message,
+                          MSG_TYPE_STATUS, {MSG_KEY_STATUS: "x" * 200})
+        self.assertEqual(len(m_sleep.mock_calls), 1)
+
+    def test_socket_messages_passed_through(self):
+        # A driver that doesn't support the ring buffer just uses the socket.
+        writer = MessageWriter(self.driver_sck)
+        writer.send_message(MSG_TYPE_STATUS, {MSG_KEY_STATUS: STATUS_RESYNC})
+        self.assertEqual(self.read_all(), [
+            (MSG_TYPE_STATUS, {MSG_KEY_TYPE: MSG_TYPE_STATUS,
+                               MSG_KEY_STATUS: STATUS_RESYNC}),
+        ])
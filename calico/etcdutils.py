@@ -16,8 +16,10 @@ import random
 from collections import namedtuple
 
 import functools
+import inspect
 import json
 import logging
+import operator
 import re
 import etcd
 import os
@@ -50,10 +52,35 @@ DEFAULT_TIMEOUT = 5
 
 
 class PathDispatcher(object):
+    """
+    Dispatches etcd events to the handlers registered for their keys.
+
+    Paths are registered as a tree but, since the tree walk is too slow
+    for the millions of keys in a resync, the tree is compiled into a
+    flat list of routes for each key length.  A route matches a key
+    (split on "/") by comparing the literal segments in one step, using
+    an itemgetter.
+    """
     def __init__(self):
         self.handler_root = {}
+        self._num_registrations = 0
+        # Maps number of key segments to a list of _Route objects; built
+        # lazily from handler_root.
+        self._routes_by_len = None
 
     def register(self, path, on_set=None, on_del=None):
+        """
+        Registers handlers for the keys matching the given path.
+
+        Path segments of the form <name> capture that segment of the key
+        and pass it to the handler as a keyword argument.  If the handler's
+        own arguments (after the response) are named after the captures,
+        in order, the captures are passed positionally, which is faster.
+
+        Routes with the same number of segments are checked in
+        registration order, so the paths of the hottest keys should be
+        registered first.
+        """
         _log.info("Registering path %s set=%s del=%s", path, on_set, on_del)
         parts = path.strip("/").split("/")
         node = self.handler_root
@@ -71,6 +98,10 @@ class PathDispatcher(object):
             node["set"] = on_set
         if on_del:
             node["delete"] = on_del
+        node.setdefault("order", self._num_registrations)
+        self._num_registrations += 1
+        # Recompile on next use.
+        self._routes_by_len = None
 
     def handle_event(self, response):
         """
@@ -79,33 +110,208 @@ class PathDispatcher(object):
                class, which we use when deserialising an event that came over
                the etcd driver socket.
         """
-        _log.debug("etcd event %s for key %s", response.action, response.key)
-        key_parts = response.key.strip("/").split("/")
-        self._handle(key_parts, response, self.handler_root, {})
-
-    def _handle(self, key_parts, response, handler_node, captures):
-        while key_parts:
-            next_part = key_parts.pop(0)
-            if "capture" in handler_node:
-                capture_name, handler_node = handler_node["capture"]
-                captures[capture_name] = next_part
-            elif next_part in handler_node:
-                handler_node = handler_node[next_part]
-            else:
-                _log.debug("No matching sub-handler for %s", response.key)
-                return
-        # We've reached the end of the key.
+        # This is called for every key in a resync so it avoids logging and
+        # intermediate objects.
+        key = response.key
+        if key[:1] != "/" or key[-1:] == "/":
+            key = _normalise_key(key)
+        parts = key.split("/")
+        routes_by_len = self._routes_by_len
+        if routes_by_len is None:
+            routes_by_len = self._compile()
+        for route in routes_by_len.get(len(parts), ()):
+            if route.get_literals(parts) == route.literals:
+                break
+        else:
+            _log.debug("No matching handler for %s", key)
+            return
         action = ACTION_MAPPING.get(response.action)
-        if action in handler_node:
-            _log.debug("Found handler for event %s for %s, captures: %s",
-                       action, response.key, captures)
-            handler_node[action](response, **captures)
+        if action == "set":
+            handler = route.on_set
+            positional = route.on_set_positional
+        elif action == "delete":
+            handler = route.on_del
+            positional = route.on_del_positional
         else:
-            _log.debug("No handler for event %s on %s. Handler node %s.",
-                       action, response.key, handler_node)
+            handler = None
+        if handler is None:
+            _log.debug("No handler for event %s on %s.", response.action,
+                       key)
+        elif positional:
+            handler(response, *route.get_captures(parts))
+        else:
+            handler(response, **route.captures_dict(parts))
 
+    def lookup(self, key, action):
+        """
+        Finds the handler registered for the given key and action.
 
-EtcdEvent = namedtuple("EtcdEvent", ["action", "key", "value"])
+        :param str key: The etcd key.
+        :param str action: The etcd action, as found in an etcd response.
+        :returns: tuple of (handler, captures), where captures is a dict
+                  mapping capture name to the captured part of the key, or
+                  (None, None) if there is no matching handler.
+        """
+        route, parts, handler = self._find_handler(key, action)
+        if handler is None:
+            return None, None
+        return handler, route.captures_dict(parts)
+
+    def lookup_args(self, key, action):
+        """
+        As lookup() but returns the captures as a tuple in the order that
+        they appear in the path, avoiding building a dict.
+
+        :returns: tuple of (handler, captures) or (None, None) if there is
+                  no matching handler.
+        """
+        route, parts, handler = self._find_handler(key, action)
+        if handler is None:
+            return None, None
+        return handler, route.get_captures(parts)
+
+    def _find_handler(self, key, action):
+        """
+        :returns: tuple of (route, key segments, handler).  handler is None
+                  if there is no matching handler.
+        """
+        if key[:1] != "/" or key[-1:] == "/":
+            key = _normalise_key(key)
+        parts = key.split("/")
+        routes_by_len = self._routes_by_len
+        if routes_by_len is None:
+            routes_by_len = self._compile()
+        for route in routes_by_len.get(len(parts), ()):
+            if route.get_literals(parts) == route.literals:
+                break
+        else:
+            _log.debug("No matching handler for %s", key)
+            return None, None, None
+        action = ACTION_MAPPING.get(action)
+        if action == "set":
+            return route, parts, route.on_set
+        elif action == "delete":
+            return route, parts, route.on_del
+        _log.debug("No handler for event %s on %s.", action, key)
+        return None, None, None
+
+    def _compile(self):
+        """
+        Flattens the handler tree into lists of routes indexed by number of
+        key segments.
+
+        Where a node of the tree has a capture, the tree walk always took
+        the capture, hiding any literal children; we skip them too.  That
+        means that at most one route matches any key.
+        """
+        routes = []
+        # Keys start with "/", so the first segment is always empty.
+        stack = [(self.handler_root, [""])]
+        while stack:
+            node, segments = stack.pop()
+            if "order" in node:
+                routes.append(_Route(segments, node.get("set"),
+                                     node.get("delete"), node["order"]))
+            if "capture" in node:
+                name, child = node["capture"]
+                stack.append((child, segments + [(name,)]))
+            else:
+                for part, child in node.iteritems():
+                    if part not in ("set", "delete", "order"):
+                        stack.append((child, segments + [part]))
+        routes.sort(key=lambda r: r.order)
+        routes_by_len = {}
+        for route in routes:
+            routes_by_len.setdefault(route.num_segments, []).append(route)
+        self._routes_by_len = routes_by_len
+        return routes_by_len
+
+
+class _Route(object):
+    """
+    A compiled path from the PathDispatcher's tree.
+    """
+    __slots__ = ["num_segments", "get_literals", "literals",
+                 "get_captures", "capture_names", "on_set", "on_del",
+                 "on_set_positional", "on_del_positional", "order"]
+
+    def __init__(self, segments, on_set, on_del, order):
+        """
+        :param list segments: The segments of the path; literal segments are
+               strings, captures are 1-tuples containing the capture name.
+        """
+        self.num_segments = len(segments)
+        literal_idxs = []
+        literals = []
+        capture_idxs = []
+        capture_names = []
+        for idx, segment in enumerate(segments):
+            if isinstance(segment, tuple):
+                capture_idxs.append(idx)
+                capture_names.append(segment[0])
+            else:
+                literal_idxs.append(idx)
+                literals.append(segment)
+        self.get_literals = _tuple_getter(literal_idxs)
+        self.literals = tuple(literals)
+        self.get_captures = _tuple_getter(capture_idxs)
+        self.capture_names = tuple(capture_names)
+        self.on_set = on_set
+        self.on_del = on_del
+        self.on_set_positional = _takes_captures_positionally(
+            on_set, capture_names)
+        self.on_del_positional = _takes_captures_positionally(
+            on_del, capture_names)
+        self.order = order
+
+    def captures_dict(self, parts):
+        return dict(zip(self.capture_names, self.get_captures(parts)))
+
+
+def _normalise_key(key):
+    """
+    Normalises a key to start with a single "/" and have no trailing "/",
+    matching the tree walk that the compiled routes replaced, which ignored
+    leading and trailing slashes.
+    """
+    return "/" + key.strip("/")
+
+
+def _tuple_getter(idxs):
+    """
+    :returns: a function that extracts the items at the given indexes from a
+              list as a tuple.  Unlike itemgetter, always returns a tuple.
+    """
+    if len(idxs) == 0:
+        return lambda l: ()
+    elif len(idxs) == 1:
+        idx = idxs[0]
+        return lambda l: (l[idx],)
+    else:
+        return operator.itemgetter(*idxs)
+
+
+def _takes_captures_positionally(handler, capture_names):
+    """
+    :returns: True if the handler's arguments after the response are named
+              after the captures, in order.
+    """
+    if handler is None:
+        return False
+    try:
+        arg_names = inspect.getargspec(handler).args
+    except TypeError:
+        # Not a plain function or method, for example a Mock.
+        return False
+    if inspect.ismethod(handler):
+        arg_names = arg_names[1:]
+    return arg_names[1:] == list(capture_names)
+
+
+EtcdEvent = namedtuple("EtcdEvent", ["action", "key", "value", "parsed"])
+# The parsed flag is set if the etcd driver has already decoded and
+# validated the value; it defaults to False.
+EtcdEvent.__new__.__defaults__ = (False,)
 
 
 class EtcdClientOwner(object):
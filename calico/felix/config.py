@@ -23,7 +23,9 @@ Configuration management for Felix.
 
 On instantiation, this module automatically parses the configuration file and
 builds a singleton configuration object. That object may (once) be changed by
-etcd configuration being reported back to it.
+etcd configuration being reported back to it.  After that, parameters in
+HOT_RELOADABLE_PARAMS may be updated when the configuration in etcd changes;
+any other change requires Felix to restart.
 """
 import os
 from numbers import Number
@@ -63,6 +65,32 @@ GLOBAL_ETCD = "Global etcd configuration"
 LOCAL_ETCD = "Host specific etcd configuration"
 DEFAULT_SOURCES = [ENV, FILE, GLOBAL_ETCD, LOCAL_ETCD]
 
+# Parameters that Felix can apply without restarting if they change in etcd.
+# The components that use them must re-read them from the config object
+# rather than caching their values.
+HOT_RELOADABLE_PARAMS = frozenset([
+    "LogSeverityFile",
+    "LogSeveritySys",
+    "LogSeverityScreen",
+    "ReportingIntervalSecs",
+    "ReportingTTLSecs",
+    "EndpointReportingDelaySecs",
+    "EndpointReportingBatchSize",
+    "PeriodicResyncInterval",
+    "IptablesRefreshInterval",
+    "HostInterfacePollInterval",
+    "MaxIpsetSize",
+])
+# Hot-reloadable parameters for which 0 disables a background greenlet.  The
+# greenlets are only started at start of day so changing one of these to or
+# from 0 still requires a restart.
+ZERO_DISABLES_PARAMS = frozenset([
+    "ReportingIntervalSecs",
+    "PeriodicResyncInterval",
+    "IptablesRefreshInterval",
+    "HostInterfacePollInterval",
+])
+
 
 class ConfigException(Exception):
     def __init__(self, message, parameter):
@@ -100,6 +128,7 @@ class ConfigParameter(object):
         self.description = description
         self.name = name
         self.sources = sources
+        self.default = default
         self.value = default
         self.active_source = None
         self.value_is_int = value_is_int
@@ -188,6 +217,11 @@ class Config(object):
         """
         self.parameters = {}
         self.plugins = {}
+        # Kept so that we can pass our configuration to Felix's worker
+        # processes (see calico.felix.workers).
+        self.config_path = config_path
+        self.etcd_host_config = None
+        self.etcd_global_config = None
 
         self.add_parameter("EtcdAddr", "Address and port for etcd",
                            "localhost:4001", sources=[ENV, FILE])
@@ -273,6 +307,11 @@ class Config(object):
         self.add_parameter("EndpointReportingDelaySecs",
                            "Minimum delay between per-endpoint status reports",
                            1, value_is_int=True)
+        self.add_parameter("EndpointReportingBatchSize",
+                           "Maximum number of per-endpoint status reports "
+                           "to write concurrently in each "
+                           "EndpointReportingDelaySecs interval",
+                           10, value_is_int=True)
         self.add_parameter("MaxIpsetSize",
                            "Maximum size of the ipsets that Felix uses to "
                            "represent profile tag memberships.  Should be set "
@@ -295,6 +334,38 @@ class Config(object):
                            "Port on which to export Prometheus metrics from "
                            "the etcd driver process.",
                            9092, value_is_int=True)
+        self.add_parameter("Ipv4WorkerPrometheusMetricsPort",
+                           "Port on which to export Prometheus metrics from "
+                           "the IPv4 worker process.",
+                           9093, value_is_int=True)
+        self.add_parameter("Ipv6WorkerPrometheusMetricsPort",
+                           "Port on which to export Prometheus metrics from "
+                           "the IPv6 worker process.",
+                           9094, value_is_int=True)
+        self.add_parameter("EtcdDriverRingBufferSize",
+                           "Size in bytes of the shared memory ring buffer "
+                           "used to pass updates from the etcd driver to "
+                           "Felix, or 0 to use the socket.",
+                           0, value_is_int=True, sources=[ENV, FILE])
+        self.add_parameter("EtcdDriverParsesValues",
+                           "If true, the etcd driver process decodes and "
+                           "validates values before sending them to Felix.",
+                           False, value_is_bool=True)
+        self.add_parameter("EtcdDriverWatcherQueueSize",
+                           "Maximum number of etcd events that the etcd "
+                           "driver buffers between its watcher and the rest "
+                           "of the driver.",
+                           20000, value_is_int=True)
+        self.add_parameter("EtcdDriverAntiEntropy",
+                           "If true, periodic resyncs check the etcd "
+                           "driver's data against etcd one subtree at a "
+                           "time and only repair what differs.",
+                           False, value_is_bool=True)
+        self.add_parameter("IpVersionWorkerProcesses",
+                           "If true, Felix calculates and programs the IPv4 "
+                           "and IPv6 dataplanes in separate worker "
+                           "processes.",
+                           False, value_is_bool=True, sources=[ENV, FILE])
 
         self.add_parameter("FailsafeInboundHostPorts",
                            "Comma-separated list of numeric TCP ports to open "
@@ -369,7 +440,40 @@ class Config(object):
         :param final: Have we completed (rather than just read env and config
                       file)
         """
+        self._store_and_validate(final=final)
+
+        for plugin in self.plugins.itervalues():
+            # Plugins don't get loaded and registered until we've read config
+            # from the environment and file.   This means that they don't get
+            # passed config until the final time through this function.
+            assert final, "Plugins should only be loaded on the final " \
+                          "config pass"
+            plugin.store_and_validate_config(self)
+
+        # Update logging.
+        common.complete_logging(self.LOGFILE,
+                                self.LOGLEVFILE,
+                                self.LOGLEVSYS,
+                                self.LOGLEVSCR,
+                                gevent_in_use=True)
+
+        if final:
+            # Log configuration - the whole lot of it.
+            for name, parameter in self.parameters.iteritems():
+                log.info("Parameter %s (%s) has value %r read from %s",
+                         name,
+                         parameter.description,
+                         parameter.value,
+                         parameter.active_source)
+
+    def _store_and_validate(self, final=False):
+        """
+        Stores the parameters in the relevant fields in the structure,
+        validates them and calculates the options that depend on them.
 
+        :param final: Have we completed (rather than just read env and config
+                      file)
+        """
         self.HOSTNAME = self.parameters["FelixHostname"].value
         self.ETCD_SCHEME = self.parameters["EtcdScheme"].value
         self.ETCD_ENDPOINTS = self.parameters["EtcdEndpoints"].value
@@ -403,6 +507,8 @@ class Config(object):
             self.parameters["EndpointReportingEnabled"].value
         self.ENDPOINT_REPORT_DELAY = \
             self.parameters["EndpointReportingDelaySecs"].value
+        self.ENDPOINT_REPORT_BATCH_SIZE = \
+            self.parameters["EndpointReportingBatchSize"].value
         self.MAX_IPSET_SIZE = self.parameters["MaxIpsetSize"].value
         self.IPTABLES_GENERATOR_PLUGIN = \
             self.parameters["IptablesGeneratorPlugin"].value
@@ -414,6 +520,20 @@ class Config(object):
             self.parameters["PrometheusMetricsPort"].value
         self.PROM_METRICS_DRIVER_PORT = \
             self.parameters["EtcdDriverPrometheusMetricsPort"].value
+        self.PROM_METRICS_V4_WORKER_PORT = \
+            self.parameters["Ipv4WorkerPrometheusMetricsPort"].value
+        self.PROM_METRICS_V6_WORKER_PORT = \
+            self.parameters["Ipv6WorkerPrometheusMetricsPort"].value
+        self.DRIVER_RING_BUFFER_SIZE = \
+            self.parameters["EtcdDriverRingBufferSize"].value
+        self.DRIVER_PARSES_VALUES = \
+            self.parameters["EtcdDriverParsesValues"].value
+        self.DRIVER_WATCHER_QUEUE_SIZE = \
+            self.parameters["EtcdDriverWatcherQueueSize"].value
+        self.DRIVER_ANTI_ENTROPY = \
+            self.parameters["EtcdDriverAntiEntropy"].value
+        self.IP_VERSION_WORKER_PROCESSES = \
+            self.parameters["IpVersionWorkerProcesses"].value
         self.FAILSAFE_INBOUND_PORTS = \
             self.parameters["FailsafeInboundHostPorts"].value
         self.FAILSAFE_OUTBOUND_PORTS = \
@@ -442,30 +562,6 @@ class Config(object):
         self.IPTABLES_MARK_ACCEPT = "0x%x" % next(set_bits)
         self.IPTABLES_MARK_NEXT_TIER = "0x%x" % next(set_bits)
 
-        for plugin in self.plugins.itervalues():
-            # Plugins don't get loaded and registered until we've read config
-            # from the environment and file.   This means that they don't get
-            # passed config until the final time through this function.
-            assert final, "Plugins should only be loaded on the final " \
-                          "config pass"
-            plugin.store_and_validate_config(self)
-
-        # Update logging.
-        common.complete_logging(self.LOGFILE,
-                                self.LOGLEVFILE,
-                                self.LOGLEVSYS,
-                                self.LOGLEVSCR,
-                                gevent_in_use=True)
-
-        if final:
-            # Log configuration - the whole lot of it.
-            for name, parameter in self.parameters.iteritems():
-                log.info("Parameter %s (%s) has value %r read from %s",
-                         name,
-                         parameter.description,
-                         parameter.value,
-                         parameter.active_source)
-
     def _read_env_vars(self):
         """
         Read all of the variables from the environment.
@@ -525,6 +621,8 @@ class Config(object):
         :raises ConfigException
         """
         log.debug("Configuration reported from etcd")
+        self.etcd_host_config = host_dict.copy()
+        self.etcd_global_config = global_dict.copy()
         for source, cfg_dict in ((LOCAL_ETCD, host_dict),
                                  (GLOBAL_ETCD, global_dict)):
             for name, parameter in self.parameters.iteritems():
@@ -535,6 +633,77 @@ class Config(object):
 
         self._finish_update(final=True)
 
+    def update_etcd_config(self, host_dict, global_dict):
+        """
+        Applies a change to the configuration in etcd, after the initial
+        call to report_etcd_config.
+
+        Parameters that were set from the environment or config file
+        override etcd so they are unaffected.  The change is only applied
+        if every parameter that it changes is hot-reloadable.
+
+        :param host_dict: Dictionary of all the etcd parameters for this
+               host.
+        :param global_dict: Dictionary of all the global etcd parameters.
+        :returns: True if the change was applied (or there was no change to
+                  the parameters), False if Felix must restart to apply it.
+        :raises ConfigException: if a new value is invalid, in which case
+                the previous config remains in place.
+        """
+        updated_params = {}
+        for name, parameter in self.parameters.iteritems():
+            if parameter.active_source not in (None, LOCAL_ETCD, GLOBAL_ETCD):
+                continue
+            new_param = ConfigParameter(
+                name, parameter.description, parameter.default,
+                sources=parameter.sources,
+                value_is_int=parameter.value_is_int,
+                value_is_bool=parameter.value_is_bool,
+                value_is_int_list=parameter.value_is_int_list
+            )
+            for source, cfg_dict in ((LOCAL_ETCD, host_dict),
+                                     (GLOBAL_ETCD, global_dict)):
+                if source in parameter.sources and name in cfg_dict:
+                    new_param.set(cfg_dict[name], source)
+            if new_param.value != parameter.value:
+                updated_params[name] = new_param
+
+        for name, new_param in updated_params.iteritems():
+            old_value = self.parameters[name].value
+            if name not in HOT_RELOADABLE_PARAMS:
+                log.warning("Parameter %s changed from %r to %r, Felix "
+                            "must restart to apply it.",
+                            name, old_value, new_param.value)
+                return False
+            if (name in ZERO_DISABLES_PARAMS and
+                    (old_value == 0) != (new_param.value == 0)):
+                log.warning("Parameter %s changed from %r to %r, Felix must "
+                            "restart to enable/disable the feature.",
+                            name, old_value, new_param.value)
+                return False
+
+        if updated_params:
+            # Only the hot-reloadable parameters have changed so there's no
+            # need to redo the plugin and logging setup that _finish_update()
+            # does at start of day.
+            old_params = self.parameters.copy()
+            self.parameters.update(updated_params)
+            try:
+                self._store_and_validate(final=True)
+            except ConfigException:
+                log.exception("Invalid config update, reverting.")
+                self.parameters = old_params
+                self._store_and_validate(final=True)
+                raise
+            common.update_logging_levels(self.LOGLEVFILE,
+                                         self.LOGLEVSYS,
+                                         self.LOGLEVSCR)
+            for name, new_param in updated_params.iteritems():
+                log.info("Parameter %s updated to %r", name, new_param.value)
+        self.etcd_host_config = host_dict.copy()
+        self.etcd_global_config = global_dict.copy()
+        return True
+
     def _validate_cfg(self, final=True):
         """
         Firewall that the config is not invalid. Called twice, once when
@@ -718,6 +887,11 @@ class Config(object):
             log.warning("Endpoint status delay is negative, defaulting to 1.")
             self.ENDPOINT_REPORT_DELAY = 1
 
+        if self.ENDPOINT_REPORT_BATCH_SIZE <= 0:
+            log.warning("Endpoint status batch size is non-positive, "
+                        "defaulting to 10.")
+            self.ENDPOINT_REPORT_BATCH_SIZE = 10
+
         if self.HOST_IF_POLL_INTERVAL_SECS < 0:
             log.warning("Host interface poll interval is negative, "
                         "defaulting to 10s.")
@@ -746,6 +920,26 @@ class Config(object):
                         "defaulting to 9092")
             self.PROM_METRICS_DRIVER_PORT = 9092
 
+        if not 0 < self.PROM_METRICS_V4_WORKER_PORT < 65536:
+            log.warning("IPv4 worker Prometheus port out-of-range, "
+                        "defaulting to 9093")
+            self.PROM_METRICS_V4_WORKER_PORT = 9093
+
+        if not 0 < self.PROM_METRICS_V6_WORKER_PORT < 65536:
+            log.warning("IPv6 worker Prometheus port out-of-range, "
+                        "defaulting to 9094")
+            self.PROM_METRICS_V6_WORKER_PORT = 9094
+
+        if self.DRIVER_RING_BUFFER_SIZE < 0:
+            log.warning("Etcd driver ring buffer size is negative, "
+                        "defaulting to 0 (disabled).")
+            self.DRIVER_RING_BUFFER_SIZE = 0
+
+        if self.DRIVER_WATCHER_QUEUE_SIZE <= 0:
+            log.warning("Etcd driver watcher queue size must be positive, "
+                        "defaulting to 20000.")
+            self.DRIVER_WATCHER_QUEUE_SIZE = 20000
+
         for name, ports in [
                 ("FailsafeInboundHostPorts", self.FAILSAFE_INBOUND_PORTS),
                 ("FailsafeOutboundHostPorts", self.FAILSAFE_OUTBOUND_PORTS)]:
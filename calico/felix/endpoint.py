@@ -35,7 +35,8 @@ from calico.felix import devices, futils
 from calico.felix.actor import actor_message
 from calico.felix.futils import FailedSystemCall
 from calico.felix.futils import IPV4, IP_TYPE_TO_VERSION
-from calico.felix.labels import LabelValueIndex, LabelInheritanceIndex
+from calico.felix.labels import (LabelValueIndex, LabelInheritanceIndex,
+                                 LabelSetIndex)
 from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
 from calico.felix.profilerules import RulesManager
 from calico.felix.frules import interface_to_chain_suffix
@@ -84,8 +85,10 @@ class EndpointManager(ReferenceManager):
         # increffed.
         self.local_endpoint_ids = set()
 
-        # Index tracking what policy applies to what endpoints.
-        self.policy_index = LabelValueIndex()
+        # Index tracking what policy applies to what endpoints.  Endpoints
+        # with identical labels share a label set, which is only evaluated
+        # once.
+        self.policy_index = LabelSetIndex(LabelValueIndex())
         self.policy_index.on_match_started = self.on_policy_match_started
         self.policy_index.on_match_stopped = self.on_policy_match_stopped
         self._label_inherit_idx = LabelInheritanceIndex(self.policy_index)
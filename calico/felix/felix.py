@@ -37,21 +37,14 @@ from prometheus_client import MetricsHandler
 from calico import common
 from calico.felix import devices
 from calico.felix import futils
-from calico.felix.fiptables import IptablesUpdater
-from calico.felix.dispatch import (HostEndpointDispatchChains,
-                                   WorkloadDispatchChains)
-from calico.felix.profilerules import RulesManager
-from calico.felix.frules import (install_global_rules, load_nf_conntrack,
-                                 HOST_DISPATCH_CHAINS)
+from calico.felix.frules import load_nf_conntrack, HOST_DISPATCH_CHAINS
 from calico.felix.splitter import UpdateSplitter, CleanupManager
 from calico.felix.config import Config
-from calico.felix.futils import IPV4, IPV6
 from calico.felix.devices import InterfaceWatcher
-from calico.felix.endpoint import EndpointManager
-from calico.felix.ipsets import IpsetManager, IpsetActor, HOSTS_IPSET_V4
-from calico.felix.masq import MasqueradeManager
-from calico.felix.fipmanager import FloatingIPManager
+from calico.felix.ipsets import IpsetActor, HOSTS_IPSET_V4
 from calico.felix.fetcd import EtcdAPI
+from calico.felix.pipeline import IpVersionPipeline
+from calico.felix.workers import WorkerProxy
 
 _log = logging.getLogger(__name__)
 
@@ -91,115 +84,54 @@ def _main_greenlet(config):
             stats_server.start()
             monitored_items.append(stats_server)
 
-        v4_filter_updater = IptablesUpdater("filter", ip_version=4,
-                                            config=config)
-        v4_nat_updater = IptablesUpdater("nat", ip_version=4, config=config)
-        v4_ipset_mgr = IpsetManager(IPV4, config)
-        v4_masq_manager = MasqueradeManager(IPV4, v4_nat_updater)
-        v4_rules_manager = RulesManager(config,
-                                        4,
-                                        v4_filter_updater,
-                                        v4_ipset_mgr)
-        v4_ep_dispatch_chains = WorkloadDispatchChains(
-            config, 4, v4_filter_updater)
-        v4_if_dispatch_chains = HostEndpointDispatchChains(
-            config, 4, v4_filter_updater)
-        v4_fip_manager = FloatingIPManager(config, 4, v4_nat_updater)
-        v4_ep_manager = EndpointManager(config,
-                                        IPV4,
-                                        v4_filter_updater,
-                                        v4_ep_dispatch_chains,
-                                        v4_if_dispatch_chains,
-                                        v4_rules_manager,
-                                        v4_fip_manager,
-                                        etcd_api.status_reporter)
-
-        cleanup_updaters = [v4_filter_updater, v4_nat_updater]
-        cleanup_ip_mgrs = [v4_ipset_mgr]
-        managers = [v4_ipset_mgr,
-                    v4_rules_manager,
-                    v4_ep_manager,
-                    v4_masq_manager,
-                    v4_nat_updater]
-
-        actors_to_start = [
-            hosts_ipset_v4,
-
-            v4_filter_updater,
-            v4_nat_updater,
-            v4_ipset_mgr,
-            v4_masq_manager,
-            v4_rules_manager,
-            v4_ep_dispatch_chains,
-            v4_if_dispatch_chains,
-            v4_ep_manager,
-            v4_fip_manager,
-        ]
-
         v6_enabled, ipv6_reason = futils.ipv6_supported()
         if v6_enabled:
-            v6_raw_updater = IptablesUpdater("raw", ip_version=6, config=config)
-            v6_filter_updater = IptablesUpdater("filter", ip_version=6,
-                                                config=config)
-            v6_nat_updater = IptablesUpdater("nat", ip_version=6, config=config)
-            v6_ipset_mgr = IpsetManager(IPV6, config)
-            v6_rules_manager = RulesManager(config,
-                                            6,
-                                            v6_filter_updater,
-                                            v6_ipset_mgr)
-            v6_ep_dispatch_chains = WorkloadDispatchChains(
-                config, 6, v6_filter_updater)
-            v6_if_dispatch_chains = HostEndpointDispatchChains(
-                config, 6, v6_filter_updater)
-            v6_fip_manager = FloatingIPManager(config, 6, v6_nat_updater)
-            v6_ep_manager = EndpointManager(config,
-                                            IPV6,
-                                            v6_filter_updater,
-                                            v6_ep_dispatch_chains,
-                                            v6_if_dispatch_chains,
-                                            v6_rules_manager,
-                                            v6_fip_manager,
-                                            etcd_api.status_reporter)
-            cleanup_updaters.append(v6_filter_updater)
-            cleanup_ip_mgrs.append(v6_ipset_mgr)
-            managers += [v6_ipset_mgr,
-                         v6_rules_manager,
-                         v6_ep_manager,
-                         v6_raw_updater,
-                         v6_nat_updater]
-            actors_to_start += [
-                v6_raw_updater,
-                v6_filter_updater,
-                v6_nat_updater,
-                v6_ipset_mgr,
-                v6_rules_manager,
-                v6_ep_dispatch_chains,
-                v6_if_dispatch_chains,
-                v6_ep_manager,
-                v6_fip_manager,
-            ]
+            ip_versions = [4, 6]
         else:
-            # Keep the linter happy.
             _log.warn("IPv6 support disabled: %s.", ipv6_reason)
-            v6_filter_updater = None
-            v6_nat_updater = None
-            v6_raw_updater = None
-            v6_if_dispatch_chains = None
+            ip_versions = [4]
+
+        managers = []
+        actors_to_start = [hosts_ipset_v4]
+        pipelines = []
+        worker_proxies = []
+        if config.IP_VERSION_WORKER_PROCESSES:
+            # Each IP version's pipeline runs in its own process, behind a
+            # proxy that forwards the updates to it.
+            _log.info("Starting worker processes for IP versions %s.",
+                      ip_versions)
+            for ip_version in ip_versions:
+                proxy = WorkerProxy(config, ip_version,
+                                    etcd_api.status_reporter)
+                worker_proxies.append(proxy)
+                managers.append(proxy)
+                actors_to_start.append(proxy)
+        else:
+            cleanup_updaters = []
+            cleanup_ip_mgrs = []
+            for ip_version in ip_versions:
+                pipeline = IpVersionPipeline(config, ip_version,
+                                             etcd_api.status_reporter)
+                pipelines.append(pipeline)
+                managers += pipeline.managers
+                actors_to_start += pipeline.actors
+                cleanup_updaters += pipeline.cleanup_updaters
+                cleanup_ip_mgrs += pipeline.cleanup_ip_mgrs
+            cleanup_mgr = CleanupManager(config, cleanup_updaters,
+                                         cleanup_ip_mgrs)
+            managers.append(cleanup_mgr)
+            actors_to_start.append(cleanup_mgr)
 
-        cleanup_mgr = CleanupManager(config, cleanup_updaters, cleanup_ip_mgrs)
-        managers.append(cleanup_mgr)
         update_splitter = UpdateSplitter(managers)
         iface_watcher = InterfaceWatcher(update_splitter)
-        actors_to_start += [
-            cleanup_mgr,
-            iface_watcher,
-        ]
+        actors_to_start.append(iface_watcher)
 
         _log.info("Starting actors.")
         for actor in actors_to_start:
             actor.start()
 
         monitored_items += [actor.greenlet for actor in actors_to_start]
+        monitored_items += [proxy.reader_greenlet for proxy in worker_proxies]
 
         # Try to ensure that the nf_conntrack_netlink kernel module is present.
         # This works around an issue[1] where the first call to the "conntrack"
@@ -208,18 +140,11 @@ def _main_greenlet(config):
         load_nf_conntrack()
 
         # Install the global rules before we start polling for updates.
+        # (Worker processes install their own before they read any
+        # updates.)
         _log.info("Installing global rules.")
-        # Dispatch chain needs to make its configuration before we insert the
-        # top-level chains.
-        v4_if_dispatch_chains.configure_iptables(async=False)
-        install_global_rules(config, v4_filter_updater, v4_nat_updater,
-                             ip_version=4)
-        if v6_enabled:
-            # Dispatch chain needs to make its configuration before we insert
-            # the top-level chains.
-            v6_if_dispatch_chains.configure_iptables(async=False)
-            install_global_rules(config, v6_filter_updater, v6_nat_updater,
-                                 ip_version=6, raw_updater=v6_raw_updater)
+        for pipeline in pipelines:
+            pipeline.install_global_rules()
 
         # Start polling for updates. These kicks make the actors poll
         # indefinitely.
@@ -30,15 +30,14 @@ from etcd import EtcdException, EtcdKeyNotFound
 import gevent
 import sys
 from gevent.event import Event
+from prometheus_client import Gauge, Histogram
 
-from calico import common
-from calico.common import ValidationFailed, validate_ip_addr, canonicalise_ip
 from calico.datamodel_v1 import (
-    VERSION_DIR, CONFIG_DIR, dir_for_per_host_config, PROFILE_DIR, HOST_DIR,
+    dir_for_per_host_config,
     WloadEndpointId, key_for_last_status, key_for_status, FELIX_STATUS_DIR,
     get_endpoint_id_from_key, dir_for_felix_status, ENDPOINT_STATUS_ERROR,
     ENDPOINT_STATUS_DOWN, ENDPOINT_STATUS_UP,
-    POLICY_DIR, TieredPolicyId, HostEndpointId, EndpointId)
+    TieredPolicyId, HostEndpointId, EndpointId)
 from calico.etcddriver.protocol import (
     MessageReader, MSG_TYPE_INIT, MSG_TYPE_CONFIG, MSG_TYPE_RESYNC,
     MSG_KEY_ETCD_URLS, MSG_KEY_HOSTNAME, MSG_KEY_LOG_FILE, MSG_KEY_SEV_FILE,
@@ -46,12 +45,24 @@ from calico.etcddriver.protocol import (
     MSG_TYPE_CONFIG_LOADED, MSG_KEY_GLOBAL_CONFIG, MSG_KEY_HOST_CONFIG,
     MSG_TYPE_UPDATE, MSG_KEY_KEY, MSG_KEY_VALUE, MessageWriter,
     MSG_TYPE_STATUS, MSG_KEY_STATUS, MSG_KEY_KEY_FILE, MSG_KEY_CERT_FILE,
-    MSG_KEY_CA_FILE, SocketClosed, MSG_KEY_PROM_PORT)
+    MSG_KEY_CA_FILE, SocketClosed, MSG_KEY_PROM_PORT, MSG_TYPE_UPDATE_BATCH,
+    MSG_KEY_UPDATES, MSG_KEY_PROTOCOL_VERSION, PROTOCOL_VERSION,
+    MSG_KEY_RING_FILE, MSG_KEY_PARSED, MSG_KEY_PARSER_CONFIG,
+    MSG_KEY_IFACE_PREFIX, MSG_KEY_STRIP_REMOTE_ENDPOINTS,
+    MSG_KEY_WATCHER_QUEUE_SIZE, MSG_KEY_FILTER_KEYS, MSG_KEY_ANTI_ENTROPY)
+from calico.etcddriver.ringbuffer import RingBuffer, RingMessageReader
 from calico.etcdutils import (
-    EtcdClientOwner, delete_empty_parents, PathDispatcher, EtcdEvent,
-    safe_decode_json, intern_list
+    EtcdClientOwner, delete_empty_parents, PathDispatcher, EtcdEvent
 )
 from calico.felix.actor import Actor, actor_message
+from calico.felix.config import ConfigException
+from calico.felix.parsing import (
+    TAGS_KEY, RULES_KEY, PROFILE_LABELS_KEY, HOST_IP_KEY, HOST_IFACE_KEY,
+    PER_ENDPOINT_KEY, CONFIG_PARAM_KEY, PER_HOST_CONFIG_PARAM_KEY, TIER_DATA,
+    TIERED_PROFILE, CIDR_V4_KEY, parsed_value, parse_endpoint, parse_host_ep,
+    parse_tier_data, parse_profile, parse_policy, parse_tags, parse_labels,
+    parse_host_ip, parse_ipam_pool
+)
 from calico.felix.futils import (
     logging_exceptions, iso_utc_timestamp, IPV4,
     IPV6, StatCounter
@@ -63,31 +74,6 @@ _log = logging.getLogger(__name__)
 
 RETRY_DELAY = 5
 
-# Etcd paths that we care about for use with the PathDispatcher class.
-# We use angle-brackets to name parameters that we want to capture.
-PER_PROFILE_DIR = PROFILE_DIR + "/<profile_id>"
-TAGS_KEY = PER_PROFILE_DIR + "/tags"
-RULES_KEY = PER_PROFILE_DIR + "/rules"
-PROFILE_LABELS_KEY = PER_PROFILE_DIR + "/labels"
-PER_HOST_DIR = HOST_DIR + "/<hostname>"
-HOST_IP_KEY = PER_HOST_DIR + "/bird_ip"
-WORKLOAD_DIR = PER_HOST_DIR + "/workload"
-HOST_IFACE_DIR = PER_HOST_DIR + "/endpoint"
-HOST_IFACE_KEY = PER_HOST_DIR + "/endpoint/<endpoint_id>"
-PER_ORCH_DIR = WORKLOAD_DIR + "/<orchestrator>"
-PER_WORKLOAD_DIR = PER_ORCH_DIR + "/<workload_id>"
-ENDPOINT_DIR = PER_WORKLOAD_DIR + "/endpoint"
-PER_ENDPOINT_KEY = ENDPOINT_DIR + "/<endpoint_id>"
-CONFIG_PARAM_KEY = CONFIG_DIR + "/<config_param>"
-PER_HOST_CONFIG_PARAM_KEY = PER_HOST_DIR + "/config/<config_param>"
-TIER_DATA = POLICY_DIR + "/tier/<tier>/metadata"
-TIERED_PROFILE = POLICY_DIR + "/tier/<tier>/policy/<policy_id>"
-
-IPAM_DIR = VERSION_DIR + "/ipam"
-IPAM_V4_DIR = IPAM_DIR + "/v4"
-POOL_V4_DIR = IPAM_V4_DIR + "/pool"
-CIDR_V4_KEY = POOL_V4_DIR + "/<pool_id>"
-
 # Max number of events from driver process before we yield to another greenlet.
 MAX_EVENTS_BEFORE_YIELD = 200
 
@@ -95,6 +81,13 @@ MAX_EVENTS_BEFORE_YIELD = 200
 # Global diagnostic counters.
 _stats = StatCounter("Etcd counters")
 
+STATUS_QUEUE_DEPTH = Gauge("felix_endpoint_status_queue_depth",
+                           "Number of endpoints whose status is waiting to "
+                           "be written to etcd.")
+STATUS_WRITE_TIME = Histogram("felix_endpoint_status_write_time",
+                              "Time taken by each endpoint status write to "
+                              "etcd.")
+
 
 class EtcdAPI(EtcdClientOwner, Actor):
     """
@@ -167,6 +160,8 @@ class EtcdAPI(EtcdClientOwner, Actor):
             _log.info("Interval is 0, periodic resync disabled.")
             return
         while True:
+            # Re-read the interval, which may be changed by a config update.
+            interval = self._config.RESYNC_INTERVAL
             # Jitter by 20% of interval.
             jitter = random.random() * 0.2 * interval
             sleep_time = interval + jitter
@@ -174,7 +169,9 @@ class EtcdAPI(EtcdClientOwner, Actor):
                        "seconds.", sleep_time)
             gevent.sleep(sleep_time)
             _stats.increment("Periodic resync")
-            self.force_resync(reason="periodic resync", async=True)
+            self.force_resync(reason="periodic resync",
+                              full=not self._config.DRIVER_ANTI_ENTROPY,
+                              async=True)
 
     @logging_exceptions
     def _periodically_report_status(self):
@@ -194,6 +191,9 @@ class EtcdAPI(EtcdClientOwner, Actor):
             return
 
         while True:
+            # Re-read the config, which may be changed by a config update.
+            ttl = self._config.REPORTING_TTL_SECS
+            interval = self._config.REPORTING_INTERVAL_SECS
             try:
                 self._update_felix_status(ttl)
             except EtcdException as e:
@@ -258,14 +258,20 @@ class EtcdAPI(EtcdClientOwner, Actor):
         self._watcher.begin_polling.set()
 
     @actor_message()
-    def force_resync(self, reason="unknown"):
+    def force_resync(self, reason="unknown", full=True):
         """
         Force a resync with etcd after the current poll completes.
 
         :param str reason: Optional reason to log out.
+        :param bool full: False to let the driver check its data against
+               etcd and only repair what differs, rather than re-reading
+               the whole snapshot.
         """
         _log.info("Forcing a resync with etcd.  Reason: %s.", reason)
-        self._watcher.resync_requested = True
+        if full:
+            self._watcher.resync_requested = True
+        else:
+            self._watcher.anti_entropy_requested = True
 
         if self._config.REPORT_ENDPOINT_STATUS:
             _log.info("Endpoint status reporting enabled, marking existing "
@@ -325,6 +331,9 @@ class _FelixEtcdWatcher(gevent.Greenlet):
         # another thread.  Automatically reset to False after the resync is
         # triggered.
         self.resync_requested = False
+        # As resync_requested but asks the driver for an anti-entropy check
+        # rather than a full resync.
+        self.anti_entropy_requested = False
         self.dispatcher = PathDispatcher()
         # The Popen object for the driver.
         self._driver_process = None
@@ -338,6 +347,9 @@ class _FelixEtcdWatcher(gevent.Greenlet):
     def _register_paths(self):
         """
         Program the dispatcher with the paths we care about.
+
+        The etcd driver skips other keys; calico.felix.parsing.KeyFilter
+        must be kept in sync with this method.
         """
         reg = self.dispatcher.register
         # Profiles and their contents.
@@ -400,6 +412,12 @@ class _FelixEtcdWatcher(gevent.Greenlet):
                 _log.info("Resync requested, sending resync request to driver")
                 self.resync_requested = False
                 self._msg_writer.send_message(MSG_TYPE_RESYNC)
+            elif self.anti_entropy_requested:
+                _log.info("Anti-entropy check requested, sending request to "
+                          "driver")
+                self.anti_entropy_requested = False
+                self._msg_writer.send_message(MSG_TYPE_RESYNC,
+                                              {MSG_KEY_ANTI_ENTROPY: True})
             # Check that the driver hasn't died.  The recv() call should
             # raise an exception when the buffer runs dry but this usually
             # gets hit first.
@@ -412,7 +430,12 @@ class _FelixEtcdWatcher(gevent.Greenlet):
     def _dispatch_msg_from_driver(self, msg_type, msg):
         # Optimization: put update first in the "switch" block because
         # it's on the critical path.
-        if msg_type == MSG_TYPE_UPDATE:
+        if msg_type == MSG_TYPE_UPDATE_BATCH:
+            _stats.increment("Update batch messages from driver")
+            self._on_update_batch_from_driver(msg)
+            # Yielding is handled per-update.
+            return
+        elif msg_type == MSG_TYPE_UPDATE:
             _stats.increment("Update messages from driver")
             self._on_update_from_driver(msg)
         elif msg_type == MSG_TYPE_CONFIG_LOADED:
@@ -423,6 +446,9 @@ class _FelixEtcdWatcher(gevent.Greenlet):
             self._on_status_from_driver(msg)
         else:
             raise RuntimeError("Unexpected message %s" % msg)
+        self._maybe_yield()
+
+    def _maybe_yield(self):
         self.msgs_processed += 1
         if self.msgs_processed % MAX_EVENTS_BEFORE_YIELD == 0:
             # Yield to ensure that other actors make progress.  (gevent only
@@ -441,13 +467,34 @@ class _FelixEtcdWatcher(gevent.Greenlet):
 
         :param dict msg: The message received from the driver.
         """
+        self._on_key_updated(msg[MSG_KEY_KEY], msg[MSG_KEY_VALUE],
+                             msg.get(MSG_KEY_PARSED, False))
+
+    def _on_update_batch_from_driver(self, msg):
+        """
+        Called when the driver sends us a batch of key/value pair updates.
+
+        :param dict msg: The message received from the driver.
+        """
+        for update in msg[MSG_KEY_UPDATES]:
+            # Each update is a [key, value] pair, or a [key, value, parsed]
+            # triple if the driver parsed the value.
+            self._on_key_updated(*update)
+            self._maybe_yield()
+
+    def _on_key_updated(self, key, value, parsed=False):
+        """
+        Dispatches a single key/value update from the driver.
+
+        :param str key: The etcd key.
+        :param value: The new value or None for a deletion.
+        :param parsed: True if the driver has already decoded and validated
+               the value.
+        """
         assert self.configured.is_set(), "Received update before config"
         # The driver starts polling immediately, make sure we block until
         # everyone else is ready to receive updates.
         self.begin_polling.wait()
-        # Unpack the message.
-        key = msg[MSG_KEY_KEY]
-        value = msg[MSG_KEY_VALUE]
         _log.debug("Update from driver: %s -> %s", key, value)
         # Output some very coarse stats.
         self.read_count += 1
@@ -459,7 +506,13 @@ class _FelixEtcdWatcher(gevent.Greenlet):
             self.last_rate_log_time = now
         # Wrap the update in an EtcdEvent object so we can dispatch it via the
         # PathDispatcher.
-        n = EtcdEvent("set" if value is not None else "delete", key, value)
+        if parsed:
+            # A parsed value of None means that validation failed, which the
+            # handlers treat like a set of an invalid value.
+            n = EtcdEvent("set", key, value, parsed=True)
+        else:
+            n = EtcdEvent("set" if value is not None else "delete", key,
+                          value)
         self.dispatcher.handle_event(n)
 
     def _on_config_loaded_from_driver(self, msg):
@@ -472,8 +525,9 @@ class _FelixEtcdWatcher(gevent.Greenlet):
         On the first call, responds to the driver synchronously with a
         config response.
 
-        If the config has changed since a previous call, triggers Felix
-        to die.
+        If the config has changed since a previous call, applies the
+        change, or triggers Felix to die if the change can't be applied
+        without a restart.
         """
         global_config = msg[MSG_KEY_GLOBAL_CONFIG]
         host_config = msg[MSG_KEY_HOST_CONFIG]
@@ -482,20 +536,12 @@ class _FelixEtcdWatcher(gevent.Greenlet):
                   global_config,
                   host_config)
         if self.configured.is_set():
-            # We've already been configured.  We don't yet support
-            # dynamic config update so instead we check if the config
-            # has changed and die if it has.
+            # We've already been configured, check if the config has
+            # changed.
             _log.info("Checking configuration for changes...")
             if (host_config != self.last_host_config or
                     global_config != self.last_global_config):
-                _log.warning("Felix configuration has changed, "
-                             "felix must restart.")
-                _log.info("Old host config: %s", self.last_host_config)
-                _log.info("New host config: %s", host_config)
-                _log.info("Old global config: %s",
-                          self.last_global_config)
-                _log.info("New global config: %s", global_config)
-                die_and_restart()
+                self._apply_config_update(host_config, global_config)
         else:
             # First time loading the config.  Report it to the config
             # object.  Take copies because report_etcd_config is
@@ -506,18 +552,32 @@ class _FelixEtcdWatcher(gevent.Greenlet):
                                             global_config)
             # Config now fully resolved, inform the driver.
             driver_log_file = self._config.DRIVERLOGFILE
-            self._msg_writer.send_message(
-                MSG_TYPE_CONFIG,
-                {
-                    MSG_KEY_LOG_FILE: driver_log_file,
-                    MSG_KEY_SEV_FILE: self._config.LOGLEVFILE,
-                    MSG_KEY_SEV_SCREEN: self._config.LOGLEVSCR,
-                    MSG_KEY_SEV_SYSLOG: self._config.LOGLEVSYS,
-                    MSG_KEY_PROM_PORT:
-                        self._config.PROM_METRICS_DRIVER_PORT if
-                        self._config.PROM_METRICS_ENABLED else None
+            config_msg = {
+                MSG_KEY_LOG_FILE: driver_log_file,
+                MSG_KEY_SEV_FILE: self._config.LOGLEVFILE,
+                MSG_KEY_SEV_SCREEN: self._config.LOGLEVSCR,
+                MSG_KEY_SEV_SYSLOG: self._config.LOGLEVSYS,
+                MSG_KEY_PROM_PORT:
+                    self._config.PROM_METRICS_DRIVER_PORT if
+                    self._config.PROM_METRICS_ENABLED else None,
+                MSG_KEY_WATCHER_QUEUE_SIZE:
+                    self._config.DRIVER_WATCHER_QUEUE_SIZE,
+                # Ask the driver to skip keys that we don't register for
+                # in _register_paths().
+                MSG_KEY_FILTER_KEYS: True,
+                MSG_KEY_ANTI_ENTROPY: self._config.DRIVER_ANTI_ENTROPY,
+            }
+            if self._config.DRIVER_PARSES_VALUES:
+                # Ask the driver to decode and validate values for us.  An
+                # older driver ignores this and sends raw values, which we
+                # still handle.  Only the IpsetManager looks at endpoints
+                # on other hosts so the driver can strip those down to the
+                # fields that it uses.
+                config_msg[MSG_KEY_PARSER_CONFIG] = {
+                    MSG_KEY_IFACE_PREFIX: self._config.IFACE_PREFIX,
+                    MSG_KEY_STRIP_REMOTE_ENDPOINTS: True,
                 }
-            )
+            self._msg_writer.send_message(MSG_TYPE_CONFIG, config_msg)
             self.configured.set()
 
     def _on_status_from_driver(self, msg):
@@ -563,15 +623,26 @@ class _FelixEtcdWatcher(gevent.Greenlet):
         _log.info("Creating server socket.")
         if os.path.exists("/run"):
             # Linux FHS version 3.0+ location for runtime sockets etc.
-            sck_filename = "/run/felix-driver.sck"
+            run_dir = "/run"
         else:
             # Older Linux versions use /var/run.
-            sck_filename = "/var/run/felix-driver.sck"
+            run_dir = "/var/run"
+        sck_filename = run_dir + "/felix-driver.sck"
         try:
             os.unlink(sck_filename)
         except OSError:
             _log.debug("Failed to delete driver socket, assuming it "
                        "didn't exist.")
+        ring = None
+        ring_filename = None
+        if self._config.DRIVER_RING_BUFFER_SIZE:
+            # Optional shared memory transport for messages from the driver.
+            # The driver removes the file once it has mapped it.
+            ring_filename = run_dir + "/felix-driver.ring"
+            _log.info("Creating %s byte ring buffer at %s",
+                      self._config.DRIVER_RING_BUFFER_SIZE, ring_filename)
+            ring = RingBuffer.create(ring_filename,
+                                     self._config.DRIVER_RING_BUFFER_SIZE)
         update_socket = socket.socket(socket.AF_UNIX,
                                       socket.SOCK_STREAM)
         update_socket.bind(sck_filename)
@@ -603,7 +674,10 @@ class _FelixEtcdWatcher(gevent.Greenlet):
 
         # Wrap the socket in reader/writer objects that simplify using the
         # protocol.
-        reader = MessageReader(update_conn)
+        if ring is not None:
+            reader = RingMessageReader(update_conn, ring)
+        else:
+            reader = MessageReader(update_conn)
         writer = MessageWriter(update_conn)
         # Give the driver its config.
         writer.send_message(
@@ -615,6 +689,8 @@ class _FelixEtcdWatcher(gevent.Greenlet):
                 MSG_KEY_KEY_FILE: self._config.ETCD_KEY_FILE,
                 MSG_KEY_CERT_FILE: self._config.ETCD_CERT_FILE,
                 MSG_KEY_CA_FILE: self._config.ETCD_CA_FILE,
+                MSG_KEY_PROTOCOL_VERSION: PROTOCOL_VERSION,
+                MSG_KEY_RING_FILE: ring_filename,
             }
         )
         return reader, writer
@@ -626,7 +702,8 @@ class _FelixEtcdWatcher(gevent.Greenlet):
                                       endpoint_id)
         _log.debug("Endpoint %s updated", combined_id)
         _stats.increment("Endpoint created/updated")
-        endpoint = parse_endpoint(self._config, combined_id, response.value)
+        endpoint = parsed_value(response, parse_endpoint, self._config,
+                                combined_id)
         self.splitter.on_endpoint_update(combined_id, endpoint)
 
     def on_endpoint_delete(self, response, hostname, orchestrator,
@@ -643,7 +720,8 @@ class _FelixEtcdWatcher(gevent.Greenlet):
         combined_id = HostEndpointId(hostname, endpoint_id)
         _log.debug("Host iface %s updated", combined_id)
         _stats.increment("Host iface created/updated")
-        iface_data = parse_host_ep(self._config, combined_id, response.value)
+        iface_data = parsed_value(response, parse_host_ep, self._config,
+                                  combined_id)
         self.splitter.on_host_ep_update(combined_id, iface_data)
 
     def on_host_ep_delete(self, response, hostname, endpoint_id):
@@ -657,7 +735,7 @@ class _FelixEtcdWatcher(gevent.Greenlet):
         """Handler for rules updates, passes the update to the splitter."""
         _log.debug("Rules for %s set", profile_id)
         _stats.increment("Rules created/updated")
-        rules = parse_profile(profile_id, response.value)
+        rules = parsed_value(response, parse_profile, profile_id)
         profile_id = intern(profile_id.encode("utf8"))
         self.splitter.on_rules_update(profile_id, rules)
 
@@ -671,7 +749,7 @@ class _FelixEtcdWatcher(gevent.Greenlet):
         """Handler for tags updates, passes the update to the splitter."""
         _log.debug("Tags for %s set", profile_id)
         _stats.increment("Tags created/updated")
-        rules = parse_tags(profile_id, response.value)
+        rules = parsed_value(response, parse_tags, profile_id)
         profile_id = intern(profile_id.encode("utf8"))
         self.splitter.on_tags_update(profile_id, rules)
 
@@ -684,7 +762,7 @@ class _FelixEtcdWatcher(gevent.Greenlet):
     def on_prof_labels_set(self, response, profile_id):
         """Handler for profile labels, passes update to the splitter."""
         _log.debug("Labels for profile %s created/updated", profile_id)
-        labels = parse_labels(profile_id, response.value)
+        labels = parsed_value(response, parse_labels, profile_id)
         profile_id = intern(profile_id.encode("utf8"))
         self.splitter.on_prof_labels_set(profile_id, labels)
 
@@ -699,7 +777,7 @@ class _FelixEtcdWatcher(gevent.Greenlet):
     def on_tier_data_set(self, response, tier):
         _log.debug("Tier data set for tier %s", tier)
         _stats.increment("Tier data created/updated")
-        data = parse_tier_data(tier, response.value)
+        data = parsed_value(response, parse_tier_data, tier)
         self.splitter.on_tier_data_update(tier, data)
 
     def on_tier_data_delete(self, response, tier):
@@ -711,7 +789,7 @@ class _FelixEtcdWatcher(gevent.Greenlet):
         _log.debug("Rules for %s/%s set", tier, policy_id)
         _stats.increment("Tiered rules created/updated")
         policy_id = TieredPolicyId(tier, policy_id)
-        rules = parse_policy(policy_id, response.value)
+        rules = parsed_value(response, parse_policy, policy_id)
         if rules is not None:
             selector = rules.pop("selector")
             order = rules.pop("order")
@@ -766,9 +844,10 @@ class _FelixEtcdWatcher(gevent.Greenlet):
     def _on_config_updated(self, response, config_param):
         new_value = response.value
         if self.last_global_config.get(config_param) != new_value:
-            _log.critical("Global config value %s updated.  Felix must be "
-                          "restarted.", config_param)
-            die_and_restart()
+            _log.info("Global config value %s updated.", config_param)
+            global_config = _updated_config(self.last_global_config,
+                                            config_param, new_value)
+            self._apply_config_update(self.last_host_config, global_config)
         _stats.increment("Global config (non) updates")
 
     def _on_host_config_updated(self, response, hostname, config_param):
@@ -778,13 +857,41 @@ class _FelixEtcdWatcher(gevent.Greenlet):
         _stats.increment("Per-host config created/updated")
         new_value = response.value
         if self.last_host_config.get(config_param) != new_value:
-            _log.critical("Global config value %s updated.  Felix must be "
-                          "restarted.", config_param)
+            _log.info("Per-host config value %s updated.", config_param)
+            host_config = _updated_config(self.last_host_config,
+                                          config_param, new_value)
+            self._apply_config_update(host_config, self.last_global_config)
+
+    def _apply_config_update(self, host_config, global_config):
+        """
+        Applies a change to the config in etcd, if possible without a
+        restart.  Otherwise, triggers Felix to die.
+        """
+        _log.info("Old host config: %s", self.last_host_config)
+        _log.info("New host config: %s", host_config)
+        _log.info("Old global config: %s", self.last_global_config)
+        _log.info("New global config: %s", global_config)
+        try:
+            applied = self._config.update_etcd_config(host_config,
+                                                      global_config)
+        except ConfigException:
+            _log.exception("Invalid config update.")
+            applied = False
+        if not applied:
+            _log.critical("Felix configuration has changed, Felix must "
+                          "restart.")
             die_and_restart()
+            return
+        _log.info("Applied config update without restarting.")
+        _stats.increment("Config updates applied")
+        self.last_host_config = host_config
+        self.last_global_config = global_config
+        if self.splitter is not None:
+            self.splitter.on_config_updated()
 
     def on_ipam_v4_pool_set(self, response, pool_id):
         _stats.increment("IPAM pool created/updated")
-        pool = parse_ipam_pool(pool_id, response.value)
+        pool = parsed_value(response, parse_ipam_pool, pool_id)
         self.splitter.on_ipam_pool_updated(pool_id, pool)
 
     def on_ipam_v4_pool_delete(self, response, pool_id):
@@ -796,6 +903,11 @@ class EtcdStatusReporter(EtcdClientOwner, Actor):
     """
     Actor that manages and rate-limits the queue of status reports to
     etcd.
+
+    Rate limiting uses a token bucket that is refilled to
+    EndpointReportingBatchSize tokens every EndpointReportingDelaySecs.
+    Each write uses up a token; the writes for a batch are issued
+    concurrently and share the etcd client's connection pool.
     """
 
     def __init__(self, config):
@@ -816,9 +928,19 @@ class EtcdStatusReporter(EtcdClientOwner, Actor):
         self._newer_dirty_endpoints = set()
         self._older_dirty_endpoints = set()
 
+        # Cache of the statuses that we believe are in etcd, used to skip
+        # writes that wouldn't change anything.  Seeded from the read that
+        # _attempt_cleanup() does.  Until that read has succeeded, we don't
+        # know which workload endpoint statuses are absent from etcd so we
+        # always do deletes.  Since that read only covers workload
+        # endpoints, we always do deletes for host endpoints.
+        self._statuses_in_etcd = {}
+        self._statuses_in_etcd_known = False
+        self._status_refresh_pending = False
+
         self._cleanup_pending = False
         self._timer_scheduled = False
-        self._reporting_allowed = True
+        self._write_tokens = config.ENDPOINT_REPORT_BATCH_SIZE
 
     @actor_message()
     def on_endpoint_status_changed(self, endpoint_id, ip_type, status):
@@ -834,8 +956,15 @@ class EtcdStatusReporter(EtcdClientOwner, Actor):
     @actor_message()
     def resync(self):
         """
-        Triggers a rewrite of all endpoint statuses.
+        Triggers a rewrite of all endpoint statuses that differ from those
+        in etcd.
         """
+        # Our cache may be out of date if someone else has modified the
+        # statuses in etcd.  Discard it and re-read etcd before we write.
+        # Until the read succeeds, all the statuses will be rewritten.
+        self._statuses_in_etcd.clear()
+        self._statuses_in_etcd_known = False
+        self._status_refresh_pending = True
         # Loop over IPv4 and IPv6 statuses.
         for statuses in self._endpoint_status.itervalues():
             for ep_id in statuses.iterkeys():
@@ -843,9 +972,9 @@ class EtcdStatusReporter(EtcdClientOwner, Actor):
 
     @actor_message()
     def _on_timer_pop(self):
-        _log.debug("Timer popped, uncorking rate limit")
+        _log.debug("Timer popped, refilling rate limit tokens")
         self._timer_scheduled = False
-        self._reporting_allowed = True
+        self._write_tokens = self._config.ENDPOINT_REPORT_BATCH_SIZE
 
     def _mark_endpoint_dirty(self, endpoint_id):
         assert isinstance(endpoint_id, EndpointId)
@@ -886,34 +1015,28 @@ class EtcdStatusReporter(EtcdClientOwner, Actor):
             else:
                 _stats.increment("Status report cleanup done")
                 self._cleanup_pending = False
-
-        if self._reporting_allowed:
-            # We're not rate limited, go ahead and do a write to etcd.
-            _log.debug("Status reporting is allowed by rate limit.")
-            if not self._older_dirty_endpoints and self._newer_dirty_endpoints:
-                _log.debug("_older_dirty_endpoints empty, promoting"
-                           "_newer_dirty_endpoints")
-                self._older_dirty_endpoints = self._newer_dirty_endpoints
-                self._newer_dirty_endpoints = set()
-            if self._older_dirty_endpoints:
-                ep_id = self._older_dirty_endpoints.pop()
-                status_v4 = self._endpoint_status[IPV4].get(ep_id)
-                status_v6 = self._endpoint_status[IPV6].get(ep_id)
-                status = combine_statuses(status_v4, status_v6)
-                try:
-                    self._write_endpoint_status_to_etcd(ep_id, status)
-                except EtcdException:
-                    _log.exception("Failed to report status for %s, will "
-                                   "retry", ep_id)
-                    # Add it into the next dirty set.  Retrying in the next
-                    # batch ensures that we try to update all of the dirty
-                    # endpoints before we do any retries, ensuring fairness.
-                    self._newer_dirty_endpoints.add(ep_id)
-                # Reset the rate limit flag.
-                self._reporting_allowed = False
-
-        if not self._timer_scheduled and ((not self._reporting_allowed) or
-                                          self._cleanup_pending):
+                self._status_refresh_pending = False
+        elif self._status_refresh_pending:
+            try:
+                self._attempt_cleanup(clean_up=False)
+            except EtcdException as e:
+                _log.error("Failed to read endpoint statuses: %r", e)
+            else:
+                self._status_refresh_pending = False
+
+        if self._write_tokens > 0:
+            # We're not rate limited, go ahead and do some writes to etcd.
+            _log.debug("Status reporting is allowed by rate limit, %s tokens "
+                       "available.", self._write_tokens)
+            self._write_dirty_endpoints()
+        STATUS_QUEUE_DEPTH.set(len(self._older_dirty_endpoints) +
+                               len(self._newer_dirty_endpoints))
+
+        tokens_used = (self._write_tokens <
+                       self._config.ENDPOINT_REPORT_BATCH_SIZE)
+        if not self._timer_scheduled and (tokens_used or
+                                          self._cleanup_pending or
+                                          self._status_refresh_pending):
             # Schedule a timer to stop our rate limiting or retry cleanup.
             timeout = self._config.ENDPOINT_REPORT_DELAY
             timeout *= (0.9 + (random.random() * 0.2))  # Jitter by +/- 10%.
@@ -922,7 +1045,104 @@ class EtcdStatusReporter(EtcdClientOwner, Actor):
                                async=True)
             self._timer_scheduled = True
 
-    def _attempt_cleanup(self):
+    def _write_dirty_endpoints(self):
+        """
+        Takes as many dirty endpoints as we have tokens for and writes
+        their statuses to etcd concurrently.  Endpoints whose status already
+        matches etcd are skipped without using up a token.
+        """
+        batch = []
+        while self._write_tokens > 0:
+            if not self._older_dirty_endpoints:
+                if not self._newer_dirty_endpoints:
+                    break
+                _log.debug("_older_dirty_endpoints empty, promoting "
+                           "_newer_dirty_endpoints")
+                self._older_dirty_endpoints = self._newer_dirty_endpoints
+                self._newer_dirty_endpoints = set()
+            ep_id = self._older_dirty_endpoints.pop()
+            status_v4 = self._endpoint_status[IPV4].get(ep_id)
+            status_v6 = self._endpoint_status[IPV6].get(ep_id)
+            status = combine_statuses(status_v4, status_v6)
+            if self._status_in_etcd_matches(ep_id, status):
+                _log.debug("Status of %s already up to date in etcd",
+                           ep_id)
+                _stats.increment("Per-port status report writes skipped")
+                continue
+            batch.append((ep_id, status))
+            self._write_tokens -= 1
+        if not batch:
+            return
+
+        _log.debug("Writing statuses for %s endpoints", len(batch))
+        greenlets = []
+        for ep_id, status in batch:
+            greenlets.append(gevent.spawn(self._write_endpoint_status,
+                                          ep_id, status))
+        gevent.joinall(greenlets)
+
+        for (ep_id, status), glet in zip(batch, greenlets):
+            if not glet.successful():
+                # Unexpected error, propagate it as if we'd done the write
+                # ourselves.
+                raise glet.exception
+            if glet.value:
+                if status:
+                    self._statuses_in_etcd[ep_id] = status
+                else:
+                    self._statuses_in_etcd.pop(ep_id, None)
+            else:
+                # We no longer know what's in etcd for this endpoint.
+                self._statuses_in_etcd.pop(ep_id, None)
+                # Add it into the next dirty set.  Since the batch is
+                # complete, it can't be promoted until all of the
+                # endpoints that are already dirty have been tried, ensuring
+                # fairness.
+                self._newer_dirty_endpoints.add(ep_id)
+
+    def _status_in_etcd_matches(self, ep_id, status):
+        """
+        :returns: True if our cache says that etcd already holds the given
+                  status for the endpoint (or that the endpoint has no status
+                  in etcd, if status is None).
+        """
+        if ep_id in self._statuses_in_etcd:
+            return self._statuses_in_etcd[ep_id] == status
+        # Not in the cache.  If we've read the statuses from etcd then that
+        # means there's no status in etcd.  We only read the workload
+        # endpoint statuses so we know nothing about absent host endpoint
+        # statuses.
+        return (not status and
+                self._statuses_in_etcd_known and
+                isinstance(ep_id, WloadEndpointId))
+
+    def _write_endpoint_status(self, ep_id, status):
+        """
+        Runs in its own greenlet to write a single endpoint's status.
+
+        :returns: True on success, False if the write failed and should be
+                  retried.
+        """
+        start_time = monotonic_time()
+        try:
+            self._write_endpoint_status_to_etcd(ep_id, status)
+        except EtcdException:
+            _log.exception("Failed to report status for %s, will retry",
+                           ep_id)
+            return False
+        finally:
+            STATUS_WRITE_TIME.observe(monotonic_time() - start_time)
+        return True
+
+    def _attempt_cleanup(self, clean_up=True):
+        """
+        Reads all our endpoint statuses from etcd, loading them into our
+        cache of the statuses in etcd.
+
+        :param bool clean_up: True to also mark the endpoints that we find
+               dirty (so that unknown ones get deleted) and to remove empty
+               directories.
+        """
         our_host_dir = "/".join([FELIX_STATUS_DIR, self._config.HOSTNAME,
                                  "workload"])
         try:
@@ -931,23 +1151,36 @@ class EtcdStatusReporter(EtcdClientOwner, Actor):
                                         recursive=True)
         except EtcdKeyNotFound:
             _log.info("No endpoint statuses found, nothing to clean up")
+            self._statuses_in_etcd = {}
         else:
-            # Mark all statuses we find as dirty.  This will result in any
-            # unknown endpoints being cleaned up.
+            # If cleaning up, mark all statuses we find as dirty.  This will
+            # result in any unknown endpoints being cleaned up.
+            self._statuses_in_etcd = {}
             for node in response.leaves:
                 combined_id = get_endpoint_id_from_key(node.key)
                 if combined_id:
-                    _log.debug("Endpoint %s removed by resync, marking "
-                               "status key for cleanup",
-                               combined_id)
-                    self._mark_endpoint_dirty(combined_id)
-                elif node.dir:
+                    if clean_up:
+                        _log.debug("Endpoint %s removed by resync, marking "
+                                   "status key for cleanup",
+                                   combined_id)
+                        self._mark_endpoint_dirty(combined_id)
+                    try:
+                        status = json.loads(node.value)
+                    except (TypeError, ValueError):
+                        # Leave it out of the cache so that it'll be
+                        # overwritten.
+                        _log.warning("Invalid status in etcd for %s: %r",
+                                     combined_id, node.value)
+                    else:
+                        self._statuses_in_etcd[combined_id] = status
+                elif node.dir and clean_up:
                     # This leaf is an empty directory, try to clean it up.
                     # This is safe even if another thread is adding keys back
                     # into the directory.
                     _log.debug("Found empty directory %s, cleaning up",
                                node.key)
                     delete_empty_parents(self.client, node.key, our_host_dir)
+        self._statuses_in_etcd_known = True
 
     def _write_endpoint_status_to_etcd(self, ep_id, status):
         """
@@ -996,6 +1229,19 @@ def combine_statuses(status_a, status_b):
         return {"status": ENDPOINT_STATUS_UP}
 
 
+def _updated_config(config, param, value):
+    """
+    :returns: a copy of the given config dict with the given parameter set
+              to value or removed if value is None.
+    """
+    config = config.copy()
+    if value is None:
+        config.pop(param, None)
+    else:
+        config[param] = value
+    return config
+
+
 def die_and_restart():
     # Sleep so that we can't die more than 5 times in 10s even if someone is
     # churning the config.  This prevents our upstart/systemd jobs from giving
@@ -1004,116 +1250,3 @@ def die_and_restart():
     # Use a failure code to tell systemd that we expect to be restarted.  We
     # use os._exit() because it is bullet-proof.
     os._exit(1)
-
-
-def parse_endpoint(config, combined_id, raw_json):
-    endpoint = safe_decode_json(raw_json,
-                                log_tag="endpoint %s" % combined_id.endpoint)
-    try:
-        common.validate_endpoint(config, combined_id, endpoint)
-    except ValidationFailed as e:
-        _log.warning("Validation failed for endpoint %s, treating as "
-                     "missing: %s; %r", combined_id, e.message, raw_json)
-        endpoint = None
-    else:
-        _log.debug("Validated endpoint : %s", endpoint)
-    return endpoint
-
-
-def parse_host_ep(config, combined_id, raw_json):
-    iface_data = safe_decode_json(raw_json,
-                                  log_tag="iface %s" % combined_id.endpoint)
-    try:
-        common.validate_host_endpoint(config, combined_id, iface_data)
-    except ValidationFailed as e:
-        _log.warning("Validation failed for host endpoint %s, treating as "
-                     "missing: %s; %r", combined_id, e.message, raw_json)
-        iface_data = None
-    else:
-        _log.debug("Validated endpoint : %s", iface_data)
-    return iface_data
-
-
-def parse_tier_data(tier, data):
-    data = safe_decode_json(data, log_tag="tier %s" % tier)
-    try:
-        common.validate_tier_data(tier, data)
-    except ValidationFailed as e:
-        _log.error("Validation failed for tier data for tier %s: %r",
-                   tier, e)
-        return None
-    else:
-        return data
-
-
-def parse_profile(profile_id, raw_json, require_selector=False,
-                  require_order=False):
-    rules = safe_decode_json(raw_json, log_tag="rules %s" % profile_id)
-    try:
-        common.validate_profile(profile_id, rules)
-    except ValidationFailed as e:
-        _log.exception("Validation failed for profile %s rules: %s",
-                       profile_id, rules)
-        return None
-    else:
-        return rules
-
-
-def parse_policy(profile_id, raw_json, require_selector=False,
-                  require_order=False):
-    policy = safe_decode_json(raw_json, log_tag="policy %s" % profile_id)
-    try:
-        common.validate_policy(profile_id, policy)
-    except ValidationFailed as e:
-        _log.exception("Validation failed for policy %s: %s",
-                       profile_id, policy)
-        return None
-    else:
-        return policy
-
-
-def parse_tags(profile_id, raw_json):
-    tags = safe_decode_json(raw_json, log_tag="tags %s" % profile_id)
-    try:
-        common.validate_tags(profile_id, tags)
-    except ValidationFailed:
-        _log.exception("Validation failed for profile %s tags : %s",
-                       profile_id, tags)
-        return None
-    else:
-        # The tags aren't in a top-level object so we need to manually
-        # intern them here.
-        return intern_list(tags)
-
-
-def parse_labels(profile_id, raw_json):
-    labels = safe_decode_json(raw_json,
-                              log_tag="profile labels for %s" % profile_id)
-    try:
-        common.validate_labels(profile_id, labels)
-    except ValidationFailed:
-        _log.exception("Validation failed for profile %s labels : %s",
-                       profile_id, labels)
-        return None
-    else:
-        return labels
-
-
-def parse_host_ip(hostname, raw_value):
-    if raw_value is None or validate_ip_addr(raw_value):
-        return canonicalise_ip(raw_value, None)
-    else:
-        _log.debug("%s has invalid IP: %r", hostname, raw_value)
-        return None
-
-
-def parse_ipam_pool(pool_id, raw_json):
-    pool = safe_decode_json(raw_json, log_tag="ipam pool %s" % pool_id)
-    try:
-        common.validate_ipam_pool(pool_id, pool, 4)
-    except ValidationFailed as e:
-        _log.exception("Validation failed for ipam pool %s: %s; %r",
-                       pool_id, pool, e)
-        return None
-    else:
-        return pool
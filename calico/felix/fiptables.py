@@ -120,7 +120,7 @@ class IptablesUpdater(Actor):
         super(IptablesUpdater, self).__init__(qualifier="v%d-%s" %
                                                         (ip_version, table))
         self.table = table
-        self.refresh_interval = config.REFRESH_INTERVAL
+        self._config = config
         self.iptables_generator = config.plugins["iptables_generator"]
         self.ip_version = ip_version
         if ip_version == 4:
@@ -182,7 +182,7 @@ class IptablesUpdater(Actor):
         self._load_chain_names_from_iptables(async=True)
 
         # Optionally, start periodic refresh timer.
-        if self.refresh_interval > 0:
+        if self._config.REFRESH_INTERVAL > 0:
             _log.info("Periodic iptables refresh enabled, starting "
                       "resync greenlet")
             refresh_greenlet = gevent.spawn(self._periodic_refresh)
@@ -493,8 +493,10 @@ class IptablesUpdater(Actor):
 
     def _periodic_refresh(self):
         while True:
-            # Jitter our sleep times by 20%.
-            gevent.sleep(self.refresh_interval * (1 + random.random() * 0.2))
+            # Jitter our sleep times by 20%.  The interval may be changed
+            # by a config update.
+            interval = self._config.REFRESH_INTERVAL
+            gevent.sleep(interval * (1 + random.random() * 0.2))
             self.refresh_iptables(async=True)
 
     def _on_worker_died(self, watch_greenlet):
@@ -26,10 +26,11 @@ import logging
 
 from calico.datamodel_v1 import HostEndpointId, WloadEndpointId
 from calico.felix import futils
-from calico.calcollections import SetDelta
+from calico.calcollections import SetDelta, BitmapMultiDict
 from calico.felix.futils import IPV4, IPV6, FailedSystemCall
 from calico.felix.actor import actor_message, Actor
-from calico.felix.labels import LabelValueIndex, LabelInheritanceIndex
+from calico.felix.labels import (LabelValueIndex, LabelInheritanceIndex,
+                                 LabelSetIndex)
 from calico.felix.refcount import ReferenceManager, RefCountedActor
 from calico.felix.selectors import SelectorExpression
 
@@ -65,10 +66,17 @@ class IpsetManager(ReferenceManager):
         # State.
         # Tag IDs indexed by profile IDs
         self.tags_by_prof_id = {}
+        # Reverse index: set of profile IDs indexed by tag ID.  Used, along
+        # with endpoint_ids_by_profile_id, to calculate the members of a
+        # tag when it is first referenced.
+        self.prof_ids_by_tag = defaultdict(set)
         # EndpointData "structs" indexed by WloadEndpointId.
         self.endpoint_data_by_ep_id = {}
 
-        # Main index.  Tracks which IPs are currently in each tag.
+        # Main index.  Tracks which IPs are currently in each tag.  Only
+        # tags and selectors that are referenced (i.e. that have an entry in
+        # objects_by_id) are tracked; there's no point in tracking the
+        # membership of the many tags that no local endpoint uses.
         self.tag_membership_index = TagMembershipIndex()
         # Take copies of the key functions; avoids messy long lines.
         self._add_mapping = self.tag_membership_index.add_mapping
@@ -78,8 +86,9 @@ class IpsetManager(ReferenceManager):
         self.endpoint_ids_by_profile_id = defaultdict(set)
 
         # LabelNode index, used to cross-reference endpoint labels against
-        # selectors.
-        self._label_index = LabelValueIndex()
+        # selectors.  Endpoints with identical labels share a label set,
+        # which is only evaluated once.
+        self._label_index = LabelSetIndex(LabelValueIndex())
         self._label_index.on_match_started = self._on_label_match_started
         self._label_index.on_match_stopped = self._on_label_match_stopped
         self._label_inherit_idx = LabelInheritanceIndex(self._label_index)
@@ -104,6 +113,7 @@ class IpsetManager(ReferenceManager):
             self._process_started_label_matches()
         else:
             _log.debug("Creating ipset for tag %s", tag_id_or_sel)
+            self._index_tag(tag_id_or_sel)
             ipset_name = futils.uniquely_shorten(tag_id_or_sel,
                                                  MAX_NAME_LENGTH)
         active_ipset = RefCountedIpsetActor(
@@ -113,6 +123,36 @@ class IpsetManager(ReferenceManager):
         )
         return active_ipset
 
+    def _on_object_unreferenced(self, tag_id_or_sel, active_ipset):
+        _log.debug("%s no longer referenced, removing from index",
+                   tag_id_or_sel)
+        if isinstance(tag_id_or_sel, SelectorExpression):
+            # Stop tracking the selector's matches.  The resulting stopped
+            # matches are all for this selector, whose entries in the tag
+            # index we remove wholesale below.
+            self._label_index.on_expression_update(tag_id_or_sel, None)
+            self._stopped_label_matches.clear()
+        self.tag_membership_index.remove_tag(tag_id_or_sel)
+
+    def _index_tag(self, tag_id):
+        """
+        Calculates the members of a newly-referenced tag and adds them to
+        the tag membership index.
+        """
+        for profile_id in self.prof_ids_by_tag.get(tag_id, ()):
+            endpoint_ids = self.endpoint_ids_by_profile_id.get(profile_id, ())
+            for endpoint_id in endpoint_ids:
+                endpoint = self.endpoint_data_by_ep_id[endpoint_id]
+                for ip in endpoint.ip_addresses:
+                    self._add_mapping(tag_id, profile_id, endpoint_id, ip)
+
+    def _is_tracked_tag(self, tag_id):
+        """
+        :returns: True if the given tag is referenced and hence its
+                  membership is being tracked in the index.
+        """
+        return tag_id in self.objects_by_id
+
     def _maybe_start(self, obj_id):
         if self._datamodel_in_sync:
             _log.debug("Datamodel is in-sync, deferring to superclass.")
@@ -240,16 +280,30 @@ class IpsetManager(ReferenceManager):
         _log.debug("Profile %s added tags: %s", profile_id, added_tags)
         _log.debug("Profile %s removed tags: %s", profile_id, removed_tags)
 
-        for endpoint_id in endpoint_ids:
-            endpoint = self.endpoint_data_by_ep_id.get(endpoint_id,
-                                                       EMPTY_ENDPOINT_DATA)
-            ip_addrs = endpoint.ip_addresses
-            for tag_id in removed_tags:
-                for ip in ip_addrs:
-                    self._remove_mapping(tag_id, profile_id, endpoint_id, ip)
-            for tag_id in added_tags:
-                for ip in ip_addrs:
-                    self._add_mapping(tag_id, profile_id, endpoint_id, ip)
+        for tag_id in removed_tags:
+            prof_ids = self.prof_ids_by_tag[tag_id]
+            prof_ids.discard(profile_id)
+            if not prof_ids:
+                del self.prof_ids_by_tag[tag_id]
+        for tag_id in added_tags:
+            self.prof_ids_by_tag[tag_id].add(profile_id)
+
+        # Only the referenced tags need their members updating.
+        removed_tags = filter(self._is_tracked_tag, removed_tags)
+        added_tags = filter(self._is_tracked_tag, added_tags)
+        if removed_tags or added_tags:
+            for endpoint_id in endpoint_ids:
+                endpoint = self.endpoint_data_by_ep_id.get(
+                    endpoint_id, EMPTY_ENDPOINT_DATA
+                )
+                ip_addrs = endpoint.ip_addresses
+                for tag_id in removed_tags:
+                    for ip in ip_addrs:
+                        self._remove_mapping(tag_id, profile_id,
+                                             endpoint_id, ip)
+                for tag_id in added_tags:
+                    for ip in ip_addrs:
+                        self._add_mapping(tag_id, profile_id, endpoint_id, ip)
 
         if tags is None:
             _log.info("Tags for profile %s deleted", profile_id)
@@ -406,7 +460,8 @@ class IpsetManager(ReferenceManager):
         old_tags = set()
         for profile_id in old_prof_ids:
             for tag in self.tags_by_prof_id.get(profile_id, []):
-                old_tags.add((profile_id, tag))
+                if self._is_tracked_tag(tag):
+                    old_tags.add((profile_id, tag))
 
         if endpoint_data != EMPTY_ENDPOINT_DATA:
             # EMPTY_ENDPOINT_DATA represents a deletion (or that the endpoint
@@ -419,7 +474,8 @@ class IpsetManager(ReferenceManager):
         new_tags = set()
         for profile_id in new_prof_ids:
             for tag in self.tags_by_prof_id.get(profile_id, []):
-                new_tags.add((profile_id, tag))
+                if self._is_tracked_tag(tag):
+                    new_tags.add((profile_id, tag))
 
         if new_prof_ids != old_prof_ids:
             # Profile ID changed, or an add/delete.  the _xxx_profile_index
@@ -501,14 +557,20 @@ class TagMembershipIndex(object):
     """Indexes tag memberships to allow efficient calculation of changes."""
     def __init__(self):
         # Main index.  Since an IP address can be assigned to multiple
-        # endpoints, we need to track which endpoints reference an IP.  When
-        # we find the set of endpoints with an IP is empty, we remove the
-        # ip from the tag.
-        # ip_owners_by_tag[tag][ip] = set([(profile_id, combined_id),
-        #                                  (profile_id, combined_id2), ...]) |
-        #                             (profile_id, combined_id)
-        # Here "combined_id" is an WloadEndpointId object.
-        self.ip_owners_by_tag = defaultdict(lambda: defaultdict(lambda: None))
+        # endpoints, we need to track how many (profile_id, endpoint_id)
+        # pairs own an IP in each tag.  When that count drops to zero, we
+        # remove the IP from the tag.
+        #
+        # As an occupancy optimization, the IPs are interned as integers and
+        # each tag's IPs are stored as a bitmap, which records a single owner
+        # for each IP.  Only the (rare) IPs that have more than one owner
+        # get an entry in _extra_owners, which maps (tag_id, ip_address) to
+        # the number of owners beyond the first.
+        #
+        # Since our caller always removes exactly the mappings that it added,
+        # there's no need to record the owners themselves.
+        self.ips_by_tag = BitmapMultiDict()
+        self._extra_owners = {}
         # IPs added and removed since the last reset.
         self.ips_added_by_tag = defaultdict(set)
         self.ips_removed_by_tag = defaultdict(set)
@@ -524,19 +586,13 @@ class TagMembershipIndex(object):
         :param EndpointId endpoint_id: ID of the endpoint
         :param str ip_address: IP address to add
         """
-        if not self.ip_owners_by_tag[tag_id][ip_address]:
+        if self.ips_by_tag.add(tag_id, ip_address):
             self._on_ip_added(ip_address, tag_id)
-        owners = self.ip_owners_by_tag[tag_id][ip_address]
-        new_mapping = (profile_id, endpoint_id)
-        if not owners:
-            self.ip_owners_by_tag[tag_id][ip_address] = new_mapping
-        elif isinstance(owners, set):
-            owners.add(new_mapping)
         else:
-            self.ip_owners_by_tag[tag_id][ip_address] = set([
-                owners,
-                new_mapping
-            ])
+            key = (tag_id, ip_address)
+            _log.debug("IP %s already in tag %s, adding owner %s",
+                       ip_address, tag_id, (profile_id, endpoint_id))
+            self._extra_owners[key] = self._extra_owners.get(key, 0) + 1
 
     def remove_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
         """
@@ -549,34 +605,47 @@ class TagMembershipIndex(object):
         :param EndpointId endpoint_id: ID of the endpoint
         :param str ip_address: IP address to remove
         """
-        owners = self.ip_owners_by_tag[tag_id][ip_address]
-        removed_mapping = (profile_id, endpoint_id)
-        if owners == removed_mapping:
+        key = (tag_id, ip_address)
+        extra_owners = self._extra_owners.get(key)
+        if extra_owners:
+            _log.debug("Tag %s still contains IP %s", tag_id, ip_address)
+            if extra_owners == 1:
+                del self._extra_owners[key]
+            else:
+                self._extra_owners[key] = extra_owners - 1
+        else:
             # This was the sole owner of the IP in the tag, remove it.
             _log.debug("%s was sole owner of IP %s, IP no longer in tag",
-                       removed_mapping, ip_address)
-            del self.ip_owners_by_tag[tag_id][ip_address]
-            if not self.ip_owners_by_tag[tag_id]:
-                _log.debug("Tag %s now empty, removing", tag_id)
-                del self.ip_owners_by_tag[tag_id]
+                       (profile_id, endpoint_id), ip_address)
+            removed = self.ips_by_tag.discard(tag_id, ip_address)
+            assert removed, ("Expected IP %s to be in tag %s" %
+                             (ip_address, tag_id))
             self._on_ip_removed(ip_address, tag_id)
-        else:
-            assert isinstance(owners, set), (
-                "Expected owners of IP %s to be %s or a set but got %s" %
-                (ip_address, removed_mapping, owners)
-            )
-            assert len(owners) > 1, ("ip_owners_by_tag entry should never "
-                                     "be a set with <=1 entry")
-            assert removed_mapping in owners, (
-                "Owners set for IP %s should contain %s" %
-                (ip_address, removed_mapping)
-            )
-            _log.debug("Tag %s still contains IP %s", tag_id, ip_address)
-            owners.remove(removed_mapping)
-            if len(owners) == 1:
-                _log.debug("IP %s now only has one owner, replacing set with "
-                           "single tuple", ip_address)
-                self.ip_owners_by_tag[tag_id][ip_address] = owners.pop()
+
+    def num_owners(self, tag_id, ip_address):
+        """
+        :return: The number of owners of the given IP in the given tag; 0
+                 if the tag doesn't contain the IP.
+        """
+        if not self.ips_by_tag.contains(tag_id, ip_address):
+            return 0
+        return 1 + self._extra_owners.get((tag_id, ip_address), 0)
+
+    def remove_tag(self, tag_id):
+        """
+        Removes all the mappings for the given tag from the index, along
+        with any changes to the tag that haven't yet been collected.
+
+        Used when a tag is no longer referenced; there's no need to
+        report the removal of its IPs.
+
+        :param str tag_id: Tag ID
+        """
+        for ip_address in self.ips_by_tag.iter_values(tag_id):
+            self.ips_by_tag.discard(tag_id, ip_address)
+            self._extra_owners.pop((tag_id, ip_address), None)
+        self.ips_added_by_tag.pop(tag_id, None)
+        self.ips_removed_by_tag.pop(tag_id, None)
 
     def _on_ip_added(self, ip_address, tag_id):
         """
@@ -589,10 +658,11 @@ class TagMembershipIndex(object):
         # Track the addition.
         self.ips_added_by_tag[tag_id].add(ip_address)
         # The addition invalidates any previous removal; clean that up.
-        removed_ips_for_tag = self.ips_removed_by_tag[tag_id]
-        removed_ips_for_tag.discard(ip_address)
-        if not removed_ips_for_tag:
-            del self.ips_removed_by_tag[tag_id]
+        removed_ips_for_tag = self.ips_removed_by_tag.get(tag_id)
+        if removed_ips_for_tag:
+            removed_ips_for_tag.discard(ip_address)
+            if not removed_ips_for_tag:
+                del self.ips_removed_by_tag[tag_id]
 
     def _on_ip_removed(self, ip_address, tag_id):
         """
@@ -604,15 +674,15 @@ class TagMembershipIndex(object):
         _log.debug("IP %s removed from tag %s", ip_address, tag_id)
         # Track the removal.
         self.ips_removed_by_tag[tag_id].add(ip_address)
-        # The addition invalidates any previous addition; clean that up.
-        added_ips_for_tag = self.ips_added_by_tag[tag_id]
-        added_ips_for_tag.discard(ip_address)
-        if not added_ips_for_tag:
-            del self.ips_added_by_tag[tag_id]
+        # The removal invalidates any previous addition; clean that up.
+        added_ips_for_tag = self.ips_added_by_tag.get(tag_id)
+        if added_ips_for_tag:
+            added_ips_for_tag.discard(ip_address)
+            if not added_ips_for_tag:
+                del self.ips_added_by_tag[tag_id]
 
     def members(self, tag_id):
-        members = self.ip_owners_by_tag.get(tag_id, {}).keys()
-        return members
+        return list(self.ips_by_tag.iter_values(tag_id))
 
     def get_and_reset_changes_by_tag(self):
         """ Get the deltas accumulated since the last reset.
@@ -14,8 +14,12 @@
 # limitations under the License.
 import logging
 
-from calico.calcollections import MultiDict
-from calico.felix.selectors import LabelToLiteralEqualityNode, LabelInSetLiteralNode
+from calico.calcollections import MultiDict, BitmapBiMultiDict
+from calico.felix.selectors import (
+    LabelToLiteralEqualityNode, LabelInSetLiteralNode, HasNode,
+    InequalityNode, NotInNode, NegationNode, AndNode, OrNode, AllNode,
+    NOT_PRESENT, add_constant, compile_expr_op
+)
 
 _log = logging.getLogger(__name__)
 
@@ -48,9 +52,14 @@ class LinearScanLabelIndex(object):
         self.labels_by_item_id = {}
         # All expressions by ID.
         self.expressions_by_id = {}
-        # Map from expression ID to matching item_ids.
-        self.matches_by_expr_id = MultiDict()
-        self.matches_by_item_id = MultiDict()
+        # Two-way index of the matches between expression IDs and item IDs.
+        # Stored as bitmaps, which is much more compact than a pair of
+        # MultiDicts when there are many matches.
+        self.matches = BitmapBiMultiDict()
+        # Read-only views of the matches, from expression ID to matching
+        # item IDs and vice versa.
+        self.matches_by_expr_id = self.matches.by_key
+        self.matches_by_item_id = self.matches.by_value
 
     def on_expression_update(self, expr_id, expr):
         """
@@ -80,6 +89,23 @@ class LinearScanLabelIndex(object):
         self._scan_all_expressions(item_id, new_labels)
         self._store_labels(item_id, new_labels)
 
+    def on_labels_update_bulk(self, updates, changed_keys):
+        """
+        Called to update the labels of many items at once, where the
+        labels only differ from their previous values in the given keys.
+        For example, when the labels of a parent that they inherit from
+        change.
+
+        Triggers events for match changes.
+        :param updates: list of (item_id, new_labels) tuples.  new_labels
+               must not be None.
+        :param changed_keys: set of label names.  For items that are
+               already in the index, new_labels must only differ from the
+               item's previous labels in these keys.
+        """
+        for item_id, new_labels in updates:
+            self.on_labels_update(item_id, new_labels)
+
     def _scan_all_labels(self, expr_id, expr):
         """
         Check the given expression against all label dicts and emit
@@ -120,7 +146,7 @@ class LinearScanLabelIndex(object):
         _log.debug("Re-evaluating %s against %s (%s)", expr_id, item_id,
                    label_values)
         if expr is not None and label_values is not None:
-            now_matches = expr.evaluate(label_values)
+            now_matches = self._evaluate(expr_id, expr, label_values)
             _log.debug("After evaluation, now matches: %s", now_matches)
         else:
             _log.debug("Expr or labels missing: no match")
@@ -132,6 +158,12 @@ class LinearScanLabelIndex(object):
         else:
             self._discard_match(expr_id, item_id)
 
+    def _evaluate(self, expr_id, expr, label_values):
+        """
+        Evaluates the given expression against the given labels.
+        """
+        return expr.evaluate(label_values)
+
     def _store_match(self, expr_id, item_id):
         """
         Stores that an expression matches an item.
@@ -139,11 +171,8 @@ class LinearScanLabelIndex(object):
         Calls on_match_started() as a side-effect. Idempotent, does
         nothing if the match is already recorded.
         """
-        previously_matched = self.matches_by_expr_id.contains(expr_id, item_id)
-        if not previously_matched:
+        if self.matches.add(expr_id, item_id):
             _log.debug("%s now matches: %s", expr_id, item_id)
-            self.matches_by_expr_id.add(expr_id, item_id)
-            self.matches_by_item_id.add(item_id, expr_id)
             self.on_match_started(expr_id, item_id)
 
     def _discard_match(self, expr_id, item_id):
@@ -153,13 +182,22 @@ class LinearScanLabelIndex(object):
         Calls on_match_stopped() as a side-effect.  Idempotent, does
         nothing if the non-match is already recorded.
         """
-        previously_matched = self.matches_by_expr_id.contains(expr_id, item_id)
-        if previously_matched:
+        if self.matches.discard(expr_id, item_id):
             _log.debug("%s no longer matches %s", expr_id, item_id)
-            self.matches_by_expr_id.discard(expr_id, item_id)
-            self.matches_by_item_id.discard(item_id, expr_id)
             self.on_match_stopped(expr_id, item_id)
 
+    def _replace_matches(self, expr_id, item_ids):
+        """
+        Replaces all the matches of an expression with the given set of
+        item IDs.  Calls on_match_stopped() and on_match_started() for
+        the differences, which are found by a bitwise diff.
+        """
+        added, removed = self.matches.diff_values(expr_id, item_ids)
+        for item_id in removed:
+            self._discard_match(expr_id, item_id)
+        for item_id in added:
+            self._store_match(expr_id, item_id)
+
     def on_match_started(self, expr_id, item_id):
         """
         Called when an expression starts matching a particular set of
@@ -181,23 +219,199 @@ class LinearScanLabelIndex(object):
                    expr_id, item_id)
 
 
+class SharedSubExpressions(object):
+    """
+    A DAG of the distinct sub-expressions of a set of selectors, used to
+    share their evaluation.
+
+    Each distinct '&&', '||' or '!' sub-expression (by ExprNode equality) is
+    stored once, with a reference count, and compiled into a function that
+    records its result in a memo dict.  The selectors' compiled functions
+    look up their sub-expressions' results in the memo so a clause that is
+    shared by many selectors is only evaluated once per label dict.
+
+    Simple comparisons are inlined rather than shared; they're as cheap to
+    evaluate as to look up.
+    """
+
+    def __init__(self):
+        self._sub_exprs_by_op = {}
+        self._free_slots = []
+        self._next_slot = 0
+
+    def acquire(self, expr_op):
+        """
+        Adds the sub-expressions of the given expression to the DAG.  Must
+        be balanced by a call to release().
+
+        :returns: function fn(labels, memo) that evaluates the expression
+                  against the labels dict.  memo should be a dict that is
+                  shared by all evaluations against the same labels dict.
+        """
+        if not isinstance(expr_op, _COMPOUND_NODE_TYPES):
+            fn = compile_expr_op(expr_op)
+            return lambda labels, memo: fn(labels)
+        code, constants = self._compile_compound(expr_op)
+        return _compile_memo_fn(
+            "lambda labels, memo: " + code, constants,
+            lambda labels, memo: expr_op.evaluate(labels),
+            expr_op
+        )
+
+    def release(self, expr_op):
+        """
+        Releases the sub-expressions of an expression that was passed to
+        acquire().
+        """
+        if isinstance(expr_op, _COMPOUND_NODE_TYPES):
+            for child in _child_expr_ops(expr_op):
+                if isinstance(child, _COMPOUND_NODE_TYPES):
+                    self._release_sub_expr(child)
+
+    def _compile_compound(self, expr_op):
+        """
+        Generates the code for a compound expression, acquiring its compound
+        children as shared sub-expressions.
+
+        :returns: tuple of the code and the constants that it refers to.
+        """
+        constants = {}
+        parts = []
+        for child in _child_expr_ops(expr_op):
+            if isinstance(child, _COMPOUND_NODE_TYPES):
+                sub_expr = self._acquire_sub_expr(child)
+                parts.append("(memo[%d] if %d in memo else %s(labels, memo))" %
+                             (sub_expr.slot, sub_expr.slot,
+                              add_constant(constants, sub_expr.fn)))
+            else:
+                fragments = []
+                child.collect_code_fragments(fragments, constants)
+                parts.append("".join(fragments))
+        if isinstance(expr_op, NegationNode):
+            return "(not %s)" % parts[0], constants
+        separator = " %s " % expr_op.python_operator
+        return "(%s)" % separator.join(parts), constants
+
+    def _acquire_sub_expr(self, expr_op):
+        sub_expr = self._sub_exprs_by_op.get(expr_op)
+        if sub_expr is None:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+            else:
+                slot = self._next_slot
+                self._next_slot += 1
+            code, constants = self._compile_compound(expr_op)
+            code = "lambda labels, memo: %s(memo, %d, %s)" % (
+                add_constant(constants, _store_result), slot, code
+            )
+            fn = _compile_memo_fn(
+                code, constants,
+                lambda labels, memo: _store_result(memo, slot,
+                                                   expr_op.evaluate(labels)),
+                expr_op
+            )
+            sub_expr = _SubExpression(slot, fn)
+            self._sub_exprs_by_op[expr_op] = sub_expr
+        sub_expr.ref_count += 1
+        return sub_expr
+
+    def _release_sub_expr(self, expr_op):
+        sub_expr = self._sub_exprs_by_op[expr_op]
+        sub_expr.ref_count -= 1
+        if sub_expr.ref_count == 0:
+            del self._sub_exprs_by_op[expr_op]
+            self._free_slots.append(sub_expr.slot)
+            self.release(expr_op)
+
+    def __len__(self):
+        return len(self._sub_exprs_by_op)
+
+
+class _SubExpression(object):
+    """A shared sub-expression in a SharedSubExpressions DAG."""
+    __slots__ = ["slot", "fn", "ref_count"]
+
+    def __init__(self, slot, fn):
+        self.slot = slot
+        self.fn = fn
+        self.ref_count = 0
+
+
+_COMPOUND_NODE_TYPES = (AndNode, OrNode, NegationNode)
+
+
+def _child_expr_ops(expr_op):
+    if isinstance(expr_op, NegationNode):
+        return [expr_op.value]
+    return expr_op.exprs
+
+
+def _store_result(memo, slot, value):
+    memo[slot] = value
+    return value
+
+
+def _compile_memo_fn(code, constants, fallback, expr_op):
+    try:
+        return eval(code, constants)
+    except (SyntaxError, MemoryError, RuntimeError):
+        # As for compile_expr_op(), fall back to walking the tree.
+        _log.warning("Failed to compile selector, using slow path: %r",
+                     expr_op)
+        return fallback
+
+
 class LabelValueIndex(LinearScanLabelIndex):
     """
     LabelNode index that indexes the values of labels, allowing for efficient
     (re)calculation of the matches for selectors of the form
     'a == "b" && c == "d" && ...', which are the mainline.
+
+    Selectors that are a union of simple terms, such as 'a == "b"',
+    'a in {"b", "c"}', 'has(a)' or an '||' of those, are evaluated purely
+    by index look-up.  So are their negations, such as 'a != "b"',
+    'a not in {...}' and '!has(a)', which match the complement of the
+    look-up.
     """
     def __init__(self):
         super(LabelValueIndex, self).__init__()
         self.item_ids_by_key_value = MultiDict()
+        self.item_ids_by_key = MultiDict()
         # Maps tuples of (a, b) to the set of expressions that are trivially
         # satisfied by label dicts with label a = value b.  For example,
         # trivial expressions of the form a == "b", and a in {"b", "c", ...}
         # can be evaluated by look-up in this dict.
         self.literal_exprs_by_kv = MultiDict()
+        # Similarly, maps label name a to the expressions that are satisfied
+        # by label dicts that have label a, such as has(a).
+        self.literal_exprs_by_key = MultiDict()
+        # Negated expressions, such as a != "b", match every label dict
+        # *except* those that would be found by the above look-ups.
+        self.negated_exprs_by_kv = MultiDict()
+        self.negated_exprs_by_key = MultiDict()
+        self.negated_exprs_by_id = {}
+        # Record of the terms that we indexed each of the above expressions
+        # under, as returned by _index_terms().
+        self.index_terms_by_expr_id = {}
+        # Expressions that are more complex but that have some required
+        # k == "v" constraint.  Maps the (k, v) tuple that we chose to index
+        # each expression on to the expressions.
+        self.required_kv_exprs_by_kv = MultiDict()
+        self.required_kv_by_expr_id = {}
         # Mapping from expression ID to any expressions that can't be
-        # represented in the way described above.
+        # represented in the ways described above.
         self.non_kv_expressions_by_id = {}
+        # Maps label name to all the expressions that refer to that label.
+        # Used to find the expressions that a bulk update could affect.
+        self.expr_ids_by_label_name = MultiDict()
+        # Shared sub-expressions of all our expressions and the functions
+        # that evaluate each expression using them.  Evaluations against the
+        # same labels dict share the memo dict, which we reset whenever we
+        # see a different labels dict.
+        self.sub_exprs = SharedSubExpressions()
+        self.eval_fns_by_expr_id = {}
+        self._memo_labels = None
+        self._memo = None
 
     def on_labels_update(self, item_id, new_labels):
         """
@@ -210,14 +424,17 @@ class LabelValueIndex(LinearScanLabelIndex):
                remove it.
         """
         _log.debug("Updating labels for %s to %s", item_id, new_labels)
-        # Find any old labels associated with this item_id and remove the
-        # ones that have changed from the index.
+        self._reset_memo()
+        new_item = item_id not in self.labels_by_item_id
         old_labels = self.labels_by_item_id.get(item_id, {})
-        for k_v in old_labels.iteritems():
-            k, v = k_v
-            if new_labels is None or new_labels.get(k) != v:
-                _log.debug("Removing old key/value (%s, %s) from index", k, v)
-                self.item_ids_by_key_value.discard(k_v, item_id)
+        labels = new_labels if new_labels is not None else {}
+        # Work out which keys and values have changed, and update the
+        # indexes to match.
+        keys = set(old_labels)
+        keys.update(labels)
+        added_kvs, added_keys, removed_kvs, removed_keys = \
+            self._update_label_indexes(item_id, old_labels, labels, keys)
+
         # Check all the old matches for updates.  Record that we've already
         # re-evaluated these expressions so we can skip them later.
         seen_expr_ids = set()
@@ -226,28 +443,161 @@ class LabelValueIndex(LinearScanLabelIndex):
             seen_expr_ids.add(expr_id)
             self._update_matches(expr_id, self.expressions_by_id[expr_id],
                                  item_id, new_labels)
+
         if new_labels is not None:
-            # Spin through the new labels, storing them in the index and
-            # looking for expressions of the form 'k == "v"', which we have
-            # indexed.
-            for k_v in new_labels.iteritems():
-                _log.debug("Adding (%s, %s) to index", *k_v)
-                self.item_ids_by_key_value.add(k_v, item_id)
+            # Any union-of-terms expressions that are indexed on a newly-added
+            # key or key/value now match.
+            for k_v in added_kvs:
                 for expr_id in self.literal_exprs_by_kv.iter_values(k_v):
-                    if expr_id in seen_expr_ids:
-                        continue
-                    self._store_match(expr_id, item_id)
+                    if expr_id not in seen_expr_ids:
+                        self._store_match(expr_id, item_id)
+                        seen_expr_ids.add(expr_id)
+            for k in added_keys:
+                for expr_id in self.literal_exprs_by_key.iter_values(k):
+                    if expr_id not in seen_expr_ids:
+                        self._store_match(expr_id, item_id)
+                        seen_expr_ids.add(expr_id)
+
+            # A negated expression that didn't previously match an item can
+            # only start matching if one of the terms that it was excluded by
+            # has gone away.  New items need checking against all of them.
+            if new_item:
+                candidates = self.negated_exprs_by_id.iterkeys()
+            else:
+                candidates = self._iter_negated_candidates(removed_kvs,
+                                                           removed_keys)
+            for expr_id in candidates:
+                if expr_id not in seen_expr_ids:
+                    self._update_matches(expr_id,
+                                         self.expressions_by_id[expr_id],
+                                         item_id, new_labels)
                     seen_expr_ids.add(expr_id)
-        # Spin through the remaining expressions, which we can't optimize.
-        for expr_id, expr in self.non_kv_expressions_by_id.iteritems():
-            if expr_id in seen_expr_ids:
-                continue
-            _log.debug("Checking updated labels against non-indexed expr: %s",
-                       expr_id)
-            self._update_matches(expr_id, expr, item_id, new_labels)
+
+            # Expressions with a required key/value can only match if the
+            # item has that key/value.
+            for k_v in new_labels.iteritems():
+                for expr_id in self.required_kv_exprs_by_kv.iter_values(k_v):
+                    if expr_id not in seen_expr_ids:
+                        self._update_matches(expr_id,
+                                             self.expressions_by_id[expr_id],
+                                             item_id, new_labels)
+                        seen_expr_ids.add(expr_id)
+
+            # Spin through the remaining expressions, which we can't
+            # optimize.
+            for expr_id, expr in self.non_kv_expressions_by_id.iteritems():
+                if expr_id in seen_expr_ids:
+                    continue
+                _log.debug("Checking updated labels against non-indexed "
+                           "expr: %s", expr_id)
+                self._update_matches(expr_id, expr, item_id, new_labels)
         # Finally, store the update.
         self._store_labels(item_id, new_labels)
 
+    def on_labels_update_bulk(self, updates, changed_keys):
+        """
+        Called to update the labels of many items at once, where the
+        labels only differ from their previous values in the given keys.
+        For example, when the labels of a parent that they inherit from
+        change.
+
+        Rather than checking each item against all its candidate
+        expressions, works out once which expressions refer to the changed
+        keys; only those can change result.
+
+        Triggers events for match changes.
+        :param updates: list of (item_id, new_labels) tuples.  new_labels
+               must not be None.
+        :param changed_keys: set of label names.  For items that are
+               already in the index, new_labels must only differ from the
+               item's previous labels in these keys.
+        """
+        self._reset_memo()
+        affected_expr_ids = set()
+        for key in changed_keys:
+            affected_expr_ids.update(
+                self.expr_ids_by_label_name.iter_values(key)
+            )
+        _log.debug("Bulk update of %s items, changed keys %s affect "
+                   "expressions %s", len(updates), changed_keys,
+                   affected_expr_ids)
+        affected_exprs = [(expr_id, self.expressions_by_id[expr_id])
+                          for expr_id in affected_expr_ids]
+        for item_id, new_labels in updates:
+            old_labels = self.labels_by_item_id.get(item_id)
+            if old_labels is None:
+                # New item, we need to check it against everything.
+                self.on_labels_update(item_id, new_labels)
+                continue
+            self._update_label_indexes(item_id, old_labels, new_labels,
+                                       changed_keys)
+            for expr_id, expr in affected_exprs:
+                self._update_matches(expr_id, expr, item_id, new_labels)
+            self._store_labels(item_id, new_labels)
+
+    def _update_label_indexes(self, item_id, old_labels, new_labels, keys):
+        """
+        Updates item_ids_by_key_value and item_ids_by_key for the given
+        item's change of labels.
+
+        :param keys: the label names to check for changes.
+        :returns: tuple of lists, (added_kvs, added_keys, removed_kvs,
+                  removed_keys).
+        """
+        added_kvs = []
+        added_keys = []
+        removed_kvs = []
+        removed_keys = []
+        for k in keys:
+            old_v = old_labels.get(k, NOT_PRESENT)
+            new_v = new_labels.get(k, NOT_PRESENT)
+            if old_v == new_v:
+                continue
+            if old_v is NOT_PRESENT:
+                _log.debug("Adding key %s to index", k)
+                added_keys.append(k)
+                self.item_ids_by_key.add(k, item_id)
+            else:
+                _log.debug("Removing old key/value (%s, %s) from index",
+                           k, old_v)
+                removed_kvs.append((k, old_v))
+                self.item_ids_by_key_value.discard((k, old_v), item_id)
+            if new_v is NOT_PRESENT:
+                _log.debug("Removing old key %s from index", k)
+                removed_keys.append(k)
+                self.item_ids_by_key.discard(k, item_id)
+            else:
+                _log.debug("Adding (%s, %s) to index", k, new_v)
+                added_kvs.append((k, new_v))
+                self.item_ids_by_key_value.add((k, new_v), item_id)
+        return added_kvs, added_keys, removed_kvs, removed_keys
+
+    def _store_expression(self, expr_id, expr):
+        """
+        Updates expressions_by_id and expr_ids_by_label_name with the new
+        value for an expression.
+        """
+        old_expr = self.expressions_by_id.get(expr_id)
+        if old_expr is not None:
+            for name in old_expr.label_names:
+                self.expr_ids_by_label_name.discard(name, expr_id)
+        if expr is not None:
+            for name in expr.label_names:
+                self.expr_ids_by_label_name.add(name, expr_id)
+        super(LabelValueIndex, self)._store_expression(expr_id, expr)
+
+    def _iter_negated_candidates(self, kvs, keys):
+        """
+        Yields the IDs of negated expressions that are indexed on any of the
+        given key/values or keys.  May yield duplicates.
+        """
+        for k_v in kvs:
+            for expr_id in self.negated_exprs_by_kv.iter_values(k_v):
+                yield expr_id
+        for k in keys:
+            for expr_id in self.negated_exprs_by_key.iter_values(k):
+                yield expr_id
+
     def on_expression_update(self, expr_id, expr):
         """
         Called to update a particular expression.
@@ -266,23 +616,21 @@ class LabelValueIndex(LinearScanLabelIndex):
         # Remove any old value from the indexes.  We'll then add the expression
         # back in if it's suitable below.
         _log.debug("Expression %s updated to %s", expr_id, expr)
-        if old_expr and isinstance(old_expr.expr_op, (LabelToLiteralEqualityNode,
-                                                      LabelInSetLiteralNode)):
-            # Either an expression of the form a == "b", or one of the form
-            # a in {"b", "c", ...}.  Undo our index for the old entry, we'll
-            # then add it back in below.
-            label_name = old_expr.expr_op.lhs
-            if isinstance(old_expr.expr_op, LabelToLiteralEqualityNode):
-                values = [old_expr.expr_op.rhs]
-            else:
-                values = old_expr.expr_op.rhs
-            for value in values:
-                _log.debug("Old expression was indexed, removing")
-                k_v = label_name, value
-                self.literal_exprs_by_kv.discard(k_v, expr_id)
-
-        self.non_kv_expressions_by_id.pop(expr_id, None)
+        self._unindex_expression(expr_id)
+        # Add the new expression to the shared sub-expressions before
+        # releasing the old one so that sub-expressions that they have in
+        # common aren't recompiled.  Changing the DAG may re-use memo slots
+        # so we need to reset the memo.
+        self._reset_memo()
+        if expr is not None:
+            self.eval_fns_by_expr_id[expr_id] = \
+                self.sub_exprs.acquire(expr.expr_op)
+        else:
+            self.eval_fns_by_expr_id.pop(expr_id, None)
+        if old_expr is not None:
+            self.sub_exprs.release(old_expr.expr_op)
 
+        terms = _index_terms(expr.expr_op) if expr else None
         if not expr:
             # Deletion, clean up the matches.
             for item_id in list(self.matches_by_expr_id.iter_values(expr_id)):
@@ -290,39 +638,37 @@ class LabelValueIndex(LinearScanLabelIndex):
                            item_id)
                 self._update_matches(expr_id, None, item_id,
                                      self.labels_by_item_id[item_id])
-        elif isinstance(expr.expr_op, (LabelToLiteralEqualityNode,
-                                       LabelInSetLiteralNode)):
-            # Either an expression of the form a == "b", or one of the form
-            # a in {"b", "c", ...}.  We can optimise these forms so that
-            # they can be evaluated by an exact lookup.
-            label_name = expr.expr_op.lhs
-            if isinstance(expr.expr_op, LabelToLiteralEqualityNode):
-                values = [expr.expr_op.rhs]
+        elif terms is not None:
+            # A union of k == "v" and has(k) terms, or the negation of one.
+            # We can evaluate these by exact lookup.
+            negated, kvs, keys = terms
+            _log.debug("New expression is indexable: negated=%s, kvs=%s, "
+                       "keys=%s", negated, kvs, keys)
+            hits = set()
+            for k_v in kvs:
+                hits.update(self.item_ids_by_key_value.iter_values(k_v))
+            for k in keys:
+                hits.update(self.item_ids_by_key.iter_values(k))
+            if negated:
+                new_matches = set(self.labels_by_item_id)
+                new_matches.difference_update(hits)
+                exprs_by_kv = self.negated_exprs_by_kv
+                exprs_by_key = self.negated_exprs_by_key
+                self.negated_exprs_by_id[expr_id] = expr
             else:
-                values = expr.expr_op.rhs
-
-            # Get the old matches as a set.  Then we can discard the items
-            # that still match, leaving us with the ones that no longer
-            # match.
-            old_matches = set(self.matches_by_expr_id.iter_values(expr_id))
-            for value in values:
-                _log.debug("New expression is a LabelToLiteralEqualityNode, using "
-                           "index")
-                k_v = label_name, value
-                for item_id in self.item_ids_by_key_value.iter_values(k_v):
-                    _log.debug("From index, %s matches %s", expr_id, item_id)
-                    old_matches.discard(item_id)
-                    self._store_match(expr_id, item_id)
-                self.literal_exprs_by_kv.add(k_v, expr_id)
-            # old_matches now contains only the items that this expression
-            # previously matched but no longer does.  Remove them.
-            for item_id in old_matches:
-                _log.debug("Removing old match %s, %s", expr_id, item_id)
-                self._discard_match(expr_id, item_id)
+                new_matches = hits
+                exprs_by_kv = self.literal_exprs_by_kv
+                exprs_by_key = self.literal_exprs_by_key
+            self._replace_matches(expr_id, new_matches)
+            for k_v in kvs:
+                exprs_by_kv.add(k_v, expr_id)
+            for k in keys:
+                exprs_by_key.add(k, expr_id)
+            self.index_terms_by_expr_id[expr_id] = terms
         else:
             # The expression isn't a super-simple k == "v", let's see if we
             # can still use the index...
-            required_kvs = expr.required_kvs if expr else None
+            required_kvs = expr.required_kvs
             if required_kvs:
                 # The expression has some required k == "v" constraints, let's
                 # try to find an index that reduces the work we need to do.
@@ -339,16 +685,60 @@ class LabelValueIndex(LinearScanLabelIndex):
                 for item_id in old_matches:
                     self._update_matches(expr_id, None, item_id,
                                          self.labels_by_item_id[item_id])
+                # Label updates only need to check this expression if the
+                # labels contain the same key/value.
+                self.required_kv_exprs_by_kv.add(best_kv, expr_id)
+                self.required_kv_by_expr_id[expr_id] = best_kv
             else:
                 # The expression was just too complex to index.  Give up and
                 # do a linear scan.
                 _log.debug("%s too complex to use indexes, doing linear scan",
                            expr_id)
                 self._scan_all_labels(expr_id, expr)
-            self.non_kv_expressions_by_id[expr_id] = expr
+                self.non_kv_expressions_by_id[expr_id] = expr
         # Finally, store the update.
         self._store_expression(expr_id, expr)
 
+    def _evaluate(self, expr_id, expr, label_values):
+        """
+        Evaluates the given expression against the given labels, sharing
+        the results of common sub-expressions with other evaluations against
+        the same labels.
+        """
+        if label_values is not self._memo_labels:
+            self._memo_labels = label_values
+            self._memo = {}
+        return self.eval_fns_by_expr_id[expr_id](label_values, self._memo)
+
+    def _reset_memo(self):
+        self._memo_labels = None
+        self._memo = None
+
+    def _unindex_expression(self, expr_id):
+        """
+        Removes the given expression from the expression indexes, undoing
+        on_expression_update().  Leaves its matches alone.
+        """
+        terms = self.index_terms_by_expr_id.pop(expr_id, None)
+        if terms is not None:
+            _log.debug("Old expression was indexed, removing")
+            negated, kvs, keys = terms
+            if negated:
+                exprs_by_kv = self.negated_exprs_by_kv
+                exprs_by_key = self.negated_exprs_by_key
+                del self.negated_exprs_by_id[expr_id]
+            else:
+                exprs_by_kv = self.literal_exprs_by_kv
+                exprs_by_key = self.literal_exprs_by_key
+            for k_v in kvs:
+                exprs_by_kv.discard(k_v, expr_id)
+            for k in keys:
+                exprs_by_key.discard(k, expr_id)
+        required_kv = self.required_kv_by_expr_id.pop(expr_id, None)
+        if required_kv is not None:
+            self.required_kv_exprs_by_kv.discard(required_kv, expr_id)
+        self.non_kv_expressions_by_id.pop(expr_id, None)
+
     def _find_best_index(self, required_kvs):
         """
         Finds the smallest index for the given set of key/value requirements.
@@ -376,6 +766,216 @@ class LabelValueIndex(LinearScanLabelIndex):
         return min_kv
 
 
+def _index_terms(expr_op):
+    """
+    Checks whether the given expression can be evaluated purely by lookup
+    in the key/value and key indexes.
+
+    Such expressions are a union of terms of the form k == "v" and has(k),
+    or the negation of such a union.  For example, 'a in {"b", "c"}' is
+    the union of a == "b" and a == "c"; 'a != "b"' is the negation of
+    a == "b"; all() is the negation of the empty union.
+
+    :returns: None if the expression can't be represented that way.
+              Otherwise, a tuple (negated, kvs, keys) where kvs is a set of
+              (key, value) tuples and keys is a set of label names.  The
+              expression matches if any of the terms matches, XORed with
+              negated.
+    """
+    if isinstance(expr_op, LabelToLiteralEqualityNode):
+        return False, set([(expr_op.lhs, expr_op.rhs)]), set()
+    elif isinstance(expr_op, LabelInSetLiteralNode):
+        return False, set((expr_op.lhs, v) for v in expr_op.rhs), set()
+    elif isinstance(expr_op, HasNode):
+        return False, set(), set([expr_op.label_name])
+    elif isinstance(expr_op, InequalityNode):
+        # The grammar only allows <label> != <string literal>.
+        return (True, set([(expr_op.lhs.label_name, expr_op.rhs.value)]),
+                set())
+    elif isinstance(expr_op, NotInNode):
+        # The grammar only allows <label> not in <set literal>.
+        return (True, set((expr_op.lhs.label_name, v)
+                          for v in expr_op.rhs.value), set())
+    elif isinstance(expr_op, AllNode):
+        return True, set(), set()
+    elif isinstance(expr_op, NegationNode):
+        terms = _index_terms(expr_op.value)
+        if terms is None:
+            return None
+        negated, kvs, keys = terms
+        return not negated, kvs, keys
+    elif isinstance(expr_op, (OrNode, AndNode)):
+        # An '||' of un-negated unions is itself a union.  By De Morgan's
+        # law, an '&&' of negated unions is the negation of a union.
+        want_negated = isinstance(expr_op, AndNode)
+        kvs = set()
+        keys = set()
+        for child in expr_op.exprs:
+            terms = _index_terms(child)
+            if terms is None or terms[0] != want_negated:
+                return None
+            kvs.update(terms[1])
+            keys.update(terms[2])
+        return want_negated, kvs, keys
+    return None
+
+
+class LabelSetIndex(LinearScanLabelIndex):
+    """
+    Wraps a label index, evaluating each distinct set of labels only once.
+
+    Many items, such as the endpoints in one deployment, tend to share
+    identical labels.  This index interns each distinct label dict as a
+    hash-consed, immutable label set and passes only the label sets to the
+    wrapped index as its items.  Match events for a label set are then fanned
+    out to all the items that share it.
+
+    Presents the same interface as the other label indexes, in terms of the
+    real item IDs.
+    """
+
+    def __init__(self, label_index=None):
+        super(LabelSetIndex, self).__init__()
+        if label_index is None:
+            label_index = LabelValueIndex()
+        self.label_index = label_index
+        self.label_index.on_match_started = self._on_set_match_started
+        self.label_index.on_match_stopped = self._on_set_match_stopped
+        # Each label set has an opaque ID, which is also its item ID in the
+        # wrapped index.  Maps the label set's key, a frozenset of its
+        # key/value tuples, to its ID and back.
+        self.set_id_by_label_key = {}
+        self.label_key_by_set_id = {}
+        self.set_id_by_item_id = {}
+        self.item_ids_by_set_id = MultiDict()
+        self._next_set_id = 0
+
+    def on_expression_update(self, expr_id, expr):
+        """
+        Called to update a particular expression.
+
+        Triggers events for match changes.
+        :param expr_id: an opaque (hashable) ID to associate with the
+               expression.  There can only be one expression per ID.
+        :param expr: The SelectorExpression to add to the index or None to
+               remove it.
+        """
+        self.label_index.on_expression_update(expr_id, expr)
+        self._store_expression(expr_id, expr)
+
+    def on_labels_update(self, item_id, new_labels):
+        """
+        Called to update a particular set of labels.
+
+        Triggers events for match changes.
+        :param item_id: an opaque (hashable) ID to associate with the
+               labels.  There can only be one set of labels per ID.
+        :param new_labels: The labels dict to add to the index or None to
+               remove it.
+        """
+        old_set_id = self.set_id_by_item_id.get(item_id)
+        if new_labels is not None:
+            label_key = frozenset(new_labels.iteritems())
+            if (old_set_id is not None and
+                    self.label_key_by_set_id[old_set_id] == label_key):
+                _log.debug("Labels for %s unchanged", item_id)
+                return
+        elif old_set_id is None:
+            _log.debug("Labels for %s already deleted", item_id)
+            return
+        _log.debug("Labels for %s now %s", item_id, new_labels)
+
+        # Add the item to its new label set first so that matches that are
+        # common to the old and new label sets don't flap.
+        set_matches = self.label_index.matches_by_item_id
+        new_set_id = None
+        if new_labels is not None:
+            new_set_id = self.set_id_by_label_key.get(label_key)
+            if new_set_id is None:
+                # First item with this label set, take a private copy of the
+                # labels and pass it to the wrapped index to evaluate.  Its
+                # match events include this item.
+                _log.debug("New label set for %s", item_id)
+                new_set_id = self._next_set_id
+                self._next_set_id += 1
+                self.set_id_by_label_key[label_key] = new_set_id
+                self.label_key_by_set_id[new_set_id] = label_key
+                self.item_ids_by_set_id.add(new_set_id, item_id)
+                self.label_index.on_labels_update(new_set_id,
+                                                  dict(new_labels))
+            else:
+                # Label set already evaluated, just copy its matches.
+                self.item_ids_by_set_id.add(new_set_id, item_id)
+                for expr_id in set_matches.iter_values(new_set_id):
+                    self._store_match(expr_id, item_id)
+            self.set_id_by_item_id[item_id] = new_set_id
+            self.labels_by_item_id[item_id] = \
+                self.label_index.labels_by_item_id[new_set_id]
+        else:
+            del self.set_id_by_item_id[item_id]
+            del self.labels_by_item_id[item_id]
+
+        if old_set_id is not None:
+            self.item_ids_by_set_id.discard(old_set_id, item_id)
+            for expr_id in list(self.matches_by_item_id.iter_values(item_id)):
+                if (new_set_id is None or
+                        not set_matches.contains(new_set_id, expr_id)):
+                    self._discard_match(expr_id, item_id)
+            if old_set_id not in self.item_ids_by_set_id:
+                _log.debug("Last user of label set gone, removing it")
+                label_key = self.label_key_by_set_id.pop(old_set_id)
+                del self.set_id_by_label_key[label_key]
+                self.label_index.on_labels_update(old_set_id, None)
+
+    def on_labels_update_bulk(self, updates, changed_keys):
+        """
+        Called to update the labels of many items at once, where the
+        labels only differ from their previous values in the given keys.
+
+        Where an item is the only user of its label set, and no other label
+        set has its new labels, the label set is relabelled in place.  The
+        wrapped index gets a single bulk update for all such label sets.
+
+        Triggers events for match changes.
+        :param updates: list of (item_id, new_labels) tuples.  new_labels
+               must not be None.
+        :param changed_keys: set of label names.  For items that are
+               already in the index, new_labels must only differ from the
+               item's previous labels in these keys.
+        """
+        set_updates = []
+        remaining_updates = []
+        for item_id, new_labels in updates:
+            set_id = self.set_id_by_item_id.get(item_id)
+            label_key = frozenset(new_labels.iteritems())
+            if (set_id is None or
+                    label_key in self.set_id_by_label_key or
+                    self.item_ids_by_set_id.num_items(set_id) > 1):
+                # Need to create a new label set or move to an existing one.
+                # Defer until the relabelled sets are up to date.
+                remaining_updates.append((item_id, new_labels))
+                continue
+            old_label_key = self.label_key_by_set_id[set_id]
+            del self.set_id_by_label_key[old_label_key]
+            self.set_id_by_label_key[label_key] = set_id
+            self.label_key_by_set_id[set_id] = label_key
+            label_set = dict(new_labels)
+            self.labels_by_item_id[item_id] = label_set
+            set_updates.append((set_id, label_set))
+        _log.debug("Relabelling %s label sets in place", len(set_updates))
+        self.label_index.on_labels_update_bulk(set_updates, changed_keys)
+        for item_id, new_labels in remaining_updates:
+            self.on_labels_update(item_id, new_labels)
+
+    def _on_set_match_started(self, expr_id, set_id):
+        for item_id in self.item_ids_by_set_id.iter_values(set_id):
+            self._store_match(expr_id, item_id)
+
+    def _on_set_match_stopped(self, expr_id, set_id):
+        for item_id in self.item_ids_by_set_id.iter_values(set_id):
+            self._discard_match(expr_id, item_id)
+
+
 class LabelInheritanceIndex(object):
     """
     Wraps a LabelIndex, adding the ability for items to inherit labels
@@ -447,10 +1047,26 @@ class LabelInheritanceIndex(object):
                 self.labels_by_parent_id[parent_id] = labels_or_none
             else:
                 del self.labels_by_parent_id[parent_id]
-            # Mark all the endpoints with this parent dirty.
-            self._dirty_items.update(
-                self.item_ids_by_parent_id.iter_values(parent_id)
-            )
+            # The items' labels can only have changed in the keys that
+            # changed on the parent, which lets the label index update all
+            # the items in one pass.
+            old_parent_labels = old_parent_labels or {}
+            new_parent_labels = labels_or_none or {}
+            changed_keys = set()
+            for key in set(old_parent_labels).union(new_parent_labels):
+                if (old_parent_labels.get(key, NOT_PRESENT) !=
+                        new_parent_labels.get(key, NOT_PRESENT)):
+                    changed_keys.add(key)
+            updates = []
+            for item_id in self.item_ids_by_parent_id.iter_values(parent_id):
+                if item_id in self.labels_by_item_id:
+                    updates.append((item_id,
+                                    self._combined_labels(item_id)))
+                else:
+                    self._dirty_items.add(item_id)
+            _log.debug("Parent labels changed in keys %s, updating %s "
+                       "items", changed_keys, len(updates))
+            self.label_index.on_labels_update_bulk(updates, changed_keys)
         self._flush_updates()
 
     def _flush_updates(self):
@@ -471,23 +1087,35 @@ class LabelInheritanceIndex(object):
             _log.debug("Flushing deletion of %s", item_id)
             self.label_index.on_labels_update(item_id, None)
         else:
-            # May need to combine labels with parents.
-            _log.debug("Combining labels for %s", item_id)
-            combined_labels = {}
-            parent_ids = self.parent_ids_by_item_id.get(item_id, [])
-            _log.debug("Item %s has parents %s", item_id, parent_ids)
-            for parent_id in parent_ids:
-                parent_labels = self.labels_by_parent_id.get(parent_id)
-                _log.debug("Parent %s has labels %s", parent_id, parent_labels)
-                if parent_labels:
-                    combined_labels.update(parent_labels)
-            if combined_labels:
-                # Some contribution from parent, need to combine.
-                _log.debug("Combined labels: %s", combined_labels)
-                combined_labels.update(item_labels)
-            else:
-                # Parent makes no contribution, just use the per-item dict.
-                _log.debug("No parent labels, using item's dict %s",
-                           combined_labels)
-                combined_labels = item_labels
-            self.label_index.on_labels_update(item_id, combined_labels)
+            self.label_index.on_labels_update(
+                item_id, self._combined_labels(item_id, item_labels)
+            )
+
+    def _combined_labels(self, item_id, item_labels=None):
+        """
+        Combines the labels for the given item with those of its parents.
+
+        :returns: the combined labels dict.
+        """
+        if item_labels is None:
+            item_labels = self.labels_by_item_id[item_id]
+        # May need to combine labels with parents.
+        _log.debug("Combining labels for %s", item_id)
+        combined_labels = {}
+        parent_ids = self.parent_ids_by_item_id.get(item_id, [])
+        _log.debug("Item %s has parents %s", item_id, parent_ids)
+        for parent_id in parent_ids:
+            parent_labels = self.labels_by_parent_id.get(parent_id)
+            _log.debug("Parent %s has labels %s", parent_id, parent_labels)
+            if parent_labels:
+                combined_labels.update(parent_labels)
+        if combined_labels:
+            # Some contribution from parent, need to combine.
+            _log.debug("Combined labels: %s", combined_labels)
+            combined_labels.update(item_labels)
+        else:
+            # Parent makes no contribution, just use the per-item dict.
+            _log.debug("No parent labels, using item's dict %s",
+                       combined_labels)
+            combined_labels = item_labels
+        return combined_labels
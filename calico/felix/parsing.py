@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.parsing
+~~~~~~~~~~~~~
+
+Functions to decode and validate the values that Felix reads from etcd.
+
+Kept free of gevent so that the etcd driver process can use them to parse
+values on Felix's behalf; see ValueParser.  KeyFilter lets the driver drop
+the keys that Felix ignores.
+"""
+import logging
+from collections import namedtuple
+
+from calico import common
+from calico.common import ValidationFailed, validate_ip_addr, canonicalise_ip
+from calico.datamodel_v1 import (
+    VERSION_DIR, CONFIG_DIR, PROFILE_DIR, HOST_DIR, POLICY_DIR, READY_KEY,
+    WloadEndpointId, HostEndpointId, TieredPolicyId
+)
+from calico.etcdutils import PathDispatcher, safe_decode_json, intern_list
+
+_log = logging.getLogger(__name__)
+
+# Etcd paths that we care about for use with the PathDispatcher class.
+# We use angle-brackets to name parameters that we want to capture.
+PER_PROFILE_DIR = PROFILE_DIR + "/<profile_id>"
+TAGS_KEY = PER_PROFILE_DIR + "/tags"
+RULES_KEY = PER_PROFILE_DIR + "/rules"
+PROFILE_LABELS_KEY = PER_PROFILE_DIR + "/labels"
+PER_HOST_DIR = HOST_DIR + "/<hostname>"
+HOST_IP_KEY = PER_HOST_DIR + "/bird_ip"
+WORKLOAD_DIR = PER_HOST_DIR + "/workload"
+HOST_IFACE_DIR = PER_HOST_DIR + "/endpoint"
+HOST_IFACE_KEY = PER_HOST_DIR + "/endpoint/<endpoint_id>"
+PER_ORCH_DIR = WORKLOAD_DIR + "/<orchestrator>"
+PER_WORKLOAD_DIR = PER_ORCH_DIR + "/<workload_id>"
+ENDPOINT_DIR = PER_WORKLOAD_DIR + "/endpoint"
+PER_ENDPOINT_KEY = ENDPOINT_DIR + "/<endpoint_id>"
+CONFIG_PARAM_KEY = CONFIG_DIR + "/<config_param>"
+PER_HOST_CONFIG_PARAM_KEY = PER_HOST_DIR + "/config/<config_param>"
+TIER_DATA = POLICY_DIR + "/tier/<tier>/metadata"
+TIERED_PROFILE = POLICY_DIR + "/tier/<tier>/policy/<policy_id>"
+
+IPAM_DIR = VERSION_DIR + "/ipam"
+IPAM_V4_DIR = IPAM_DIR + "/v4"
+POOL_V4_DIR = IPAM_V4_DIR + "/pool"
+CIDR_V4_KEY = POOL_V4_DIR + "/<pool_id>"
+
+
+# Subset of Felix's config that the parse functions depend on.
+ParserConfig = namedtuple("ParserConfig", ["HOSTNAME", "IFACE_PREFIX"])
+
+# Fields of workload and host endpoints on other hosts that Felix uses.  Only
+# the IpsetManager handles remote endpoints; it needs their profiles, labels
+# and IP addresses.
+REMOTE_ENDPOINT_FIELDS = frozenset([
+    "profile_ids",
+    "labels",
+    "ipv4_nets",
+    "ipv6_nets",
+    "expected_ipv4_addrs",
+    "expected_ipv6_addrs",
+])
+
+
+class ValueParser(object):
+    """
+    Decodes and validates the values of the etcd keys that Felix parses
+    before handling them.
+
+    Used by the etcd driver to parse values before they are sent to Felix,
+    which moves the JSON decoding and validation off Felix's main thread.
+    """
+    def __init__(self, config, strip_remote_endpoints=False):
+        """
+        :param config: Felix config, or a ParserConfig containing the
+               relevant subset.
+        :param strip_remote_endpoints: If True, once validated, endpoints
+               on other hosts are stripped down to the REMOTE_ENDPOINT_FIELDS.
+        """
+        self._config = config
+        self._strip_remote_endpoints = strip_remote_endpoints
+        self._dispatcher = PathDispatcher()
+        reg = self._dispatcher.register
+        reg(TAGS_KEY, on_set=self._parse_tags)
+        reg(RULES_KEY, on_set=self._parse_rules)
+        reg(PROFILE_LABELS_KEY, on_set=self._parse_prof_labels)
+        reg(TIER_DATA, on_set=self._parse_tier_data)
+        reg(TIERED_PROFILE, on_set=self._parse_tiered_policy)
+        reg(PER_ENDPOINT_KEY, on_set=self._parse_endpoint)
+        reg(HOST_IFACE_KEY, on_set=self._parse_host_ep)
+        reg(CIDR_V4_KEY, on_set=self._parse_ipam_v4_pool)
+
+    def parse(self, key, value):
+        """
+        Parses the value of the given key, if it is a key that Felix parses.
+
+        :param str key: The etcd key.
+        :param str value: The raw value of the key; must not be None.
+        :returns: tuple of (parsed, value).  If parsed is True, value is the
+                  decoded and validated value, or None if validation failed.
+                  Otherwise, value is the input value, unchanged.
+        """
+        handler, captures = self._dispatcher.lookup_args(key, "set")
+        if handler is None:
+            return False, value
+        return True, handler(value, *captures)
+
+    def _parse_tags(self, value, profile_id):
+        return parse_tags(profile_id, value)
+
+    def _parse_rules(self, value, profile_id):
+        return parse_profile(profile_id, value)
+
+    def _parse_prof_labels(self, value, profile_id):
+        return parse_labels(profile_id, value)
+
+    def _parse_tier_data(self, value, tier):
+        return parse_tier_data(tier, value)
+
+    def _parse_tiered_policy(self, value, tier, policy_id):
+        return parse_policy(TieredPolicyId(tier, policy_id), value)
+
+    def _parse_endpoint(self, value, hostname, orchestrator, workload_id,
+                        endpoint_id):
+        combined_id = WloadEndpointId(hostname, orchestrator, workload_id,
+                                      endpoint_id)
+        endpoint = parse_endpoint(self._config, combined_id, value)
+        return self._maybe_strip(combined_id, endpoint)
+
+    def _parse_host_ep(self, value, hostname, endpoint_id):
+        combined_id = HostEndpointId(hostname, endpoint_id)
+        iface_data = parse_host_ep(self._config, combined_id, value)
+        return self._maybe_strip(combined_id, iface_data)
+
+    def _maybe_strip(self, combined_id, endpoint):
+        if (endpoint is None or
+                not self._strip_remote_endpoints or
+                combined_id.host == self._config.HOSTNAME):
+            return endpoint
+        return strip_remote_endpoint(endpoint)
+
+    def _parse_ipam_v4_pool(self, value, pool_id):
+        return parse_ipam_pool(pool_id, value)
+
+
+class KeyFilter(object):
+    """
+    Decides whether Felix is interested in a (non-directory) etcd key.
+
+    Mirrors the leaf keys that Felix registers with its PathDispatcher.
+    Used by the etcd driver to skip other keys, such as other hosts'
+    config, before they reach its high-water mark tracker or Felix.
+    """
+    def __init__(self, hostname):
+        self._hostname = hostname
+        self._dispatcher = PathDispatcher()
+        reg = self._dispatcher.register
+        for key in [TAGS_KEY, RULES_KEY, PROFILE_LABELS_KEY, TIER_DATA,
+                    TIERED_PROFILE, HOST_IP_KEY, PER_ENDPOINT_KEY,
+                    HOST_IFACE_KEY, CIDR_V4_KEY, CONFIG_PARAM_KEY]:
+            reg(key, on_set=self._any_host)
+        reg(PER_HOST_CONFIG_PARAM_KEY, on_set=self._our_host)
+
+    def is_relevant(self, key):
+        """
+        :returns: True if Felix handles the given key.
+        """
+        if key == READY_KEY:
+            return True
+        check, captures = self._dispatcher.lookup_args(key, "set")
+        return check is not None and check(*captures)
+
+    def _any_host(self, *captures):
+        return True
+
+    def _our_host(self, hostname, config_param):
+        return hostname == self._hostname
+
+
+def strip_remote_endpoint(endpoint):
+    """
+    :returns: a copy of the given (validated) endpoint dict containing only
+              the REMOTE_ENDPOINT_FIELDS.
+    """
+    return dict((k, v) for k, v in endpoint.iteritems()
+                if k in REMOTE_ENDPOINT_FIELDS)
+
+
+def parsed_value(response, parse_fn, *args):
+    """
+    Returns the decoded and validated value from the given etcd response.
+
+    If the driver has already parsed the value (as indicated by the
+    response's "parsed" field), it is returned as-is; the driver protocol
+    preserves the string types and interning that parse_fn would have
+    produced.  Otherwise, returns parse_fn(*args, response.value).
+    """
+    if getattr(response, "parsed", False):
+        return response.value
+    return parse_fn(*(args + (response.value,)))
+
+
+def parse_endpoint(config, combined_id, raw_json):
+    endpoint = safe_decode_json(raw_json,
+                                log_tag="endpoint %s" % combined_id.endpoint)
+    try:
+        common.validate_endpoint(config, combined_id, endpoint)
+    except ValidationFailed as e:
+        _log.warning("Validation failed for endpoint %s, treating as "
+                     "missing: %s; %r", combined_id, e.message, raw_json)
+        endpoint = None
+    else:
+        _log.debug("Validated endpoint : %s", endpoint)
+    return endpoint
+
+
+def parse_host_ep(config, combined_id, raw_json):
+    iface_data = safe_decode_json(raw_json,
+                                  log_tag="iface %s" % combined_id.endpoint)
+    try:
+        common.validate_host_endpoint(config, combined_id, iface_data)
+    except ValidationFailed as e:
+        _log.warning("Validation failed for host endpoint %s, treating as "
+                     "missing: %s; %r", combined_id, e.message, raw_json)
+        iface_data = None
+    else:
+        _log.debug("Validated endpoint : %s", iface_data)
+    return iface_data
+
+
+def parse_tier_data(tier, data):
+    data = safe_decode_json(data, log_tag="tier %s" % tier)
+    try:
+        common.validate_tier_data(tier, data)
+    except ValidationFailed as e:
+        _log.error("Validation failed for tier data for tier %s: %r",
+                   tier, e)
+        return None
+    else:
+        return data
+
+
+def parse_profile(profile_id, raw_json, require_selector=False,
+                  require_order=False):
+    rules = safe_decode_json(raw_json, log_tag="rules %s" % profile_id)
+    try:
+        common.validate_profile(profile_id, rules)
+    except ValidationFailed as e:
+        _log.exception("Validation failed for profile %s rules: %s",
+                       profile_id, rules)
+        return None
+    else:
+        return rules
+
+
+def parse_policy(profile_id, raw_json, require_selector=False,
+                  require_order=False):
+    policy = safe_decode_json(raw_json, log_tag="policy %s" % profile_id)
+    try:
+        common.validate_policy(profile_id, policy)
+    except ValidationFailed as e:
+        _log.exception("Validation failed for policy %s: %s",
+                       profile_id, policy)
+        return None
+    else:
+        return policy
+
+
+def parse_tags(profile_id, raw_json):
+    tags = safe_decode_json(raw_json, log_tag="tags %s" % profile_id)
+    try:
+        common.validate_tags(profile_id, tags)
+    except ValidationFailed:
+        _log.exception("Validation failed for profile %s tags : %s",
+                       profile_id, tags)
+        return None
+    else:
+        # The tags aren't in a top-level object so we need to manually
+        # intern them here.
+        return intern_list(tags)
+
+
+def parse_labels(profile_id, raw_json):
+    labels = safe_decode_json(raw_json,
+                              log_tag="profile labels for %s" % profile_id)
+    try:
+        common.validate_labels(profile_id, labels)
+    except ValidationFailed:
+        _log.exception("Validation failed for profile %s labels : %s",
+                       profile_id, labels)
+        return None
+    else:
+        return labels
+
+
+def parse_host_ip(hostname, raw_value):
+    if raw_value is None or validate_ip_addr(raw_value):
+        return canonicalise_ip(raw_value, None)
+    else:
+        _log.debug("%s has invalid IP: %r", hostname, raw_value)
+        return None
+
+
+def parse_ipam_pool(pool_id, raw_json):
+    pool = safe_decode_json(raw_json, log_tag="ipam pool %s" % pool_id)
+    try:
+        common.validate_ipam_pool(pool_id, pool, 4)
+    except ValidationFailed as e:
+        _log.exception("Validation failed for ipam pool %s: %s; %r",
+                       pool_id, pool, e)
+        return None
+    else:
+        return pool
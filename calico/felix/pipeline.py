@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+felix.pipeline
+~~~~~~~~~~~~~~
+
+Creates the actors that calculate and program the dataplane for one IP
+version.
+"""
+import logging
+
+from calico.felix.dispatch import (HostEndpointDispatchChains,
+                                   WorkloadDispatchChains)
+from calico.felix.endpoint import EndpointManager
+from calico.felix.fipmanager import FloatingIPManager
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.frules import install_global_rules
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.ipsets import IpsetManager
+from calico.felix.masq import MasqueradeManager
+from calico.felix.profilerules import RulesManager
+
+_log = logging.getLogger(__name__)
+
+
+class IpVersionPipeline(object):
+    """
+    The managers and iptables updaters for one IP version.
+
+    Felix runs one pipeline per IP version, either in its main process or,
+    if IpVersionWorkerProcesses is enabled, in a worker process of its own.
+    See calico.felix.workers.
+    """
+    def __init__(self, config, ip_version, status_reporter):
+        assert ip_version in (4, 6)
+        self.config = config
+        self.ip_version = ip_version
+        ip_type = IPV4 if ip_version == 4 else IPV6
+
+        if ip_version == 6:
+            self.raw_updater = IptablesUpdater("raw", ip_version=6,
+                                               config=config)
+        else:
+            self.raw_updater = None
+        self.filter_updater = IptablesUpdater("filter", ip_version=ip_version,
+                                              config=config)
+        self.nat_updater = IptablesUpdater("nat", ip_version=ip_version,
+                                           config=config)
+        self.ipset_mgr = IpsetManager(ip_type, config)
+        if ip_version == 4:
+            self.masq_manager = MasqueradeManager(IPV4, self.nat_updater)
+        else:
+            self.masq_manager = None
+        self.rules_manager = RulesManager(config,
+                                          ip_version,
+                                          self.filter_updater,
+                                          self.ipset_mgr)
+        self.ep_dispatch_chains = WorkloadDispatchChains(
+            config, ip_version, self.filter_updater)
+        self.if_dispatch_chains = HostEndpointDispatchChains(
+            config, ip_version, self.filter_updater)
+        self.fip_manager = FloatingIPManager(config, ip_version,
+                                             self.nat_updater)
+        self.ep_manager = EndpointManager(config,
+                                          ip_type,
+                                          self.filter_updater,
+                                          self.ep_dispatch_chains,
+                                          self.if_dispatch_chains,
+                                          self.rules_manager,
+                                          self.fip_manager,
+                                          status_reporter)
+
+        self.cleanup_updaters = [self.filter_updater, self.nat_updater]
+        self.cleanup_ip_mgrs = [self.ipset_mgr]
+        # Actors that receive updates from the UpdateSplitter.
+        self.managers = [self.ipset_mgr,
+                         self.rules_manager,
+                         self.ep_manager]
+        if ip_version == 4:
+            self.managers.append(self.masq_manager)
+        else:
+            self.managers.append(self.raw_updater)
+        self.managers.append(self.nat_updater)
+
+        self.actors = []
+        if ip_version == 6:
+            self.actors.append(self.raw_updater)
+        self.actors += [self.filter_updater,
+                        self.nat_updater,
+                        self.ipset_mgr]
+        if ip_version == 4:
+            self.actors.append(self.masq_manager)
+        self.actors += [self.rules_manager,
+                        self.ep_dispatch_chains,
+                        self.if_dispatch_chains,
+                        self.ep_manager,
+                        self.fip_manager]
+
+    def install_global_rules(self):
+        """
+        Installs the global iptables rules for this IP version.  Must be
+        called after the actors have been started and before we start
+        polling for updates.
+        """
+        _log.info("Installing global rules for IPv%s.", self.ip_version)
+        # Dispatch chain needs to make its configuration before we insert the
+        # top-level chains.
+        self.if_dispatch_chains.configure_iptables(async=False)
+        if self.ip_version == 4:
+            install_global_rules(self.config, self.filter_updater,
+                                 self.nat_updater, ip_version=4)
+        else:
+            install_global_rules(self.config, self.filter_updater,
+                                 self.nat_updater, ip_version=6,
+                                 raw_updater=self.raw_updater)
@@ -139,6 +139,7 @@ class ReferenceManager(Actor):
                 self.stopping_objects_by_id[object_id].add(obj)
             self.objects_by_id.pop(object_id)
             self.pending_ref_callbacks.pop(object_id, None)
+            self._on_object_unreferenced(object_id, obj)
 
     @actor_message()
     def on_object_cleanup_complete(self, object_id, obj):
@@ -213,6 +214,14 @@ class ReferenceManager(Actor):
         """
         raise NotImplementedError()  # pragma nocover
 
+    def _on_object_unreferenced(self, obj_id, obj):
+        """
+        May be overriden by subclasses, called after the last reference to
+        an object has been released and it has been removed from
+        objects_by_id.
+        """
+        pass
+
     def _create(self, object_id):
         """
         To be overriden by subclasses.
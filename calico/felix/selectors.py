@@ -29,8 +29,9 @@ or
 The main entry point is the parse_selector() function, which converts the
 string representation of a selector into an object.
 
-Selector expressions follow this syntax, defined as a grammar in the
-_define_grammar() function:
+Selector expressions follow this syntax, which is parsed by the _Parser
+class.  (The _define_grammar() function defines the same syntax as a
+pyparsing grammar, which is used as a reference in tests.)
 
     label == "string_literal"  ->  comparison, e.g. my_label == "foo bar"
     label != "string_literal"   ->  not equal; also matches if label is not
@@ -48,9 +49,11 @@ _define_grammar() function:
 """
 
 from base64 import b64encode
+from collections import OrderedDict
 import hashlib
 import logging
 import operator
+import re
 from weakref import WeakValueDictionary
 
 from pyparsing import (QuotedString, Word, Forward, Suppress,
@@ -74,6 +77,32 @@ class ExprNode(object):
     def collect_reqd_values(self, pr_set):
         pass
 
+    def collect_label_names(self, names):
+        """
+        Adds the names of all the labels that this expression refers to
+        to the given set.  The result of evaluating the expression can only
+        depend on the values of those labels.
+        """
+        pass
+
+    def collect_code_fragments(self, fragment_list, constants):
+        """
+        Appends a series of strings to the fragment_list that, when
+        concatenated, form a Python expression that evaluates this
+        expression against a dict called "labels".
+
+        Values from the selector are never put into the code; they are
+        added to the constants dict and referred to by name.
+
+        The default implementation calls our evaluate() method.
+
+        :param fragment_list: list of fragments to add our contribution to.
+        :param constants: dict mapping name to value of the constants that
+               the code uses.
+        """
+        fragment_list.append("%s.evaluate(labels)" %
+                             add_constant(constants, self))
+
     def collect_str_fragments(self, fragment_list):
         """
         Appends a series of strings to the fragment_list that, when
@@ -126,6 +155,21 @@ class NotPresent(object):
     pass
 
 
+# Instance of NotPresent used by compiled expressions.
+NOT_PRESENT = NotPresent()
+
+
+def add_constant(constants, value):
+    """
+    Adds a value to the constants dict used by compiled code.
+
+    :returns: the name that the code should use to refer to the value.
+    """
+    name = "c%d" % len(constants)
+    constants[name] = value
+    return name
+
+
 class LabelNode(ExprNode):
     """
     AST node for a label.
@@ -141,6 +185,9 @@ class LabelNode(ExprNode):
         except KeyError:
             return NotPresent()
 
+    def collect_label_names(self, names):
+        names.add(self.label_name)
+
     def __hash__(self):
         return hash(self.label_name) * 37 + 0x5bce8abd
 
@@ -148,6 +195,12 @@ class LabelNode(ExprNode):
         return (type(other) == type(self) and
                 self.label_name == other.label_name)
 
+    def collect_code_fragments(self, fragment_list, constants):
+        fragment_list.append("labels.get(%s, %s)" % (
+            add_constant(constants, self.label_name),
+            add_constant(constants, NOT_PRESENT)
+        ))
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append(self.label_name)
 
@@ -164,6 +217,9 @@ class HasNode(ExprNode):
     def evaluate(self, labels):
         return self.label_name in labels
 
+    def collect_label_names(self, names):
+        names.add(self.label_name)
+
     def __hash__(self):
         return hash(self.label_name) * 37 + 0x742fe51e
 
@@ -171,6 +227,10 @@ class HasNode(ExprNode):
         return (type(other) == type(self) and
                 self.label_name == other.label_name)
 
+    def collect_code_fragments(self, fragment_list, constants):
+        fragment_list.append("(%s in labels)" %
+                             add_constant(constants, self.label_name))
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append("has(%s)" % self.label_name)
 
@@ -194,6 +254,9 @@ class LiteralNode(ExprNode):
         return (type(other) == type(self) and
                 self.value == other.value)
 
+    def collect_code_fragments(self, fragment_list, constants):
+        fragment_list.append(add_constant(constants, self.value))
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append(repr(self.value))
 
@@ -217,6 +280,9 @@ class SetLiteralNode(ExprNode):
         return (type(other) == type(self) and
                 self.value == other.value)
 
+    def collect_code_fragments(self, fragment_list, constants):
+        fragment_list.append(add_constant(constants, self.value))
+
     def collect_str_fragments(self, fragment_list):
         collect_set_string_fragments(fragment_list, self.value)
 
@@ -252,6 +318,10 @@ class BaseBinaryOpNode(ExprNode):
         return self.operation(self.lhs.evaluate(labels),
                               self.rhs.evaluate(labels))
 
+    def collect_label_names(self, names):
+        self.lhs.collect_label_names(names)
+        self.rhs.collect_label_names(names)
+
     def __hash__(self):
         h = hash(self.__class__)
         h = h * 37 + hash(self.lhs)
@@ -263,6 +333,16 @@ class BaseBinaryOpNode(ExprNode):
                 self.lhs == other.lhs and
                 self.rhs == other.rhs)
 
+    def collect_code_fragments(self, fragment_list, constants):
+        # Our operators all have the same syntax in Python.
+        fragment_list.append("(")
+        self.lhs.collect_code_fragments(fragment_list, constants)
+        fragment_list.append(" ")
+        fragment_list.append(self.operation_str)
+        fragment_list.append(" ")
+        self.rhs.collect_code_fragments(fragment_list, constants)
+        fragment_list.append(")")
+
     def collect_str_fragments(self, fragment_list):
         self.lhs.collect_str_fragments(fragment_list)
         fragment_list.append(" ")
@@ -302,6 +382,15 @@ class LabelToLiteralEqualityNode(BaseBinaryOpNode):
     def collect_reqd_values(self, pr_set):
         pr_set.add((self.lhs, self.rhs))
 
+    def collect_label_names(self, names):
+        names.add(self.lhs)
+
+    def collect_code_fragments(self, fragment_list, constants):
+        fragment_list.append("(labels.get(%s) == %s)" % (
+            add_constant(constants, self.lhs),
+            add_constant(constants, self.rhs)
+        ))
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append(self.lhs)
         fragment_list.append(" == ")
@@ -341,6 +430,15 @@ class LabelInSetLiteralNode(BaseBinaryOpNode):
             # express a requirement if there's only one entry in the set.
             pr_set.update(self.rhs)
 
+    def collect_label_names(self, names):
+        names.add(self.lhs)
+
+    def collect_code_fragments(self, fragment_list, constants):
+        fragment_list.append("(labels.get(%s) in %s)" % (
+            add_constant(constants, self.lhs),
+            add_constant(constants, self.rhs)
+        ))
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append(self.lhs)
         fragment_list.append(" in ")
@@ -374,6 +472,7 @@ class BaseListNode(ExprNode):
     """
     __slots__ = ["exprs"]
     operator_str = None
+    python_operator = None
 
     def __init__(self, exprs):
         self.exprs = exprs
@@ -389,6 +488,25 @@ class BaseListNode(ExprNode):
         return (type(other) == type(self) and
                 self.exprs == other.exprs)
 
+    def collect_label_names(self, names):
+        for expr in self.exprs:
+            expr.collect_label_names(names)
+
+    def collect_code_fragments(self, fragment_list, constants):
+        # The code for our children always evaluates to a bool so Python's
+        # short-circuit "and" and "or" give the right result.
+        fragment_list.append("(")
+        first = True
+        for child in self.exprs:
+            if not first:
+                fragment_list.append(" ")
+                fragment_list.append(self.python_operator)
+                fragment_list.append(" ")
+            else:
+                first = False
+            child.collect_code_fragments(fragment_list, constants)
+        fragment_list.append(")")
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append("(")
         first = True
@@ -408,6 +526,7 @@ class AndNode(BaseListNode):
 
     __slots__ = []
     operator_str = "&&"
+    python_operator = "and"
 
     def evaluate(self, labels):
         for expr in self.exprs:
@@ -433,6 +552,7 @@ class OrNode(BaseListNode):
     """AST node for '||'."""
     __slots__ = []
     operator_str = "||"
+    python_operator = "or"
 
     def evaluate(self, labels):
         for expr in self.exprs:
@@ -496,6 +616,9 @@ class NegationNode(ExprNode):
     def evaluate(self, labels):
         return not self.value.evaluate(labels)
 
+    def collect_label_names(self, names):
+        self.value.collect_label_names(names)
+
     def __hash__(self):
         return hash(self.value) * 37 + 0xa37b8d8c
 
@@ -503,6 +626,11 @@ class NegationNode(ExprNode):
         return (type(other) == type(self) and
                 self.value == other.value)
 
+    def collect_code_fragments(self, fragment_list, constants):
+        fragment_list.append("(not ")
+        self.value.collect_code_fragments(fragment_list, constants)
+        fragment_list.append(")")
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append("! ")
         self.value.collect_str_fragments(fragment_list)
@@ -521,6 +649,9 @@ class AllNode(ExprNode):
     def __eq__(self, other):
         return type(other) == type(self)
 
+    def collect_code_fragments(self, fragment_list, constants):
+        fragment_list.append("True")
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append("all()")
 
@@ -533,19 +664,42 @@ class SelectorExpression(object):
     Top-level expression.  Caches hash and the like for its children.
     """
 
-    __slots__ = ["expr_op", "_hash", "_prereq_values", "_unique_id", "_str",
+    __slots__ = ["expr_op", "expr_str", "_hash", "_prereq_values",
+                 "_label_names", "_unique_id", "_str", "_compiled",
                  "__weakref__"]
 
-    def __init__(self, expr_op):
+    def __init__(self, expr_op, expr_str=None):
         super(SelectorExpression, self).__init__()
         self.expr_op = expr_op
+        # The string that we were parsed from, if known.  Unlike str(self),
+        # it parses back to the same expression even if it contains
+        # non-ASCII characters.
+        self.expr_str = expr_str
         self._hash = hash(expr_op)
         self._unique_id = None
         self._str = None
         self._prereq_values = None
+        self._label_names = None
+        self._compiled = None
 
     def evaluate(self, labels):
-        return self.expr_op.evaluate(labels)
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self.compiled
+        return compiled(labels)
+
+    @property
+    def compiled(self):
+        """
+        A function that evaluates this expression against a labels dict.
+
+        Rather than walking the tree of ExprNodes, the function is compiled
+        from a single Python expression, so evaluating it makes only one
+        Python function call.  Compiled on first use.
+        """
+        if self._compiled is None:
+            self._compiled = compile_expr_op(self.expr_op)
+        return self._compiled
 
     @property
     def required_kvs(self):
@@ -560,6 +714,18 @@ class SelectorExpression(object):
             self.expr_op.collect_reqd_values(self._prereq_values)
         return self._prereq_values
 
+    @property
+    def label_names(self):
+        """
+        The set of label names that this selector refers to.
+
+        For example, selector a == 'b' || has(c) would return set(["a", "c"])
+        """
+        if self._label_names is None:
+            self._label_names = set()
+            self.expr_op.collect_label_names(self._label_names)
+        return self._label_names
+
     @property
     def unique_id(self):
         """
@@ -597,6 +763,27 @@ class SelectorExpression(object):
         return self.__class__.__name__ + "<%s>" % self.__str__()
 
 
+def compile_expr_op(expr_op):
+    """
+    Compiles the given tree of ExprNodes into a function that evaluates it.
+
+    :returns: function that takes a labels dict and returns True if the
+              expression matches it.
+    """
+    fragments = ["lambda labels: "]
+    constants = {}
+    expr_op.collect_code_fragments(fragments, constants)
+    code = "".join(fragments)
+    try:
+        return eval(code, constants)
+    except (SyntaxError, MemoryError, RuntimeError):
+        # Very deeply nested expressions can overflow Python's parser; fall
+        # back to walking the tree.
+        _log.warning("Failed to compile selector, using slow path: %r",
+                     expr_op)
+        return expr_op.evaluate
+
+
 def _define_grammar():
     """
     Creates and returns a copy of the selector grammar.
@@ -668,8 +855,13 @@ class BadSelector(ValueError):
     pass
 
 
-_grammar = _define_grammar()
 _parse_cache = WeakValueDictionary()
+# Strong references to the most recently used expressions, in LRU order.
+# These keep recently-used expressions in _parse_cache even if nothing else
+# refers to them; the size of _parse_cache is bounded by this plus the
+# expressions that are still in use elsewhere.
+_recent_exprs = OrderedDict()
+RECENT_EXPRS_CACHE_SIZE = 1000
 
 
 def parse_selector(expr_str):
@@ -695,6 +887,11 @@ def parse_selector(expr_str):
         _log.debug("Expression %s not found in cache, parsing...", expr_str)
         expr = _parse_no_cache(expr_str)
         _parse_cache[expr_str] = expr
+    # Move to the most-recently-used end of the LRU.
+    _recent_exprs.pop(expr_str, None)
+    _recent_exprs[expr_str] = expr
+    if len(_recent_exprs) > RECENT_EXPRS_CACHE_SIZE:
+        _recent_exprs.popitem(last=False)
     return expr
 
 
@@ -704,11 +901,240 @@ def _parse_no_cache(expr_str):
         expr_op = ALL_OP
     else:
         try:
-            token_list = _grammar.parseString(expr_str)
-        except ParseBaseException:
-            _log.warning("Bad selector %r", expr_str)
+            expr_op = _Parser(expr_str).parse()
+        except _ParseError as e:
+            _log.warning("Bad selector %r: %s", expr_str, e)
+            raise BadSelector(expr_str)
+        except RuntimeError:
+            # Very deeply nested expression overflowed the stack.
+            _log.warning("Bad selector %r: too deeply nested", expr_str)
             raise BadSelector(expr_str)
-        # Returned value is a list/dict hybrid.  Unpacking it as a list
-        # gets the top-level expression object.
-        [expr_op] = token_list
-    return SelectorExpression(expr_op)
+    return SelectorExpression(expr_op, expr_str)
+
+
+class _ParseError(Exception):
+    pass
+
+
+# Tokens are tuples of (kind, value, start, end), where kind is one of
+# these or the operator itself.
+_LABEL = "label"
+_STRING = "string"
+_END = "end"
+
+# Matches the next token, skipping any whitespace before it.  The whitespace
+# characters and the contents of quoted strings match the pyparsing grammar.
+_TOKEN_RE = re.compile(r"""
+    [ \t\n\r]*
+    (?:
+        (?P<label>[%s]+) |
+        "(?P<dq_string>[^"\n\r]*)" |
+        '(?P<sq_string>[^'\n\r]*)' |
+        (?P<op>==|!=|&&|\|\||!|\(|\)|\{|\}|,)
+    )
+""" % re.escape(LABEL_CHARS), re.VERBOSE)
+_TRAILING_WHITESPACE_RE = re.compile(r"[ \t\n\r]*\Z")
+
+# Escaped whitespace in string literals is converted to the real character.
+_ESCAPED_WHITESPACE = [(r"\t", "\t"), (r"\n", "\n"), (r"\f", "\f"),
+                       (r"\r", "\r")]
+
+
+def _tokenize(expr_str):
+    """
+    Splits the selector into tokens.
+
+    :returns: list of tokens, terminated by an _END token.
+    :raises _ParseError: if the selector contains an invalid character or
+            an unterminated string.
+    """
+    tokens = []
+    pos = 0
+    length = len(expr_str)
+    match = _TOKEN_RE.match
+    while True:
+        m = match(expr_str, pos)
+        if m is None:
+            break
+        kind = m.lastgroup
+        start, pos = m.span(kind)
+        if kind == "label":
+            tokens.append((_LABEL, m.group(kind), start, pos))
+        elif kind == "op":
+            op = m.group(kind)
+            tokens.append((op, op, start, pos))
+        else:
+            # Quoted string, the span includes the quotes.
+            value = m.group(kind)
+            if "\\" in value:
+                for escaped, char in _ESCAPED_WHITESPACE:
+                    value = value.replace(escaped, char)
+            tokens.append((_STRING, value, start - 1, pos + 1))
+            pos += 1
+    if pos != length and not _TRAILING_WHITESPACE_RE.match(expr_str, pos):
+        raise _ParseError("unexpected character at %s" % pos)
+    tokens.append((_END, None, length, length))
+    return tokens
+
+
+class _Parser(object):
+    """
+    Recursive-descent parser for selectors.
+
+    Accepts exactly the same language, and produces the same ExprNodes, as
+    the pyparsing grammar defined by _define_grammar(), which is much
+    slower.  In order of increasing precedence:
+
+        expr       := and_expr ( "||" and_expr )*
+        and_expr   := value ( "&&" value )*
+        value      := "!"* ( comparison | "(" expr ")" )
+        comparison := label "==" string | label "!=" string |
+                      label "in" set | label "not" "in" set |
+                      "has(" label ")" | "all()"
+        set        := "{" string ( "," string )* "}"
+    """
+
+    def __init__(self, expr_str):
+        # For compatibility with pyparsing, which expands tabs before
+        # parsing, even inside string literals.
+        self._tokens = _tokenize(expr_str.expandtabs())
+        self._pos = 0
+
+    def parse(self):
+        expr_op = self._parse_or()
+        self._expect(_END)
+        return expr_op
+
+    def _peek(self):
+        return self._tokens[self._pos][0]
+
+    def _peek_at(self, offset):
+        return self._tokens[self._pos + offset][0]
+
+    def _expect(self, kind, value=None):
+        token = self._tokens[self._pos]
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise _ParseError("expected %s at %s" % (value or kind,
+                                                     token[2]))
+        self._pos += 1
+        return token[1]
+
+    def _parse_or(self):
+        exprs = [self._parse_and()]
+        while self._peek() == "||":
+            self._pos += 1
+            exprs.append(self._parse_and())
+        if len(exprs) == 1:
+            return exprs[0]
+        return OrNode(exprs)
+
+    def _parse_and(self):
+        exprs = [self._parse_value()]
+        while self._peek() == "&&":
+            self._pos += 1
+            exprs.append(self._parse_value())
+        if len(exprs) == 1:
+            return exprs[0]
+        return AndNode(exprs)
+
+    def _parse_value(self):
+        negated = False
+        while self._peek() == "!":
+            self._pos += 1
+            negated = not negated
+        if self._peek() == "(":
+            self._pos += 1
+            value = self._parse_or()
+            self._expect(")")
+        else:
+            value = self._parse_comparison()
+        if negated:
+            return NegationNode(value)
+        return value
+
+    def _adjacent(self, offset):
+        """
+        :returns: True if the token at the given offset from the current
+                  one directly follows the token before it, with no
+                  whitespace.
+        """
+        tokens = self._tokens
+        return tokens[self._pos + offset][2] == \
+            tokens[self._pos + offset - 1][3]
+
+    def _parse_comparison(self):
+        tokens = self._tokens
+        label = self._expect(_LABEL)
+        kind = self._peek()
+        if kind == "==":
+            self._pos += 1
+            return LabelToLiteralEqualityNode(tokens=[
+                LabelNode(tokens=[label]),
+                LiteralNode(tokens=[self._expect(_STRING)])
+            ])
+        elif kind == "!=":
+            self._pos += 1
+            return InequalityNode(tokens=[
+                LabelNode(tokens=[label]),
+                LiteralNode(tokens=[self._expect(_STRING)])
+            ])
+        elif kind == _LABEL and tokens[self._pos][1] == "in":
+            self._pos += 1
+            return LabelInSetLiteralNode(tokens=[
+                LabelNode(tokens=[label]),
+                self._parse_set()
+            ])
+        elif kind == _LABEL and tokens[self._pos][1] == "not":
+            self._pos += 1
+            self._expect(_LABEL, "in")
+            return NotInNode(tokens=[
+                LabelNode(tokens=[label]),
+                self._parse_set()
+            ])
+        elif kind == "(" and label == "has" and self._adjacent(0):
+            # "has(" must be written without whitespace.
+            self._pos += 1
+            has_label = self._expect(_LABEL)
+            self._expect(")")
+            return HasNode(tokens=[has_label])
+        elif (kind == "(" and label == "all" and self._adjacent(0) and
+                self._peek_at(1) == ")" and self._adjacent(1)):
+            # "all()" must be written without whitespace.
+            self._pos += 2
+            return AllNode()
+        raise _ParseError("expected comparison at %s" % tokens[self._pos][2])
+
+    def _parse_set(self):
+        self._expect("{")
+        values = [self._expect(_STRING)]
+        while self._peek() == ",":
+            self._pos += 1
+            values.append(self._expect(_STRING))
+        self._expect("}")
+        return SetLiteralNode(tokens=values)
+
+
+def _parse_with_grammar(expr_str):
+    """
+    Parses a selector using the pyparsing grammar from _define_grammar().
+
+    Slow; kept as the reference implementation for testing _Parser.
+
+    :returns: the top-level ExprNode.
+    :raises BadSelector if the input is not a valid selector expression.
+    """
+    global _grammar
+    if _grammar is None:
+        _grammar = _define_grammar()
+    try:
+        token_list = _grammar.parseString(expr_str)
+    except ParseBaseException:
+        raise BadSelector(expr_str)
+    # Returned value is a list/dict hybrid.  Unpacking it as a list
+    # gets the top-level expression object.
+    [expr_op] = token_list
+    return expr_op
+
+
+# Built on first use by _parse_with_grammar().
+_grammar = None
@@ -55,6 +55,7 @@ class UpdateSplitter(object):
         self.selector_mgrs = self._managers_with("on_policy_selector_update")
         self.tier_data_mgrs = self._managers_with("on_tier_data_update")
         self.prof_labels_mgrs = self._managers_with("on_prof_labels_set")
+        self.config_upd_mgrs = self._managers_with("on_config_updated")
 
     def _managers_with(self, method_name):
         return [m for m in self.managers if hasattr(m, method_name)]
@@ -166,6 +167,15 @@ class UpdateSplitter(object):
         for mgr in self.ipam_upd_mgrs:
             mgr.on_ipam_pool_updated(pool_id, pool, async=True)
 
+    def on_config_updated(self):
+        """
+        Called after a change to the config in etcd has been applied to
+        the Config object without a restart.
+        """
+        _log.info("Config updated")
+        for mgr in self.config_upd_mgrs:
+            mgr.on_config_updated(async=True)
+
 
 class CleanupManager(Actor):
     """
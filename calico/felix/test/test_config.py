@@ -20,10 +20,14 @@ Top level tests for Felix configuration.
 """
 
 import logging
+import logging.handlers
+import os
 import re
 import mock
+import shutil
 import socket
 import sys
+import tempfile
 from contextlib import nested
 from calico.felix.config import Config, ConfigException
 from calico.felix.test.base import load_config
@@ -47,6 +51,9 @@ class TestConfig(unittest.TestCase):
         self.compl_log_patch = mock.patch("calico.common.complete_logging",
                                           autospec=True)
         self.compl_log_patch.start()
+        self.upd_log_patch = mock.patch("calico.common.update_logging_levels",
+                                        autospec=True)
+        self.upd_log_patch.start()
 
     def dummy_gethostbyname(self, host):
         if host in ("localhost", "127.0.0.1"):
@@ -57,6 +64,7 @@ class TestConfig(unittest.TestCase):
             raise socket.gaierror("Dummy test error")
 
     def tearDown(self):
+        self.upd_log_patch.stop()
         self.compl_log_patch.stop()
         self.ghbn_patch.stop()
         super(TestConfig, self).tearDown()
@@ -558,6 +566,21 @@ class TestConfig(unittest.TestCase):
 
         self.assertEqual(config.MAX_IPSET_SIZE, 2**20)
 
+    def test_default_endpoint_report_batch_size(self):
+        """
+        Test that the status batch size is defaulted if out of range.
+        """
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = {
+            "InterfacePrefix": "blah",
+            "EndpointReportingBatchSize": "0",
+        }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+
+        self.assertEqual(config.ENDPOINT_REPORT_BATCH_SIZE, 10)
+
     def test_host_if_poll_defaulted(self):
         """
         Test that the poll interval is defaulted if out-of-range
@@ -572,30 +595,161 @@ class TestConfig(unittest.TestCase):
         cfg_dict = {"InterfacePrefix": "blah",
                     "PrometheusMetricsEnabled": True,
                     "PrometheusMetricsPort": 9123,
-                    "EtcdDriverPrometheusMetricsPort": 9124}
+                    "EtcdDriverPrometheusMetricsPort": 9124,
+                    "Ipv4WorkerPrometheusMetricsPort": 9125,
+                    "Ipv6WorkerPrometheusMetricsPort": 9126}
         config = load_config("felix_missing.cfg", host_dict=cfg_dict)
 
         self.assertEqual(config.PROM_METRICS_PORT, 9123)
         self.assertEqual(config.PROM_METRICS_DRIVER_PORT, 9124)
+        self.assertEqual(config.PROM_METRICS_V4_WORKER_PORT, 9125)
+        self.assertEqual(config.PROM_METRICS_V6_WORKER_PORT, 9126)
         self.assertEqual(config.PROM_METRICS_ENABLED, True)
 
     def test_prometheus_port_invalid(self):
         cfg_dict = {"InterfacePrefix": "blah",
                     "PrometheusMetricsEnabled": False,
                     "PrometheusMetricsPort": -1,
-                    "EtcdDriverPrometheusMetricsPort": 65536}
+                    "EtcdDriverPrometheusMetricsPort": 65536,
+                    "Ipv4WorkerPrometheusMetricsPort": 0,
+                    "Ipv6WorkerPrometheusMetricsPort": 70000}
         config = load_config("felix_missing.cfg", host_dict=cfg_dict)
 
         self.assertEqual(config.PROM_METRICS_PORT, 9091)
         self.assertEqual(config.PROM_METRICS_DRIVER_PORT, 9092)
+        self.assertEqual(config.PROM_METRICS_V4_WORKER_PORT, 9093)
+        self.assertEqual(config.PROM_METRICS_V6_WORKER_PORT, 9094)
         self.assertEqual(config.PROM_METRICS_ENABLED, False)
 
+    def test_driver_ring_buffer_size(self):
+        cfg_dict = {"InterfacePrefix": "blah"}
+        config = load_config("felix_missing.cfg", host_dict=cfg_dict)
+        self.assertEqual(config.DRIVER_RING_BUFFER_SIZE, 0)
+
+        config = load_config(
+            "felix_missing.cfg",
+            env_dict={"FELIX_ETCDDRIVERRINGBUFFERSIZE": "-1"},
+            host_dict=cfg_dict
+        )
+        self.assertEqual(config.DRIVER_RING_BUFFER_SIZE, 0)
+
+    def test_driver_watcher_queue_size(self):
+        cfg_dict = {"InterfacePrefix": "blah"}
+        config = load_config("felix_missing.cfg", host_dict=cfg_dict)
+        self.assertEqual(config.DRIVER_WATCHER_QUEUE_SIZE, 20000)
+
+        cfg_dict["EtcdDriverWatcherQueueSize"] = "0"
+        config = load_config("felix_missing.cfg", host_dict=cfg_dict)
+        self.assertEqual(config.DRIVER_WATCHER_QUEUE_SIZE, 20000)
+
+    def test_update_etcd_config_hot_reload(self):
+        host_dict = {"InterfacePrefix": "blah", "LogSeverityFile": "INFO"}
+        config = load_config("felix_missing.cfg", host_dict=host_dict.copy())
+        self.assertEqual(config.LOGLEVFILE, logging.INFO)
+        self.assertEqual(config.MAX_IPSET_SIZE, 2**20)
+
+        # Unchanged parameters are ignored, as are unknown ones.
+        host_dict["Unknown"] = "foo"
+        self.assertTrue(config.update_etcd_config(host_dict, {}))
+
+        host_dict["LogSeverityFile"] = "DEBUG"
+        self.assertTrue(config.update_etcd_config(
+            host_dict, {"MaxIpsetSize": "1234", "LogSeverityFile": "ERROR"}
+        ))
+        # Per-host config takes precedence.
+        self.assertEqual(config.LOGLEVFILE, logging.DEBUG)
+        self.assertEqual(config.MAX_IPSET_SIZE, 1234)
+
+        # Removing a value reverts to the default.
+        self.assertTrue(config.update_etcd_config(
+            {"InterfacePrefix": "blah"}, {}
+        ))
+        self.assertEqual(config.LOGLEVFILE, logging.INFO)
+        self.assertEqual(config.MAX_IPSET_SIZE, 2**20)
+
+    def test_update_etcd_config_logging(self):
+        # Use the real logging setup, restoring the root logger afterwards.
+        self.compl_log_patch.stop()
+        self.upd_log_patch.stop()
+        root_logger = logging.getLogger()
+        old_handlers = root_logger.handlers[:]
+        log_dir = tempfile.mkdtemp()
+        try:
+            log_file = os.path.join(log_dir, "felix.log")
+            with mock.patch.dict("os.environ",
+                                 {"FELIX_LOGFILEPATH": log_file}):
+                config = Config("calico/felix/test/data/felix_missing.cfg")
+            host_dict = {"InterfacePrefix": "blah",
+                         "LogSeverityFile": "INFO"}
+            config.report_etcd_config(host_dict.copy(), {})
+            file_handlers = [
+                h for h in root_logger.handlers
+                if isinstance(h, logging.handlers.WatchedFileHandler)
+            ]
+            self.assertEqual(len(file_handlers), 1)
+            num_handlers = len(root_logger.handlers)
+
+            for interval in ("10", "20", "30"):
+                host_dict["ReportingIntervalSecs"] = interval
+                self.assertTrue(config.update_etcd_config(host_dict, {}))
+            host_dict["LogSeverityFile"] = "WARNING"
+            self.assertTrue(config.update_etcd_config(host_dict, {}))
+
+            self.assertEqual(len(root_logger.handlers), num_handlers)
+            self.assertEqual(file_handlers[0].level, logging.WARNING)
+        finally:
+            for handler in root_logger.handlers[:]:
+                if handler not in old_handlers:
+                    root_logger.removeHandler(handler)
+                    handler.close()
+            logging.disable(logging.NOTSET)
+            shutil.rmtree(log_dir)
+            self.compl_log_patch.start()
+            self.upd_log_patch.start()
+
+    def test_update_etcd_config_restart_required(self):
+        host_dict = {"InterfacePrefix": "blah"}
+        config = load_config("felix_missing.cfg", host_dict=host_dict.copy())
+        self.assertFalse(config.update_etcd_config(
+            {"InterfacePrefix": "tap"}, {}
+        ))
+        self.assertEqual(config.IFACE_PREFIX, "blah")
+        # Enabling/disabling periodic resync requires a restart but changing
+        # the interval doesn't.
+        self.assertFalse(config.update_etcd_config(
+            {"InterfacePrefix": "blah", "PeriodicResyncInterval": "0"}, {}
+        ))
+        self.assertTrue(config.update_etcd_config(
+            {"InterfacePrefix": "blah", "PeriodicResyncInterval": "60"}, {}
+        ))
+        self.assertEqual(config.RESYNC_INTERVAL, 60)
+
+    def test_update_etcd_config_env_overrides(self):
+        config = load_config("felix_missing.cfg",
+                             env_dict={"FELIX_MAXIPSETSIZE": "100"},
+                             host_dict={"InterfacePrefix": "blah"})
+        self.assertTrue(config.update_etcd_config(
+            {"InterfacePrefix": "blah", "MaxIpsetSize": "200"}, {}
+        ))
+        self.assertEqual(config.MAX_IPSET_SIZE, 100)
+
+    def test_update_etcd_config_invalid(self):
+        host_dict = {"InterfacePrefix": "blah"}
+        config = load_config("felix_missing.cfg", host_dict=host_dict.copy())
+        self.assertRaises(ConfigException, config.update_etcd_config,
+                          {"InterfacePrefix": "blah",
+                           "LogSeverityFile": "foo"}, {})
+        self.assertEqual(config.LOGLEVFILE, logging.INFO)
+        self.assertEqual(config.parameters["LogSeverityFile"].value, "INFO")
+
     def test_prometheus_port_defaults(self):
         cfg_dict = {"InterfacePrefix": "blah"}
         config = load_config("felix_missing.cfg", host_dict=cfg_dict)
 
         self.assertEqual(config.PROM_METRICS_PORT, 9091)
         self.assertEqual(config.PROM_METRICS_DRIVER_PORT, 9092)
+        self.assertEqual(config.PROM_METRICS_V4_WORKER_PORT, 9093)
+        self.assertEqual(config.PROM_METRICS_V6_WORKER_PORT, 9094)
         self.assertEqual(config.PROM_METRICS_ENABLED, False)
 
     def test_failsafe_ports_defaults(self):
@@ -65,11 +65,12 @@ class TestBasic(BaseTestCase):
     @mock.patch("calico.felix.frules.HOSTS_IPSET_V4", autospec=True)
     @mock.patch("calico.felix.fetcd.EtcdAPI.load_config")
     @mock.patch("gevent.Greenlet.start", autospec=True)
-    @mock.patch("calico.felix.felix.WorkloadDispatchChains", autospec=True)
-    @mock.patch("calico.felix.felix.HostEndpointDispatchChains", autospec=True)
+    @mock.patch("calico.felix.pipeline.WorkloadDispatchChains", autospec=True)
+    @mock.patch("calico.felix.pipeline.HostEndpointDispatchChains",
+                autospec=True)
     @mock.patch("calico.felix.felix.UpdateSplitter", autospec=True)
-    @mock.patch("calico.felix.felix.IptablesUpdater", autospec=True)
-    @mock.patch("calico.felix.felix.MasqueradeManager", autospec=True)
+    @mock.patch("calico.felix.pipeline.IptablesUpdater", autospec=True)
+    @mock.patch("calico.felix.pipeline.MasqueradeManager", autospec=True)
     @mock.patch("gevent.iwait", autospec=True, side_effect=TestException())
     def test_main_greenlet(self, m_iwait, m_MasqueradeManager,
                            m_IptablesUpdater, m_UpdateSplitter,
@@ -117,7 +118,7 @@ class TestBasic(BaseTestCase):
                                               felix.MetricsHandler)
 
     @mock.patch("calico.felix.felix.load_nf_conntrack", autospec=True)
-    @mock.patch("calico.felix.felix.install_global_rules", autospec=True)
+    @mock.patch("calico.felix.pipeline.install_global_rules", autospec=True)
     @mock.patch("os.path.exists", autospec=True, return_value=False)
     @mock.patch("calico.felix.devices.list_interface_ips", autospec=True)
     @mock.patch("calico.felix.devices.configure_global_kernel_config",
@@ -128,11 +129,12 @@ class TestBasic(BaseTestCase):
     @mock.patch("calico.felix.frules.HOSTS_IPSET_V4", autospec=True)
     @mock.patch("calico.felix.fetcd.EtcdAPI.load_config")
     @mock.patch("gevent.Greenlet.start", autospec=True)
-    @mock.patch("calico.felix.felix.WorkloadDispatchChains", autospec=True)
-    @mock.patch("calico.felix.felix.HostEndpointDispatchChains", autospec=True)
+    @mock.patch("calico.felix.pipeline.WorkloadDispatchChains", autospec=True)
+    @mock.patch("calico.felix.pipeline.HostEndpointDispatchChains",
+                autospec=True)
     @mock.patch("calico.felix.felix.UpdateSplitter", autospec=True)
-    @mock.patch("calico.felix.felix.IptablesUpdater", autospec=True)
-    @mock.patch("calico.felix.felix.MasqueradeManager", autospec=True)
+    @mock.patch("calico.felix.pipeline.IptablesUpdater", autospec=True)
+    @mock.patch("calico.felix.pipeline.MasqueradeManager", autospec=True)
     @mock.patch("gevent.iwait", autospec=True, side_effect=TestException())
     def test_main_greenlet_no_ipv6(self, m_iwait, m_MasqueradeManager,
                                    m_IptablesUpdater, m_UpdateSplitter,
@@ -177,3 +179,53 @@ class TestBasic(BaseTestCase):
 
         # Cover the diags dump function.
         futils.dump_diags()
+
+    @mock.patch("calico.felix.felix.load_nf_conntrack", autospec=True)
+    @mock.patch("calico.felix.pipeline.install_global_rules", autospec=True)
+    @mock.patch("os.path.exists", autospec=True, return_value=False)
+    @mock.patch("calico.felix.devices.list_interface_ips", autospec=True)
+    @mock.patch("calico.felix.devices.configure_global_kernel_config",
+                autospec=True)
+    @mock.patch("calico.felix.futils.Popen", autospec=True)
+    @mock.patch("calico.felix.futils.check_call", autospec=True)
+    @mock.patch("calico.felix.futils.check_output", autospec=True)
+    @mock.patch("calico.felix.frules.HOSTS_IPSET_V4", autospec=True)
+    @mock.patch("calico.felix.fetcd.EtcdAPI.load_config")
+    @mock.patch("gevent.Greenlet.start", autospec=True)
+    @mock.patch("calico.felix.felix.UpdateSplitter", autospec=True)
+    @mock.patch("calico.felix.felix.WorkerProxy", autospec=True)
+    @mock.patch("gevent.iwait", autospec=True, side_effect=TestException())
+    def test_main_greenlet_worker_processes(self, m_iwait, m_WorkerProxy,
+                                            m_UpdateSplitter,
+                                            m_start, m_load,
+                                            m_ipset_4,
+                                            m_check_output, m_check_call,
+                                            m_popen,
+                                            m_configure_global_kernel_config,
+                                            m_list_interface_ips,
+                                            m_path_exists,
+                                            m_install_globals, m_conntrack):
+        m_popen.return_value.communicate.return_value = "", ""
+        m_proxy = m_WorkerProxy.return_value
+        m_proxy.greenlet = mock.Mock()
+        m_proxy.reader_greenlet = mock.Mock()
+        m_list_interface_ips.return_value = set()
+        env_dict = {
+            "FELIX_ETCDADDR": "localhost:4001",
+            "FELIX_FELIXHOSTNAME": "myhost",
+            "FELIX_INTERFACEPREFIX": "tap",
+            "FELIX_METADATAIP": "10.0.0.1",
+            "FELIX_IPVERSIONWORKERPROCESSES": "true",
+        }
+        config = load_config("felix_missing.cfg", env_dict=env_dict)
+
+        with gevent.Timeout(5):
+            self.assertRaises(TestException,
+                              felix._main_greenlet, config)
+        # Without IPv6 support, we only need an IPv4 worker.  It installs
+        # its own global rules.
+        m_WorkerProxy.assert_called_once_with(config, 4, mock.ANY)
+        m_UpdateSplitter.assert_called_once_with([m_proxy])
+        m_proxy.start.assert_called_once_with()
+        self.assertIn(m_proxy.reader_greenlet, m_iwait.mock_calls[0][1][0])
+        self.assertFalse(m_install_globals.called)
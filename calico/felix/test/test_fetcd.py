@@ -31,12 +31,19 @@ from calico.etcddriver.protocol import MessageReader, MessageWriter, \
     MSG_TYPE_UPDATE, MSG_KEY_KEY, MSG_KEY_VALUE, MSG_KEY_TYPE, \
     MSG_KEY_HOST_CONFIG, MSG_KEY_GLOBAL_CONFIG, MSG_TYPE_CONFIG, \
     MSG_KEY_LOG_FILE, MSG_KEY_SEV_FILE, MSG_KEY_SEV_SCREEN, MSG_KEY_SEV_SYSLOG, \
-    STATUS_IN_SYNC, SocketClosed, MSG_KEY_PROM_PORT
-from calico.felix.config import Config
+    STATUS_IN_SYNC, SocketClosed, MSG_KEY_PROM_PORT, MSG_TYPE_UPDATE_BATCH, \
+    MSG_KEY_UPDATES, MSG_KEY_RING_FILE, MSG_KEY_PARSED, \
+    MSG_KEY_PARSER_CONFIG, MSG_KEY_IFACE_PREFIX, \
+    MSG_KEY_STRIP_REMOTE_ENDPOINTS, MSG_KEY_WATCHER_QUEUE_SIZE, \
+    MSG_KEY_FILTER_KEYS, MSG_KEY_ANTI_ENTROPY, MSG_TYPE_RESYNC
+from calico.etcddriver.ringbuffer import RingMessageReader
+from calico.etcdutils import EtcdEvent
+from calico.felix.config import Config, ConfigException
 from calico.felix.futils import IPV4, IPV6
 from calico.felix.ipsets import IpsetActor
 from calico.felix.fetcd import (_FelixEtcdWatcher, EtcdAPI,
-    die_and_restart, EtcdStatusReporter, combine_statuses)
+    die_and_restart, EtcdStatusReporter, combine_statuses,
+    MAX_EVENTS_BEFORE_YIELD)
 from calico.felix.splitter import UpdateSplitter
 from calico.felix.test.base import BaseTestCase, JSONString
 
@@ -104,6 +111,7 @@ class TestEtcdAPI(BaseTestCase):
         self.m_config.ETCD_KEY_FILE = None
         self.m_config.ETCD_CERT_FILE = None
         self.m_config.ETCD_CA_FILE = None
+        self.m_config.ENDPOINT_REPORT_BATCH_SIZE = 10
         self.m_hosts_ipset = Mock(spec=IpsetActor)
         with patch("calico.felix.fetcd._FelixEtcdWatcher",
                    autospec=True) as m_etcd_watcher:
@@ -134,6 +142,7 @@ class TestEtcdAPI(BaseTestCase):
     @patch("gevent.sleep", autospec=True)
     def test_periodic_resync_mainline(self, m_sleep):
         self.m_config.RESYNC_INTERVAL = 10
+        self.m_config.DRIVER_ANTI_ENTROPY = False
         m_configured = Mock(spec=Event)
         self.m_etcd_watcher.configured = m_configured
         with patch.object(self.api, "force_resync") as m_force_resync:
@@ -145,6 +154,20 @@ class TestEtcdAPI(BaseTestCase):
         sleep_time = m_sleep.call_args[0][0]
         self.assertTrue(sleep_time >= 10)
         self.assertTrue(sleep_time <= 12)
+        m_force_resync.assert_called_once_with(reason="periodic resync",
+                                               full=True, async=True)
+
+    @patch("gevent.sleep", autospec=True)
+    def test_periodic_resync_anti_entropy(self, m_sleep):
+        self.m_config.RESYNC_INTERVAL = 10
+        self.m_config.DRIVER_ANTI_ENTROPY = True
+        self.m_etcd_watcher.configured = Mock(spec=Event)
+        with patch.object(self.api, "force_resync") as m_force_resync:
+            m_force_resync.side_effect = ExpectedException()
+            self.assertRaises(ExpectedException,
+                              self.api._periodically_resync)
+        m_force_resync.assert_called_once_with(reason="periodic resync",
+                                               full=False, async=True)
 
     @patch("gevent.sleep", autospec=True)
     def test_periodic_resync_disabled(self, m_sleep):
@@ -162,6 +185,14 @@ class TestEtcdAPI(BaseTestCase):
         m_status_rep.resync.assert_called_once_with(async=True)
         self.assertTrue(self.m_etcd_watcher.resync_requested)
 
+    def test_force_resync_anti_entropy(self):
+        self.m_config.REPORT_ENDPOINT_STATUS = False
+        self.m_etcd_watcher.resync_requested = False
+        self.api.force_resync(full=False, async=True)
+        self.step_actor(self.api)
+        self.assertTrue(self.m_etcd_watcher.anti_entropy_requested)
+        self.assertFalse(self.m_etcd_watcher.resync_requested)
+
     def test_load_config(self):
         result = self.api.load_config(async=True)
         self.step_actor(self.api)
@@ -202,6 +233,10 @@ class TestEtcdWatcher(BaseTestCase):
         self.m_config.ETCD_KEY_FILE = None
         self.m_config.ETCD_CERT_FILE = None
         self.m_config.ETCD_CA_FILE = None
+        self.m_config.DRIVER_RING_BUFFER_SIZE = 0
+        self.m_config.DRIVER_PARSES_VALUES = False
+        self.m_config.DRIVER_WATCHER_QUEUE_SIZE = 20000
+        self.m_config.DRIVER_ANTI_ENTROPY = False
         self.m_hosts_ipset = Mock(spec=IpsetActor)
         self.m_api = Mock(spec=EtcdAPI)
         self.m_status_rep = Mock(spec=EtcdStatusReporter)
@@ -261,6 +296,20 @@ class TestEtcdWatcher(BaseTestCase):
         m_die.side_effect = ExpectedException()
         self.assertRaises(ExpectedException,
                           self.watcher._loop_reading_from_driver)
+        self.assertEqual(self.m_writer.send_message.mock_calls,
+                         [call(MSG_TYPE_RESYNC)])
+
+    @patch("calico.felix.fetcd.die_and_restart", autospec=True)
+    def test_read_loop_anti_entropy(self, m_die):
+        self.m_reader.new_messages.side_effect = iter([iter([]), iter([])])
+        self.m_driver_proc.poll.side_effect = iter([None, 1])
+        self.watcher.anti_entropy_requested = True
+        m_die.side_effect = ExpectedException()
+        self.assertRaises(ExpectedException,
+                          self.watcher._loop_reading_from_driver)
+        self.assertEqual(self.m_writer.send_message.mock_calls,
+                         [call(MSG_TYPE_RESYNC, {MSG_KEY_ANTI_ENTROPY: True})])
+        self.assertFalse(self.watcher.anti_entropy_requested)
 
     def test_dispatch_from_driver(self):
         for msg_type, expected_method in [
@@ -272,6 +321,28 @@ class TestEtcdWatcher(BaseTestCase):
                 self.watcher._dispatch_msg_from_driver(msg_type, msg)
                 self.assertEqual(m_meth.mock_calls, [call(msg)])
 
+    @patch("gevent.sleep")
+    def test_dispatch_update_batch(self, m_sleep):
+        self.watcher.msgs_processed = MAX_EVENTS_BEFORE_YIELD - 1
+        with patch.object(self.watcher, "_on_key_updated") as m_upd:
+            self.watcher._dispatch_msg_from_driver(MSG_TYPE_UPDATE_BATCH, {
+                MSG_KEY_TYPE: MSG_TYPE_UPDATE_BATCH,
+                MSG_KEY_UPDATES: [
+                    ["/calico/v1/Ready", "true"],
+                    ["/calico/v1/foo", None],
+                    ["/calico/v1/bar", {"a": "b"}, True],
+                ],
+            })
+        self.assertEqual(m_upd.mock_calls, [
+            call("/calico/v1/Ready", "true"),
+            call("/calico/v1/foo", None),
+            call("/calico/v1/bar", {"a": "b"}, True),
+        ])
+        # Yield is per-update, not per-message.
+        self.assertEqual(m_sleep.mock_calls, [call(0.000001)])
+        self.assertEqual(self.watcher.msgs_processed,
+                         MAX_EVENTS_BEFORE_YIELD + 2)
+
     def test_dispatch_from_driver_unexpected(self):
         self.assertRaises(RuntimeError,
                           self.watcher._dispatch_msg_from_driver,
@@ -296,6 +367,34 @@ class TestEtcdWatcher(BaseTestCase):
             })
         m_begin.wait.assert_called_once_with()
 
+    def test_on_parsed_update_from_driver(self):
+        self.watcher.configured.set()
+        self.watcher.begin_polling.set()
+        with patch.object(self.watcher.dispatcher,
+                          "handle_event") as m_handle:
+            self.watcher._on_update_from_driver({
+                MSG_KEY_TYPE: MSG_TYPE_UPDATE,
+                MSG_KEY_KEY: "/calico/v1/foo",
+                MSG_KEY_VALUE: None,
+                MSG_KEY_PARSED: True,
+            })
+        # A parsed value of None is a failed validation, not a deletion.
+        self.assertEqual(m_handle.mock_calls, [
+            call(EtcdEvent("set", "/calico/v1/foo", None, True)),
+        ])
+
+    def test_on_config_loaded_driver_parses_values(self):
+        self.m_config.DRIVER_PARSES_VALUES = True
+        self.watcher._on_config_loaded_from_driver({
+            MSG_KEY_GLOBAL_CONFIG: {},
+            MSG_KEY_HOST_CONFIG: {},
+        })
+        _, (msg_type, msg), _ = self.m_writer.send_message.mock_calls[0]
+        self.assertEqual(msg_type, MSG_TYPE_CONFIG)
+        self.assertEqual(msg[MSG_KEY_PARSER_CONFIG],
+                         {MSG_KEY_IFACE_PREFIX: "tap",
+                          MSG_KEY_STRIP_REMOTE_ENDPOINTS: True})
+
     @patch("calico.felix.fetcd.die_and_restart", autospec=True)
     def test_on_config_loaded(self, m_die):
         self.m_config.DRIVERLOGFILE = "/tmp/driver.log"
@@ -321,19 +420,47 @@ class TestEtcdWatcher(BaseTestCase):
                       MSG_KEY_SEV_SCREEN: self.m_config.LOGLEVSCR,
                       MSG_KEY_SEV_SYSLOG: self.m_config.LOGLEVSYS,
                       MSG_KEY_PROM_PORT: 9092,
+                      MSG_KEY_WATCHER_QUEUE_SIZE: 20000,
+                      MSG_KEY_FILTER_KEYS: True,
+                      MSG_KEY_ANTI_ENTROPY: False,
                   })]
         )
         self.assertEqual(m_die.mock_calls, [])
 
-        # Check a subsequent config change results in Felix dying.
+        # Check a subsequent config change that can't be applied results in
+        # Felix dying.
+        self.m_config.update_etcd_config.return_value = False
         global_config = {"InterfacePrefix": "not!tap"}
         local_config = {"LogSeverityFile": "not!DEBUG"}
         self.watcher._on_config_loaded_from_driver({
             MSG_KEY_GLOBAL_CONFIG: global_config,
             MSG_KEY_HOST_CONFIG: local_config,
         })
+        self.m_config.update_etcd_config.assert_called_once_with(
+            local_config, global_config
+        )
         self.assertEqual(m_die.mock_calls, [call()])
 
+    @patch("calico.felix.fetcd.die_and_restart", autospec=True)
+    def test_on_config_loaded_hot_reload(self, m_die):
+        self.watcher.configured.set()
+        self.watcher.last_global_config = {"InterfacePrefix": "tap"}
+        self.watcher.last_host_config = {}
+        self.m_config.update_etcd_config.return_value = True
+        local_config = {"LogSeverityFile": "DEBUG"}
+        self.watcher._on_config_loaded_from_driver({
+            MSG_KEY_GLOBAL_CONFIG: {"InterfacePrefix": "tap"},
+            MSG_KEY_HOST_CONFIG: local_config,
+        })
+        self.assertEqual(m_die.mock_calls, [])
+        self.assertEqual(self.watcher.last_host_config, local_config)
+        # No change, no update.
+        self.watcher._on_config_loaded_from_driver({
+            MSG_KEY_GLOBAL_CONFIG: {"InterfacePrefix": "tap"},
+            MSG_KEY_HOST_CONFIG: local_config,
+        })
+        self.assertEqual(len(self.m_config.update_etcd_config.mock_calls), 1)
+
     def test_on_status_from_driver(self):
         self.watcher._on_status_from_driver({
             MSG_KEY_STATUS: STATUS_RESYNC
@@ -383,6 +510,30 @@ class TestEtcdWatcher(BaseTestCase):
         m_exists.assert_called_once_with("/run")
         m_timeout.assert_called_once_with(10)
 
+    @patch("calico.felix.fetcd.RingBuffer", autospec=True)
+    @patch("os.path.exists", autospec=True)
+    @patch("subprocess.Popen")
+    @patch("gevent.Timeout", autospec=True)
+    @patch("socket.socket")
+    @patch("os.unlink")
+    def test_start_driver_ring_buffer(self, m_unlink, m_socket, m_timeout,
+                                      m_popen, m_exists, m_ring_buffer):
+        self.m_config.DRIVER_RING_BUFFER_SIZE = 1024
+        m_exists.return_value = True
+        m_sck = Mock()
+        m_socket.return_value = m_sck
+        m_conn = Mock()
+        m_sck.accept.return_value = m_conn, None
+        with patch("calico.felix.fetcd.MessageWriter",
+                   autospec=True) as m_writer_cls:
+            reader, writer = self.watcher._start_driver()
+        self.assertEqual(m_ring_buffer.create.mock_calls,
+                         [call("/run/felix-driver.ring", 1024)])
+        self.assertTrue(isinstance(reader, RingMessageReader))
+        init_msg = m_writer_cls.return_value.send_message.mock_calls[0]
+        self.assertEqual(init_msg[1][1][MSG_KEY_RING_FILE],
+                         "/run/felix-driver.ring")
+
     @patch("calico.felix.fetcd.sys")
     @patch("os.path.exists", autospec=True)
     @patch("subprocess.Popen")
@@ -436,13 +587,50 @@ class TestEtcdWatcher(BaseTestCase):
     @patch("calico.felix.fetcd.die_and_restart", autospec=True)
     def test_config_set(self, m_die):
         self.watcher.last_global_config = {}
+        self.watcher.last_host_config = {}
+        self.m_config.update_etcd_config.return_value = False
         self.dispatch("/calico/v1/config/InterfacePrefix",
                       "set", value="foo")
+        self.m_config.update_etcd_config.assert_called_once_with(
+            {}, {"InterfacePrefix": "foo"}
+        )
+        self.assertEqual(m_die.mock_calls, [call()])
+        self.assertEqual(self.watcher.last_global_config, {})
+
+    @patch("calico.felix.fetcd.die_and_restart", autospec=True)
+    def test_config_set_hot_reload(self, m_die):
+        self.watcher.last_global_config = {"LogSeverityFile": "INFO"}
+        self.watcher.last_host_config = {}
+        self.m_config.update_etcd_config.return_value = True
+        self.dispatch("/calico/v1/config/LogSeverityFile",
+                      "set", value="DEBUG")
+        self.assertEqual(m_die.mock_calls, [])
+        self.assertEqual(self.watcher.last_global_config,
+                         {"LogSeverityFile": "DEBUG"})
+        self.dispatch("/calico/v1/config/LogSeverityFile", "delete")
+        self.assertEqual(m_die.mock_calls, [])
+        self.assertEqual(self.watcher.last_global_config, {})
+        # The splitter passes each applied update on to any worker
+        # processes.
+        self.assertEqual(self.m_splitter.on_config_updated.mock_calls,
+                         [call(), call()])
+
+    @patch("calico.felix.fetcd.die_and_restart", autospec=True)
+    def test_config_set_invalid(self, m_die):
+        self.watcher.last_global_config = {}
+        self.watcher.last_host_config = {}
+        self.m_config.update_etcd_config.side_effect = ConfigException(
+            "Invalid", Mock()
+        )
+        self.dispatch("/calico/v1/config/LogSeverityFile",
+                      "set", value="foo")
         self.assertEqual(m_die.mock_calls, [call()])
 
     @patch("calico.felix.fetcd.die_and_restart", autospec=True)
     def test_host_config_set(self, m_die):
         self.watcher.last_host_config = {}
+        self.watcher.last_global_config = {}
+        self.m_config.update_etcd_config.return_value = False
         self.dispatch("/calico/v1/host/notourhostname/config/InterfacePrefix",
                       "set", value="foo")
         self.dispatch("/calico/v1/host/hostname/config/InterfacePrefix",
@@ -457,6 +645,22 @@ class TestEtcdWatcher(BaseTestCase):
             VALID_ENDPOINT,
         )
 
+    def test_endpoint_set_parsed(self):
+        self.dispatch("/calico/v1/host/h1/workload/o1/w1/endpoint/e1",
+                      "set", value=VALID_ENDPOINT, parsed=True)
+        self.m_splitter.on_endpoint_update.assert_called_once_with(
+            WloadEndpointId("h1", "o1", "w1", "e1"),
+            VALID_ENDPOINT,
+        )
+
+    def test_endpoint_set_parsed_invalid(self):
+        self.dispatch("/calico/v1/host/h1/workload/o1/w1/endpoint/e1",
+                      "set", value=None, parsed=True)
+        self.m_splitter.on_endpoint_update.assert_called_once_with(
+            WloadEndpointId("h1", "o1", "w1", "e1"),
+            None,
+        )
+
     def test_endpoint_set_bad_json(self):
         self.dispatch("/calico/v1/host/h1/workload/o1/w1/endpoint/e1",
                       "set", value="{")
@@ -711,10 +915,18 @@ class TestEtcdWatcher(BaseTestCase):
         m_sleep.assert_called_once_with(2)
         m_exit.assert_called_once_with(1)
 
-    def dispatch(self, key, action, value=None):
+    def dispatch(self, key, action, value=None, parsed=False):
         """
         Send an EtcdResult to the watcher's dispatcher.
+
+        If parsed is True, sends an EtcdEvent containing a value that has
+        been parsed by the driver instead.
         """
+        if parsed:
+            self.watcher.dispatcher.handle_event(
+                EtcdEvent(action, key, value, parsed=True)
+            )
+            return
         m_response = Mock(spec=EtcdResult)
         m_response.key = key
         m_response.action = action
@@ -812,6 +1024,7 @@ class TestEtcdStatusReporter(BaseTestCase):
         self.m_config.HOSTNAME = "foo"
         self.m_config.REPORT_ENDPOINT_STATUS = True
         self.m_config.ENDPOINT_REPORT_DELAY = 1
+        self.m_config.ENDPOINT_REPORT_BATCH_SIZE = 1
         self.m_client = Mock()
         self.rep = EtcdStatusReporter(self.m_config)
         self.rep.client = self.m_client
@@ -843,7 +1056,7 @@ class TestEtcdStatusReporter(BaseTestCase):
             [call(ANY, self.rep._on_timer_pop, async=True)]
         )
         self.assertTrue(self.rep._timer_scheduled)
-        self.assertFalse(self.rep._reporting_allowed)
+        self.assertEqual(self.rep._write_tokens, 0)
 
         # Send in another update, shouldn't get written until we pop the timer.
         self.m_client.reset_mock()
@@ -887,7 +1100,7 @@ class TestEtcdStatusReporter(BaseTestCase):
         self.assertTrue(spawn_delay <= 1.10001)
 
         self.assertTrue(self.rep._timer_scheduled)
-        self.assertFalse(self.rep._reporting_allowed)
+        self.assertEqual(self.rep._write_tokens, 0)
         # Cache should be cleaned up.
         self.assertEqual(self.rep._endpoint_status[IPV4], {})
         # Nothing queued.
@@ -920,6 +1133,70 @@ class TestEtcdStatusReporter(BaseTestCase):
         self.assertEqual(self.rep._newer_dirty_endpoints, set([endpoint_id]))
         self.assertEqual(self.rep._older_dirty_endpoints, set())
 
+    def test_on_endpoint_status_batch(self):
+        self.m_config.ENDPOINT_REPORT_BATCH_SIZE = 3
+        self.rep._write_tokens = 3
+        ep_ids = [WloadEndpointId("foo", "bar", "baz", "ep%s" % i)
+                  for i in xrange(5)]
+        with patch("gevent.spawn_later", autospec=True) as m_spawn:
+            for ep_id in ep_ids:
+                self.rep.on_endpoint_status_changed(ep_id, IPV4,
+                                                    {"status": "up"},
+                                                    async=True)
+            self.step_actor(self.rep)
+        # Should write one batch's worth of statuses then wait for the
+        # timer.
+        self.assertEqual(len(self.m_client.set.mock_calls), 3)
+        self.assertEqual(self.rep._write_tokens, 0)
+        self.assertEqual(
+            m_spawn.mock_calls,
+            [call(ANY, self.rep._on_timer_pop, async=True)]
+        )
+        self.assertEqual(len(self.rep._older_dirty_endpoints), 2)
+
+        # Popping the timer refills the bucket, allowing the rest to be
+        # written.
+        with patch("gevent.spawn_later", autospec=True) as m_spawn:
+            self.rep._on_timer_pop(async=True)
+            self.step_actor(self.rep)
+        self.assertEqual(len(self.m_client.set.mock_calls), 5)
+        written = set(c[1][0] for c in self.m_client.set.mock_calls)
+        self.assertEqual(written,
+                         set(ep_id.path_for_status for ep_id in ep_ids))
+        self.assertEqual(self.rep._write_tokens, 1)
+        self.assertTrue(self.rep._timer_scheduled)
+        self.assertEqual(self.rep._older_dirty_endpoints, set())
+        self.assertEqual(self.rep._newer_dirty_endpoints, set())
+
+    def test_on_endpoint_status_batch_failure_not_retried_in_batch(self):
+        self.m_config.ENDPOINT_REPORT_BATCH_SIZE = 3
+        self.rep._write_tokens = 3
+        ep_id_1 = WloadEndpointId("foo", "bar", "baz", "ep1")
+        ep_id_2 = WloadEndpointId("foo", "bar", "baz", "ep2")
+        for ep_id in [ep_id_1, ep_id_2]:
+            self.rep._endpoint_status[IPV4][ep_id] = {"status": "up"}
+        self.rep._older_dirty_endpoints.add(ep_id_1)
+        self.rep._newer_dirty_endpoints.add(ep_id_2)
+        self.m_client.set.side_effect = EtcdException()
+        with patch("gevent.spawn_later", autospec=True):
+            self.rep._finish_msg_batch([], [])
+        # Both endpoints tried once, even though there was a spare token.
+        self.assertEqual(len(self.m_client.set.mock_calls), 2)
+        self.assertEqual(self.rep._write_tokens, 1)
+        # Both re-queued for the next batch.
+        self.assertEqual(self.rep._newer_dirty_endpoints,
+                         set([ep_id_1, ep_id_2]))
+        self.assertEqual(self.rep._older_dirty_endpoints, set())
+
+    def test_on_endpoint_status_unexpected_error(self):
+        ep_id = WloadEndpointId("foo", "bar", "baz", "ep1")
+        self.rep._endpoint_status[IPV4][ep_id] = {"status": "up"}
+        self.rep._older_dirty_endpoints.add(ep_id)
+        self.m_client.set.side_effect = RuntimeError()
+        with patch("gevent.spawn_later", autospec=True):
+            self.assertRaises(RuntimeError, self.rep._finish_msg_batch,
+                              [], [])
+
     def test_on_endpoint_status_changed_disabled(self):
         self.m_config.REPORT_ENDPOINT_STATUS = False
         endpoint_id = WloadEndpointId("foo", "bar", "baz", "biff")
@@ -974,11 +1251,120 @@ class TestEtcdStatusReporter(BaseTestCase):
         self.assertEqual(self.rep._older_dirty_endpoints, set())
         self.assertEqual(self.rep._newer_dirty_endpoints, set())
 
-        self.rep.resync(async=True)
-        self.step_actor(self.rep)
+        self.m_client.read.side_effect = EtcdException()
+        with patch("gevent.spawn_later", autospec=True) as m_spawn:
+            self.rep.resync(async=True)
+            self.step_actor(self.rep)
 
         self.assertEqual(self.rep._older_dirty_endpoints, set())
         self.assertEqual(self.rep._newer_dirty_endpoints, set([endpoint_id, endpoint_id_2]))
+        # Cache discarded, re-read of etcd still pending.
+        self.assertEqual(self.rep._statuses_in_etcd, {})
+        self.assertTrue(self.rep._status_refresh_pending)
+
+    def test_resync_skips_unchanged(self):
+        ep_id = WloadEndpointId("foo", "bar", "baz", "biff")
+        ep_id_2 = WloadEndpointId("foo", "bar", "baz", "boff")
+        self.rep._endpoint_status[IPV4][ep_id] = {"status": "up"}
+        self.rep._endpoint_status[IPV4][ep_id_2] = {"status": "up"}
+        # etcd has the right status for one endpoint and a stale status for
+        # the other.
+        self.m_client.read.return_value.leaves = [
+            self.status_node(ep_id, {"status": "up"}),
+            self.status_node(ep_id_2, {"status": "down"}),
+        ]
+        self.m_config.ENDPOINT_REPORT_BATCH_SIZE = 10
+        self.rep._write_tokens = 10
+        with patch("gevent.spawn_later", autospec=True):
+            self.rep.resync(async=True)
+            self.step_actor(self.rep)
+        self.assertEqual(
+            self.m_client.set.mock_calls,
+            [call(ep_id_2.path_for_status, JSONString({"status": "up"}))]
+        )
+        self.assertFalse(self.rep._status_refresh_pending)
+        self.assertEqual(self.rep._newer_dirty_endpoints, set())
+        self.assertEqual(self.rep._older_dirty_endpoints, set())
+        self.assertEqual(self.rep._statuses_in_etcd,
+                         {ep_id: {"status": "up"},
+                          ep_id_2: {"status": "up"}})
+
+    def test_cleanup_seeds_cache(self):
+        ep_id = WloadEndpointId("foo", "bar", "baz", "biff")
+        ep_id_2 = WloadEndpointId("foo", "bar", "baz", "boff")
+        bad_node = self.status_node(ep_id_2, None)
+        bad_node.value = "{"
+        self.m_client.read.return_value.leaves = [
+            self.status_node(ep_id, {"status": "up"}),
+            bad_node,
+        ]
+        self.m_config.ENDPOINT_REPORT_BATCH_SIZE = 10
+        self.rep._write_tokens = 10
+        with patch("gevent.spawn_later", autospec=True):
+            self.rep.clean_up_endpoint_statuses(async=True)
+            self.rep.on_endpoint_status_changed(ep_id, IPV4,
+                                                {"status": "up"},
+                                                async=True)
+            self.rep.on_endpoint_status_changed(ep_id_2, IPV4,
+                                                {"status": "up"},
+                                                async=True)
+            self.step_actor(self.rep)
+        # Status matching etcd skipped, invalid one overwritten.
+        self.assertEqual(
+            self.m_client.set.mock_calls,
+            [call(ep_id_2.path_for_status, JSONString({"status": "up"}))]
+        )
+        # Skipped writes don't use up tokens.
+        self.assertEqual(self.rep._write_tokens, 9)
+
+        # Deleting a status that isn't in etcd is skipped too.
+        ep_id_3 = WloadEndpointId("foo", "bar", "baz", "buff")
+        with patch("gevent.spawn_later", autospec=True):
+            self.rep.on_endpoint_status_changed(ep_id_3, IPV4, None,
+                                                async=True)
+            self.step_actor(self.rep)
+        self.assertFalse(self.m_client.delete.called)
+
+        # Host endpoint statuses aren't read so we can't tell whether they're
+        # in etcd; the delete is always done.
+        hep_id = HostEndpointId("foo", "eth0")
+        with patch("gevent.spawn_later", autospec=True):
+            self.rep.on_endpoint_status_changed(hep_id, IPV4, None,
+                                                async=True)
+            self.step_actor(self.rep)
+        self.assertEqual(self.m_client.delete.mock_calls[0],
+                         call(hep_id.path_for_status))
+
+        # But a real change is written.
+        with patch("gevent.spawn_later", autospec=True):
+            self.rep.on_endpoint_status_changed(ep_id, IPV4,
+                                                {"status": "down"},
+                                                async=True)
+            self.step_actor(self.rep)
+        self.assertEqual(
+            self.m_client.set.mock_calls[-1],
+            call(ep_id.path_for_status, JSONString({"status": "down"}))
+        )
+        self.assertEqual(self.rep._statuses_in_etcd[ep_id],
+                         {"status": "down"})
+
+    def test_failed_write_uncached(self):
+        ep_id = WloadEndpointId("foo", "bar", "baz", "biff")
+        self.rep._statuses_in_etcd[ep_id] = {"status": "up"}
+        self.rep._endpoint_status[IPV4][ep_id] = {"status": "down"}
+        self.rep._older_dirty_endpoints.add(ep_id)
+        self.m_client.set.side_effect = EtcdException()
+        with patch("gevent.spawn_later", autospec=True):
+            self.rep._finish_msg_batch([], [])
+        self.assertEqual(self.rep._statuses_in_etcd, {})
+        self.assertEqual(self.rep._newer_dirty_endpoints, set([ep_id]))
+
+    def status_node(self, ep_id, status):
+        node = Mock()
+        node.key = ep_id.path_for_status
+        node.value = json.dumps(status)
+        node.dir = False
+        return node
 
     def test_combine_statuses(self):
         """
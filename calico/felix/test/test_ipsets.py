@@ -21,7 +21,6 @@ Unit tests for the IpsetManager.
 from collections import defaultdict
 
 import logging
-from pprint import pformat
 
 from calico.felix.selectors import parse_selector, SelectorExpression
 from mock import *
@@ -31,7 +30,7 @@ from calico.datamodel_v1 import WloadEndpointId, HostEndpointId
 from calico.felix.futils import IPV4, FailedSystemCall, CommandOutput, IPV6
 from calico.felix.ipsets import (EndpointData, IpsetManager, IpsetActor,
                                  RefCountedIpsetActor, EMPTY_ENDPOINT_DATA, Ipset,
-                                 list_ipset_names)
+                                 list_ipset_names, TagMembershipIndex)
 from calico.felix.refcount import CREATED
 from calico.felix.test.base import BaseTestCase
 
@@ -186,8 +185,15 @@ class TestIpsetManager(BaseTestCase):
             self.assertEqual(m_maybe_start.mock_calls,
                              [call("tag-123")])
 
+    def incref_tags(self, *tag_ids):
+        # Only referenced tags have their members tracked.
+        for tag_id in tag_ids:
+            self.mgr.get_and_incref(tag_id, callback=self.on_ref_acquired,
+                                    async=True)
+
     def test_tag_then_endpoint(self):
         # Send in the messages.
+        self.incref_tags("tag1")
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         # Let the actor process them.
@@ -201,6 +207,7 @@ class TestIpsetManager(BaseTestCase):
 
     def test_endpoint_then_tag(self):
         # Send in the messages.
+        self.incref_tags("tag1")
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         # Let the actor process them.
@@ -208,6 +215,7 @@ class TestIpsetManager(BaseTestCase):
         self.assert_one_ep_one_tag()
 
     def test_endpoint_then_tag_idempotent(self):
+        self.incref_tags("tag1")
         for _ in xrange(3):
             # Send in the messages.
             self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
@@ -216,11 +224,49 @@ class TestIpsetManager(BaseTestCase):
             self.step_mgr()
             self.assert_one_ep_one_tag()
 
+    def test_unreferenced_tag_not_indexed(self):
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_tags_update("prof1", ["tag1"], async=True)
+        self.step_mgr()
+        self.assert_tag_owners({})
+        self.assertEqual(self.mgr.prof_ids_by_tag, {"tag1": set(["prof1"])})
+        # Referencing the tag calculates its members.
+        self.incref_tags("tag1")
+        self.step_mgr()
+        self.assert_one_ep_one_tag()
+        # Releasing the reference removes them again.
+        self.mgr.decref("tag1", async=True)
+        self.step_mgr()
+        self.assert_tag_owners({})
+        # Updates to unreferenced tags are ignored.
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_IP, async=True)
+        self.mgr.on_tags_update("prof1", None, async=True)
+        self.step_mgr()
+        self.assert_tag_owners({})
+        self.assertEqual(self.mgr.prof_ids_by_tag, {})
+
+    def test_unreferenced_selector_removed(self):
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        selector = parse_selector("all()")
+        self.mgr.get_and_incref(selector,
+                                callback=self.on_ref_acquired,
+                                async=True)
+        self.step_mgr()
+        self.assert_one_selector_one_ep(selector)
+        self.mgr.decref(selector, async=True)
+        self.step_mgr()
+        self.assert_tag_owners({})
+        self.assertEqual(self.mgr._label_index.expressions_by_id, {})
+        # Endpoint is still indexed, ready for the next selector.
+        self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
+            EP_ID_1_1: EP_DATA_1_1,
+        })
+
     def assert_one_ep_one_tag(self):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
             EP_ID_1_1: EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             "tag1": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             }
@@ -261,7 +307,7 @@ class TestIpsetManager(BaseTestCase):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
             HOST_EP_ID_1_1: HOST_EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             selector: {
                 "10.0.0.1": ("dummy", HOST_EP_ID_1_1),
             }
@@ -329,7 +375,7 @@ class TestIpsetManager(BaseTestCase):
         self.step_mgr()
 
         # Should be no match yet.
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {})
+        self.assert_tag_owners({})
 
         # Now fire in a parent label.
         self.mgr.on_prof_labels_set("prof1", {"p": "p1"}, async=True)
@@ -341,7 +387,7 @@ class TestIpsetManager(BaseTestCase):
         # Undo our messages to check that the index is correctly updated.
         self.mgr.on_prof_labels_set("prof1", None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {})
+        self.assert_tag_owners({})
         self.mgr.decref(selector, async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, None, async=True)
         self.step_mgr()
@@ -369,7 +415,7 @@ class TestIpsetManager(BaseTestCase):
                                     async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             selector: {
                 "10.0.0.2": ("dummy", EP_ID_1_1),
             }
@@ -385,18 +431,34 @@ class TestIpsetManager(BaseTestCase):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
             EP_ID_1_1: EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             selector: {
                 "10.0.0.1": ("dummy", EP_ID_1_1),
             }
         })
 
+    def assert_tag_owners(self, expected_owners):
+        # The index only stores the number of owners of each IP, check that
+        # against the expected owners.
+        index = self.mgr.tag_membership_index
+        for tag_id, owners_by_ip in expected_owners.iteritems():
+            self.assertEqual(sorted(index.members(tag_id)),
+                             sorted(owners_by_ip))
+            for ip, owners in owners_by_ip.iteritems():
+                if isinstance(owners, set):
+                    num_owners = len(owners)
+                else:
+                    num_owners = 1
+                self.assertEqual(index.num_owners(tag_id, ip), num_owners)
+        self.assertEqual(len(index.ips_by_tag), len(expected_owners))
+
     def assert_index_empty(self):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {})
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {})
+        self.assert_tag_owners({})
 
     def test_change_ip(self):
         # Initial set-up.
+        self.incref_tags("tag1")
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.step_mgr()
@@ -404,7 +466,7 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_IP, async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             "tag1": {
                 "10.0.0.2": ("prof1", EP_ID_1_1),
                 "10.0.0.3": ("prof1", EP_ID_1_1),
@@ -413,6 +475,7 @@ class TestIpsetManager(BaseTestCase):
 
     def test_tag_updates(self):
         # Initial set-up.
+        self.incref_tags("tag1", "tag2")
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.step_mgr()
@@ -420,7 +483,7 @@ class TestIpsetManager(BaseTestCase):
         # Add a tag, keep a tag.
         self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             "tag1": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             },
@@ -433,7 +496,7 @@ class TestIpsetManager(BaseTestCase):
         # Remove a tag.
         self.mgr.on_tags_update("prof1", ["tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             "tag2": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             }
@@ -442,7 +505,7 @@ class TestIpsetManager(BaseTestCase):
         # Delete the tags:
         self.mgr.on_tags_update("prof1", None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {})
+        self.assert_tag_owners({})
         self.assertEqual(self.mgr.tags_by_prof_id, {})
 
     def step_mgr(self):
@@ -450,6 +513,7 @@ class TestIpsetManager(BaseTestCase):
 
     def test_update_profile_and_ips(self):
         # Initial set-up.
+        self.incref_tags("tag1", "tag3")
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_tags_update("prof3", ["tag3"], async=True)
@@ -458,7 +522,7 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_PROF_IP, async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             "tag3": {
                 "10.0.0.3": ("prof3", EP_ID_1_1)
             }
@@ -497,6 +561,7 @@ class TestIpsetManager(BaseTestCase):
 
     def test_duplicate_ips(self):
         # Add in two endpoints with the same IP.
+        self.incref_tags("tag1", "tag2")
         self.mgr.on_tags_update("prof1", ["tag1"], async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
         self.mgr.on_endpoint_update(EP_ID_2_1, EP_2_1, async=True)
@@ -506,7 +571,7 @@ class TestIpsetManager(BaseTestCase):
             EP_ID_1_1: EP_DATA_1_1,
             EP_ID_2_1: EP_DATA_2_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -518,7 +583,7 @@ class TestIpsetManager(BaseTestCase):
         # Second profile tags arrive:
         self.mgr.on_tags_update("prof2", ["tag1", "tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -537,7 +602,7 @@ class TestIpsetManager(BaseTestCase):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
             EP_ID_1_1: EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assert_tag_owners({
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -553,9 +618,7 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, None, async=True)
         self.step_mgr()
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {})
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {},
-                         "ip_owners_by_tag should be empty, not %s" %
-                         pformat(self.mgr.tag_membership_index.ip_owners_by_tag))
+        self.assert_tag_owners({})
 
     def on_ref_acquired(self, tag_id, ipset):
         self.acquired_refs[tag_id] = ipset
@@ -641,6 +704,54 @@ class TestIpsetManager(BaseTestCase):
         self.step_mgr()
 
 
+class TestTagMembershipIndex(BaseTestCase):
+    def setUp(self):
+        super(TestTagMembershipIndex, self).setUp()
+        self.index = TagMembershipIndex()
+
+    def test_reads_dont_create_entries(self):
+        self.assertEqual(self.index.members("tag1"), [])
+        self.assertEqual(self.index.num_owners("tag1", "10.0.0.1"), 0)
+        self.assertFalse(self.index.ips_by_tag)
+        self.assertEqual(self.index.get_and_reset_changes_by_tag(), ({}, {}))
+
+    def test_multiple_owners(self):
+        self.index.add_mapping("tag1", "prof1", EP_ID_1_1, "10.0.0.1")
+        self.index.add_mapping("tag1", "prof2", EP_ID_1_1, "10.0.0.1")
+        self.index.add_mapping("tag1", "prof1", EP_ID_2_1, "10.0.0.1")
+        self.assertEqual(self.index.num_owners("tag1", "10.0.0.1"), 3)
+        self.assertEqual(self.index.get_and_reset_changes_by_tag(),
+                         ({"tag1": set(["10.0.0.1"])}, {}))
+        self.index.remove_mapping("tag1", "prof1", EP_ID_1_1, "10.0.0.1")
+        self.index.remove_mapping("tag1", "prof2", EP_ID_1_1, "10.0.0.1")
+        self.assertEqual(self.index.members("tag1"), ["10.0.0.1"])
+        self.assertEqual(self.index.get_and_reset_changes_by_tag(), ({}, {}))
+        self.index.remove_mapping("tag1", "prof1", EP_ID_2_1, "10.0.0.1")
+        self.assertEqual(self.index.members("tag1"), [])
+        self.assertEqual(self.index.get_and_reset_changes_by_tag(),
+                         ({}, {"tag1": set(["10.0.0.1"])}))
+        self.assertFalse(self.index.ips_by_tag)
+        self.assertEqual(self.index._extra_owners, {})
+
+    def test_add_then_remove_cancels_out(self):
+        self.index.add_mapping("tag1", "prof1", EP_ID_1_1, "10.0.0.1")
+        self.index.remove_mapping("tag1", "prof1", EP_ID_1_1, "10.0.0.1")
+        self.assertEqual(self.index.get_and_reset_changes_by_tag(),
+                         ({}, {"tag1": set(["10.0.0.1"])}))
+
+    def test_remove_tag(self):
+        self.index.add_mapping("tag1", "prof1", EP_ID_1_1, "10.0.0.1")
+        self.index.add_mapping("tag1", "prof2", EP_ID_1_1, "10.0.0.1")
+        self.index.add_mapping("tag1", "prof1", EP_ID_1_1, "10.0.0.2")
+        self.index.add_mapping("tag2", "prof1", EP_ID_1_1, "10.0.0.1")
+        self.index.remove_tag("tag1")
+        self.assertEqual(self.index.members("tag1"), [])
+        self.assertEqual(self.index.members("tag2"), ["10.0.0.1"])
+        self.assertEqual(self.index._extra_owners, {})
+        self.assertEqual(self.index.get_and_reset_changes_by_tag(),
+                         ({"tag2": set(["10.0.0.1"])}, {}))
+
+
 class TestEndpointData(BaseTestCase):
     def test_repr(self):
         self.assertEqual(repr(EP_DATA_1_1),
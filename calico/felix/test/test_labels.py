@@ -25,7 +25,7 @@ import unittest2
 from mock import Mock, call, patch
 
 from calico.felix.labels import LinearScanLabelIndex, LabelValueIndex, \
-    LabelInheritanceIndex
+    LabelInheritanceIndex, LabelSetIndex, SharedSubExpressions
 from calico.felix.selectors import parse_selector
 from calico.felix.test.base import BaseTestCase
 
@@ -205,6 +205,69 @@ class _LabelTestBase(unittest2.TestCase):
         self.index.on_labels_update("l3", None)
         self.assert_indexes_empty()
 
+    def test_has_and_or_matches(self):
+        self.index.on_labels_update("l0", {})
+        self.index.on_labels_update("l1", {"a": "a1", "b": "b1"})
+        self.index.on_labels_update("l2", {"b": "b2"})
+        self.index.on_expression_update("has_a", parse_selector('has(a)'))
+        self.index.on_expression_update("not_has_a",
+                                        parse_selector('!has(a)'))
+        self.index.on_expression_update("or", parse_selector(
+            'b == "b2" || has(c) || a in {"a2", "a3"}'))
+        self.index.on_expression_update("nor", parse_selector(
+            'b != "b1" && !has(c)'))
+        self.index.on_expression_update("all", parse_selector('all()'))
+        self.assert_add("has_a", "l1")
+        self.assert_add("not_has_a", "l0")
+        self.assert_add("not_has_a", "l2")
+        self.assert_add("or", "l2")
+        self.assert_add("nor", "l0")
+        self.assert_add("nor", "l2")
+        self.assert_add("all", "l0")
+        self.assert_add("all", "l1")
+        self.assert_add("all", "l2")
+        self.assert_no_updates()
+
+        # Changing a value without removing the key leaves has() alone.
+        self.index.on_labels_update("l1", {"a": "a2", "b": "b1"})
+        self.assert_add("or", "l1")
+        self.assert_no_updates()
+        # Removing the key that excluded an item from a negation.
+        self.index.on_labels_update("l1", {"b": "b3"})
+        self.assert_remove("has_a", "l1")
+        self.assert_remove("or", "l1")
+        self.assert_add("not_has_a", "l1")
+        self.assert_add("nor", "l1")
+        self.assert_no_updates()
+        self.index.on_labels_update("l0", {"c": "c"})
+        self.assert_add("or", "l0")
+        self.assert_remove("nor", "l0")
+        self.assert_no_updates()
+        # New item.
+        self.index.on_labels_update("l3", {"a": "a3"})
+        self.assert_add("has_a", "l3")
+        self.assert_add("or", "l3")
+        self.assert_add("nor", "l3")
+        self.assert_add("all", "l3")
+        self.assert_no_updates()
+
+        # Flip an expression from negated to un-negated.
+        self.index.on_expression_update("nor", parse_selector(
+            'b == "b1" || has(c)'))
+        self.assert_remove("nor", "l1")
+        self.assert_remove("nor", "l2")
+        self.assert_remove("nor", "l3")
+        self.assert_add("nor", "l0")
+        self.assert_no_updates()
+
+        for item_id in ["l0", "l1", "l2", "l3"]:
+            self.index.on_labels_update(item_id, None)
+        self.updates = []
+        for expr_id in ["has_a", "not_has_a", "or", "nor", "all"]:
+            self.index.on_expression_update(expr_id, None)
+        self.assert_no_updates()
+        self.assert_indexes_empty()
+
     def test_inheritance_index_mainline(self):
         ii = LabelInheritanceIndex(self.index)
 
@@ -290,3 +353,182 @@ class TestLabelValueIndex(TestLinearScanLabelIndex):
         self.assertFalse(self.index.item_ids_by_key_value)
         self.assertFalse(self.index.literal_exprs_by_kv)
         self.assertFalse(self.index.non_kv_expressions_by_id)
+        self.assertFalse(self.index.item_ids_by_key)
+        self.assertFalse(self.index.literal_exprs_by_key)
+        self.assertFalse(self.index.negated_exprs_by_kv)
+        self.assertFalse(self.index.negated_exprs_by_key)
+        self.assertFalse(self.index.negated_exprs_by_id)
+        self.assertFalse(self.index.index_terms_by_expr_id)
+        self.assertFalse(self.index.required_kv_exprs_by_kv)
+        self.assertFalse(self.index.required_kv_by_expr_id)
+        self.assertFalse(self.index.expr_ids_by_label_name)
+        self.assertFalse(self.index.eval_fns_by_expr_id)
+        self.assertEqual(len(self.index.sub_exprs), 0)
+
+    def test_bulk_update_only_checks_affected(self):
+        self.index.on_labels_update("l1", {"a": "a1", "b": "b1"})
+        self.index.on_labels_update("l2", {"a": "a2", "b": "b1"})
+        self.index.on_expression_update("e1", parse_selector('a == "a1"'))
+        self.index.on_expression_update("e2", parse_selector(
+            'b == "b2" && a != "a3"'))
+        self.assert_add("e1", "l1")
+        self.assert_no_updates()
+        with patch.object(self.index, "_update_matches",
+                          wraps=self.index._update_matches) as m_update:
+            self.index.on_labels_update_bulk(
+                [("l1", {"a": "a1", "b": "b2"}),
+                 ("l2", {"a": "a2", "b": "b2"}),
+                 ("l3", {"b": "b2"})],
+                set(["b"])
+            )
+        # e1 doesn't refer to label b so it can't have changed.
+        self.assertEqual(
+            [c for c in m_update.mock_calls if c[1][0] == "e1"], []
+        )
+        self.assert_add("e2", "l1")
+        self.assert_add("e2", "l2")
+        self.assert_add("e2", "l3")
+        self.assert_no_updates()
+        self.assertEqual(
+            set(self.index.item_ids_by_key_value.iter_values(("b", "b2"))),
+            set(["l1", "l2", "l3"])
+        )
+        self.assertFalse(("b", "b1") in self.index.item_ids_by_key_value)
+
+    def test_label_update_only_checks_candidates(self):
+        self.index.on_labels_update("l1", {"a": "a1", "b": "b1"})
+        for expr_id, sel in [("eq", 'a == "a2"'),
+                             ("has", 'has(c)'),
+                             ("ne", 'b != "b1"'),
+                             ("or", 'a == "a3" || has(d)'),
+                             ("and", 'a == "a4" && b != "b2"')]:
+            self.index.on_expression_update(expr_id, parse_selector(sel))
+        self.assertFalse(self.index.non_kv_expressions_by_id)
+        self.assert_no_updates()
+        with patch.object(self.index, "_update_matches",
+                          wraps=self.index._update_matches) as m_update:
+            self.index.on_labels_update("l1", {"a": "a1", "b": "b1",
+                                               "e": "e1"})
+        self.assertFalse(m_update.called)
+        self.assert_no_updates()
+
+
+class TestSharedSubExpressions(unittest2.TestCase):
+    def setUp(self):
+        super(TestSharedSubExpressions, self).setUp()
+        self.sub_exprs = SharedSubExpressions()
+
+    def test_shared_clause_evaluated_once(self):
+        shared = '(env == "prod" || env == "staging")'
+        ops = [parse_selector(shared + ' && app == "%s"' % app).expr_op
+               for app in ["a1", "a2"]]
+        ops.append(parse_selector('!' + shared).expr_op)
+        fns = [self.sub_exprs.acquire(op) for op in ops]
+        self.assertEqual(len(self.sub_exprs), 1)
+        for labels in [{"env": "prod", "app": "a1"},
+                       {"env": "dev", "app": "a2"},
+                       {"app": "a2", "env": "staging"},
+                       {}]:
+            memo = {}
+            results = [fn(labels, memo) for fn in fns]
+            self.assertEqual(results, [op.evaluate(labels) for op in ops])
+            # Only the shared clause is stored in the memo.
+            self.assertEqual(memo.values(),
+                             [labels.get("env") in ("prod", "staging")])
+        for op in ops:
+            self.sub_exprs.release(op)
+        self.assertEqual(len(self.sub_exprs), 0)
+
+    def test_nested_and_simple(self):
+        op = parse_selector('a == "b" && !(has(c) || d != "e")').expr_op
+        fn = self.sub_exprs.acquire(op)
+        # The negation and the OR inside it.
+        self.assertEqual(len(self.sub_exprs), 2)
+        self.assertTrue(fn({"a": "b", "d": "e"}, {}))
+        self.assertFalse(fn({"a": "b", "c": "d", "d": "e"}, {}))
+        simple = parse_selector('a == "b"').expr_op
+        self.assertTrue(self.sub_exprs.acquire(simple)({"a": "b"}, {}))
+        self.sub_exprs.release(simple)
+        self.sub_exprs.release(op)
+        self.assertEqual(len(self.sub_exprs), 0)
+
+
+class TestLabelSetIndex(TestLinearScanLabelIndex):
+    cls_to_test = LabelSetIndex
+
+    def assert_indexes_empty(self):
+        super(TestLabelSetIndex, self).assert_indexes_empty()
+        self.assertFalse(self.index.set_id_by_item_id)
+        self.assertFalse(self.index.item_ids_by_set_id)
+        self.assertFalse(self.index.set_id_by_label_key)
+        self.assertFalse(self.index.label_key_by_set_id)
+        self.assertFalse(self.index.label_index.labels_by_item_id)
+        self.assertFalse(self.index.label_index.expressions_by_id)
+        self.assertFalse(self.index.label_index.matches_by_expr_id)
+
+    def test_shared_label_set(self):
+        self.index.on_expression_update("e1", parse_selector('a == "a1"'))
+        self.index.on_expression_update("e2", parse_selector('b != "b1"'))
+        with patch.object(self.index.label_index, "on_labels_update",
+                          wraps=self.index.label_index.on_labels_update) as m:
+            self.index.on_labels_update("l1", {"a": "a1", "b": "b1"})
+            self.index.on_labels_update("l2", {"a": "a1", "b": "b1"})
+            self.index.on_labels_update("l3", {"a": "a1", "b": "b2"})
+        # Identical labels are only evaluated once and share one dict.
+        self.assertEqual(m.call_count, 2)
+        self.assertTrue(self.index.labels_by_item_id["l1"] is
+                        self.index.labels_by_item_id["l2"])
+        self.assert_add("e1", "l1")
+        self.assert_add("e1", "l2")
+        self.assert_add("e1", "l3")
+        self.assert_add("e2", "l3")
+        self.assert_no_updates()
+
+        # Expression updates fan out to all items with the label set.
+        self.index.on_expression_update("e2", parse_selector('b == "b1"'))
+        self.assert_remove("e2", "l3")
+        self.assert_add("e2", "l1")
+        self.assert_add("e2", "l2")
+        self.assert_no_updates()
+
+        # Moving an item to another existing label set doesn't flap the
+        # matches that are common to both.
+        self.index.on_labels_update("l1", {"a": "a1", "b": "b2"})
+        self.assert_remove("e2", "l1")
+        self.assert_no_updates()
+        self.assertEqual(len(self.index.label_index.labels_by_item_id), 2)
+
+        for item_id in ["l1", "l2", "l3"]:
+            self.index.on_labels_update(item_id, None)
+        self.assert_remove("e1", "l1")
+        self.assert_remove("e1", "l2")
+        self.assert_remove("e1", "l3")
+        self.assert_remove("e2", "l2")
+        self.index.on_expression_update("e1", None)
+        self.index.on_expression_update("e2", None)
+        self.assert_indexes_empty()
+
+    def test_bulk_update_relabels_in_place(self):
+        self.index.on_expression_update("e1", parse_selector('a == "a2"'))
+        self.index.on_labels_update("l1", {"a": "a1", "b": "b1"})
+        self.index.on_labels_update("l2", {"a": "a1", "b": "b2"})
+        self.index.on_labels_update("l3", {"a": "a1", "b": "b2"})
+        set_id = self.index.set_id_by_item_id["l1"]
+        self.index.on_labels_update_bulk(
+            [("l1", {"a": "a2", "b": "b1"}),
+             ("l2", {"a": "a2", "b": "b2"}),
+             ("l3", {"a": "a2", "b": "b2"})],
+            set(["a"])
+        )
+        self.assert_add("e1", "l1")
+        self.assert_add("e1", "l2")
+        self.assert_add("e1", "l3")
+        self.assert_no_updates()
+        # l1 was the only user of its label set so it was relabelled in
+        # place.  l2 and l3 shared theirs so they moved to a new one.
+        self.assertEqual(self.index.set_id_by_item_id["l1"], set_id)
+        self.assertEqual(self.index.set_id_by_item_id["l2"],
+                         self.index.set_id_by_item_id["l3"])
+        self.assertEqual(len(self.index.label_index.labels_by_item_id), 2)
+        self.assertEqual(self.index.labels_by_item_id["l1"],
+                         {"a": "a2", "b": "b1"})
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test_parsing
+~~~~~~~~~~~~
+
+Tests for the etcd value parsing functions.
+"""
+
+import json
+import logging
+from unittest import TestCase
+
+from mock import Mock
+
+from calico.etcddriver.protocol import (MessageWriter, new_unpacker,
+                                        MSG_KEY_VALUE)
+from calico.felix.parsing import ValueParser, ParserConfig, KeyFilter
+from calico.felix.selectors import parse_selector
+
+_log = logging.getLogger(__name__)
+
+ENDPOINT = {
+    "state": "active",
+    "name": "tap1234",
+    "mac": "AA:bb:cc:dd:ee:ff",
+    "profile_ids": ["prof1"],
+    "ipv4_nets": ["10.0.0.1"],
+}
+ENDPOINT_KEY = "/calico/v1/host/thehost/workload/o1/w1/endpoint/e1"
+
+
+class TestValueParser(TestCase):
+    def setUp(self):
+        self.parser = ValueParser(ParserConfig(HOSTNAME="thehost",
+                                               IFACE_PREFIX="tap"))
+
+    def test_endpoint(self):
+        parsed, endpoint = self.parser.parse(ENDPOINT_KEY,
+                                             json.dumps(ENDPOINT))
+        self.assertTrue(parsed)
+        # Values are canonicalised.
+        self.assertEqual(endpoint["mac"], "aa:bb:cc:dd:ee:ff")
+        self.assertEqual(endpoint["ipv4_nets"], ["10.0.0.1/32"])
+
+    def test_endpoint_invalid(self):
+        # Local endpoint, so the interface prefix is checked.
+        endpoint = dict(ENDPOINT, name="foo1234")
+        self.assertEqual(self.parser.parse(ENDPOINT_KEY, json.dumps(endpoint)),
+                         (True, None))
+
+    def test_endpoint_bad_json(self):
+        self.assertEqual(self.parser.parse(ENDPOINT_KEY, "{"), (True, None))
+
+    def test_policy(self):
+        policy = {
+            "selector": "a == 'b'",
+            "order": 10,
+            "inbound_rules": [],
+            "outbound_rules": [],
+        }
+        parsed, value = self.parser.parse(
+            "/calico/v1/policy/tier/t1/policy/p1", json.dumps(policy)
+        )
+        self.assertTrue(parsed)
+        self.assertEqual(value["selector"], parse_selector("a == 'b'"))
+
+    def test_remote_endpoint_not_stripped_by_default(self):
+        key = ENDPOINT_KEY.replace("thehost", "otherhost")
+        _, endpoint = self.parser.parse(key, json.dumps(ENDPOINT))
+        self.assertEqual(endpoint["state"], "active")
+
+    def test_unparsed_keys(self):
+        for key in ["/calico/v1/config/LogSeverityFile",
+                    "/calico/v1/host/thehost/bird_ip",
+                    "/calico/v1/Ready",
+                    "/calico/v1/host/thehost/workload/o1/w1/endpoint"]:
+            self.assertEqual(self.parser.parse(key, "foo"), (False, "foo"))
+
+
+class TestDriverParsedValues(TestCase):
+    """
+    Checks that values parsed by the driver reach Felix in the same form as
+    if Felix had parsed them itself, down to the types of their strings and
+    the interning of the byte strings.
+    """
+    def setUp(self):
+        self.parser = ValueParser(ParserConfig(HOSTNAME="thehost",
+                                               IFACE_PREFIX="tap"))
+
+    def assert_driver_parsed_matches(self, key, value):
+        # Raw values reach Felix's parsing code as unicode.
+        raw_json = unicode(json.dumps(value))
+        _, felix_parsed = self.parser.parse(key, raw_json)
+
+        _, driver_parsed = self.parser.parse(key, raw_json)
+        sck = Mock()
+        writer = MessageWriter(sck)
+        writer.send_update(key, driver_parsed, parsed=True)
+        writer.flush()
+        unpacker = new_unpacker()
+        for (data,), _ in sck.sendall.call_args_list:
+            unpacker.feed(data)
+        msg, = list(unpacker)
+
+        self.assert_same_form(msg[MSG_KEY_VALUE], felix_parsed)
+
+    def assert_same_form(self, value, expected):
+        self.assertEqual(value, expected)
+        self.assertIs(type(value), type(expected))
+        if isinstance(expected, dict):
+            keys = dict((k, k) for k in value)
+            for k, v in expected.iteritems():
+                self.assert_same_form(keys[k], k)
+                self.assert_same_form(value[k], v)
+        elif isinstance(expected, list):
+            for v, exp_v in zip(value, expected):
+                self.assert_same_form(v, exp_v)
+        elif isinstance(expected, str) and expected is intern(expected):
+            # We intern all byte strings, the parsing code only interns
+            # some of them.
+            self.assertIs(value, expected)
+
+    def test_endpoint(self):
+        self.assert_driver_parsed_matches(ENDPOINT_KEY, ENDPOINT)
+
+    def test_tags(self):
+        self.assert_driver_parsed_matches("/calico/v1/policy/profile/p1/tags",
+                                          ["tag-a", "tag-b"])
+
+    def test_labels(self):
+        self.assert_driver_parsed_matches(
+            "/calico/v1/policy/profile/p1/labels",
+            {"a": "b", "role": u"caf\xe9"}
+        )
+
+    def test_rules(self):
+        self.assert_driver_parsed_matches(
+            "/calico/v1/policy/profile/p1/rules",
+            {"inbound_rules": [{"action": "allow", "src_tag": "tag-a",
+                                "protocol": "tcp"}],
+             "outbound_rules": [{"action": "deny"}]}
+        )
+
+    def test_policy(self):
+        self.assert_driver_parsed_matches(
+            "/calico/v1/policy/tier/t1/policy/p1",
+            {"selector": "a == 'b'", "order": 10,
+             "inbound_rules": [{"action": "allow", "src_selector": "c"}],
+             "outbound_rules": []}
+        )
+
+
+class TestStripRemoteEndpoints(TestCase):
+    def setUp(self):
+        self.parser = ValueParser(ParserConfig(HOSTNAME="thehost",
+                                               IFACE_PREFIX="tap"),
+                                  strip_remote_endpoints=True)
+
+    def test_local_endpoint(self):
+        _, endpoint = self.parser.parse(ENDPOINT_KEY, json.dumps(ENDPOINT))
+        self.assertEqual(endpoint["state"], "active")
+        self.assertEqual(endpoint["name"], "tap1234")
+
+    def test_remote_endpoint(self):
+        key = ENDPOINT_KEY.replace("thehost", "otherhost")
+        endpoint = dict(ENDPOINT, labels={"a": "b"})
+        self.assertEqual(self.parser.parse(key, json.dumps(endpoint)),
+                         (True, {"profile_ids": ["prof1"],
+                                 "ipv4_nets": ["10.0.0.1/32"],
+                                 "labels": {"a": "b"}}))
+
+    def test_remote_endpoint_invalid(self):
+        # Validation happens before the endpoint is stripped.
+        key = ENDPOINT_KEY.replace("thehost", "otherhost")
+        endpoint = dict(ENDPOINT, mac="foo")
+        self.assertEqual(self.parser.parse(key, json.dumps(endpoint)),
+                         (True, None))
+
+    def test_remote_host_endpoint(self):
+        host_ep = {
+            "name": "eth0",
+            "profile_ids": ["prof1"],
+            "expected_ipv4_addrs": ["10.0.0.1"],
+        }
+        self.assertEqual(
+            self.parser.parse("/calico/v1/host/otherhost/endpoint/eth0",
+                              json.dumps(host_ep)),
+            (True, {"profile_ids": ["prof1"],
+                    "expected_ipv4_addrs": ["10.0.0.1"]})
+        )
+
+
+class TestKeyFilter(TestCase):
+    def setUp(self):
+        self.filter = KeyFilter("thehost")
+
+    def test_relevant_keys(self):
+        for key in ["/calico/v1/Ready",
+                    "/calico/v1/config/LogSeverityFile",
+                    "/calico/v1/host/thehost/config/LogSeverityFile",
+                    "/calico/v1/host/otherhost/bird_ip",
+                    ENDPOINT_KEY,
+                    "/calico/v1/host/otherhost/endpoint/eth0",
+                    "/calico/v1/policy/profile/prof1/rules",
+                    "/calico/v1/policy/profile/prof1/tags",
+                    "/calico/v1/policy/profile/prof1/labels",
+                    "/calico/v1/policy/tier/t1/metadata",
+                    "/calico/v1/policy/tier/t1/policy/p1",
+                    "/calico/v1/ipam/v4/pool/10.0.0.0-8"]:
+            self.assertTrue(self.filter.is_relevant(key), key)
+
+    def test_irrelevant_keys(self):
+        for key in ["/calico/v1/host/otherhost/config/LogSeverityFile",
+                    "/calico/v1/host/thehost/bird_ip6",
+                    "/calico/v1/ipam/v6/pool/fd00::-64",
+                    "/calico/v1/host/thehost/workload/o1/w1/endpoint",
+                    "/calico/v1/foo"]:
+            self.assertFalse(self.filter.is_relevant(key), key)
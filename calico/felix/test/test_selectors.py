@@ -25,8 +25,11 @@ import re
 from hypothesis import given
 from hypothesis.strategies import text, lists, sampled_from
 from nose.tools import *
+from calico.felix import selectors
 from calico.felix.selectors import (parse_selector, SelectorExpression,
-                                    BadSelector, ExprNode)
+                                    BadSelector, ExprNode, HasNode,
+                                    NegationNode, compile_expr_op,
+                                    _parse_no_cache, _parse_with_grammar)
 from calico.test.utils import fail_if_time_exceeds
 
 _log = logging.getLogger(__name__)
@@ -113,6 +116,17 @@ def test_prereq_values():
     yield check_prereqs, "a == 'a1' || a == 'a1'", [("a", "a1")]
 
 
+def test_label_names():
+    yield check_label_names, "a == 'a1'", ["a"]
+    yield check_label_names, "a != 'a1'", ["a"]
+    yield check_label_names, 'a in {"a1", "b1"}', ["a"]
+    yield check_label_names, 'a not in {"a1", "b1"}', ["a"]
+    yield check_label_names, 'has(a)', ["a"]
+    yield check_label_names, 'all()', []
+    yield check_label_names, "a == 'a1' && (b != 'b1' || !has(c))", \
+        ["a", "b", "c"]
+
+
 def test_unique_id():
     seen_ids = {}
 
@@ -189,12 +203,92 @@ def test_plausible_garbage(l):
     else:
         assert isinstance(expr, SelectorExpression)
         expr.evaluate({})
+        for labels in [{}, {"a": "a"}, {"a": "b"}, {"b": "a"}]:
+            assert_equal(expr.compiled(labels),
+                         bool(expr.expr_op.evaluate(labels)),
+                         "Compiled %r disagreed with tree walk for %s" %
+                         (sel, labels))
+
+
+@given(lists(sampled_from(["a", "b", "in", "not", "has", "all", "has(", "all()",
+                           "(", ")", "==", "!=", "=", "!", "&&", "||", "{",
+                           "}", ",", '"a"', "'b'", '""', '"\\t"', " ", "\t",
+                           "\n", "\r", "\f", "$", "-", ".", "/", "_"])))
+@fail_if_time_exceeds(2)
+def test_parser_matches_grammar(l):
+    check_parser_matches_grammar("".join(l))
+
+
+def test_parser_matches_grammar_edge_cases():
+    for sel in ["a == 'b'", "a=='b'", "\ta\t==\t'b'", "a == 'b\tc'",
+                "a == 'b\\tc'", "a == 'b\\n\\f\\r\\x\\'",
+                "a == \"b\nc\"", "a == ''", "a in {''}", "a in{'b',\"c\"}",
+                "a not in {'b'}", "a notin {'b'}", "a not in{'b'}",
+                "a in {}", "a in {'b',}", "in in {'a'}", "not not in {'a'}",
+                "has == 'a'", "all != 'a'", "has(a)", "has( a )", "has (a)",
+                "hasa(b)", "has(a b)", "!all()", "all( )", "all ()",
+                "all()x", "a == 'b' && all()", "!!!has(a)", "!=",
+                "((a == 'b'))", "(a == 'b'", "a == 'b' &&", "a == 'b' |",
+                "a == 'b' || c != 'd' && !(e in {'f'} || has(g))",
+                "a-b.c/d_e == 'f'", "a$ == 'b'", u"a == '\xe9'",
+                u"\xe9 == 'a'", "a in\x00{'b'}", "a == 'b' \f",
+                "  has(a)  \n"]:
+        yield check_parser_matches_grammar, sel
+
+
+def check_parser_matches_grammar(sel):
+    if sel.strip() in ("", "all()"):
+        # Special-cased before either parser is used.
+        return
+    try:
+        expected = _parse_with_grammar(sel)
+    except BadSelector:
+        assert_raises(BadSelector, _parse_no_cache, sel)
+    else:
+        expr = _parse_no_cache(sel)
+        assert_equal(expr.expr_op, expected,
+                     "Parsers disagreed on %r: %r != %r" %
+                     (sel, expr.expr_op, expected))
+        assert_equal(str(expr), str(SelectorExpression(expected)))
+
+
+def test_parse_deeply_nested():
+    assert_raises(BadSelector, parse_selector, "(" * 5000 + "has(a)" +
+                  ")" * 5000)
+
+
+def test_parse_cache_bounded():
+    selectors._recent_exprs.clear()
+    for ii in xrange(selectors.RECENT_EXPRS_CACHE_SIZE + 10):
+        parse_selector("a == '%s'" % ii)
+    assert_equal(len(selectors._recent_exprs),
+                 selectors.RECENT_EXPRS_CACHE_SIZE)
+    assert_false("a == '0'" in selectors._parse_cache)
+    assert_true("a == '10'" in selectors._parse_cache)
+    # Using an expression moves it to the end of the LRU.
+    parse_selector("a == '10'")
+    parse_selector("a == 'new'")
+    assert_true("a == '10'" in selectors._recent_exprs)
+    assert_false("a == '11'" in selectors._recent_exprs)
+
+
+def test_compile_fallback():
+    # Too deeply nested for Python's parser, should fall back to the
+    # tree walk.
+    expr_op = HasNode(tokens=["a"])
+    for _ in xrange(200):
+        expr_op = NegationNode(expr_op)
+    fn = compile_expr_op(expr_op)
+    assert_equal(fn, expr_op.evaluate)
+    assert_true(fn({"a": "b"}))
 
 
 def check_match(selector, labels):
     expr = parse_selector(selector)
     assert_true(expr.evaluate(labels),
                 "%r did not match %s" % (selector, labels))
+    assert_true(expr.expr_op.evaluate(labels),
+                "Tree walk of %r did not match %s" % (selector, labels))
     if selector.strip():
         # Check that wrapping the selector in a negation reverses its effect.
         negated_expr = parse_selector("!(%s)" % selector)
@@ -224,6 +318,9 @@ def check_no_match(selector, labels):
     expr = parse_selector(selector)
     assert_false(expr.evaluate(labels),
                  "%r unexpectedly matched %s" % (selector, labels))
+    assert_false(expr.expr_op.evaluate(labels),
+                 "Tree walk of %r unexpectedly matched %s" %
+                 (selector, labels))
     if selector.strip():
         # Check that wrapping the selector in a negation reverses its effect.
         negated_expr = parse_selector("!(%s)" % selector)
@@ -237,6 +334,11 @@ def check_bad_selector(selector):
     assert_raises(BadSelector, parse_selector, selector)
 
 
+def check_label_names(selector, expected):
+    expr = parse_selector(selector)
+    assert_equal(expr.label_names, set(expected))
+
+
 def check_prereqs(selector, expected):
     expr = parse_selector(selector)
     assert_equal(expr.required_kvs, set(expected))
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_workers
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests for the IP version worker processes and their proxies.
+"""
+import logging
+import socket
+
+import mock
+from prometheus_client import MetricsHandler
+
+from calico.datamodel_v1 import (WloadEndpointId, ResolvedHostEndpointId,
+                                  TieredPolicyId)
+from calico.etcddriver.protocol import (
+    MessageWriter, SocketClosed, new_unpacker, MSG_KEY_TYPE,
+    MSG_KEY_HOST_CONFIG, MSG_KEY_GLOBAL_CONFIG, MSG_KEY_STATUS
+)
+from calico.felix.futils import IPV4
+from calico.felix.selectors import parse_selector
+from calico.felix.splitter import UpdateSplitter
+from calico.felix.test.base import (BaseTestCase, ExpectedException,
+                                    load_config)
+from calico.felix.workers import (
+    WorkerProxy, WorkerUplink, Worker, WORKER_METHODS, MSG_TYPE_CALL,
+    MSG_KEY_METHOD, MSG_KEY_ARGS, MSG_TYPE_CONFIG_UPDATE,
+    MSG_TYPE_ENDPOINT_STATUS, MSG_KEY_ENDPOINT_ID, MSG_KEY_IP_TYPE,
+    MSG_TYPE_HEARTBEAT, MSG_TYPE_WORKER_INIT, MSG_KEY_CONFIG_FILE,
+    MSG_KEY_IP_VERSION, HEARTBEAT_TIMEOUT
+)
+
+_log = logging.getLogger(__name__)
+
+EP_ID = WloadEndpointId("h", "o", "w", "e")
+
+
+class StubSocket(object):
+    def __init__(self):
+        self.chunks = []
+        self.unpacker = new_unpacker()
+
+    def sendall(self, data):
+        self.chunks.append(data)
+        self.unpacker.feed(data)
+
+    def messages(self):
+        return list(self.unpacker)
+
+
+class TestWorkerMethods(BaseTestCase):
+    def test_splitter_methods_forwarded(self):
+        # Every update that the UpdateSplitter fans out must reach the
+        # workers.
+        splitter_methods = set(name for name in UpdateSplitter.__dict__
+                               if name.startswith("on_"))
+        self.assertEqual(splitter_methods - WORKER_METHODS,
+                         set(["on_config_updated"]))
+        for method in splitter_methods:
+            self.assertTrue(hasattr(WorkerProxy, method), method)
+
+
+class TestWorkerProxy(BaseTestCase):
+    def setUp(self):
+        super(TestWorkerProxy, self).setUp()
+        self.config = load_config("felix_default.cfg",
+                                  host_dict={"LogSeverityFile": "INFO"})
+        self.m_status_reporter = mock.Mock()
+        self.proxy = WorkerProxy(self.config, 4, self.m_status_reporter)
+        self.sck = StubSocket()
+        self.proxy._msg_writer = MessageWriter(self.sck)
+        self.proxy._msg_reader = mock.Mock()
+        self.proxy._msg_reader.new_messages.return_value = iter([])
+        self.proxy._worker_process = mock.Mock()
+        self.proxy._worker_process.poll.return_value = None
+        self.proxy._last_msg_time = 100
+
+    def test_updates_forwarded_in_one_write(self):
+        self.proxy.on_rules_update("prof1", {"inbound_rules": []},
+                                   async=True)
+        self.proxy.on_endpoint_update(EP_ID, None, async=True)
+        self.proxy.on_datamodel_in_sync(async=True)
+        self.step_actor(self.proxy)
+        self.assertEqual(len(self.sck.chunks), 1)
+        self.assertEqual(self.sck.messages(), [
+            {MSG_KEY_TYPE: MSG_TYPE_CALL,
+             MSG_KEY_METHOD: "on_rules_update",
+             MSG_KEY_ARGS: ["prof1", {"inbound_rules": []}]},
+            {MSG_KEY_TYPE: MSG_TYPE_CALL,
+             MSG_KEY_METHOD: "on_endpoint_update",
+             MSG_KEY_ARGS: [EP_ID, None]},
+            {MSG_KEY_TYPE: MSG_TYPE_CALL,
+             MSG_KEY_METHOD: "on_datamodel_in_sync",
+             MSG_KEY_ARGS: []},
+        ])
+
+    def test_non_ascii_round_trip(self):
+        policy_id = TieredPolicyId(u"t\xe9", u"p\xe9")
+        selector = parse_selector(u"role == 'caf\xe9'")
+        ep_id = WloadEndpointId(u"h\xe9", u"o", u"w\xe9", u"e\xe9")
+        endpoint = {"labels": {u"role": u"caf\xe9", u"r\xf4le": u"b"}}
+        host_ep_id = ResolvedHostEndpointId(u"h\xe9", u"e\xe9", "eth0")
+        self.proxy.on_policy_selector_update(policy_id, selector, 10,
+                                             async=True)
+        self.proxy.on_endpoint_update(ep_id, endpoint, async=True)
+        self.proxy.on_host_ep_update(host_ep_id, None, async=True)
+        self.step_actor(self.proxy)
+
+        worker = Worker(mock.Mock(spec=socket.socket))
+        worker.splitter = mock.Mock(spec=UpdateSplitter)
+        for msg in self.sck.messages():
+            worker._dispatch_msg_from_felix(msg.pop(MSG_KEY_TYPE), msg)
+        self.assertEqual(worker.splitter.mock_calls, [
+            mock.call.on_policy_selector_update(policy_id, selector, 10),
+            mock.call.on_endpoint_update(ep_id, endpoint),
+            mock.call.on_host_ep_update(host_ep_id, None),
+        ])
+        # The selector still matches the label it was written for.
+        _, args, _ = worker.splitter.mock_calls[0]
+        self.assertTrue(args[1].evaluate(endpoint["labels"]))
+
+    def test_config_updated(self):
+        with mock.patch("calico.common.update_logging_levels"):
+            self.assertTrue(self.config.update_etcd_config(
+                {"LogSeverityFile": "DEBUG"}, {"Foo": "bar"}
+            ))
+        self.proxy.on_config_updated(async=True)
+        self.step_actor(self.proxy)
+        self.assertEqual(self.sck.messages(), [
+            {MSG_KEY_TYPE: MSG_TYPE_CONFIG_UPDATE,
+             MSG_KEY_HOST_CONFIG: {"LogSeverityFile": "DEBUG"},
+             MSG_KEY_GLOBAL_CONFIG: {"Foo": "bar"}},
+        ])
+
+    def test_status_from_worker(self):
+        self.proxy._dispatch_msg_from_worker(MSG_TYPE_ENDPOINT_STATUS, {
+            MSG_KEY_ENDPOINT_ID: EP_ID,
+            MSG_KEY_IP_TYPE: IPV4,
+            MSG_KEY_STATUS: {"status": "up"},
+        })
+        self.assertEqual(
+            self.m_status_reporter.on_endpoint_status_changed.mock_calls,
+            [mock.call(EP_ID, IPV4, {"status": "up"}, async=True)]
+        )
+
+    def test_unexpected_message(self):
+        self.proxy._dispatch_msg_from_worker(MSG_TYPE_HEARTBEAT, {})
+        self.assertRaises(RuntimeError, self.proxy._dispatch_msg_from_worker,
+                          "foo", {})
+
+    @mock.patch("calico.felix.workers.die_and_restart", autospec=True,
+                side_effect=ExpectedException())
+    def test_reader_socket_closed(self, m_die):
+        self.proxy._msg_reader.new_messages.side_effect = SocketClosed()
+        self.assertRaises(ExpectedException,
+                          self.proxy._loop_reading_from_worker)
+
+    @mock.patch("calico.felix.workers.die_and_restart", autospec=True,
+                side_effect=ExpectedException())
+    @mock.patch("calico.felix.workers.monotonic_time", autospec=True)
+    def test_reader_worker_died(self, m_time, m_die):
+        m_time.return_value = 101
+        self.proxy._worker_process.poll.return_value = 1
+        self.assertRaises(ExpectedException,
+                          self.proxy._loop_reading_from_worker)
+
+    @mock.patch("calico.felix.workers.die_and_restart", autospec=True,
+                side_effect=ExpectedException())
+    @mock.patch("calico.felix.workers.monotonic_time", autospec=True)
+    def test_reader_heartbeat_timeout(self, m_time, m_die):
+        # First time around the loop, we get a heartbeat, which resets the
+        # timer.  After that, the worker goes quiet.
+        self.proxy._msg_reader.new_messages.side_effect = iter([
+            iter([(MSG_TYPE_HEARTBEAT, {})]),
+            iter([]),
+            iter([]),
+        ])
+        m_time.side_effect = iter([
+            101,
+            101 + HEARTBEAT_TIMEOUT,
+            102 + HEARTBEAT_TIMEOUT,
+        ])
+        self.assertRaises(ExpectedException,
+                          self.proxy._loop_reading_from_worker)
+        self.assertEqual(len(m_die.mock_calls), 1)
+
+    @mock.patch("os.unlink", autospec=True)
+    @mock.patch("os.path.exists", autospec=True, return_value=True)
+    @mock.patch("socket.socket", autospec=True)
+    @mock.patch("subprocess.Popen", autospec=True)
+    def test_start_worker(self, m_popen, m_socket, m_exists, m_unlink):
+        m_popen.return_value.pid = 1234
+        m_conn = StubSocket()
+        m_socket.return_value.accept.return_value = (m_conn, None)
+        self.proxy._start_worker()
+        m_socket.return_value.bind.assert_called_once_with(
+            "/run/felix-worker-v4.sck"
+        )
+        cmd = m_popen.mock_calls[0][1][0]
+        self.assertEqual(cmd[1:], ["-m", "calico.felix.workers",
+                                   "/run/felix-worker-v4.sck"])
+        self.assertEqual(m_conn.messages(), [{
+            MSG_KEY_TYPE: MSG_TYPE_WORKER_INIT,
+            MSG_KEY_CONFIG_FILE: self.config.config_path,
+            MSG_KEY_IP_VERSION: 4,
+            MSG_KEY_HOST_CONFIG: {"LogSeverityFile": "INFO"},
+            MSG_KEY_GLOBAL_CONFIG: {},
+        }])
+
+
+class TestWorkerUplink(BaseTestCase):
+    def test_messages(self):
+        sck = StubSocket()
+        uplink = WorkerUplink(MessageWriter(sck))
+        uplink.on_endpoint_status_changed(EP_ID, IPV4, None, async=True)
+        uplink.send_heartbeat(async=True)
+        self.step_actor(uplink)
+        self.assertEqual(len(sck.chunks), 1)
+        self.assertEqual(sck.messages(), [
+            {MSG_KEY_TYPE: MSG_TYPE_ENDPOINT_STATUS,
+             MSG_KEY_ENDPOINT_ID: EP_ID,
+             MSG_KEY_IP_TYPE: IPV4,
+             MSG_KEY_STATUS: None},
+            {MSG_KEY_TYPE: MSG_TYPE_HEARTBEAT},
+        ])
+
+
+class TestWorker(BaseTestCase):
+    def setUp(self):
+        super(TestWorker, self).setUp()
+        self.worker = Worker(mock.Mock(spec=socket.socket))
+
+    @mock.patch("gevent.spawn", autospec=True)
+    @mock.patch("calico.felix.workers.CleanupManager", autospec=True)
+    @mock.patch("calico.felix.workers.WorkerUplink", autospec=True)
+    @mock.patch("calico.felix.workers.IpVersionPipeline", autospec=True)
+    @mock.patch("calico.felix.workers.Config", autospec=True)
+    def test_init(self, m_Config, m_Pipeline, m_Uplink, m_Cleanup, m_spawn):
+        m_pipeline = m_Pipeline.return_value
+        m_actor = mock.Mock()
+        m_pipeline.actors = [m_actor]
+        self.init_worker(m_Config, m_Pipeline, m_Uplink, m_Cleanup,
+                         ip_version=6, prom_enabled=False)
+        m_Config.assert_called_once_with("/etc/calico/felix.cfg")
+        m_config = m_Config.return_value
+        m_config.report_etcd_config.assert_called_once_with(
+            {"LogSeverityFile": "INFO"}, {}
+        )
+        m_Pipeline.assert_called_once_with(m_config, 6,
+                                           m_Uplink.return_value)
+        for actor in (m_Uplink.return_value, m_actor, m_Cleanup.return_value):
+            actor.start.assert_called_once_with()
+            actor.greenlet.link.assert_called_once_with(
+                self.worker._on_greenlet_died
+            )
+        m_Cleanup.assert_called_once_with(m_config,
+                                          m_pipeline.cleanup_updaters,
+                                          m_pipeline.cleanup_ip_mgrs)
+        m_pipeline.install_global_rules.assert_called_once_with()
+        m_spawn.assert_called_once_with(self.worker._send_heartbeats)
+        self.assertEqual(self.worker.splitter.managers,
+                         m_pipeline.managers + [m_Cleanup.return_value])
+
+    @mock.patch("calico.felix.workers.HTTPServer", autospec=True)
+    @mock.patch("gevent.spawn", autospec=True)
+    @mock.patch("calico.felix.workers.CleanupManager", autospec=True)
+    @mock.patch("calico.felix.workers.WorkerUplink", autospec=True)
+    @mock.patch("calico.felix.workers.IpVersionPipeline", autospec=True)
+    @mock.patch("calico.felix.workers.Config", autospec=True)
+    def test_init_prometheus(self, m_Config, m_Pipeline, m_Uplink, m_Cleanup,
+                             m_spawn, m_HTTPServer):
+        m_Pipeline.return_value.actors = []
+        self.init_worker(m_Config, m_Pipeline, m_Uplink, m_Cleanup,
+                         ip_version=6, prom_enabled=True)
+        m_HTTPServer.assert_called_once_with(("0.0.0.0", 9094),
+                                             MetricsHandler)
+        self.assertEqual(m_spawn.call_args_list[1],
+                         mock.call(m_HTTPServer.return_value.serve_forever))
+        m_spawn.return_value.link.assert_called_with(
+            self.worker._on_greenlet_died
+        )
+
+    def init_worker(self, m_Config, m_Pipeline, m_Uplink, m_Cleanup,
+                    ip_version, prom_enabled):
+        m_config = m_Config.return_value
+        m_config.PROM_METRICS_ENABLED = prom_enabled
+        m_config.PROM_METRICS_V4_WORKER_PORT = 9093
+        m_config.PROM_METRICS_V6_WORKER_PORT = 9094
+        m_pipeline = m_Pipeline.return_value
+        m_pipeline.managers = [mock.Mock()]
+        m_pipeline.cleanup_updaters = [mock.Mock()]
+        m_pipeline.cleanup_ip_mgrs = [mock.Mock()]
+        m_Uplink.return_value.greenlet = mock.Mock()
+        m_Cleanup.return_value.greenlet = mock.Mock()
+        self.worker._dispatch_msg_from_felix(MSG_TYPE_WORKER_INIT, {
+            MSG_KEY_CONFIG_FILE: "/etc/calico/felix.cfg",
+            MSG_KEY_IP_VERSION: ip_version,
+            MSG_KEY_HOST_CONFIG: {"LogSeverityFile": "INFO"},
+            MSG_KEY_GLOBAL_CONFIG: {},
+        })
+
+    def test_call(self):
+        self.worker.splitter = mock.Mock(spec=UpdateSplitter)
+        self.worker._dispatch_msg_from_felix(MSG_TYPE_CALL, {
+            MSG_KEY_METHOD: "on_tags_update",
+            MSG_KEY_ARGS: ["prof1", ["tag1"]],
+        })
+        self.worker.splitter.on_tags_update.assert_called_once_with(
+            "prof1", ["tag1"]
+        )
+        self.assertRaises(RuntimeError,
+                          self.worker._dispatch_msg_from_felix,
+                          MSG_TYPE_CALL,
+                          {MSG_KEY_METHOD: "__init__", MSG_KEY_ARGS: []})
+        self.assertRaises(RuntimeError,
+                          self.worker._dispatch_msg_from_felix,
+                          "foo", {})
+
+    @mock.patch("calico.felix.workers.die_and_restart", autospec=True)
+    def test_config_update(self, m_die):
+        self.worker.config = mock.Mock()
+        self.worker.config.update_etcd_config.return_value = True
+        msg = {MSG_KEY_HOST_CONFIG: {"LogSeverityFile": "DEBUG"},
+               MSG_KEY_GLOBAL_CONFIG: {}}
+        self.worker._dispatch_msg_from_felix(MSG_TYPE_CONFIG_UPDATE, msg)
+        self.worker.config.update_etcd_config.assert_called_once_with(
+            {"LogSeverityFile": "DEBUG"}, {}
+        )
+        self.assertFalse(m_die.called)
+        self.worker.config.update_etcd_config.return_value = False
+        self.worker._dispatch_msg_from_felix(MSG_TYPE_CONFIG_UPDATE, msg)
+        m_die.assert_called_once_with()
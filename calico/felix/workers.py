@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+felix.workers
+~~~~~~~~~~~~~
+
+Support for running the IPv4 and IPv6 pipelines in worker processes.
+
+If IpVersionWorkerProcesses is enabled, Felix starts a worker process for
+each IP version and gives the UpdateSplitter a WorkerProxy in place of that
+version's managers.  The proxy forwards the splitter's updates to the worker
+over a Unix socket, using the same msgpack framing as the etcd driver.  The
+worker runs an IpVersionPipeline behind an UpdateSplitter of its own and
+sends endpoint statuses and periodic heartbeats back to Felix.
+
+Felix exits (and is restarted) if a worker dies or stops sending heartbeats.
+A worker exits if Felix closes its socket.
+"""
+# Monkey-patch before we do anything else...
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+import os
+import socket
+import subprocess
+import sys
+
+import gevent
+from BaseHTTPServer import HTTPServer
+from prometheus_client import MetricsHandler
+
+from calico import common
+from calico.etcddriver.protocol import (
+    MessageReader, MessageWriter, SocketClosed, MSG_KEY_GLOBAL_CONFIG,
+    MSG_KEY_HOST_CONFIG, MSG_KEY_STATUS
+)
+from calico.felix.actor import Actor, actor_message
+from calico.felix.config import Config
+from calico.felix.fetcd import die_and_restart
+from calico.felix.futils import logging_exceptions
+from calico.felix.pipeline import IpVersionPipeline
+from calico.felix.splitter import UpdateSplitter, CleanupManager
+from calico.monotonic import monotonic_time
+
+_log = logging.getLogger(__name__)
+
+# Init message Felix -> worker.  Also carries MSG_KEY_HOST_CONFIG and
+# MSG_KEY_GLOBAL_CONFIG, the config that Felix loaded from etcd.
+MSG_TYPE_WORKER_INIT = "winit"
+MSG_KEY_CONFIG_FILE = "config_file"
+MSG_KEY_IP_VERSION = "ip_version"
+
+# Call to one of WORKER_METHODS of the worker's UpdateSplitter,
+# Felix -> worker.
+MSG_TYPE_CALL = "call"
+MSG_KEY_METHOD = "m"
+MSG_KEY_ARGS = "a"
+
+# Config updated message Felix -> worker.  Carries MSG_KEY_HOST_CONFIG and
+# MSG_KEY_GLOBAL_CONFIG.
+MSG_TYPE_CONFIG_UPDATE = "conf_upd"
+
+# Endpoint status message worker -> Felix.  MSG_KEY_STATUS is the status
+# dict or None.
+MSG_TYPE_ENDPOINT_STATUS = "ep_stat"
+MSG_KEY_ENDPOINT_ID = "ep_id"
+MSG_KEY_IP_TYPE = "ip_type"
+
+# Heartbeat message worker -> Felix.
+MSG_TYPE_HEARTBEAT = "hb"
+
+# UpdateSplitter methods that Felix forwards to its workers.
+WORKER_METHODS = frozenset([
+    "on_datamodel_in_sync",
+    "on_rules_update",
+    "on_tags_update",
+    "on_prof_labels_set",
+    "on_tier_data_update",
+    "on_policy_selector_update",
+    "on_interface_update",
+    "on_endpoint_update",
+    "on_host_ep_update",
+    "on_ipam_pool_updated",
+])
+
+# Interval, in seconds, at which workers send heartbeats.
+HEARTBEAT_INTERVAL = 5
+# Time, in seconds, after which Felix gives up on a silent worker.
+HEARTBEAT_TIMEOUT = 30
+
+
+class WorkerProxy(Actor):
+    """
+    Stands in for the managers of one IP version, which run in a worker
+    process.
+
+    Forwards the updates that it receives from the UpdateSplitter to the
+    worker, batching up the messages that it sends.  A separate greenlet,
+    reader_greenlet, passes the endpoint statuses reported by the worker
+    to the status reporter and checks that the worker is still alive.  The
+    caller should monitor reader_greenlet as well as our own greenlet.
+    """
+    def __init__(self, config, ip_version, status_reporter):
+        super(WorkerProxy, self).__init__(qualifier="v%s" % ip_version)
+        self.config = config
+        self.ip_version = ip_version
+        self.status_reporter = status_reporter
+        self._worker_process = None
+        self._msg_reader = None
+        self._msg_writer = None
+        # Monotonic time at which we last heard from the worker.
+        self._last_msg_time = None
+        self.reader_greenlet = gevent.Greenlet(self._loop_reading_from_worker)
+
+    def _on_actor_started(self):
+        self._msg_reader, self._msg_writer = self._start_worker()
+        self._last_msg_time = monotonic_time()
+        self.reader_greenlet.start()
+
+    @actor_message()
+    def on_datamodel_in_sync(self):
+        self._send_call("on_datamodel_in_sync")
+
+    @actor_message()
+    def on_rules_update(self, profile_id, rules):
+        self._send_call("on_rules_update", profile_id, rules)
+
+    @actor_message()
+    def on_tags_update(self, profile_id, tags):
+        self._send_call("on_tags_update", profile_id, tags)
+
+    @actor_message()
+    def on_prof_labels_set(self, profile_id, labels):
+        self._send_call("on_prof_labels_set", profile_id, labels)
+
+    @actor_message()
+    def on_tier_data_update(self, tier, data_or_none):
+        self._send_call("on_tier_data_update", tier, data_or_none)
+
+    @actor_message()
+    def on_policy_selector_update(self, policy_id, selector_or_none,
+                                  order_or_none):
+        self._send_call("on_policy_selector_update", policy_id,
+                        selector_or_none, order_or_none)
+
+    @actor_message()
+    def on_interface_update(self, name, iface_up):
+        self._send_call("on_interface_update", name, iface_up)
+
+    @actor_message()
+    def on_endpoint_update(self, endpoint_id, endpoint):
+        self._send_call("on_endpoint_update", endpoint_id, endpoint)
+
+    @actor_message()
+    def on_host_ep_update(self, combined_id, iface_data):
+        self._send_call("on_host_ep_update", combined_id, iface_data)
+
+    @actor_message()
+    def on_ipam_pool_updated(self, pool_id, pool):
+        self._send_call("on_ipam_pool_updated", pool_id, pool)
+
+    @actor_message()
+    def on_config_updated(self):
+        """
+        Called after Felix has applied a change to the config in etcd,
+        passes the new config on to the worker.
+        """
+        self._msg_writer.send_message(
+            MSG_TYPE_CONFIG_UPDATE,
+            {
+                MSG_KEY_HOST_CONFIG: self.config.etcd_host_config,
+                MSG_KEY_GLOBAL_CONFIG: self.config.etcd_global_config,
+            },
+            flush=False
+        )
+
+    def _send_call(self, method, *args):
+        assert method in WORKER_METHODS
+        self._msg_writer.send_message(
+            MSG_TYPE_CALL,
+            {
+                MSG_KEY_METHOD: method,
+                MSG_KEY_ARGS: args,
+            },
+            flush=False
+        )
+
+    def _finish_msg_batch(self, batch, results):
+        self._msg_writer.flush()
+
+    @logging_exceptions
+    def _loop_reading_from_worker(self):
+        while True:
+            try:
+                for msg_type, msg in self._msg_reader.new_messages(timeout=1):
+                    self._last_msg_time = monotonic_time()
+                    self._dispatch_msg_from_worker(msg_type, msg)
+            except SocketClosed:
+                _log.critical("The IPv%s worker process closed its socket, "
+                              "Felix must exit.", self.ip_version)
+                die_and_restart()
+            worker_rc = self._worker_process.poll()
+            if worker_rc is not None:
+                _log.critical("IPv%s worker process died with RC = %s.  "
+                              "Felix must exit.", self.ip_version, worker_rc)
+                die_and_restart()
+            if monotonic_time() - self._last_msg_time > HEARTBEAT_TIMEOUT:
+                _log.critical("No heartbeat from IPv%s worker process for "
+                              "%s seconds.  Felix must exit.",
+                              self.ip_version, HEARTBEAT_TIMEOUT)
+                die_and_restart()
+
+    def _dispatch_msg_from_worker(self, msg_type, msg):
+        if msg_type == MSG_TYPE_ENDPOINT_STATUS:
+            self.status_reporter.on_endpoint_status_changed(
+                msg[MSG_KEY_ENDPOINT_ID],
+                msg[MSG_KEY_IP_TYPE],
+                msg[MSG_KEY_STATUS],
+                async=True
+            )
+        elif msg_type == MSG_TYPE_HEARTBEAT:
+            _log.debug("Heartbeat from IPv%s worker", self.ip_version)
+        else:
+            raise RuntimeError("Unexpected message %s" % msg)
+
+    def _start_worker(self):
+        """
+        Starts the worker subprocess, waits for it to connect to our
+        socket and sends it the init message.
+
+        Stores the Popen object in self._worker_process.
+
+        :return: tuple of MessageReader and MessageWriter for the
+                 connection to the worker.
+        """
+        if os.path.exists("/run"):
+            # Linux FHS version 3.0+ location for runtime sockets etc.
+            run_dir = "/run"
+        else:
+            # Older Linux versions use /var/run.
+            run_dir = "/var/run"
+        sck_filename = run_dir + "/felix-worker-v%s.sck" % self.ip_version
+        try:
+            os.unlink(sck_filename)
+        except OSError:
+            _log.debug("Failed to delete worker socket, assuming it "
+                       "didn't exist.")
+        worker_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        worker_socket.bind(sck_filename)
+        worker_socket.listen(1)
+        if getattr(sys, "frozen", False):
+            # We're running under pyinstaller, where we share our executable
+            # with the worker.  Re-run this executable with the "worker"
+            # argument to invoke the worker.
+            cmd = [sys.argv[0], "worker"]
+        else:
+            cmd = [sys.executable, "-m", "calico.felix.workers"]
+        cmd += [sck_filename]
+        _log.info("IPv%s worker command line: %s", self.ip_version, cmd)
+        self._worker_process = subprocess.Popen(cmd)
+        _log.info("Started IPv%s worker with PID %s", self.ip_version,
+                  self._worker_process.pid)
+        with gevent.Timeout(10):
+            worker_conn, _ = worker_socket.accept()
+        _log.info("Accepted connection from IPv%s worker", self.ip_version)
+        try:
+            os.unlink(sck_filename)
+        except OSError:
+            # Unexpected but carry on...
+            _log.exception("Failed to unlink socket")
+
+        reader = MessageReader(worker_conn)
+        writer = MessageWriter(worker_conn)
+        writer.send_message(
+            MSG_TYPE_WORKER_INIT,
+            {
+                MSG_KEY_CONFIG_FILE: self.config.config_path,
+                MSG_KEY_IP_VERSION: self.ip_version,
+                MSG_KEY_HOST_CONFIG: self.config.etcd_host_config,
+                MSG_KEY_GLOBAL_CONFIG: self.config.etcd_global_config,
+            }
+        )
+        return reader, writer
+
+
+class WorkerUplink(Actor):
+    """
+    Sends messages from a worker process to Felix.
+
+    Stands in for the status reporter in the worker's pipeline.
+    """
+    def __init__(self, msg_writer):
+        super(WorkerUplink, self).__init__()
+        self._msg_writer = msg_writer
+
+    @actor_message()
+    def on_endpoint_status_changed(self, endpoint_id, ip_type, status):
+        self._msg_writer.send_message(
+            MSG_TYPE_ENDPOINT_STATUS,
+            {
+                MSG_KEY_ENDPOINT_ID: endpoint_id,
+                MSG_KEY_IP_TYPE: ip_type,
+                MSG_KEY_STATUS: status,
+            },
+            flush=False
+        )
+
+    @actor_message()
+    def send_heartbeat(self):
+        self._msg_writer.send_message(MSG_TYPE_HEARTBEAT, flush=False)
+
+    def _finish_msg_batch(self, batch, results):
+        self._msg_writer.flush()
+
+
+class Worker(object):
+    """
+    The body of a worker process: runs the pipeline for the IP version
+    given in the init message from Felix and feeds it the updates that
+    Felix forwards.
+    """
+    def __init__(self, sck):
+        self._msg_reader = MessageReader(sck)
+        self._msg_writer = MessageWriter(sck)
+        self.config = None
+        self.splitter = None
+        self.uplink = None
+
+    def run(self):
+        """Reads and handles messages from Felix.  Never returns."""
+        while True:
+            try:
+                for msg_type, msg in self._msg_reader.new_messages(timeout=1):
+                    self._dispatch_msg_from_felix(msg_type, msg)
+            except SocketClosed:
+                _log.critical("Felix closed the worker's socket, exiting.")
+                die_and_restart()
+
+    def _dispatch_msg_from_felix(self, msg_type, msg):
+        # Optimization: put calls first in the "switch" block because
+        # they're on the critical path.
+        if msg_type == MSG_TYPE_CALL:
+            method = msg[MSG_KEY_METHOD]
+            if method not in WORKER_METHODS:
+                raise RuntimeError("Unexpected method %s" % method)
+            getattr(self.splitter, method)(*msg[MSG_KEY_ARGS])
+        elif msg_type == MSG_TYPE_CONFIG_UPDATE:
+            self._on_config_update(msg)
+        elif msg_type == MSG_TYPE_WORKER_INIT:
+            self._on_init(msg)
+        else:
+            raise RuntimeError("Unexpected message %s" % msg)
+
+    def _on_init(self, msg):
+        """
+        Handles the init message from Felix: loads our config, starts the
+        pipeline and installs the global rules for our IP version.
+        """
+        assert self.config is None, "Already initialized"
+        self.config = Config(msg[MSG_KEY_CONFIG_FILE])
+        self.config.report_etcd_config(msg[MSG_KEY_HOST_CONFIG],
+                                       msg[MSG_KEY_GLOBAL_CONFIG])
+        ip_version = msg[MSG_KEY_IP_VERSION]
+        _log.info("Starting IPv%s worker", ip_version)
+
+        self.uplink = WorkerUplink(self._msg_writer)
+        pipeline = IpVersionPipeline(self.config, ip_version, self.uplink)
+        cleanup_mgr = CleanupManager(self.config,
+                                     pipeline.cleanup_updaters,
+                                     pipeline.cleanup_ip_mgrs)
+        self.splitter = UpdateSplitter(pipeline.managers + [cleanup_mgr])
+        actors_to_start = [self.uplink] + pipeline.actors + [cleanup_mgr]
+        for actor in actors_to_start:
+            actor.start()
+            actor.greenlet.link(self._on_greenlet_died)
+        pipeline.install_global_rules()
+        heartbeat_greenlet = gevent.spawn(self._send_heartbeats)
+        heartbeat_greenlet.link(self._on_greenlet_died)
+        if self.config.PROM_METRICS_ENABLED:
+            # The pipeline's metrics live in this process so we need our
+            # own server to export them.
+            if ip_version == 4:
+                port = self.config.PROM_METRICS_V4_WORKER_PORT
+            else:
+                port = self.config.PROM_METRICS_V6_WORKER_PORT
+            _log.info("Exporting Prometheus metrics on port %s", port)
+            httpd = HTTPServer(("0.0.0.0", port), MetricsHandler)
+            stats_greenlet = gevent.spawn(httpd.serve_forever)
+            stats_greenlet.link(self._on_greenlet_died)
+
+    def _on_config_update(self, msg):
+        applied = self.config.update_etcd_config(msg[MSG_KEY_HOST_CONFIG],
+                                                 msg[MSG_KEY_GLOBAL_CONFIG])
+        if not applied:
+            # Felix should already have restarted.
+            _log.critical("Worker unable to apply config update, exiting.")
+            die_and_restart()
+
+    def _send_heartbeats(self):
+        while True:
+            self.uplink.send_heartbeat(async=True)
+            gevent.sleep(HEARTBEAT_INTERVAL)
+
+    def _on_greenlet_died(self, greenlet):
+        """
+        Called by the gevent Hub if one of our greenlets ever stops,
+        kills the worker, which in turn kills Felix.
+        """
+        _log.critical("Greenlet died: %s; worker exiting.", greenlet)
+        os._exit(1)
+
+
+def main():
+    """Worker process entry point.
+
+    Implemented as a function to allow it to be imported and executed
+    from the pyinstaller launcher.
+    """
+    common.default_logging(gevent_in_use=True,
+                           syslog_executable_name="calico-felix-worker")
+    felix_sck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        felix_sck.connect(sys.argv[1])
+    except:
+        _log.exception("Failed to connect to Felix")
+        raise
+    try:
+        Worker(felix_sck).run()  # Should never return
+    except Exception:
+        _log.exception("Worker exiting due to exception")
+        os._exit(1)
+        raise  # Unreachable but keeps the linter happy about the broad except.
+
+
+if __name__ == "__main__":
+    main()
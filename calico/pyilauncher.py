@@ -28,6 +28,9 @@ if __name__ == "__main__":
     elif len(sys.argv) > 1 and sys.argv[1] == "cleanup":
         sys.argv[1:] = sys.argv[2:]
         from calico.felix.cleanup import main
+    elif len(sys.argv) > 1 and sys.argv[1] == "worker":
+        sys.argv[1:] = sys.argv[2:]
+        from calico.felix.workers import main
     else:
         from calico.felix.felix import main
     main()
@@ -22,7 +22,8 @@ Test for collections library.
 import logging
 from mock import Mock, call, patch
 
-from calico.calcollections import SetDelta, MultiDict
+from calico.calcollections import (SetDelta, MultiDict, DenseIdMap,
+                                   BitmapBiMultiDict, BitmapMultiDict)
 from unittest2 import TestCase
 
 _log = logging.getLogger(__name__)
@@ -130,3 +131,122 @@ class TestMultiDict(TestCase):
         self.assertTrue(self.index.contains("k", "v3"))
         self.index.discard("k", "v3")
         self.assertEqual(self.index._index, {})
+
+
+class TestDenseIdMap(TestCase):
+    def test_reuse(self):
+        ids = DenseIdMap()
+        self.assertEqual(ids.get_or_alloc("a"), 0)
+        self.assertEqual(ids.get_or_alloc("b"), 1)
+        self.assertEqual(ids.get_or_alloc("a"), 0)
+        self.assertEqual(ids.id_for(1), "b")
+        ids.free("a")
+        ids.free("a")  # No-op
+        self.assertEqual(ids.get("a"), None)
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(ids.get_or_alloc("c"), 0)
+        self.assertEqual(ids.id_for(0), "c")
+
+
+class TestBitmapBiMultiDict(TestCase):
+    def setUp(self):
+        super(TestBitmapBiMultiDict, self).setUp()
+        self.index = BitmapBiMultiDict()
+
+    def test_empty(self):
+        self.assertFalse(self.index)
+        self.assertFalse(self.index.by_key)
+        self.assertFalse(self.index.by_value)
+        self.assertEqual(self.index.by_key.num_items("k"), 0)
+        self.assertEqual(list(self.index.by_key.iter_values("k")), [])
+        self.assertFalse(self.index.contains("k", "v"))
+        self.assertFalse(self.index.discard("k", "v"))
+
+    def test_add_discard(self):
+        # Enough values to span several words of the bitmap.
+        values = ["v%s" % i for i in xrange(200)]
+        for value in values:
+            self.assertTrue(self.index.add("k", value))
+        self.assertFalse(self.index.add("k", "v0"))
+        self.assertTrue(self.index.add("k2", "v150"))
+        self.assertEqual(self.index.by_key.num_items("k"), 200)
+        self.assertEqual(set(self.index.by_key.iter_values("k")),
+                         set(values))
+        self.assertEqual(set(self.index.by_value.iter_values("v150")),
+                         set(["k", "k2"]))
+        self.assertTrue(self.index.contains("k", "v199"))
+        self.assertTrue(self.index.by_value.contains("v199", "k"))
+        self.assertFalse(self.index.contains("k2", "v199"))
+        self.assertIn("k2", self.index.by_key)
+        self.assertNotIn("k3", self.index.by_key)
+        self.assertEqual(len(self.index.by_key), 2)
+        self.assertEqual(len(self.index.by_value), 200)
+
+        for value in values:
+            self.assertTrue(self.index.discard("k", value))
+        self.assertFalse(self.index.discard("k", "v0"))
+        self.assertNotIn("k", self.index.by_key)
+        self.assertEqual(list(self.index.by_value.iter_values("v150")),
+                         ["k2"])
+        self.assertTrue(self.index.discard("k2", "v150"))
+        self.assertFalse(self.index)
+        self.assertEqual(len(self.index._key_nums), 0)
+        self.assertEqual(len(self.index._value_nums), 0)
+
+    def test_iter_values_snapshot(self):
+        for value in ["a", "b", "c"]:
+            self.index.add("k", value)
+        for value in self.index.by_key.iter_values("k"):
+            self.index.discard("k", value)
+        self.assertFalse(self.index)
+
+    def test_diff_values(self):
+        self.index.add("k", "a")
+        self.index.add("k", "b")
+        self.index.add("k2", "c")
+        added, removed = self.index.diff_values("k", set(["b", "c", "d"]))
+        self.assertEqual(set(added), set(["c", "d"]))
+        self.assertEqual(removed, ["a"])
+        # Diffing doesn't change the mappings.
+        self.assertEqual(set(self.index.by_key.iter_values("k")),
+                         set(["a", "b"]))
+        added, removed = self.index.diff_values("k3", set(["a"]))
+        self.assertEqual((added, removed), (["a"], []))
+
+
+class TestBitmapMultiDict(TestCase):
+    def setUp(self):
+        super(TestBitmapMultiDict, self).setUp()
+        self.index = BitmapMultiDict()
+
+    def test_empty(self):
+        self.assertFalse(self.index)
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.num_items("k"), 0)
+        self.assertEqual(list(self.index.iter_values("k")), [])
+        self.assertFalse(self.index.contains("k", "v"))
+        self.assertFalse(self.index.discard("k", "v"))
+
+    def test_add_discard(self):
+        values = ["v%s" % i for i in xrange(200)]
+        for value in values:
+            self.assertTrue(self.index.add("k", value))
+        self.assertFalse(self.index.add("k", "v0"))
+        self.assertTrue(self.index.add("k2", "v150"))
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.num_items("k"), 200)
+        self.assertEqual(set(self.index.iter_values("k")), set(values))
+        self.assertTrue(self.index.contains("k2", "v150"))
+        self.assertFalse(self.index.contains("k2", "v149"))
+
+        for value in values:
+            self.assertTrue(self.index.discard("k", value))
+        self.assertFalse(self.index.discard("k", "v0"))
+        self.assertNotIn("k", self.index)
+        # v150 is still mapped to k2 so it keeps its integer.
+        self.assertEqual(len(self.index._value_nums), 1)
+        self.assertEqual(list(self.index.iter_values("k2")), ["v150"])
+        self.assertTrue(self.index.discard("k2", "v150"))
+        self.assertFalse(self.index)
+        self.assertEqual(len(self.index._key_nums), 0)
+        self.assertEqual(len(self.index._value_nums), 0)
@@ -197,6 +197,9 @@ class _TestPathDispatcherBase(BaseTestCase):
         self.assert_handled("/a/bval/c/eval", exp_handler=None)
         self.assert_handled("/foo", exp_handler=None)
 
+    def test_dispatch_unnormalised_key(self):
+        self.assert_handled("a/bval/c//", exp_handler="/a/<b>/c", b="bval")
+
     def test_cover_no_match(self):
         m_result = Mock(spec=etcd.EtcdResult)
         m_result.key = "/a"
@@ -208,6 +211,57 @@ class _TestPathDispatcherBase(BaseTestCase):
                                  msg="Unexpected handler called: %s" % key)
 
 
+class TestPathDispatcher(BaseTestCase):
+    def setUp(self):
+        super(TestPathDispatcher, self).setUp()
+        self.dispatcher = PathDispatcher()
+        self.calls = []
+
+    def on_set(self, response, b, e):
+        self.calls.append((response, b, e))
+
+    def test_positional_handler(self):
+        self.dispatcher.register("/a/<b>/d/<e>", on_set=self.on_set)
+        m_response = Mock(spec=etcd.EtcdResult)
+        m_response.key = "/a/bval/d/eval"
+        m_response.action = "set"
+        self.dispatcher.handle_event(m_response)
+        self.assertEqual(self.calls, [(m_response, "bval", "eval")])
+
+    def test_lookup(self):
+        self.dispatcher.register("/a/<b>/d/<e>", on_set=self.on_set)
+        self.assertEqual(self.dispatcher.lookup("/a/bval/d/eval", "set"),
+                         (self.on_set, {"b": "bval", "e": "eval"}))
+        self.assertEqual(self.dispatcher.lookup_args("/a/bval/d/eval",
+                                                     "create"),
+                         (self.on_set, ("bval", "eval")))
+        self.assertEqual(self.dispatcher.lookup_args("/a/bval/d/eval",
+                                                     "delete"),
+                         (None, None))
+        self.assertEqual(self.dispatcher.lookup_args("/a/bval/d", "set"),
+                         (None, None))
+
+    def test_register_after_use(self):
+        m_handler = Mock()
+        self.dispatcher.register("/a/<b>", on_set=m_handler)
+        self.assertEqual(self.dispatcher.lookup_args("/c/d", "set"),
+                         (None, None))
+        self.dispatcher.register("/c/<d>", on_set=m_handler)
+        self.assertEqual(self.dispatcher.lookup_args("/c/d", "set"),
+                         (m_handler, ("d",)))
+
+    def test_capture_hides_literal(self):
+        # As in the tree walk, a capture takes precedence over a literal
+        # segment at the same level.
+        m_handler = Mock()
+        self.dispatcher.register("/a/<b>", on_set=m_handler)
+        self.dispatcher.register("/a/c/d", on_set=m_handler)
+        self.assertEqual(self.dispatcher.lookup_args("/a/c", "set"),
+                         (m_handler, ("c",)))
+        self.assertEqual(self.dispatcher.lookup_args("/a/c/d", "set"),
+                         (None, None))
+
+
 class TestDispatcherSet(_TestPathDispatcherBase):
     action = "set"
     expected_handlers = "set"